@@ -0,0 +1,238 @@
+"""
+Agrupación de alertas por usuario en emails de resumen
+Las alertas de un mismo destinatario que se disparan dentro de una ventana se envían
+en un solo email; la ventana se alarga cuando el usuario recibe muchas alertas
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from email_templates import get_alert_digest_email_template, get_alert_email_template
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = "spool"
+ALERT_FIELDS = ("rule_name", "ticker", "alert_message", "current_price", "threshold", "rule_type")
+
+
+def render_alert_email(to_email: str, alerts: List[Dict]) -> Dict:
+    """
+    Arma el email de un grupo de alertas del mismo destinatario
+
+    Args:
+        to_email: Destinatario
+        alerts: Alertas con las claves de get_alert_email_template
+
+    Returns:
+        {to_email, subject, html_content}; una sola alerta usa el template individual
+    """
+    if len(alerts) == 1:
+        template = get_alert_email_template(**{field: alerts[0][field] for field in ALERT_FIELDS})
+    else:
+        template = get_alert_digest_email_template(alerts)
+    return {
+        "to_email": to_email,
+        "subject": template["subject"],
+        "html_content": template["html_content"]
+    }
+
+
+class AlertDigestCoalescer:
+    """
+    Ventana de agrupación de alertas por destinatario
+
+    La primera alerta de un destinatario abre una ventana de window_for() segundos;
+    las que llegan antes del cierre se suman y pueden extenderla, sin pasar nunca de
+    max_window desde la primera. La ventana es min_window multiplicado por la cantidad
+    de alertas del destinatario en los últimos burst_horizon segundos: un usuario
+    tranquilo recibe su alerta a los pocos segundos y uno en plena ráfaga recibe un
+    resumen cada max_window como mucho.
+
+    Las alertas pendientes se guardan en un spool JSONL (igual que
+    ExecutionWriteBuffer) para no perder emails si el worker se reinicia.
+    """
+
+    def __init__(
+        self,
+        enqueue_emails: Callable[[List[Dict]], object],
+        spool_path: Optional[str] = None,
+        min_window: float = 10,
+        max_window: float = 120,
+        burst_horizon: float = 300,
+        fsync: bool = True
+    ):
+        """
+        Args:
+            enqueue_emails: Función que encola una lista de {to_email, subject, html_content}
+            spool_path: Archivo JSONL de respaldo local (None desactiva el spool)
+            min_window: Segundos de espera de una alerta aislada
+            max_window: Segundos máximos entre la primera alerta y el envío del resumen
+            burst_horizon: Segundos de historial usados para medir la ráfaga
+            fsync: Forzar escritura a disco en cada alerta
+        """
+        self.enqueue_emails = enqueue_emails
+        self.spool_path = spool_path
+        self.min_window = min_window
+        self.max_window = max_window
+        self.burst_horizon = burst_horizon
+        self.fsync = fsync
+        self._buckets: Dict[str, Dict] = {}  # to_email -> {alerts, opened_at, deadline}
+        self._recent: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+        if self.spool_path:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            self._recover()
+
+    @classmethod
+    def from_env(cls, enqueue_emails: Callable[[List[Dict]], object]) -> "AlertDigestCoalescer":
+        """Crea el agrupador usando RULE_WORKER_SPOOL_DIR, ALERT_DIGEST_MIN_WINDOW y ALERT_DIGEST_MAX_WINDOW"""
+        spool_dir = os.getenv("RULE_WORKER_SPOOL_DIR", DEFAULT_SPOOL_DIR)
+        return cls(
+            enqueue_emails,
+            spool_path=os.path.join(spool_dir, "alert_digest.jsonl"),
+            min_window=float(os.getenv("ALERT_DIGEST_MIN_WINDOW", "10")),
+            max_window=float(os.getenv("ALERT_DIGEST_MAX_WINDOW", "120"))
+        )
+
+    def _recover(self):
+        """Carga las alertas que quedaron sin enviar en una ejecución anterior"""
+        if not os.path.exists(self.spool_path):
+            return
+        recovered = []
+        with open(self.spool_path, "r", encoding="utf-8") as spool:
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    recovered.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("Línea inválida en el spool de alertas, se descarta")
+        # Se envían en la primera revisión: ya esperaron su ventana antes del reinicio
+        now = time.time()
+        for alert in recovered:
+            bucket = self._buckets.setdefault(alert["to_email"], {"alerts": [], "opened_at": now, "deadline": now})
+            bucket["alerts"].append(alert)
+        if recovered:
+            logger.info(f"Recuperadas {len(recovered)} alertas pendientes de email del spool")
+
+    def _append_to_spool(self, records: List[Dict]):
+        with open(self.spool_path, "a", encoding="utf-8") as spool:
+            for record in records:
+                spool.write(json.dumps(record, default=str) + "\n")
+            spool.flush()
+            if self.fsync:
+                os.fsync(spool.fileno())
+
+    def _rewrite_spool(self):
+        tmp_path = f"{self.spool_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as spool:
+            for bucket in self._buckets.values():
+                for record in bucket["alerts"]:
+                    spool.write(json.dumps(record, default=str) + "\n")
+            spool.flush()
+            if self.fsync:
+                os.fsync(spool.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+    def window_for(self, to_email: str, now: float) -> float:
+        """Segundos de ventana para el destinatario según sus alertas recientes"""
+        recent = self._recent.get(to_email)
+        while recent and recent[0] < now - self.burst_horizon:
+            recent.popleft()
+        count = len(recent) if recent else 0
+        return min(self.max_window, self.min_window * max(1, count))
+
+    def add_many(self, alerts: List[Dict], now: Optional[float] = None) -> int:
+        """
+        Agrega alertas a la ventana de su destinatario
+
+        Args:
+            alerts: Alertas con to_email y las claves de get_alert_email_template
+            now: Hora actual (epoch), para tests
+
+        Returns:
+            Cantidad de alertas agregadas
+        """
+        now = time.time() if now is None else now
+        alerts = [alert for alert in alerts if alert.get("to_email")]
+        if not alerts:
+            return 0
+
+        with self._lock:
+            if self.spool_path:
+                self._append_to_spool(alerts)
+            for alert in alerts:
+                to_email = alert["to_email"]
+                self._recent.setdefault(to_email, deque()).append(now)
+            for alert in alerts:
+                to_email = alert["to_email"]
+                window = self.window_for(to_email, now)
+                bucket = self._buckets.get(to_email)
+                if bucket is None:
+                    self._buckets[to_email] = {"alerts": [alert], "opened_at": now, "deadline": now + window}
+                    continue
+                bucket["alerts"].append(alert)
+                bucket["deadline"] = min(bucket["opened_at"] + self.max_window, max(bucket["deadline"], now + window))
+        return len(alerts)
+
+    def pending_count(self) -> int:
+        return sum(len(bucket["alerts"]) for bucket in self._buckets.values())
+
+    def flush_due(self, now: Optional[float] = None, force: bool = False) -> int:
+        """
+        Encola un email por cada destinatario cuya ventana cerró
+
+        Args:
+            now: Hora actual (epoch), para tests
+            force: Cerrar todas las ventanas (al apagar el worker)
+
+        Returns:
+            Cantidad de emails encolados
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            due = [
+                to_email for to_email, bucket in self._buckets.items()
+                if force or bucket["deadline"] <= now
+            ]
+            if not due:
+                return 0
+
+            messages = [render_alert_email(to_email, self._buckets[to_email]["alerts"]) for to_email in due]
+            try:
+                self.enqueue_emails(messages)
+            except Exception as e:
+                # Las alertas quedan pendientes y se reintentan en la próxima revisión
+                logger.error(f"Error encolando {len(messages)} emails de alertas: {str(e)}")
+                return 0
+
+            alerts = 0
+            for to_email in due:
+                alerts += len(self._buckets.pop(to_email)["alerts"])
+            if self.spool_path:
+                self._rewrite_spool()
+            for to_email in [key for key, recent in self._recent.items() if not recent or recent[-1] < now - self.burst_horizon]:
+                del self._recent[to_email]
+
+        logger.info(f"Encolados {len(messages)} emails para {alerts} alertas")
+        return len(messages)
+
+    async def run(self, stop_event: Optional[asyncio.Event] = None, interval: float = 1.0):
+        """
+        Cierra ventanas vencidas en segundo plano hasta que se cancele o se active stop_event
+
+        Al terminar encola todo lo pendiente.
+        """
+        try:
+            while stop_event is None or not stop_event.is_set():
+                await asyncio.sleep(interval)
+                self.flush_due()
+        finally:
+            self.flush_due(force=True)
@@ -0,0 +1,263 @@
+"""
+Pipeline de evaluación de reglas ALERT_ONLY
+Evalúa en lote todas las reglas de alerta activas contra cotizaciones compartidas,
+guarda las alertas en bloque y encola los emails (agrupados por usuario si hay
+un AlertDigestCoalescer)
+"""
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+from alert_digest import AlertDigestCoalescer, render_alert_email
+from market_calendar import market_for_ticker
+from quote_book import QuoteBook
+from rule_execution import RuleEvaluator
+from rule_schedule import CooldownSchedule
+
+logger = logging.getLogger(__name__)
+
+ALERT_RULE_COLUMNS = "id,user_id,name,rule_type,ticker,value_threshold,email,last_triggered,cooldown_minutes"
+FUNDAMENTAL_RULE_TYPES = ("pe_below", "pe_above")
+
+
+def build_alert_message(rule: Dict, quote: Dict) -> str:
+    """
+    Arma el mensaje de una alerta disparada
+
+    Args:
+        rule: Regla de alerta
+        quote: Cotización usada en la evaluación
+
+    Returns:
+        Mensaje para la tabla alerts y el email
+    """
+    ticker = rule.get("ticker")
+    rule_type = rule.get("rule_type")
+    threshold = float(rule.get("value_threshold", 0))
+
+    if rule_type == "price_below":
+        return f"{ticker} está por debajo de ${threshold:,.2f}"
+    if rule_type == "price_above":
+        return f"{ticker} está por encima de ${threshold:,.2f}"
+    if rule_type == "pe_below":
+        return f"El P/E de {ticker} ({quote.get('pe_ratio'):.2f}) está por debajo de {threshold:g}"
+    if rule_type == "pe_above":
+        return f"El P/E de {ticker} ({quote.get('pe_ratio'):.2f}) está por encima de {threshold:g}"
+    if rule_type == "max_distance":
+        distance = (quote["current_price"] - quote["high_52w"]) / quote["high_52w"] * 100
+        return f"{ticker} está {abs(distance):.1f}% debajo de su máximo de 52 semanas"
+    return f"{ticker} cumplió la regla {rule.get('name')}"
+
+
+def in_cooldown(rule: Dict, now: datetime) -> bool:
+    """Indica si la regla se disparó hace menos de cooldown_minutes"""
+    last_triggered = rule.get("last_triggered")
+    if not last_triggered:
+        return False
+    try:
+        last = datetime.fromisoformat(last_triggered.replace('Z', '+00:00'))
+    except ValueError:
+        logger.warning(f"last_triggered inválido en regla {rule.get('id')}: {last_triggered}")
+        return False
+    cooldown_minutes = rule.get("cooldown_minutes")
+    if cooldown_minutes is None:
+        cooldown_minutes = 60
+    return (now - last).total_seconds() < cooldown_minutes * 60
+
+
+class AlertPipeline:
+    """
+    Evaluación en lote de reglas ALERT_ONLY
+
+    Cada ciclo carga las reglas paginadas, pide una cotización por ticker (no por
+    regla) al QuoteBook, evalúa en memoria, guarda las alertas con record_rule_alerts
+    (que también actualiza rules.last_triggered) y encola los emails de los lotes
+    que se guardaron. Un lote que falla no envía emails y se vuelve a disparar en el
+    ciclo siguiente.
+    """
+
+    def __init__(
+        self,
+        supabase_client,
+        quote_book: Optional[QuoteBook] = None,
+        enqueue_emails: Optional[Callable[[List[Dict]], object]] = None,
+        digest: Optional[AlertDigestCoalescer] = None,
+        schedule: Optional[CooldownSchedule] = None,
+        page_size: int = 1000,
+        insert_batch: int = 500
+    ):
+        """
+        Args:
+            supabase_client: Cliente de Supabase (service role)
+            quote_book: Cotizaciones compartidas
+            enqueue_emails: Función que encola una lista de {to_email, subject, html_content}
+            digest: Agrupador de alertas por usuario (reemplaza a enqueue_emails)
+            schedule: Agenda de cooldowns sobre last_triggered (evita revisar todas las reglas)
+            page_size: Reglas por página al cargar
+            insert_batch: Alertas por llamada a record_rule_alerts
+        """
+        self.supabase = supabase_client
+        self.quote_book = quote_book or QuoteBook()
+        self.enqueue_emails = enqueue_emails
+        self.digest = digest
+        self.schedule = schedule
+        self.page_size = page_size
+        self.insert_batch = insert_batch
+
+    def load_rules(self) -> List[Dict]:
+        """Carga todas las reglas ALERT_ONLY activas (paginado por id)"""
+        rules = []
+        start = 0
+        while True:
+            response = self.supabase.table("rules") \
+                .select(ALERT_RULE_COLUMNS) \
+                .eq("is_active", True) \
+                .eq("execution_type", "ALERT_ONLY") \
+                .order("id") \
+                .range(start, start + self.page_size - 1) \
+                .execute()
+            page = response.data or []
+            rules.extend(page)
+            if len(page) < self.page_size:
+                return rules
+            start += self.page_size
+
+    def evaluate(self, rules: List[Dict], quotes: Dict[str, Dict], now: Optional[datetime] = None) -> List[Dict]:
+        """
+        Evalúa las reglas contra las cotizaciones ya obtenidas
+
+        Returns:
+            Lista de {"alert": fila para alerts, "rule": regla, "quote": cotización}
+        """
+        now = now or datetime.now(timezone.utc)
+        triggered = []
+        for rule in rules:
+            quote = quotes.get(rule.get("ticker"))
+            if not quote or in_cooldown(rule, now):
+                continue
+            try:
+                condition_met = RuleEvaluator.check_condition(
+                    rule.get("rule_type"),
+                    float(rule.get("value_threshold", 0)),
+                    quote["current_price"],
+                    pe_ratio=quote.get("pe_ratio"),
+                    high_52w=quote.get("high_52w")
+                )
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Regla {rule.get('id')} inválida: {str(e)}")
+                continue
+            if not condition_met:
+                continue
+
+            triggered.append({
+                "alert": {
+                    "id": str(uuid.uuid4()),
+                    "user_id": rule.get("user_id"),
+                    "rule_id": rule.get("id"),
+                    "ticker": rule.get("ticker"),
+                    "message": build_alert_message(rule, quote),
+                    "alert_type": rule.get("rule_type"),
+                    "created_at": now.isoformat()
+                },
+                "rule": rule,
+                "quote": quote
+            })
+        return triggered
+
+    def persist(self, triggered: List[Dict]) -> List[Dict]:
+        """
+        Guarda las alertas en lotes de insert_batch
+
+        Returns:
+            Las alertas de los lotes que se guardaron
+        """
+        persisted = []
+        for start in range(0, len(triggered), self.insert_batch):
+            batch = triggered[start:start + self.insert_batch]
+            try:
+                self.supabase.rpc("record_rule_alerts", {"p_alerts": [item["alert"] for item in batch]}).execute()
+            except Exception as e:
+                logger.error(f"Error guardando {len(batch)} alertas, se reintentarán en el próximo ciclo: {str(e)}")
+                continue
+            persisted.extend(batch)
+        return persisted
+
+    def queue_emails(self, triggered: List[Dict]) -> int:
+        """
+        Encola los emails de las alertas
+
+        Con digest, las alertas pasan a la ventana de su usuario y se devuelve la
+        cantidad de alertas agregadas; sin digest se encola un email por alerta.
+        """
+        alerts = []
+        for item in triggered:
+            rule, quote, alert = item["rule"], item["quote"], item["alert"]
+            if not rule.get("email"):
+                continue
+            alerts.append({
+                "to_email": rule["email"],
+                "rule_name": rule.get("name") or alert["message"],
+                "ticker": rule.get("ticker"),
+                "alert_message": alert["message"],
+                "current_price": quote["current_price"],
+                "threshold": float(rule.get("value_threshold", 0)),
+                "rule_type": rule.get("rule_type")
+            })
+        if not alerts:
+            return 0
+        if self.digest is not None:
+            return self.digest.add_many(alerts)
+        if self.enqueue_emails is None:
+            return 0
+        self.enqueue_emails([render_alert_email(alert["to_email"], [alert]) for alert in alerts])
+        return len(alerts)
+
+    async def run_cycle(
+        self,
+        rule_filter: Optional[Callable[[List[Dict]], List[Dict]]] = None,
+        now: Optional[datetime] = None
+    ) -> Dict:
+        """
+        Ejecuta un ciclo completo del pipeline
+
+        Las reglas cuyo mercado está cerrado no se evalúan: la cotización quedó fija en el
+        cierre y una condición cumplida volvería a disparar en cada cooldown hasta la
+        apertura.
+
+        Args:
+            rule_filter: Filtro de reglas (por ejemplo, las particiones del worker)
+            now: Momento del ciclo (por defecto, ahora)
+
+        Returns:
+            Resumen del ciclo (reglas, tickers, alertas, emails)
+        """
+        rules = self.load_rules()
+        if rule_filter is not None:
+            rules = rule_filter(rules)
+
+        now = now or datetime.now(timezone.utc)
+        if self.schedule is not None:
+            cooled = self.schedule.eligible(rules, now.timestamp())
+        else:
+            cooled = [rule for rule in rules if not in_cooldown(rule, now)]
+        eligible = [rule for rule in cooled if market_for_ticker(rule.get("ticker")).is_open(now)]
+        tickers = {rule.get("ticker") for rule in eligible}
+        fundamentals = {rule.get("ticker") for rule in eligible if rule.get("rule_type") in FUNDAMENTAL_RULE_TYPES}
+
+        quotes = await self.quote_book.get_quotes(tickers, with_fundamentals=fundamentals)
+        triggered = self.evaluate(eligible, quotes, now)
+        persisted = self.persist(triggered)
+        emails = self.queue_emails(persisted)
+
+        summary = {
+            "rules": len(rules),
+            "closed_market": len(cooled) - len(eligible),
+            "evaluated": len(eligible),
+            "tickers": len(tickers),
+            "quotes": len(quotes),
+            "alerts": len(persisted),
+            "emails": emails
+        }
+        logger.info(f"Ciclo de alertas: {summary}")
+        return summary
@@ -9,9 +9,9 @@ from fastapi.responses import FileResponse, Response, RedirectResponse, JSONResp
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import yfinance as yf
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Union
 from pydantic import BaseModel, EmailStr
-from cachetools import TTLCache
+from cachetools import TTLCache, TLRUCache
 import uvicorn
 import asyncio
 import io
@@ -26,8 +26,7 @@ import feedparser
 from groq import Groq
 from supabase import create_client, Client
 from dotenv import load_dotenv
-from sib_api_v3_sdk import ApiClient, Configuration, TransactionalEmailsApi
-from sib_api_v3_sdk.rest import ApiException
+from email_outbox import EmailOutbox
 from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from email_templates import (
     get_onboarding_email_template,
@@ -38,9 +37,15 @@ from email_templates import (
 from cryptography.fernet import Fernet
 import hmac
 import hashlib
-from conexion_iol import ConexionIOL, get_iol_access_token, get_iol_portfolio
+from conexion_iol import ConexionIOL, get_iol_access_token, get_iol_portfolio, iol_token_manager
 from conexion_binance import ConexionBinance, get_binance_portfolio
 from rule_execution import RuleEvaluator, BacktestEngine
+from backtest_jobs import BacktestJobQueue, BacktestQueueFull
+from backtest_robustness import OBJECTIVES as ROBUSTNESS_OBJECTIVES
+from backtest_storage import BACKTEST_SUMMARY_COLUMNS, BATCH_SUMMARY_COLUMNS, RESOLUTIONS, decode_records, resample_curve
+from execution_buffer import persist_executions
+from market_calendar import cache_ttl_for_ticker
+from price_providers import get_price_provider
 
 # Load environment variables
 load_dotenv()
@@ -66,12 +71,18 @@ if not SUPABASE_JWT_SECRET:
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+# Backtests run in the background on a process pool; endpoints only queue them
+backtest_jobs = BacktestJobQueue.from_env(supabase)
+
 # User table name - using user_profiles (standard table)
 USER_TABLE_NAME = "user_profiles"
 
 # Brevo Email Configuration
 BREVO_API_KEY = os.getenv("BREVO_API_KEY")
 
+# Durable email outbox: handlers only enqueue, a background task sends through Brevo
+email_outbox = EmailOutbox.from_env(BREVO_API_KEY)
+
 # PayPal Configuration
 PAYPAL_MODE = os.getenv("PAYPAL_MODE", "live")  # 'sandbox' o 'live'
 PAYPAL_CLIENT_ID = os.getenv("PAYPAL_CLIENT_ID")
@@ -115,6 +126,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_email_sender():
+    """Background sender for the email outbox"""
+    app.state.email_sender_task = asyncio.create_task(email_outbox.run())
+
+@app.on_event("shutdown")
+async def stop_email_sender():
+    task = getattr(app.state, "email_sender_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("startup")
+async def recover_backtests():
+    """Background task that keeps this process's backtests alive and fails orphaned ones"""
+    app.state.backtest_recovery_task = asyncio.create_task(backtest_jobs.run_recovery())
+
+@app.on_event("shutdown")
+async def stop_backtests():
+    task = getattr(app.state, "backtest_recovery_task", None)
+    if task:
+        task.cancel()
+    backtest_jobs.shutdown()
+
 # Security
 security = HTTPBearer()
 
@@ -122,6 +156,15 @@ security = HTTPBearer()
 # Earnings calendar uses 24-hour cache (86400 seconds) - handled in endpoint
 cache = TTLCache(maxsize=500, ttl=120)
 
+# Market data (quotes and price history) is cached per ticker for MARKET_DATA_TTL while
+# its market is open; after the close it stays valid until the next session opens
+MARKET_DATA_TTL = 120
+
+def _market_data_ttu(key, value, now):
+    return now + cache_ttl_for_ticker(key[1], MARKET_DATA_TTL)
+
+market_cache = TLRUCache(maxsize=1000, ttu=_market_data_ttu)
+
 # Asset definitions
 TRACKING_ASSETS = {
     "GOOGL": "Alphabet (Google)",
@@ -381,22 +424,22 @@ def fetch_with_timeout(func, timeout=20):
 
 def _fetch_ticker_data(ticker: str):
     """Internal function to fetch ticker data with timeout"""
-    stock = yf.Ticker(ticker)
-    info = stock.info
-    hist = stock.history(period="max")
-    hist_1y = stock.history(period="1y")
-    return stock, info, hist, hist_1y
+    provider = get_price_provider()
+    info = provider.get_fundamentals(ticker)
+    hist = provider.get_bars(ticker, period="max")
+    # The last year is a slice of the full history, no second download needed
+    hist_1y = hist[hist.index >= hist.index[-1] - timedelta(days=365)] if not hist.empty else hist
+    return info, hist, hist_1y
 
 def get_asset_data(ticker: str, name: str) -> Optional[AssetData]:
     """
     Fetch asset data from Yahoo Finance with caching.
     Improved error handling with timeout to prevent worker crashes.
     """
-    cache_window = int(datetime.now().timestamp() // 120)
-    cache_key = f"{ticker}_{cache_window}"
+    cache_key = ("asset", ticker)
     
-    if cache_key in cache:
-        return cache[cache_key]
+    if cache_key in market_cache:
+        return market_cache[cache_key]
     
     try:
         # Fetch data with 20 second timeout
@@ -406,7 +449,7 @@ def get_asset_data(ticker: str, name: str) -> Optional[AssetData]:
             logger.warning(f"Timeout or error fetching data for {ticker}")
             return None
         
-        stock, info, hist, hist_1y = result
+        info, hist, hist_1y = result
         
         # Validate data
         if not info or len(info) == 0:
@@ -497,7 +540,7 @@ def get_asset_data(ticker: str, name: str) -> Optional[AssetData]:
             logo_url=logo_url
         )
         
-        cache[cache_key] = asset_data
+        market_cache[cache_key] = asset_data
         return asset_data
         
     except KeyError as e:
@@ -839,11 +882,14 @@ async def get_argentina_assets():
 @app.get("/api/asset/{ticker}/history")
 async def get_asset_history(ticker: str, period: str = "1y", interval: str = "1d"):
     """Get historical price data for an asset"""
+    cache_key = ("history", ticker, period, interval)
+    if cache_key in market_cache:
+        return market_cache[cache_key]
+    
     try:
-        stock = yf.Ticker(ticker)
-        hist = stock.history(period=period, interval=interval)
+        hist = get_price_provider().get_bars(ticker, period=period, interval=interval)
         
-        if hist.empty:
+        if hist is None or hist.empty:
             raise HTTPException(status_code=404, detail=f"No historical data found for {ticker}")
         
         # Convert to list of dicts
@@ -858,6 +904,7 @@ async def get_asset_history(ticker: str, period: str = "1y", interval: str = "1d
                 "volume": float(row['Volume'])
             })
         
+        market_cache[cache_key] = history_data
         return history_data
         
     except Exception as e:
@@ -1779,10 +1826,99 @@ class BacktestRequest(BaseModel):
     start_date: str
     end_date: str
     initial_capital: float = 10000
+    interval: str = "1d"
+
+class SweepRange(BaseModel):
+    start: float
+    stop: float
+    step: float
+
+class BacktestSweepRequest(BaseModel):
+    start_date: str
+    end_date: str
+    initial_capital: float = 10000
+    thresholds: Optional[List[float]] = None
+    threshold_range: Optional[SweepRange] = None
+    quantities: Optional[List[float]] = None
+    cooldown_minutes: Optional[List[int]] = None
+    objective: str = "total_return"
+
+class BacktestTemplate(BaseModel):
+    rule_type: str
+    value_threshold: float
+    execution_type: str = "BUY"
+    quantity: float = 1
+
+class BatchBacktestRequest(BaseModel):
+    start_date: str
+    end_date: str
+    initial_capital: float = 10000  # Per rule
+    rule_ids: Optional[List[str]] = None
+    watchlist_id: Optional[str] = None
+    template: Optional[BacktestTemplate] = None
+
+class RobustnessRequest(BaseModel):
+    start_date: str
+    end_date: str
+    initial_capital: float = 10000
+    paths: int = 2000
+    block_size: int = 20
+    folds: int = 5
+    thresholds: Optional[List[float]] = None
+    threshold_range: Optional[SweepRange] = None
+    anchored: bool = True
+    objective: str = "total_return"
+    seed: Optional[int] = None
+
+# Maximum parameter combinations evaluated by one sweep
+SWEEP_MAX_COMBINATIONS = int(os.getenv("SWEEP_MAX_COMBINATIONS", "2000"))
+
+# Maximum resampled paths and walk-forward folds of one robustness analysis
+ROBUSTNESS_MAX_PATHS = int(os.getenv("ROBUSTNESS_MAX_PATHS", "10000"))
+ROBUSTNESS_MAX_FOLDS = 20
+
+# Maximum rules simulated by one batch backtest
+BACKTEST_BATCH_MAX_RULES = int(os.getenv("BACKTEST_BATCH_MAX_RULES", "200"))
+
+def require_backtesting_plan(user_id: str):
+    """Raise 403 unless the user has an active Plus or Pro subscription"""
+    sub_response = supabase.table("subscriptions") \
+        .select("*, subscription_plans(*)") \
+        .eq("user_id", user_id) \
+        .eq("status", "active") \
+        .order("created_at", desc=True) \
+        .limit(1) \
+        .execute()
+    
+    if not sub_response.data:
+        raise HTTPException(
+            status_code=403,
+            detail="Backtesting requires an active paid subscription"
+        )
+    
+    plan = sub_response.data[0].get("subscription_plans", {})
+    if plan.get("name") == "free":
+        raise HTTPException(
+            status_code=403,
+            detail="Backtesting is only available for Plus and Pro plans"
+        )
+
+def sweep_thresholds(sweep_request: Union[BacktestSweepRequest, RobustnessRequest]) -> Optional[List[float]]:
+    """Thresholds of a sweep or walk-forward: the explicit list plus the inclusive range"""
+    thresholds = list(sweep_request.thresholds or [])
+    threshold_range = sweep_request.threshold_range
+    if threshold_range:
+        if threshold_range.step <= 0 or threshold_range.stop < threshold_range.start:
+            raise HTTPException(status_code=400, detail="threshold_range needs start <= stop and step > 0")
+        count = int((threshold_range.stop - threshold_range.start) / threshold_range.step + 1e-9) + 1
+        if count > SWEEP_MAX_COMBINATIONS:
+            raise HTTPException(status_code=400, detail=f"Too many thresholds (max {SWEEP_MAX_COMBINATIONS})")
+        thresholds.extend(round(threshold_range.start + i * threshold_range.step, 10) for i in range(count))
+    return thresholds or None
 
 @app.post("/api/rules/{rule_id}/backtest")
 async def backtest_rule(rule_id: str, backtest_request: BacktestRequest, user = Depends(get_current_user)):
-    """Run a backtest for a rule"""
+    """Queue a backtest for a rule (poll GET /api/backtests/{backtest_id} for progress)"""
     try:
         # Get rule
         rule_response = supabase.table("rules") \
@@ -1797,110 +1933,270 @@ async def backtest_rule(rule_id: str, backtest_request: BacktestRequest, user =
         rule = rule_response.data[0]
         
         # Check if user has active paid subscription for backtesting
-        sub_response = supabase.table("subscriptions") \
-            .select("*, subscription_plans(*)") \
+        require_backtesting_plan(user.id)
+        
+        if backtest_request.interval not in BacktestEngine.INTERVALS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"interval must be one of {', '.join(BacktestEngine.INTERVALS)}"
+            )
+        
+        # Queue the backtest; progress and results are written to rule_backtests
+        try:
+            backtest_id = backtest_jobs.submit(
+                rule,
+                user.id,
+                backtest_request.start_date,
+                backtest_request.end_date,
+                backtest_request.initial_capital,
+                backtest_request.interval
+            )
+        except BacktestQueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        
+        return JSONResponse(
+            status_code=202,
+            content={
+                "success": True,
+                "backtest_id": backtest_id,
+                "status": "PENDING"
+            }
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in backtest endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error running backtest: {str(e)}")
+
+@app.post("/api/rules/{rule_id}/backtest/sweep")
+async def backtest_sweep(rule_id: str, sweep_request: BacktestSweepRequest, user = Depends(get_current_user)):
+    """Backtest every combination of thresholds, quantities and cooldowns on one price series"""
+    try:
+        rule_response = supabase.table("rules") \
+            .select("*") \
+            .eq("id", rule_id) \
             .eq("user_id", user.id) \
-            .eq("status", "active") \
-            .order("created_at", desc=True) \
-            .limit(1) \
             .execute()
         
-        if not sub_response.data:
+        if not rule_response.data:
+            raise HTTPException(status_code=404, detail="Rule not found")
+        
+        rule = rule_response.data[0]
+        if not rule.get("ticker") or not rule.get("rule_type"):
+            raise HTTPException(status_code=400, detail="Rule has no ticker or rule type")
+        
+        require_backtesting_plan(user.id)
+        
+        if sweep_request.objective not in BacktestEngine.SWEEP_OBJECTIVES:
             raise HTTPException(
-                status_code=403,
-                detail="Backtesting requires an active paid subscription"
+                status_code=400,
+                detail=f"objective must be one of {', '.join(BacktestEngine.SWEEP_OBJECTIVES)}"
             )
         
-        plan = sub_response.data[0].get("subscription_plans", {})
-        if plan.get("name") == "free":
+        thresholds = sweep_thresholds(sweep_request)
+        combinations = len(set(thresholds or [0])) * len(sweep_request.quantities or [0]) * len(sweep_request.cooldown_minutes or [0])
+        if combinations > SWEEP_MAX_COMBINATIONS:
             raise HTTPException(
-                status_code=403,
-                detail="Backtesting is only available for Plus and Pro plans"
+                status_code=400,
+                detail=f"Sweep has {combinations} combinations (max {SWEEP_MAX_COMBINATIONS})"
             )
         
-        # Create backtest record
-        backtest_data = {
-            "rule_id": rule_id,
-            "user_id": user.id,
-            "start_date": backtest_request.start_date,
-            "end_date": backtest_request.end_date,
-            "initial_capital": backtest_request.initial_capital,
-            "status": "RUNNING"
-        }
+        results = await backtest_jobs.run_sweep(
+            rule,
+            sweep_request.start_date,
+            sweep_request.end_date,
+            sweep_request.initial_capital,
+            thresholds=thresholds,
+            quantities=sweep_request.quantities,
+            cooldowns=sweep_request.cooldown_minutes,
+            objective=sweep_request.objective
+        )
+        
+        if not results.get("success"):
+            raise HTTPException(status_code=422, detail=results.get("error", "Sweep failed"))
+        
+        return results
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in backtest sweep endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error running sweep: {str(e)}")
+
+def batch_backtest_rules(batch_request: BatchBacktestRequest, user_id: str) -> List[Dict]:
+    """Rules of a batch: the user's rules, or the template applied to every watchlist asset"""
+    if batch_request.watchlist_id:
+        if not batch_request.template:
+            raise HTTPException(status_code=400, detail="A watchlist batch needs a rule template")
+        watchlist_response = supabase.table("watchlists") \
+            .select("id, watchlist_assets(ticker, asset_name)") \
+            .eq("id", batch_request.watchlist_id) \
+            .eq("user_id", user_id) \
+            .execute()
+        
+        if not watchlist_response.data:
+            raise HTTPException(status_code=404, detail="Watchlist not found")
+        
+        template = batch_request.template.model_dump()
+        tickers = dict.fromkeys(
+            asset["ticker"] for asset in watchlist_response.data[0].get("watchlist_assets") or [] if asset.get("ticker")
+        )
+        return [dict(template, ticker=ticker, name=f"{ticker} {template['rule_type']}") for ticker in tickers]
+    
+    query = supabase.table("rules") \
+        .select("*") \
+        .eq("user_id", user_id)
+    if batch_request.rule_ids:
+        query = query.in_("id", batch_request.rule_ids)
+    rules_response = query.execute()
+    
+    return [rule for rule in rules_response.data or [] if rule.get("ticker") and rule.get("rule_type")]
+
+@app.post("/api/rules/{rule_id}/backtest/robustness")
+async def backtest_robustness(rule_id: str, robustness_request: RobustnessRequest, user = Depends(get_current_user)):
+    """Block-bootstrap and walk-forward distributions of return, drawdown and Sharpe for a rule"""
+    try:
+        rule_response = supabase.table("rules") \
+            .select("*") \
+            .eq("id", rule_id) \
+            .eq("user_id", user.id) \
+            .execute()
         
-        backtest_response = supabase.table("rule_backtests").insert(backtest_data).execute()
-        backtest_id = backtest_response.data[0]["id"]
+        if not rule_response.data:
+            raise HTTPException(status_code=404, detail="Rule not found")
+        
+        rule = rule_response.data[0]
+        if not rule.get("ticker") or not rule.get("rule_type"):
+            raise HTTPException(status_code=400, detail="Rule has no ticker or rule type")
+        
+        require_backtesting_plan(user.id)
+        
+        if robustness_request.objective not in ROBUSTNESS_OBJECTIVES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"objective must be one of {', '.join(ROBUSTNESS_OBJECTIVES)}"
+            )
+        if not 1 <= robustness_request.paths <= ROBUSTNESS_MAX_PATHS:
+            raise HTTPException(status_code=400, detail=f"paths must be between 1 and {ROBUSTNESS_MAX_PATHS}")
+        if not 1 <= robustness_request.folds <= ROBUSTNESS_MAX_FOLDS:
+            raise HTTPException(status_code=400, detail=f"folds must be between 1 and {ROBUSTNESS_MAX_FOLDS}")
+        if robustness_request.block_size < 1:
+            raise HTTPException(status_code=400, detail="block_size must be at least 1")
+        
+        thresholds = sweep_thresholds(robustness_request)
+        if thresholds and len(set(thresholds)) > SWEEP_MAX_COMBINATIONS:
+            raise HTTPException(status_code=400, detail=f"Too many thresholds (max {SWEEP_MAX_COMBINATIONS})")
+        
+        results = await backtest_jobs.run_robustness(
+            rule,
+            robustness_request.start_date,
+            robustness_request.end_date,
+            robustness_request.initial_capital,
+            paths=robustness_request.paths,
+            block_size=robustness_request.block_size,
+            folds=robustness_request.folds,
+            thresholds=thresholds,
+            anchored=robustness_request.anchored,
+            objective=robustness_request.objective,
+            seed=robustness_request.seed
+        )
+        
+        if not results.get("success"):
+            raise HTTPException(status_code=422, detail=results.get("error", "Robustness analysis failed"))
+        
+        return results
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in backtest robustness endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error running robustness analysis: {str(e)}")
+
+@app.post("/api/backtests/batch")
+async def backtest_batch(batch_request: BatchBacktestRequest, user = Depends(get_current_user)):
+    """Queue one backtest over many rules (poll GET /api/backtests/batch/{batch_id} for progress)"""
+    try:
+        require_backtesting_plan(user.id)
+        
+        rules = batch_backtest_rules(batch_request, user.id)
+        if not rules:
+            raise HTTPException(status_code=400, detail="No rules with a ticker and rule type to backtest")
+        if len(rules) > BACKTEST_BATCH_MAX_RULES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Batch has {len(rules)} rules (max {BACKTEST_BATCH_MAX_RULES})"
+            )
         
-        # Run backtest asynchronously
         try:
-            backtest_engine = BacktestEngine()
-            results = await backtest_engine.run_backtest(
-                rule,
-                backtest_request.start_date,
-                backtest_request.end_date,
-                backtest_request.initial_capital
+            batch_id = backtest_jobs.submit_batch(
+                rules,
+                user.id,
+                batch_request.start_date,
+                batch_request.end_date,
+                batch_request.initial_capital,
+                watchlist_id=batch_request.watchlist_id,
+                template=batch_request.template.model_dump() if batch_request.watchlist_id else None
             )
-            
-            if results.get("success"):
-                # Update backtest with results
-                update_data = {
-                    "status": "COMPLETED",
-                    "completed_at": datetime.now(timezone.utc).isoformat(),
-                    "total_executions": results.get("total_executions", 0),
-                    "successful_executions": results.get("successful_executions", 0),
-                    "failed_executions": results.get("failed_executions", 0),
-                    "final_capital": results.get("final_capital"),
-                    "total_return": results.get("total_return"),
-                    "total_profit_loss": results.get("total_profit_loss"),
-                    "max_drawdown": results.get("max_drawdown"),
-                    "win_rate": results.get("win_rate"),
-                    "profit_factor": results.get("profit_factor"),
-                    "sharpe_ratio": results.get("sharpe_ratio"),
-                    "execution_details": results.get("execution_details", []),
-                    "daily_equity_curve": results.get("daily_equity_curve", [])
-                }
-                
-                supabase.table("rule_backtests") \
-                    .update(update_data) \
-                    .eq("id", backtest_id) \
-                    .execute()
-                
-                return {
-                    "success": True,
-                    "backtest_id": backtest_id,
-                    "results": results
-                }
-            else:
-                # Update with error
-                supabase.table("rule_backtests") \
-                    .update({
-                        "status": "FAILED",
-                        "error_message": results.get("error", "Unknown error"),
-                        "completed_at": datetime.now(timezone.utc).isoformat()
-                    }) \
-                    .eq("id", backtest_id) \
-                    .execute()
-                
-                raise HTTPException(status_code=500, detail=results.get("error", "Backtest failed"))
-                
-        except Exception as e:
-            # Update with error
-            supabase.table("rule_backtests") \
-                .update({
-                    "status": "FAILED",
-                    "error_message": str(e),
-                    "completed_at": datetime.now(timezone.utc).isoformat()
-                }) \
-                .eq("id", backtest_id) \
-                .execute()
-            
-            raise HTTPException(status_code=500, detail=f"Error running backtest: {str(e)}")
-            
+        except BacktestQueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        
+        return JSONResponse(
+            status_code=202,
+            content={
+                "success": True,
+                "batch_id": batch_id,
+                "rule_count": len(rules),
+                "ticker_count": len({rule["ticker"] for rule in rules}),
+                "status": "PENDING"
+            }
+        )
+        
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error in backtest endpoint: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error running backtest: {str(e)}")
+        logger.error(f"Error in batch backtest endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error running batch backtest: {str(e)}")
+
+@app.get("/api/backtests/batch/{batch_id}")
+async def get_backtest_batch(batch_id: str, user = Depends(get_current_user)):
+    """Get the status and per-rule summary of a batch backtest"""
+    try:
+        response = supabase.table("rule_backtest_batches") \
+            .select(BATCH_SUMMARY_COLUMNS) \
+            .eq("id", batch_id) \
+            .eq("user_id", user.id) \
+            .execute()
+        
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Batch backtest not found")
+        
+        return response.data[0]
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching batch backtest: {str(e)}")
+
+@app.get("/api/backtests/batch/{batch_id}/equity-curve")
+async def get_backtest_batch_equity_curve(batch_id: str, resolution: str = "1d", user = Depends(get_current_user)):
+    """Get a batch backtest's portfolio equity curve at 1d, 1wk or 1mo resolution"""
+    try:
+        response = supabase.table("rule_backtest_batches") \
+            .select("id, portfolio_equity_curve") \
+            .eq("id", batch_id) \
+            .eq("user_id", user.id) \
+            .execute()
+        
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Batch backtest not found")
+        
+        return equity_curve_response(response.data[0].get("portfolio_equity_curve"), resolution)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching equity curve: {str(e)}")
 
 @app.get("/api/rules/{rule_id}/backtests")
 async def get_rule_backtests(rule_id: str, user = Depends(get_current_user)):
@@ -1916,9 +2212,9 @@ async def get_rule_backtests(rule_id: str, user = Depends(get_current_user)):
         if not rule_response.data:
             raise HTTPException(status_code=404, detail="Rule not found")
         
-        # Get backtests
+        # Get backtests (summary only; curves are served by /api/backtests/{backtest_id}/equity-curve)
         backtests_response = supabase.table("rule_backtests") \
-            .select("*") \
+            .select(BACKTEST_SUMMARY_COLUMNS) \
             .eq("rule_id", rule_id) \
             .order("created_at", desc=True) \
             .execute()
@@ -1930,6 +2226,57 @@ async def get_rule_backtests(rule_id: str, user = Depends(get_current_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching backtests: {str(e)}")
 
+@app.get("/api/backtests/{backtest_id}")
+async def get_backtest(backtest_id: str, details: bool = False, user = Depends(get_current_user)):
+    """Get the status, progress and summary of a backtest (details=true adds its executions)"""
+    try:
+        columns = BACKTEST_SUMMARY_COLUMNS + (", execution_details" if details else "")
+        response = supabase.table("rule_backtests") \
+            .select(columns) \
+            .eq("id", backtest_id) \
+            .eq("user_id", user.id) \
+            .execute()
+        
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Backtest not found")
+        
+        backtest = response.data[0]
+        if details:
+            backtest["execution_details"] = decode_records(backtest.get("execution_details"))
+        return backtest
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching backtest: {str(e)}")
+
+def equity_curve_response(stored, resolution: str) -> Dict:
+    """Decode a stored equity curve and resample it to the requested resolution"""
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    points = resample_curve(decode_records(stored), resolution)
+    return {"resolution": resolution, "points": len(points), "equity_curve": points}
+
+@app.get("/api/backtests/{backtest_id}/equity-curve")
+async def get_backtest_equity_curve(backtest_id: str, resolution: str = "1d", user = Depends(get_current_user)):
+    """Get one backtest's equity curve at 1d, 1wk or 1mo resolution"""
+    try:
+        response = supabase.table("rule_backtests") \
+            .select("id, daily_equity_curve") \
+            .eq("id", backtest_id) \
+            .eq("user_id", user.id) \
+            .execute()
+        
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Backtest not found")
+        
+        return equity_curve_response(response.data[0].get("daily_equity_curve"), resolution)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching equity curve: {str(e)}")
+
 @app.post("/api/rules/{rule_id}/execute")
 async def execute_rule(rule_id: str, user = Depends(get_current_user)):
     """Manually trigger rule execution (for testing)"""
@@ -2003,7 +2350,7 @@ async def execute_rule(rule_id: str, user = Depends(get_current_user)):
             if broker_name == "IOL":
                 username = decrypt_api_key(broker_connection.get("username_encrypted"))
                 password = decrypt_api_key(broker_connection.get("password_encrypted"))
-                conexion = ConexionIOL(username, password)
+                conexion = ConexionIOL(username, password, connection_id=broker_connection.get("id"))
                 execution_result = await conexion.ejecutar_orden(ticker, quantity, execution_type)
                 
             elif broker_name == "BINANCE":
@@ -2032,17 +2379,12 @@ async def execute_rule(rule_id: str, user = Depends(get_current_user)):
             "executed_at": datetime.now(timezone.utc).isoformat() if execution_result and execution_result.get("success") else None
         }
         
-        execution_response = supabase.table("rule_executions").insert(execution_data).execute()
-        
-        # Update rule's last_execution_at
-        supabase.table("rules") \
-            .update({"last_execution_at": datetime.now(timezone.utc).isoformat()}) \
-            .eq("id", rule_id) \
-            .execute()
+        # Insert execution and update rule's last_execution_at in one round-trip
+        persisted = persist_executions(supabase, [execution_data])
         
         return {
             "success": execution_result.get("success") if execution_result else False,
-            "execution": execution_response.data[0] if execution_response.data else None,
+            "execution": persisted[0] if persisted else None,
             "message": "Order executed successfully" if execution_result and execution_result.get("success") else "Execution failed"
         }
         
@@ -2653,6 +2995,9 @@ async def delete_broker_connection(connection_id: str, user = Depends(get_curren
         # Delete connection
         supabase.table("broker_connections").delete().eq("id", connection_id).execute()
         
+        # Drop cached IOL tokens for this connection
+        iol_token_manager.invalidate(connection_id, keep_refresh_token=False)
+        
         return {"message": "Broker connection deleted successfully"}
     
     except HTTPException:
@@ -2689,7 +3034,7 @@ async def get_broker_portfolio(connection_id: str, user = Depends(get_current_us
             password = decrypt_api_key(connection["password_encrypted"])
             
             # Use new IOL connection module
-            conexion_iol = ConexionIOL(username, password)
+            conexion_iol = ConexionIOL(username, password, connection_id=connection_id)
             portfolio = await conexion_iol.obtener_portfolio()
             if portfolio is None:
                 raise HTTPException(status_code=400, detail="Failed to fetch portfolio from IOL")
@@ -3846,45 +4191,28 @@ async def health_check():
 # ============================================
 
 def send_alert_email(to_email: str, subject: str, html_content: str, sender_name: str = "BullAnalytics", sender_email: str = "noreply@aperturaia.com"):
-    """Envía un correo de alerta usando Brevo"""
+    """Encola un correo en el outbox; el envío con Brevo ocurre en segundo plano"""
     if not BREVO_API_KEY:
         logger.error("BREVO_API_KEY no configurada en variables de entorno")
         return {"success": False, "error": "BREVO_API_KEY no configurada"}
     
     try:
-        configuration = Configuration()
-        configuration.api_key['api-key'] = BREVO_API_KEY
-        
-        api_instance = TransactionalEmailsApi(ApiClient(configuration))
-        
-        send_smtp_email = {
-            'sender': {
-                'name': sender_name,
-                'email': sender_email
-            },
-            'to': [{'email': to_email}],
-            'subject': subject,
-            'htmlContent': html_content
-        }
-        
-        api_response = api_instance.send_transac_email(send_smtp_email)
-        logger.info(f"✅ Email enviado exitosamente a {to_email}: {api_response.message_id}")
+        outbox_id = email_outbox.enqueue(
+            to_email=to_email,
+            subject=subject,
+            html_content=html_content,
+            sender_name=sender_name,
+            sender_email=sender_email
+        )
+        logger.info(f"Email encolado para {to_email} (outbox {outbox_id})")
         return {
             "success": True,
-            "message_id": api_response.message_id,
+            "queued": True,
+            "outbox_id": outbox_id,
             "to": to_email
         }
-        
-    except ApiException as e:
-        error_msg = f"Error enviando email: {e}"
-        logger.error(error_msg)
-        return {
-            "success": False,
-            "error": str(e),
-            "status_code": e.status if hasattr(e, 'status') else None
-        }
     except Exception as e:
-        error_msg = f"Error inesperado enviando email: {str(e)}"
+        error_msg = f"Error inesperado encolando email: {str(e)}"
         logger.error(error_msg, exc_info=True)
         return {
             "success": False,
@@ -3979,8 +4307,8 @@ async def test_email(email: str = Query(..., description="Email destino para pru
     
     if result.get("success"):
         return {
-            "message": "Email enviado exitosamente",
-            "message_id": result.get("message_id"),
+            "message": "Email encolado para envío",
+            "outbox_id": result.get("outbox_id"),
             "to": email
         }
     else:
@@ -4012,7 +4340,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
         results.append({
             "template": "onboarding",
             "success": result.get("success", False),
-            "message_id": result.get("message_id") if result.get("success") else None,
+            "outbox_id": result.get("outbox_id") if result.get("success") else None,
             "error": result.get("error") if not result.get("success") else None
         })
     except Exception as e:
@@ -4040,7 +4368,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
         results.append({
             "template": "alert_price_below",
             "success": result.get("success", False),
-            "message_id": result.get("message_id") if result.get("success") else None,
+            "outbox_id": result.get("outbox_id") if result.get("success") else None,
             "error": result.get("error") if not result.get("success") else None
         })
     except Exception as e:
@@ -4068,7 +4396,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
         results.append({
             "template": "alert_price_above",
             "success": result.get("success", False),
-            "message_id": result.get("message_id") if result.get("success") else None,
+            "outbox_id": result.get("outbox_id") if result.get("success") else None,
             "error": result.get("error") if not result.get("success") else None
         })
     except Exception as e:
@@ -4092,7 +4420,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
         results.append({
             "template": "password_reset",
             "success": result.get("success", False),
-            "message_id": result.get("message_id") if result.get("success") else None,
+            "outbox_id": result.get("outbox_id") if result.get("success") else None,
             "error": result.get("error") if not result.get("success") else None
         })
     except Exception as e:
@@ -4117,7 +4445,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
         results.append({
             "template": "subscription_confirmation",
             "success": result.get("success", False),
-            "message_id": result.get("message_id") if result.get("success") else None,
+            "outbox_id": result.get("outbox_id") if result.get("success") else None,
             "error": result.get("error") if not result.get("success") else None
         })
     except Exception as e:
@@ -4132,7 +4460,7 @@ async def test_all_templates(email: str = Query(..., description="Email destino
     total = len(results)
     
     return {
-        "message": f"Prueba de templates completada: {successful}/{total} enviados exitosamente",
+        "message": f"Prueba de templates completada: {successful}/{total} encolados para envío",
         "to": email,
         "results": results,
         "summary": {
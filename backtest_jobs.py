@@ -0,0 +1,650 @@
+"""
+Cola de backtests en segundo plano
+El endpoint solo registra el backtest (PENDING) y devuelve su id; la descarga de datos
+corre en un thread y la simulación en un pool de procesos, con un límite de backtests
+simultáneos por usuario. Los backtests intradiarios leen y simulan las velas por tramos
+dentro del proceso hijo. El progreso se informa en rule_backtests
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, List, Optional, Set
+
+from backtest_robustness import run_robustness
+from backtest_storage import encode_records
+from bar_cache import get_bar_cache
+from rule_execution import BacktestEngine
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ["PENDING", "RUNNING"]
+INTERRUPTED_ERROR = "El backtest se interrumpió por un reinicio del servidor"
+
+# Cada cuánto se marcan como vivos los backtests propios y se recuperan los huérfanos,
+# y cuánto tiempo sin actualizarse hace falta para darlos por huérfanos
+RECOVERY_INTERVAL = 300
+STALE_AFTER = 1800
+
+
+class BacktestQueueFull(Exception):
+    """El usuario ya tiene el máximo de backtests pendientes o en curso"""
+
+
+def _simulate(rule: Dict, hist, initial_capital: float) -> Dict:
+    """Simulación que corre en el proceso hijo (función de módulo para poder picklearla)"""
+    return BacktestEngine.simulate(rule, hist, initial_capital)
+
+
+def _simulate_stream(rule: Dict, start_date: str, end_date: str, interval: str, initial_capital: float) -> Dict:
+    """Backtest por tramos en el proceso hijo: las velas se leen de la caché de a un tramo"""
+    chunks = BacktestEngine.stream_history(rule["ticker"], start_date, end_date, interval, [rule["rule_type"]])
+    return BacktestEngine.simulate_stream(rule, chunks, initial_capital, interval)
+
+
+def _sweep(rule: Dict, hist, initial_capital: float, grid: Dict) -> Dict:
+    return BacktestEngine.sweep(rule, hist, initial_capital, **grid)
+
+
+def _simulate_group(rules: List[Dict], hist, initial_capital: float) -> List[Dict]:
+    """Simula todas las reglas de un ticker (las velas viajan al proceso hijo una sola vez)"""
+    results = []
+    for rule in rules:
+        try:
+            results.append(BacktestEngine.simulate(rule, hist, initial_capital))
+        except Exception as e:
+            results.append({"success": False, "error": str(e)})
+    return results
+
+
+def results_update(results: Dict) -> Dict:
+    """Campos de rule_backtests de un backtest terminado (series en formato por columnas)"""
+    if not results.get("success"):
+        return {
+            "status": "FAILED",
+            "error_message": results.get("error", "Unknown error"),
+            "completed_at": datetime.now(timezone.utc).isoformat()
+        }
+    return {
+        "status": "COMPLETED",
+        "progress": 100,
+        "progress_message": None,
+        "completed_at": datetime.now(timezone.utc).isoformat(),
+        "total_executions": results.get("total_executions", 0),
+        "successful_executions": results.get("successful_executions", 0),
+        "failed_executions": results.get("failed_executions", 0),
+        "final_capital": results.get("final_capital"),
+        "total_return": results.get("total_return"),
+        "total_profit_loss": results.get("total_profit_loss"),
+        "max_drawdown": results.get("max_drawdown"),
+        "win_rate": results.get("win_rate"),
+        "profit_factor": results.get("profit_factor"),
+        "sharpe_ratio": results.get("sharpe_ratio"),
+        "data_version": results.get("data_version"),
+        "execution_details": encode_records(results.get("execution_details", [])),
+        "daily_equity_curve": encode_records(results.get("daily_equity_curve", []))
+    }
+
+
+class BacktestJobQueue:
+    """
+    Backtests encolados por usuario
+
+    - Admisión: un usuario puede tener hasta max_active_per_user backtests PENDING o
+      RUNNING (contados en rule_backtests, así que el límite vale para todos los
+      procesos de la API); por encima, submit lanza BacktestQueueFull
+    - Ejecución: hasta max_workers backtests a la vez por proceso y per_user_running
+      por usuario; los usuarios se atienden por turnos para que uno con muchos
+      backtests no demore al resto
+    - Progreso: PENDING (0) -> RUNNING (descarga, simulación) -> COMPLETED (100) o
+      FAILED con error_message
+    - Recuperación: run_recovery renueva updated_at de los backtests de este proceso
+      (en cola o en curso) y marca FAILED los que nadie renueva hace STALE_AFTER, que
+      quedaron huérfanos por un reinicio
+    """
+
+    def __init__(
+        self,
+        supabase,
+        max_workers: int = 2,
+        per_user_running: int = 1,
+        max_active_per_user: int = 5,
+        max_active_batches: int = 1,
+        executor: Optional[Executor] = None
+    ):
+        """
+        Args:
+            supabase: Cliente de Supabase
+            max_workers: Procesos del pool y backtests simultáneos
+            per_user_running: Backtests simultáneos por usuario
+            max_active_per_user: Backtests pendientes o en curso por usuario
+            max_active_batches: Lotes pendientes o en curso por usuario
+            executor: Executor para la simulación (por defecto, un pool de procesos)
+        """
+        self.supabase = supabase
+        self.max_workers = max_workers
+        self.per_user_running = per_user_running
+        self.max_active_per_user = max_active_per_user
+        self.max_active_batches = max_active_batches
+        self._executor_instance = executor
+        self._owns_executor = executor is None
+        self._pending: Dict[str, Deque[Dict]] = {}
+        self._turns: Deque[str] = deque()
+        self._running: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._active: Dict[str, str] = {}  # id -> tabla de los backtests en cola o en curso
+
+    @classmethod
+    def from_env(cls, supabase) -> "BacktestJobQueue":
+        """Crea la cola usando BACKTEST_WORKERS, BACKTEST_USER_CONCURRENCY y BACKTEST_USER_MAX_ACTIVE"""
+        return cls(
+            supabase,
+            max_workers=int(os.getenv("BACKTEST_WORKERS", str(min(2, os.cpu_count() or 1)))),
+            per_user_running=int(os.getenv("BACKTEST_USER_CONCURRENCY", "1")),
+            max_active_per_user=int(os.getenv("BACKTEST_USER_MAX_ACTIVE", "5")),
+            max_active_batches=int(os.getenv("BACKTEST_USER_MAX_BATCHES", "1"))
+        )
+
+    def _executor(self) -> Executor:
+        if self._executor_instance is None:
+            # spawn: el proceso de la API tiene threads (no es seguro hacer fork)
+            self._executor_instance = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor_instance
+
+    def _update(self, backtest_id: str, data: Dict, table: str = "rule_backtests"):
+        data = dict(data, updated_at=datetime.now(timezone.utc).isoformat())
+        self.supabase.table(table) \
+            .update(data) \
+            .eq("id", backtest_id) \
+            .execute()
+
+    async def _report(self, backtest_id: str, data: Dict, table: str = "rule_backtests"):
+        try:
+            await asyncio.to_thread(self._update, backtest_id, data, table)
+        except Exception as e:
+            logger.warning(f"No se pudo actualizar el backtest {backtest_id}: {str(e)}")
+
+    def active_count(self, user_id: str, table: str = "rule_backtests") -> int:
+        """Backtests (o lotes) PENDING o RUNNING del usuario en todos los procesos"""
+        response = self.supabase.table(table) \
+            .select("id", count="exact") \
+            .eq("user_id", user_id) \
+            .in_("status", ACTIVE_STATUSES) \
+            .execute()
+        return response.count or 0
+
+    def pending_count(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def running_count(self) -> int:
+        return sum(self._running.values())
+
+    def submit(
+        self,
+        rule: Dict,
+        user_id: str,
+        start_date: str,
+        end_date: str,
+        initial_capital: float,
+        interval: str = "1d"
+    ) -> str:
+        """
+        Registra un backtest y lo encola (llamar desde el event loop)
+
+        Args:
+            rule: Regla a simular
+            user_id: Dueño de la regla
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD)
+            initial_capital: Capital inicial
+            interval: Intervalo de las velas (los intradiarios se simulan por tramos)
+
+        Returns:
+            El id del backtest en rule_backtests
+
+        Raises:
+            BacktestQueueFull: Si el usuario superó max_active_per_user
+        """
+        if self.active_count(user_id) >= self.max_active_per_user:
+            raise BacktestQueueFull(
+                f"Ya tenés {self.max_active_per_user} backtests en curso; esperá a que terminen"
+            )
+
+        response = self.supabase.table("rule_backtests").insert({
+            "rule_id": rule.get("id"),
+            "user_id": user_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "initial_capital": initial_capital,
+            "interval": interval,
+            "status": "PENDING",
+            "progress": 0,
+            "progress_message": "En cola"
+        }).execute()
+        backtest_id = response.data[0]["id"]
+
+        self._enqueue({
+            "id": backtest_id,
+            "user_id": user_id,
+            "rule": rule,
+            "start_date": start_date,
+            "end_date": end_date,
+            "initial_capital": initial_capital,
+            "interval": interval
+        })
+        return backtest_id
+
+    def submit_batch(
+        self,
+        rules: List[Dict],
+        user_id: str,
+        start_date: str,
+        end_date: str,
+        initial_capital: float,
+        watchlist_id: Optional[str] = None,
+        template: Optional[Dict] = None
+    ) -> str:
+        """
+        Registra un backtest en lote y lo encola (llamar desde el event loop)
+
+        Args:
+            rules: Reglas a simular (las de una plantilla no tienen id)
+            user_id: Dueño de las reglas
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD)
+            initial_capital: Capital inicial de cada regla
+            watchlist_id: Watchlist de origen, si las reglas salen de una plantilla
+            template: Regla plantilla aplicada a la watchlist
+
+        Returns:
+            El id del lote en rule_backtest_batches
+
+        Raises:
+            BacktestQueueFull: Si el usuario superó max_active_batches
+        """
+        if self.active_count(user_id, "rule_backtest_batches") >= self.max_active_batches:
+            raise BacktestQueueFull(
+                f"Ya tenés {self.max_active_batches} backtest en lote en curso; esperá a que termine"
+            )
+
+        response = self.supabase.table("rule_backtest_batches").insert({
+            "user_id": user_id,
+            "source": "watchlist" if watchlist_id else "rules",
+            "watchlist_id": watchlist_id,
+            "template": template,
+            "start_date": start_date,
+            "end_date": end_date,
+            "initial_capital": initial_capital,
+            "rule_count": len(rules),
+            "ticker_count": len({rule["ticker"] for rule in rules}),
+            "status": "PENDING",
+            "progress": 0,
+            "progress_message": "En cola"
+        }).execute()
+        batch_id = response.data[0]["id"]
+
+        self._enqueue({
+            "id": batch_id,
+            "kind": "batch",
+            "user_id": user_id,
+            "rules": rules,
+            "start_date": start_date,
+            "end_date": end_date,
+            "initial_capital": initial_capital
+        })
+        return batch_id
+
+    def _enqueue(self, job: Dict):
+        self._active[job["id"]] = "rule_backtest_batches" if job.get("kind") == "batch" else "rule_backtests"
+        user_id = job["user_id"]
+        if user_id not in self._pending:
+            self._pending[user_id] = deque()
+            self._turns.append(user_id)
+        self._pending[user_id].append(job)
+        self._pump()
+
+    def _next_job(self) -> Optional[Dict]:
+        """Próximo backtest por turnos entre usuarios, respetando per_user_running"""
+        for _ in range(len(self._turns)):
+            user_id = self._turns[0]
+            self._turns.rotate(-1)
+            if self._running.get(user_id, 0) >= self.per_user_running:
+                continue
+            jobs = self._pending[user_id]
+            job = jobs.popleft()
+            if not jobs:
+                del self._pending[user_id]
+                self._turns.remove(user_id)
+            return job
+        return None
+
+    def _pump(self):
+        while self.running_count() < self.max_workers:
+            job = self._next_job()
+            if job is None:
+                return
+            self._running[job["user_id"]] = self._running.get(job["user_id"], 0) + 1
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Dict):
+        backtest_id = job["id"]
+        is_batch = job.get("kind") == "batch"
+        try:
+            if is_batch:
+                update = await self._execute_batch(job)
+            else:
+                update = results_update(await self._execute(job))
+        except Exception as e:
+            logger.error(f"Error en backtest {backtest_id}: {str(e)}", exc_info=True)
+            update = results_update({"success": False, "error": str(e)})
+        finally:
+            self._running[job["user_id"]] -= 1
+            if not self._running[job["user_id"]]:
+                del self._running[job["user_id"]]
+            self._pump()
+        await self._report(backtest_id, update, "rule_backtest_batches" if is_batch else "rule_backtests")
+        self._active.pop(backtest_id, None)
+
+    async def _execute(self, job: Dict) -> Dict:
+        rule = job["rule"]
+        if not rule.get("ticker") or not rule.get("rule_type"):
+            return {"success": False, "error": "Ticker o tipo de regla no especificado"}
+
+        await self._report(job["id"], {
+            "status": "RUNNING",
+            "progress": 10,
+            "progress_message": "Descargando datos históricos",
+            "started_at": datetime.now(timezone.utc).isoformat()
+        })
+        interval = job.get("interval", "1d")
+        if interval != "1d":
+            return await self._execute_stream(job, interval)
+
+        hist = await asyncio.to_thread(
+            BacktestEngine.load_history, rule["ticker"], job["start_date"], job["end_date"], [rule["rule_type"]]
+        )
+        if hist is None or hist.empty:
+            return {"success": False, "error": "No se pudieron obtener datos históricos"}
+
+        await self._report(job["id"], {"progress": 50, "progress_message": f"Simulando {len(hist)} velas"})
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), _simulate, rule, hist, job["initial_capital"])
+        except BrokenProcessPool:
+            # Un proceso hijo murió (por ejemplo, sin memoria): el próximo backtest usa un pool nuevo
+            if self._owns_executor:
+                self._executor_instance = None
+            raise
+
+    async def _execute_stream(self, job: Dict, interval: str) -> Dict:
+        """
+        Backtest intradiario: el proceso hijo lee y simula las velas por tramos, así que
+        la memoria no crece con el horizonte ni las velas viajan entre procesos
+        """
+        await self._report(job["id"], {"progress": 30, "progress_message": f"Simulando velas de {interval} por tramos"})
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self._executor(), _simulate_stream, job["rule"], job["start_date"], job["end_date"], interval,
+                job["initial_capital"]
+            )
+        except BrokenProcessPool:
+            if self._owns_executor:
+                self._executor_instance = None
+            raise
+
+    async def _execute_batch(self, job: Dict) -> Dict:
+        """
+        Backtest en lote: una descarga por ticker, simulación en paralelo por ticker,
+        un solo insert de resultados y la curva de equity agregada
+
+        Returns:
+            Campos finales de rule_backtest_batches
+        """
+        batch_id = job["id"]
+        rules = job["rules"]
+        capital = job["initial_capital"]
+        by_ticker: Dict[str, List[int]] = {}
+        for i, rule in enumerate(rules):
+            by_ticker.setdefault(rule["ticker"], []).append(i)
+
+        started_at = datetime.now(timezone.utc).isoformat()
+        await self._report(batch_id, {
+            "status": "RUNNING",
+            "progress": 10,
+            "progress_message": f"Descargando {len(by_ticker)} tickers",
+            "started_at": started_at
+        }, "rule_backtest_batches")
+        bars = await asyncio.to_thread(
+            get_bar_cache().get_bars_batch, list(by_ticker), start=job["start_date"], end=job["end_date"]
+        )
+        pe_tickers = {rule["ticker"] for rule in rules if rule["rule_type"] in BacktestEngine.PE_RULES}
+        for ticker in pe_tickers & set(bars):
+            earnings = await asyncio.to_thread(BacktestEngine.earnings, ticker)
+            bars[ticker] = BacktestEngine.attach_pe(bars[ticker], earnings)
+
+        await self._report(batch_id, {"progress": 30, "progress_message": f"Simulando {len(rules)} reglas"}, "rule_backtest_batches")
+        results: List[Optional[Dict]] = [None] * len(rules)
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+
+        async def simulate_ticker(indexes: List[int], hist):
+            group = await loop.run_in_executor(executor, _simulate_group, [rules[i] for i in indexes], hist, capital)
+            return indexes, group
+
+        tasks = []
+        for ticker, indexes in by_ticker.items():
+            hist = bars.get(ticker)
+            if hist is None or hist.empty:
+                for i in indexes:
+                    results[i] = {"success": False, "error": "No se pudieron obtener datos históricos"}
+            else:
+                tasks.append(simulate_ticker(indexes, hist))
+
+        done = sum(result is not None for result in results)
+        reported = 30
+        try:
+            for finished in asyncio.as_completed(tasks):
+                indexes, group = await finished
+                for i, result in zip(indexes, group):
+                    results[i] = result
+                done += len(indexes)
+                # Como mucho un update cada 5 puntos de progreso
+                progress = 30 + int(60 * done / len(rules))
+                if progress - reported >= 5:
+                    reported = progress
+                    await self._report(batch_id, {
+                        "progress": progress,
+                        "progress_message": f"Simuladas {done} de {len(rules)} reglas"
+                    }, "rule_backtest_batches")
+        except BrokenProcessPool:
+            if self._owns_executor:
+                self._executor_instance = None
+            raise
+
+        # Un solo insert con el resultado de cada regla guardada
+        completed_at = datetime.now(timezone.utc).isoformat()
+        rows = [
+            dict(
+                results_update(result),
+                rule_id=rule["id"],
+                user_id=job["user_id"],
+                batch_id=batch_id,
+                start_date=job["start_date"],
+                end_date=job["end_date"],
+                initial_capital=capital,
+                started_at=started_at
+            )
+            for rule, result in zip(rules, results) if rule.get("id")
+        ]
+        if rows:
+            await asyncio.to_thread(lambda: self.supabase.table("rule_backtests").insert(rows).execute())
+
+        succeeded = [result for result in results if result.get("success")]
+        summary = [
+            {
+                "rule_id": rule.get("id"),
+                "name": rule.get("name"),
+                "ticker": rule["ticker"],
+                "success": bool(result.get("success")),
+                "error": result.get("error"),
+                "total_executions": result.get("total_executions"),
+                "final_capital": result.get("final_capital"),
+                "total_return": result.get("total_return"),
+                "max_drawdown": result.get("max_drawdown"),
+                "win_rate": result.get("win_rate"),
+                "data_version": result.get("data_version")
+            }
+            for rule, result in zip(rules, results)
+        ]
+        if not succeeded:
+            return {
+                "status": "FAILED",
+                "error_message": "Ninguna regla pudo simularse",
+                "failed_count": len(rules),
+                "results": summary,
+                "completed_at": completed_at
+            }
+
+        portfolio = BacktestEngine.portfolio(succeeded, capital)
+        return {
+            "status": "COMPLETED",
+            "progress": 100,
+            "progress_message": None,
+            "completed_count": len(succeeded),
+            "failed_count": len(rules) - len(succeeded),
+            "final_equity": portfolio["final_equity"],
+            "total_return": portfolio["total_return"],
+            "max_drawdown": portfolio["max_drawdown"],
+            "results": summary,
+            "portfolio_equity_curve": encode_records(portfolio["equity_curve"]),
+            "completed_at": completed_at
+        }
+
+    async def run_sweep(self, rule: Dict, start_date: str, end_date: str, initial_capital: float, **grid) -> Dict:
+        """
+        Barrido de parámetros sobre una sola descarga de velas, en el pool de procesos
+
+        Args:
+            rule: Regla base
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD)
+            initial_capital: Capital inicial de cada combinación
+            **grid: thresholds, quantities, cooldowns y objective de BacktestEngine.sweep
+
+        Returns:
+            Resultado de BacktestEngine.sweep, o {"success": False, "error": ...}
+        """
+        hist = await asyncio.to_thread(
+            BacktestEngine.load_history, rule["ticker"], start_date, end_date, [rule["rule_type"]]
+        )
+        if hist is None or hist.empty:
+            return {"success": False, "error": "No se pudieron obtener datos históricos"}
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), _sweep, rule, hist, initial_capital, grid)
+        except BrokenProcessPool:
+            if self._owns_executor:
+                self._executor_instance = None
+            raise
+
+    async def run_robustness(self, rule: Dict, start_date: str, end_date: str, initial_capital: float, **options) -> Dict:
+        """
+        Bootstrap y walk-forward de una regla repartidos en el pool de procesos
+
+        Las velas se publican una vez en memoria compartida y cada tarea del pool simula
+        un grupo de caminos o una ventana (ver backtest_robustness.run_robustness)
+
+        Args:
+            rule: Regla a analizar
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD)
+            initial_capital: Capital inicial de cada camino
+            **options: paths, block_size, folds, thresholds, anchored, objective y seed
+
+        Returns:
+            Resultado de run_robustness, o {"success": False, "error": ...}
+        """
+        hist = await asyncio.to_thread(
+            BacktestEngine.load_history, rule["ticker"], start_date, end_date, [rule["rule_type"]]
+        )
+        if hist is None or hist.empty:
+            return {"success": False, "error": "No se pudieron obtener datos históricos"}
+        try:
+            return await asyncio.to_thread(run_robustness, rule, hist, initial_capital, executor=self._executor(), **options)
+        except BrokenProcessPool:
+            if self._owns_executor:
+                self._executor_instance = None
+            raise
+
+    def heartbeat(self) -> int:
+        """Renueva updated_at de los backtests y lotes en cola o en curso en este proceso"""
+        now = datetime.now(timezone.utc).isoformat()
+        touched = 0
+        for table in ("rule_backtests", "rule_backtest_batches"):
+            ids = [backtest_id for backtest_id, owner in list(self._active.items()) if owner == table]
+            if ids:
+                self.supabase.table(table) \
+                    .update({"updated_at": now}) \
+                    .in_("id", ids) \
+                    .in_("status", ACTIVE_STATUSES) \
+                    .execute()
+                touched += len(ids)
+        return touched
+
+    async def run_recovery(
+        self,
+        interval: float = RECOVERY_INTERVAL,
+        stale_after: float = STALE_AFTER,
+        stop_event: Optional[asyncio.Event] = None
+    ):
+        """
+        Recuperación en segundo plano: primero renueva los backtests propios y después
+        falla los huérfanos, así un reinicio no deja backtests activos para siempre
+        """
+        while stop_event is None or not stop_event.is_set():
+            try:
+                await asyncio.to_thread(self.heartbeat)
+                await asyncio.to_thread(self.recover_stale, stale_after)
+            except Exception as e:
+                logger.error(f"Error recuperando backtests: {str(e)}", exc_info=True)
+            await asyncio.sleep(interval)
+
+    def recover_stale(self, stale_after: float = STALE_AFTER) -> int:
+        """
+        Marca como FAILED los backtests y lotes activos que no se actualizan hace
+        stale_after segundos (quedaron huérfanos por un reinicio)
+        """
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=stale_after)).isoformat()
+        recovered = 0
+        for table in ("rule_backtests", "rule_backtest_batches"):
+            response = self.supabase.table(table) \
+                .update({
+                    "status": "FAILED",
+                    "error_message": INTERRUPTED_ERROR,
+                    "completed_at": datetime.now(timezone.utc).isoformat()
+                }) \
+                .in_("status", ACTIVE_STATUSES) \
+                .lt("updated_at", cutoff) \
+                .execute()
+            count = len(response.data or [])
+            if count:
+                logger.warning(f"{count} filas interrumpidas de {table} marcadas como FAILED")
+            recovered += count
+        return recovered
+
+    def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._owns_executor and self._executor_instance is not None:
+            self._executor_instance.shutdown(wait=False, cancel_futures=True)
+            self._executor_instance = None
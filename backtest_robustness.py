@@ -0,0 +1,363 @@
+"""
+Análisis de robustez de los backtests
+Un backtest es un solo camino de precios. Este módulo simula la regla sobre miles de
+caminos remuestreados por bloques (bootstrap de los retornos, que conserva la
+volatilidad agrupada) y en ventanas walk-forward (se elige el umbral en un tramo y se
+prueba en el siguiente), y devuelve distribuciones de retorno, drawdown y Sharpe.
+
+La serie de precios se publica una sola vez en memoria compartida: cada tarea del pool
+de procesos recibe el nombre del segmento y una semilla, arma sus propios caminos y
+devuelve solo las métricas. Cada tarea simula todos sus caminos a la vez (matriz de
+caminos x velas), así que miles de caminos cuestan segundos
+"""
+import logging
+from concurrent.futures import Executor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+OBJECTIVES = ("total_return", "sharpe_ratio", "max_drawdown")
+METRICS = ("total_return", "max_drawdown", "sharpe_ratio")
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Celdas (caminos x velas) por tarea: acota la memoria de cada proceso hijo (unos 45 MB)
+CELLS_PER_TASK = 500_000
+
+
+def path_signals(rule_type: str, value_threshold, close: np.ndarray, high: np.ndarray, pe: np.ndarray) -> np.ndarray:
+    """
+    Señales de BacktestEngine.signals sobre matrices de caminos
+
+    Args:
+        rule_type: Tipo de regla
+        value_threshold: Umbral, o array de umbrales (una fila por umbral)
+        close: Cierres (velas, o caminos x velas)
+        high: Máximos con la misma forma que close
+        pe: P/E con la misma forma que close (NaN: la regla no se cumple)
+
+    Returns:
+        Matriz booleana (caminos o umbrales x velas)
+    """
+    if np.ndim(value_threshold):
+        value_threshold = np.asarray(value_threshold, dtype=float)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if rule_type == "price_below":
+            signals = close < value_threshold
+        elif rule_type == "price_above":
+            signals = close > value_threshold
+        elif rule_type == "max_distance":
+            # fmax acumulado ignora NaN, como cummax().ffill()
+            high_so_far = np.fmax.accumulate(high, axis=-1)
+            signals = ((close - high_so_far) / high_so_far) * 100 <= value_threshold
+        elif rule_type == "pe_below":
+            signals = pe < value_threshold
+        elif rule_type == "pe_above":
+            signals = pe > value_threshold
+        else:
+            signals = np.zeros(np.broadcast(close, value_threshold).shape, dtype=bool)
+    return np.atleast_2d(signals)
+
+
+def simulate_paths(
+    signals: np.ndarray,
+    close: np.ndarray,
+    quantity: float,
+    initial_capital: float,
+    execution_type: str = "BUY",
+    periods_per_year: float = 252
+) -> Dict[str, np.ndarray]:
+    """
+    Simula la regla en todas las filas a la vez, con las mismas compras que simulate
+
+    La equity se valúa a mercado (capital + posiciones al cierre de cada vela), así que
+    el drawdown y el Sharpe reflejan la volatilidad de las posiciones abiertas. El
+    retorno total coincide con el de simulate (las posiciones se cierran al final).
+
+    Args:
+        signals: Matriz booleana (filas x velas)
+        close: Cierres (velas, o filas x velas)
+        quantity: Cantidad por compra
+        initial_capital: Capital inicial de cada fila
+        execution_type: BUY compra; SELL y ALERT_ONLY no abren posiciones
+        periods_per_year: Velas por año para anualizar el Sharpe
+
+    Returns:
+        Dict con arrays total_return, max_drawdown, sharpe_ratio y trades (uno por fila)
+    """
+    rows, n = signals.shape
+    close = np.broadcast_to(close, signals.shape)
+    bought = np.zeros((rows, n), dtype=bool)
+    if execution_type == "BUY" and quantity > 0:
+        amount = close * quantity
+        capital = np.full(rows, float(initial_capital))
+        # Vela por vela con todas las filas en un vector (traspuestas: cada vela es contigua);
+        # solo cambian el estado las velas en que alguna fila se dispara
+        signals_by_bar = np.ascontiguousarray(signals.T)
+        amount_by_bar = np.ascontiguousarray(amount.T)
+        bought_by_bar = np.zeros((n, rows), dtype=bool)
+        for bar in np.flatnonzero(signals_by_bar.any(axis=1)):
+            buy = signals_by_bar[bar] & (capital >= amount_by_bar[bar])
+            np.subtract(capital, amount_by_bar[bar], out=capital, where=buy)
+            bought_by_bar[bar] = buy
+        bought = bought_by_bar.T
+        spent = np.cumsum(np.where(bought, amount, 0.0), axis=1)
+        shares = np.cumsum(bought, axis=1) * quantity
+        equity = initial_capital - spent + shares * close
+    else:
+        equity = np.full((rows, n), float(initial_capital))
+
+    start = np.full((rows, 1), float(initial_capital))
+    peaks = np.maximum.accumulate(np.concatenate((start, equity), axis=1), axis=1)[:, 1:]
+    returns = np.diff(np.concatenate((start, equity), axis=1), axis=1) / np.concatenate((start, equity[:, :-1]), axis=1)
+    volatility = returns.std(axis=1, ddof=1) if n > 1 else np.zeros(rows)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sharpe = np.where(volatility > 0, returns.mean(axis=1) / volatility * np.sqrt(periods_per_year), 0.0)
+    return {
+        "total_return": (equity[:, -1] - initial_capital) / initial_capital * 100,
+        "max_drawdown": ((peaks - equity) / peaks * 100).max(axis=1),
+        "sharpe_ratio": sharpe,
+        "trades": bought.sum(axis=1)
+    }
+
+
+def block_bootstrap(
+    series: np.ndarray,
+    paths: int,
+    block_size: int,
+    rng: np.random.Generator
+) -> Dict[str, np.ndarray]:
+    """
+    Caminos de precios remuestreando bloques de retornos consecutivos
+
+    Cada camino arranca en el primer cierre y encadena bloques de block_size retornos
+    logarítmicos tomados al azar; el máximo de cada vela sigue a su cierre y el P/E se
+    recalcula con el EPS publicado a esa fecha (el calendario de resultados no cambia).
+
+    Args:
+        series: Matriz (3 x velas) con Close, High y PE
+        paths: Cantidad de caminos
+        block_size: Velas por bloque
+        rng: Generador aleatorio
+
+    Returns:
+        Dict con matrices close, high y pe (caminos x velas)
+    """
+    close, high, pe = series
+    n = len(close)
+    log_close = np.log(close)
+    returns = np.diff(log_close)
+    high_gap = np.log(high / close)[1:]
+    block_size = max(1, min(block_size, len(returns)))
+    blocks = -(-len(returns) // block_size)
+    starts = rng.integers(0, len(returns) - block_size + 1, size=(paths, blocks))
+    picks = (starts[:, :, None] + np.arange(block_size)).reshape(paths, -1)[:, :len(returns)]
+
+    path_close = np.empty((paths, n))
+    path_close[:, 0] = close[0]
+    path_close[:, 1:] = close[0] * np.exp(np.cumsum(returns[picks], axis=1))
+    path_high = np.empty((paths, n))
+    path_high[:, 0] = high[0]
+    path_high[:, 1:] = path_close[:, 1:] * np.exp(high_gap[picks])
+    # EPS de los últimos 4 trimestres a cada fecha = cierre / P/E de la serie original
+    with np.errstate(invalid="ignore", divide="ignore"):
+        path_pe = path_close / (close / pe)
+    return {"close": path_close, "high": path_high, "pe": path_pe}
+
+
+def _attach(name: str, shape) -> tuple:
+    """Abre el segmento compartido desde una tarea (sin adueñarse de él)"""
+    # Los hijos (spawn) comparten el resource tracker del padre, que es quien lo borra
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+
+def _bootstrap_task(name: str, shape, rule: Dict, paths: int, block_size: int, seed, initial_capital: float, periods_per_year: float) -> Dict:
+    """Tarea del pool: caminos remuestreados de la serie compartida y sus métricas"""
+    shm, series = _attach(name, shape)
+    try:
+        sampled = block_bootstrap(series, paths, block_size, np.random.default_rng(seed))
+    finally:
+        del series
+        shm.close()
+    signals = path_signals(rule.get("rule_type"), float(rule.get("value_threshold", 0)), sampled["close"], sampled["high"], sampled["pe"])
+    return simulate_paths(
+        signals, sampled["close"], rule.get("quantity") or 0, initial_capital,
+        rule.get("execution_type", "ALERT_ONLY"), periods_per_year
+    )
+
+
+def _walk_forward_task(
+    name: str,
+    shape,
+    rule: Dict,
+    thresholds: List[float],
+    train: tuple,
+    test: tuple,
+    objective: str,
+    initial_capital: float,
+    periods_per_year: float
+) -> Dict:
+    """Tarea del pool: elige el umbral en el tramo de entrenamiento y lo prueba en el siguiente"""
+    shm, series = _attach(name, shape)
+    try:
+        close, high, pe = np.array(series)
+    finally:
+        del series
+        shm.close()
+    # Señales sobre la serie completa: el máximo de max_distance incluye las velas previas
+    signals = path_signals(rule.get("rule_type"), thresholds, close, high, pe)
+    quantity = rule.get("quantity") or 0
+    execution_type = rule.get("execution_type", "ALERT_ONLY")
+
+    fitted = simulate_paths(signals[:, train[0]:train[1]], close[train[0]:train[1]], quantity, initial_capital, execution_type, periods_per_year)
+    scores = fitted[objective]
+    best = int(np.argmin(scores) if objective == "max_drawdown" else np.argmax(scores))
+    tested = simulate_paths(signals[best:best + 1, test[0]:test[1]], close[test[0]:test[1]], quantity, initial_capital, execution_type, periods_per_year)
+    return {
+        "value_threshold": thresholds[best],
+        f"train_{objective}": float(scores[best]),
+        **{metric: float(tested[metric][0]) for metric in METRICS},
+        "trades": int(tested["trades"][0])
+    }
+
+
+def distribution(values: np.ndarray, bins: int = 20) -> Dict:
+    """Resumen de una métrica: media, desvío, percentiles e histograma"""
+    values = np.asarray(values, dtype=float)
+    counts, edges = np.histogram(values, bins=bins)
+    summary = {"mean": float(values.mean()), "std": float(values.std())}
+    summary.update({f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+    summary["histogram"] = {"edges": edges.tolist(), "counts": counts.tolist()}
+    return summary
+
+
+def bars_per_year(index: pd.Index) -> float:
+    """Velas por año de la serie (252 en acciones, 365 en cripto)"""
+    index = pd.DatetimeIndex(index)
+    years = (index[-1] - index[0]).days / 365.25 if len(index) > 1 else 0
+    return (len(index) - 1) / years if years > 0 else 252.0
+
+
+def _run(executor: Optional[Executor], fn, calls: Sequence[tuple]) -> List:
+    if executor is None:
+        return [fn(*args) for args in calls]
+    futures = [executor.submit(fn, *args) for args in calls]
+    return [future.result() for future in futures]
+
+
+def run_robustness(
+    rule: Dict,
+    hist: pd.DataFrame,
+    initial_capital: float = 10000,
+    paths: int = 2000,
+    block_size: int = 20,
+    folds: int = 5,
+    thresholds: Optional[List[float]] = None,
+    anchored: bool = True,
+    objective: str = "total_return",
+    seed: Optional[int] = None,
+    executor: Optional[Executor] = None
+) -> Dict:
+    """
+    Bootstrap por bloques y walk-forward de una regla, repartidos en el executor
+
+    Args:
+        rule: Regla (rule_type, value_threshold, execution_type, quantity)
+        hist: Velas diarias (con PE si la regla es de P/E, ver load_history)
+        initial_capital: Capital inicial de cada camino y de cada ventana
+        paths: Caminos remuestreados
+        block_size: Velas por bloque del bootstrap
+        folds: Ventanas de prueba del walk-forward
+        thresholds: Umbrales entre los que elige cada ventana (por defecto, el de la regla)
+        anchored: Si el entrenamiento arranca siempre al principio (si no, solo el tramo previo)
+        objective: Métrica para elegir el umbral (max_drawdown se minimiza)
+        seed: Semilla del bootstrap (None: al azar)
+        executor: Pool de procesos (None: corre en el proceso actual)
+
+    Returns:
+        Dict con actual (el camino real), bootstrap y walk_forward
+
+    Raises:
+        ValueError: Si objective no es uno de OBJECTIVES
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"objective debe ser uno de {', '.join(OBJECTIVES)}")
+    hist = hist.dropna(subset=["Close"])
+    n = len(hist)
+    if n < 3:
+        return {"success": False, "error": "No hay suficientes velas para el análisis"}
+    if folds < 1 or n < 2 * (folds + 1):
+        return {"success": False, "error": f"No hay suficientes velas para {folds} ventanas"}
+
+    close = hist["Close"].to_numpy(dtype=float)
+    high = hist["High"].fillna(hist["Close"]).to_numpy(dtype=float)
+    pe = hist["PE"].to_numpy(dtype=float) if "PE" in hist else np.full(n, np.nan)
+    periods = bars_per_year(hist.index)
+    quantity = rule.get("quantity") or 0
+    execution_type = rule.get("execution_type", "ALERT_ONLY")
+    thresholds = sorted(set(float(t) for t in (thresholds or [float(rule.get("value_threshold", 0))])))
+
+    actual = simulate_paths(
+        path_signals(rule.get("rule_type"), float(rule.get("value_threshold", 0)), close, high, pe),
+        close, quantity, initial_capital, execution_type, periods
+    )
+
+    per_task = max(1, CELLS_PER_TASK // n)
+    sizes = [min(per_task, paths - start) for start in range(0, paths, per_task)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    edges = np.linspace(0, n, folds + 2).astype(int)
+    windows = [((0 if anchored else edges[k]), edges[k + 1], edges[k + 1], edges[k + 2]) for k in range(folds)]
+
+    shm = SharedMemory(create=True, size=3 * n * 8)
+    try:
+        shared = np.ndarray((3, n), dtype=np.float64, buffer=shm.buf)
+        shared[:] = (close, high, pe)
+        del shared
+        shape = (3, n)
+        bootstrap = _run(executor, _bootstrap_task, [
+            (shm.name, shape, rule, size, block_size, task_seed, initial_capital, periods)
+            for size, task_seed in zip(sizes, seeds)
+        ])
+        walk_forward = _run(executor, _walk_forward_task, [
+            (shm.name, shape, rule, thresholds, (train_start, train_end), (test_start, test_end), objective, initial_capital, periods)
+            for train_start, train_end, test_start, test_end in windows
+        ])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    sampled = {metric: np.concatenate([part[metric] for part in bootstrap]) for metric in METRICS}
+    dates = hist.index.strftime("%Y-%m-%d").tolist()
+    folds_detail = [
+        dict(
+            train_start=dates[train_start], train_end=dates[train_end - 1],
+            test_start=dates[test_start], test_end=dates[test_end - 1],
+            **result
+        )
+        for (train_start, train_end, test_start, test_end), result in zip(windows, walk_forward)
+    ]
+    test_returns = np.array([fold["total_return"] for fold in folds_detail])
+    return {
+        "success": True,
+        "bars": n,
+        "actual": dict({metric: float(actual[metric][0]) for metric in METRICS}, trades=int(actual["trades"][0])),
+        "bootstrap": {
+            "paths": paths,
+            "block_size": block_size,
+            "seed": seed,
+            **{metric: distribution(sampled[metric]) for metric in METRICS},
+            "probability_of_loss": float((sampled["total_return"] < 0).mean())
+        },
+        "walk_forward": {
+            "anchored": anchored,
+            "objective": objective,
+            "thresholds": thresholds,
+            "folds": folds_detail,
+            "mean_test_return": float(test_returns.mean()),
+            "positive_folds": int((test_returns > 0).sum())
+        }
+    }
@@ -0,0 +1,138 @@
+"""
+Formato compacto de las curvas de equity y ejecuciones de los backtests
+En lugar de un array de diccionarios por día (con las claves repetidas en cada
+elemento), las series se guardan por columnas: las fechas como inicio + saltos en días
+y cada métrica como un array de números redondeados. Las filas guardadas en el formato
+anterior (listas) se leen igual
+"""
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional
+
+FORMAT = "columnar-v1"
+
+# Decimales de los valores guardados (como las columnas DECIMAL(20, 4) de rule_backtests)
+DECIMALS = 4
+
+RESOLUTIONS = ("1d", "1wk", "1mo")
+
+# Columnas de los listados: todo menos las series grandes
+BACKTEST_SUMMARY_COLUMNS = (
+    "id, rule_id, user_id, batch_id, status, progress, progress_message, start_date, end_date, "
+    "interval, initial_capital, total_executions, successful_executions, failed_executions, final_capital, "
+    "total_return, total_profit_loss, max_drawdown, win_rate, profit_factor, sharpe_ratio, "
+    "data_version, error_message, started_at, completed_at, created_at, updated_at"
+)
+
+BATCH_SUMMARY_COLUMNS = (
+    "id, user_id, source, watchlist_id, template, start_date, end_date, initial_capital, rule_count, "
+    "ticker_count, completed_count, failed_count, final_equity, total_return, max_drawdown, results, "
+    "status, progress, progress_message, error_message, started_at, completed_at, created_at, updated_at"
+)
+
+
+def _is_day(value: Any) -> bool:
+    return isinstance(value, str) and len(value) == 10 and value[4] == "-" and value[7] == "-"
+
+
+def _compact(value: Any) -> Any:
+    if isinstance(value, float):
+        rounded = round(value, DECIMALS)
+        return int(rounded) if rounded.is_integer() else rounded
+    return value
+
+
+def encode_records(records: Optional[List[Dict]], time_key: str = "date") -> Optional[Dict]:
+    """
+    Convierte una lista de diccionarios al formato por columnas
+
+    Args:
+        records: Puntos de la curva o ejecuciones (mismas claves en todos)
+        time_key: Clave de la fecha (YYYY-MM-DD), que se guarda como saltos en días
+
+    Returns:
+        Diccionario {format, start, day_steps | dates, columns} o None si no hay registros
+    """
+    if records is None:
+        return None
+    if isinstance(records, dict):
+        # Ya está codificado
+        return records
+    keys = list(dict.fromkeys(key for record in records for key in record if key != time_key))
+    encoded = {
+        "format": FORMAT,
+        "length": len(records),
+        "columns": {key: [_compact(record.get(key)) for record in records] for key in keys}
+    }
+    times = [record.get(time_key) for record in records]
+    if times and all(_is_day(value) for value in times):
+        days = [date.fromisoformat(value) for value in times]
+        encoded["start"] = times[0]
+        encoded["day_steps"] = [(b - a).days for a, b in zip(days, days[1:])]
+    else:
+        encoded["dates"] = times
+    return encoded
+
+
+def decode_records(stored: Any, time_key: str = "date") -> List[Dict]:
+    """
+    Lista de diccionarios a partir del formato por columnas (o del formato anterior)
+
+    Args:
+        stored: Valor de la columna JSONB
+        time_key: Clave con la que se devuelve la fecha
+
+    Returns:
+        Lista de diccionarios, uno por punto o ejecución
+    """
+    if not stored:
+        return []
+    if isinstance(stored, list):
+        return stored
+    if stored.get("format") != FORMAT:
+        raise ValueError(f"Formato de serie desconocido: {stored.get('format')}")
+
+    length = stored["length"]
+    if "dates" in stored:
+        times = stored["dates"]
+    else:
+        day = date.fromisoformat(stored["start"])
+        times = [day.isoformat()]
+        for step in stored["day_steps"]:
+            day += timedelta(days=step)
+            times.append(day.isoformat())
+    columns = stored["columns"]
+    return [
+        dict({time_key: times[i]}, **{key: values[i] for key, values in columns.items()})
+        for i in range(length)
+    ]
+
+
+def resample_curve(points: List[Dict], resolution: str = "1d", time_key: str = "date") -> List[Dict]:
+    """
+    Curva de equity a resolución semanal o mensual (último punto de cada período)
+
+    Args:
+        points: Puntos diarios ordenados por fecha
+        resolution: 1d, 1wk o 1mo
+
+    Returns:
+        Puntos de la resolución pedida
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution debe ser una de {', '.join(RESOLUTIONS)}")
+    if resolution == "1d":
+        return points
+
+    def period(point: Dict):
+        day = date.fromisoformat(str(point[time_key])[:10])
+        if resolution == "1wk":
+            return day.isocalendar()[:2]
+        return day.year, day.month
+
+    resampled = []
+    for point in points:
+        if resampled and period(resampled[-1]) == period(point):
+            resampled[-1] = point
+        else:
+            resampled.append(point)
+    return resampled
@@ -0,0 +1,496 @@
+"""
+Caché persistente de velas históricas para backtests
+Guarda en SQLite (modo WAL) las velas por fuente, ticker e intervalo junto con los rangos
+de fechas ya descargados: cualquier subrango se sirve desde disco y solo se piden al
+proveedor los bordes que faltan. Los datos se versionan: si el proveedor corrige
+velas ya guardadas (splits, dividendos), se abre una versión nueva y las anteriores
+quedan intactas para reproducir los backtests que las usaron
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from price_providers import (
+    BAR_COLUMNS, INTERVAL_MINUTES, DateLike, PriceProvider, earnings_frame, empty_bars, get_price_provider, period_range
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = "spool"
+
+# Intervalos cuyas velas no dependen del rango pedido (las semanales y mensuales sí)
+CACHEABLE_INTERVALS = ("1d",) + tuple(INTERVAL_MINUTES)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bar_versions (
+    source TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    tz TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (source, ticker, interval, version)
+);
+CREATE TABLE IF NOT EXISTS bar_coverage (
+    source TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    start_day TEXT NOT NULL,
+    end_day TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_bar_coverage_series ON bar_coverage(source, ticker, interval, version);
+CREATE TABLE IF NOT EXISTS bars (
+    source TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume REAL,
+    PRIMARY KEY (source, ticker, interval, version, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_bars_day ON bars(source, ticker, interval, version, day);
+CREATE TABLE IF NOT EXISTS earnings_quarters (
+    source TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    quarter TEXT NOT NULL,
+    day TEXT NOT NULL,
+    eps REAL NOT NULL,
+    PRIMARY KEY (source, ticker, quarter)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS earnings_fetches (
+    source TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (source, ticker)
+);
+"""
+
+# (source, ticker, interval, version)
+SeriesKey = Tuple[str, str, str, int]
+
+
+def version_label(key: SeriesKey) -> str:
+    """Identificador de la versión de datos que se guarda con cada backtest"""
+    source, ticker, interval, version = key
+    return f"{source}:{ticker}:{interval}:v{version}"
+
+
+def missing_ranges(coverage: List[Tuple[date, date]], start: date, end: date) -> List[Tuple[date, date]]:
+    """
+    Partes de [start, end) que no están en los rangos cubiertos
+
+    Args:
+        coverage: Rangos [inicio, fin) ya descargados, ordenados y sin solaparse
+        start: Inicio pedido (incluido)
+        end: Fin pedido (excluido)
+
+    Returns:
+        Lista de rangos [inicio, fin) a descargar
+    """
+    gaps = []
+    cursor = start
+    for cover_start, cover_end in coverage:
+        if cover_end <= cursor:
+            continue
+        if cover_start >= end:
+            break
+        if cover_start > cursor:
+            gaps.append((cursor, cover_start))
+        cursor = max(cursor, cover_end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+class BarCache:
+    """
+    Velas históricas servidas desde SQLite
+
+    Cada serie (fuente, ticker, intervalo) tiene versiones numeradas. Las velas de una
+    versión no se modifican: al completar un borde se vuelven a pedir OVERLAP_DAYS días
+    ya guardados y, si el cierre cambió, se abre una versión nueva con el rango completo.
+    Las velas del día en curso se devuelven pero no se guardan (todavía pueden cambiar).
+    """
+
+    OVERLAP_DAYS = 5
+    # Yahoo da las velas de 1m de a 8 días por pedido: los bordes intradiarios se solapan menos
+    INTRADAY_OVERLAP_DAYS = 1
+
+    def __init__(self, path: str, provider: Optional[PriceProvider] = None, earnings_ttl: float = 86400):
+        """
+        Args:
+            path: Archivo SQLite de la caché
+            provider: Proveedor de velas (por defecto, el compartido del proceso)
+            earnings_ttl: Segundos antes de volver a pedir los resultados trimestrales
+        """
+        self.path = path
+        self.provider = provider
+        self.earnings_ttl = earnings_ttl
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @classmethod
+    def from_env(cls) -> "BarCache":
+        """Crea la caché usando BAR_CACHE_PATH o RULE_WORKER_SPOOL_DIR"""
+        path = os.getenv("BAR_CACHE_PATH") or os.path.join(
+            os.getenv("RULE_WORKER_SPOOL_DIR", DEFAULT_SPOOL_DIR), "bar_cache.db"
+        )
+        return cls(path)
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            # El archivo se crea con el primer ticker cacheable
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+                # La tabla anterior guardaba el EPS por día de publicación y podía tener un
+                # trimestre dos veces: se descarta y los resultados se vuelven a pedir
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'earnings'").fetchone():
+                    conn.executescript("DROP TABLE earnings; DELETE FROM earnings_fetches;")
+            self._initialized = True
+        conn = sqlite3.connect(self.path, timeout=30)
+        # Perder las últimas escrituras tras un corte solo obliga a descargarlas de nuevo
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _provider(self) -> PriceProvider:
+        return self.provider or get_price_provider()
+
+    @staticmethod
+    def _today() -> date:
+        return datetime.now(timezone.utc).date()
+
+    # ----------------------------------------
+    # Lectura y escritura de SQLite
+    # ----------------------------------------
+
+    @staticmethod
+    def _version(conn: sqlite3.Connection, source: str, ticker: str, interval: str, version: Optional[int] = None) -> Optional[SeriesKey]:
+        if version is None:
+            row = conn.execute(
+                "SELECT MAX(version) FROM bar_versions WHERE source = ? AND ticker = ? AND interval = ?",
+                (source, ticker, interval)
+            ).fetchone()
+            if row[0] is None:
+                with conn:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO bar_versions (source, ticker, interval, version, created_at) VALUES (?, ?, ?, 1, ?)",
+                        (source, ticker, interval, time.time())
+                    )
+                return (source, ticker, interval, 1)
+            return (source, ticker, interval, row[0])
+        row = conn.execute(
+            "SELECT version FROM bar_versions WHERE source = ? AND ticker = ? AND interval = ? AND version = ?",
+            (source, ticker, interval, version)
+        ).fetchone()
+        return (source, ticker, interval, version) if row else None
+
+    @staticmethod
+    def _new_version(conn: sqlite3.Connection, key: SeriesKey) -> SeriesKey:
+        source, ticker, interval, _ = key
+        with conn:
+            version = conn.execute(
+                "SELECT MAX(version) FROM bar_versions WHERE source = ? AND ticker = ? AND interval = ?",
+                (source, ticker, interval)
+            ).fetchone()[0] + 1
+            conn.execute(
+                "INSERT INTO bar_versions (source, ticker, interval, version, created_at) VALUES (?, ?, ?, ?, ?)",
+                (source, ticker, interval, version, time.time())
+            )
+        return (source, ticker, interval, version)
+
+    @staticmethod
+    def _coverage(conn: sqlite3.Connection, key: SeriesKey) -> List[Tuple[date, date]]:
+        rows = conn.execute(
+            "SELECT start_day, end_day FROM bar_coverage WHERE source = ? AND ticker = ? AND interval = ? AND version = ? "
+            "ORDER BY start_day",
+            key
+        ).fetchall()
+        return [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in rows]
+
+    def _store(self, conn: sqlite3.Connection, key: SeriesKey, frame: pd.DataFrame, start: date, end: date):
+        """Guarda las velas de [start, end) y marca el rango como cubierto"""
+        end = min(end, self._today())
+        if end <= start:
+            return
+        frame = frame.dropna(subset=["Close"])
+        index = pd.DatetimeIndex(frame.index)
+        days = np.array([day.isoformat() for day in index.date], dtype=object)
+        keep = (days >= start.isoformat()) & (days < end.isoformat())
+        values = frame.reindex(columns=BAR_COLUMNS).to_numpy(dtype=float)[keep]
+        timestamps = index.as_unit("ns").asi8[keep]
+        rows = [
+            key + (int(ts), day) + tuple(None if np.isnan(v) else float(v) for v in row)
+            for ts, day, row in zip(timestamps, days[keep], values)
+        ]
+
+        coverage = self._coverage(conn, key) + [(start, end)]
+        coverage.sort()
+        merged = [coverage[0]]
+        for cover_start, cover_end in coverage[1:]:
+            if cover_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], cover_end))
+            else:
+                merged.append((cover_start, cover_end))
+
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO bars (source, ticker, interval, version, ts, day, open, high, low, close, volume) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if index.tz is not None:
+                conn.execute(
+                    "UPDATE bar_versions SET tz = ? WHERE source = ? AND ticker = ? AND interval = ? AND version = ?",
+                    (str(index.tz),) + key
+                )
+            conn.execute(
+                "DELETE FROM bar_coverage WHERE source = ? AND ticker = ? AND interval = ? AND version = ?", key
+            )
+            conn.executemany(
+                "INSERT INTO bar_coverage (source, ticker, interval, version, start_day, end_day) VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (cover_start.isoformat(), cover_end.isoformat()) for cover_start, cover_end in merged]
+            )
+
+    @staticmethod
+    def _revised(conn: sqlite3.Connection, key: SeriesKey, frame: pd.DataFrame) -> bool:
+        """Indica si alguna vela ya guardada cambió de cierre en la descarga nueva"""
+        frame = frame.dropna(subset=["Close"])
+        if frame.empty:
+            return False
+        fetched = pd.Series(frame["Close"].to_numpy(dtype=float), index=pd.DatetimeIndex(frame.index).as_unit("ns").asi8)
+        rows = conn.execute(
+            "SELECT ts, close FROM bars WHERE source = ? AND ticker = ? AND interval = ? AND version = ? "
+            "AND ts BETWEEN ? AND ?",
+            key + (int(fetched.index.min()), int(fetched.index.max()))
+        ).fetchall()
+        stored = pd.Series([close for _, close in rows], index=[ts for ts, _ in rows], dtype=float)
+        common = stored.index.intersection(fetched.index)
+        if common.empty:
+            return False
+        return not np.allclose(stored[common].to_numpy(), fetched[common].to_numpy(), rtol=1e-6, atol=0)
+
+    @staticmethod
+    def _read(conn: sqlite3.Connection, key: SeriesKey, start: date, end: date) -> pd.DataFrame:
+        rows = conn.execute(
+            "SELECT ts, open, high, low, close, volume FROM bars "
+            "WHERE source = ? AND ticker = ? AND interval = ? AND version = ? AND day >= ? AND day < ? ORDER BY ts",
+            key + (start.isoformat(), end.isoformat())
+        ).fetchall()
+        tz = conn.execute(
+            "SELECT tz FROM bar_versions WHERE source = ? AND ticker = ? AND interval = ? AND version = ?", key
+        ).fetchone()[0]
+        if not rows:
+            return empty_bars()
+        values = np.array(rows, dtype=float)
+        index = pd.to_datetime(values[:, 0].astype(np.int64), unit="ns", utc=True)
+        index = index.tz_convert(tz) if tz else index.tz_localize(None)
+        index.name = "Date" if key[2] == "1d" else "Datetime"
+        return pd.DataFrame(values[:, 1:], index=index, columns=BAR_COLUMNS)
+
+    # ----------------------------------------
+    # API
+    # ----------------------------------------
+
+    def get_bars(
+        self,
+        ticker: str,
+        start: DateLike = None,
+        end: DateLike = None,
+        interval: str = "1d",
+        version: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Velas de [start, end) desde la caché, descargando solo lo que falta
+
+        Args:
+            ticker: Ticker
+            start: Fecha de inicio (incluida)
+            end: Fecha de fin (excluida, como en yfinance)
+            interval: Intervalo de las velas
+            version: Versión fija de los datos (solo lee lo guardado, no descarga)
+
+        Returns:
+            DataFrame de velas; attrs["data_version"] identifica la versión usada
+        """
+        if version is not None:
+            provider = self._provider()
+            source = provider.cache_key(ticker)
+            start_day, end_day = period_range(None, start, end)
+            with closing(self._connect()) as conn:
+                key = self._version(conn, source, ticker, interval, version) if source else None
+                if key is None:
+                    raise ValueError(f"No hay versión {version} de las velas {interval} de {ticker}")
+                if missing_ranges(self._coverage(conn, key), start_day, min(end_day, self._today())):
+                    logger.warning(f"La versión {version_label(key)} no cubre {start_day} - {end_day}")
+                frame = self._read(conn, key, start_day, end_day)
+            frame.attrs["data_version"] = version_label(key)
+            return frame
+        return self.get_bars_batch([ticker], start=start, end=end, interval=interval).get(ticker, empty_bars())
+
+    def get_bars_batch(
+        self,
+        tickers: Iterable[str],
+        start: DateLike = None,
+        end: DateLike = None,
+        interval: str = "1d"
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Velas de varios tickers; los bordes que faltan se piden en lote por rango
+
+        Returns:
+            Diccionario ticker -> DataFrame (se omiten los que no tienen datos)
+        """
+        provider = self._provider()
+        tickers = list(dict.fromkeys(tickers))
+        cached = {}
+        direct = []
+        for ticker in tickers:
+            source = provider.cache_key(ticker) if interval in CACHEABLE_INTERVALS else None
+            if source:
+                cached[ticker] = source
+            else:
+                direct.append(ticker)
+
+        bars = provider.get_bars_batch(direct, start=start, end=end, interval=interval) if direct else {}
+        if not cached:
+            return bars
+
+        start_day, end_day = period_range(None, start, end)
+        keys: Dict[str, SeriesKey] = {}
+        groups: Dict[Tuple[date, date], List[str]] = {}
+        with self._lock, closing(self._connect()) as conn:
+            for ticker, source in cached.items():
+                keys[ticker] = self._version(conn, source, ticker, interval)
+                coverage = self._coverage(conn, keys[ticker])
+                for gap_start, gap_end in missing_ranges(coverage, start_day, end_day):
+                    if coverage:
+                        # Volver a pedir unos días guardados para detectar correcciones
+                        overlap = timedelta(days=self.OVERLAP_DAYS if interval == "1d" else self.INTRADAY_OVERLAP_DAYS)
+                        gap_start, gap_end = gap_start - overlap, gap_end + overlap
+                    groups.setdefault((gap_start, gap_end), []).append(ticker)
+
+        live: Dict[str, List[pd.DataFrame]] = {}
+        revised = set()
+        for (gap_start, gap_end), group in groups.items():
+            fetched = provider.get_bars_batch(group, start=gap_start.isoformat(), end=gap_end.isoformat(), interval=interval)
+            with self._lock, closing(self._connect()) as conn:
+                for ticker in group:
+                    frame = fetched.get(ticker)
+                    if frame is None or frame.empty or ticker in revised:
+                        continue
+                    if self._revised(conn, keys[ticker], frame):
+                        revised.add(ticker)
+                        continue
+                    self._store(conn, keys[ticker], frame, gap_start, gap_end)
+                    live.setdefault(ticker, []).append(frame)
+
+        for ticker in revised:
+            logger.warning(f"{ticker}: el proveedor corrigió velas ya guardadas; se abre una versión nueva")
+            frame = provider.get_bars(ticker, start=start_day.isoformat(), end=end_day.isoformat(), interval=interval)
+            with self._lock, closing(self._connect()) as conn:
+                keys[ticker] = self._new_version(conn, keys[ticker])
+                if frame is not None and not frame.empty:
+                    self._store(conn, keys[ticker], frame, start_day, end_day)
+                    live[ticker] = [frame]
+
+        today = self._today()
+        with closing(self._connect()) as conn:
+            for ticker in cached:
+                frame = self._read(conn, keys[ticker], start_day, end_day)
+                # Velas del día en curso: se devuelven pero no se guardan
+                recent = [
+                    part.reindex(columns=BAR_COLUMNS)[
+                        (pd.DatetimeIndex(part.index).date >= max(today, start_day))
+                        & (pd.DatetimeIndex(part.index).date < end_day)
+                    ]
+                    for part in live.get(ticker, [])
+                ]
+                recent = [part for part in recent if not part.empty]
+                if recent:
+                    frame = pd.concat([frame] + recent) if not frame.empty else pd.concat(recent)
+                    frame = frame[~frame.index.duplicated(keep="last")].sort_index()
+                if frame.empty:
+                    continue
+                frame.attrs["data_version"] = version_label(keys[ticker])
+                bars[ticker] = frame
+        return bars
+
+    def get_earnings(self, ticker: str) -> pd.DataFrame:
+        """
+        EPS trimestral point-in-time del ticker (se vuelve a pedir cada earnings_ttl)
+
+        Se guarda un registro por trimestre: un trimestre que el proveedor vuelve a dar
+        (quizá con otra fecha de publicación) reemplaza al anterior. Una respuesta vacía
+        no cuenta como pedido, así que se reintenta en la próxima lectura.
+
+        Raises:
+            NotImplementedError: Si el proveedor no tiene resultados para el ticker
+        """
+        provider = self._provider()
+        source = provider.cache_key(ticker)
+        if not source:
+            return provider.get_earnings(ticker)
+
+        with closing(self._connect()) as conn:
+            fetched = conn.execute(
+                "SELECT fetched_at FROM earnings_fetches WHERE source = ? AND ticker = ?", (source, ticker)
+            ).fetchone()
+        if not fetched or time.time() - fetched[0] >= self.earnings_ttl:
+            frame = provider.get_earnings(ticker)
+            if not frame.empty:
+                with self._lock, closing(self._connect()) as conn, conn:
+                    # Se suman los trimestres nuevos; los viejos que el proveedor ya no devuelve se conservan
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO earnings_quarters (source, ticker, quarter, day, eps) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (source, ticker, quarter, day.date().isoformat(), float(eps))
+                            for day, eps, quarter in zip(frame.index, frame["eps"], frame["quarter"])
+                        ]
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO earnings_fetches (source, ticker, fetched_at) VALUES (?, ?, ?)",
+                        (source, ticker, time.time())
+                    )
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT day, eps, quarter FROM earnings_quarters WHERE source = ? AND ticker = ? ORDER BY day",
+                (source, ticker)
+            ).fetchall()
+        return earnings_frame([row[1] for row in rows], [row[0] for row in rows], [row[2] for row in rows])
+
+
+_cache: Optional[BarCache] = None
+
+
+def get_bar_cache() -> BarCache:
+    """Caché compartida del proceso (se crea la primera vez desde el entorno)"""
+    global _cache
+    if _cache is None:
+        _cache = BarCache.from_env()
+    return _cache
+
+
+def set_bar_cache(cache: Optional[BarCache]):
+    """Reemplaza la caché compartida (None vuelve a leerla del entorno)"""
+    global _cache
+    _cache = cache
@@ -0,0 +1,262 @@
+"""
+Benchmark del motor de backtesting
+Corre BacktestEngine sobre series sintéticas (movimiento browniano geométrico con
+semilla fija, y EPS trimestral sintético para las reglas de P/E) de 1k, 10k y 100k
+velas, para cada tipo de regla y BUY/SELL. Reporta
+velas por segundo, pico de memoria y bloques asignados, y compara contra los valores
+de referencia guardados en bench_baselines.json. No usa la red
+
+Uso:
+    python bench_backtest.py                       # compara contra la referencia
+    python bench_backtest.py --sizes 1000,10000    # solo algunos tamaños
+    python bench_backtest.py --engine loop         # implementación día a día
+    python bench_backtest.py --engine stream       # motor por tramos
+    python bench_backtest.py --update-baseline     # guarda los resultados como referencia
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from rule_execution import BacktestEngine
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+RULE_TYPES = ("price_below", "price_above", "pe_below", "pe_above", "max_distance")
+EXECUTION_TYPES = ("BUY", "SELL")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines.json")
+
+# Una caída de throughput o una suba de memoria mayor a esto cuenta como regresión
+DEFAULT_TOLERANCE = 0.25
+
+
+def gbm_bars(n: int, seed: int = 42, drift: float = 0.0003, volatility: float = 0.02, start: str = "1700-01-01") -> pd.DataFrame:
+    """
+    Velas diarias sintéticas de un movimiento browniano geométrico
+
+    Args:
+        n: Cantidad de velas (días hábiles desde start; el índice en segundos admite
+            más de 100k velas)
+        seed: Semilla del generador
+        drift: Retorno logarítmico diario medio
+        volatility: Desvío diario de los retornos logarítmicos
+
+    Returns:
+        DataFrame con columnas Open, High, Low, Close, Volume
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((n, 3))
+    close = 100 * np.exp(np.cumsum(drift + volatility * noise[:, 0]))
+    open_ = np.concatenate(([100.0], close[:-1]))
+    high = np.maximum(open_, close) * (1 + np.abs(noise[:, 1]) * volatility / 2)
+    low = np.minimum(open_, close) * (1 - np.abs(noise[:, 2]) * volatility / 2)
+    volume = np.round(1_000_000 * np.exp(0.3 * noise[:, 1]))
+    index = pd.date_range(start, periods=n, freq="B", unit="s", name="Date")
+    return pd.DataFrame({"Open": open_, "High": high, "Low": low, "Close": close, "Volume": volume}, index=index)
+
+
+def gbm_earnings(hist: pd.DataFrame, seed: int = 42, pe: float = 15.0) -> pd.DataFrame:
+    """
+    EPS trimestral sintético para las reglas de P/E (cada 63 velas, P/E alrededor de `pe`)
+
+    Returns:
+        DataFrame con columna eps indexado por el día de publicación
+    """
+    rng = np.random.default_rng(seed + 1)
+    published = hist.index[63::63]
+    closes = hist["Close"].to_numpy()[62:-1:63][:len(published)]
+    eps = closes / (pe * np.exp(0.2 * rng.standard_normal(len(published)))) / 4
+    return pd.DataFrame({"eps": eps}, index=published)
+
+
+def bench_rule(hist: pd.DataFrame, rule_type: str) -> Dict:
+    """Regla de benchmark con un umbral que dispara en una parte de las velas"""
+    thresholds = {
+        "price_below": float(hist["Close"].median()),
+        "price_above": float(hist["Close"].median()),
+        "pe_below": 15.0,
+        "pe_above": 15.0,
+        "max_distance": -20.0
+    }
+    return {"ticker": "BENCH", "rule_type": rule_type, "value_threshold": thresholds[rule_type], "quantity": 1}
+
+
+def measure(
+    hist: pd.DataFrame,
+    rule: Dict,
+    engine: str = "vectorized",
+    repeats: int = 3,
+    initial_capital: float = 1e9,
+    earnings: Optional[pd.DataFrame] = None
+) -> Dict:
+    """
+    Mide un caso: mejor tiempo de `repeats` corridas y memoria de una corrida aparte
+
+    Args:
+        earnings: EPS trimestral; si se pasa, el P/E diario se arma dentro de la medición
+
+    Returns:
+        Dict con seconds, bars_per_second, peak_kb, blocks y executions
+    """
+    if engine == "stream":
+        def engine_simulate(rule, hist, initial_capital):
+            chunk = BacktestEngine.STREAM_CHUNK_BARS
+            chunks = (hist.iloc[i:i + chunk] for i in range(0, len(hist), chunk))
+            return BacktestEngine.simulate_stream(rule, chunks, initial_capital)
+    else:
+        engine_simulate = BacktestEngine.simulate_loop if engine == "loop" else BacktestEngine.simulate
+
+    def simulate(rule, hist, initial_capital):
+        if earnings is not None:
+            hist = BacktestEngine.attach_pe(hist, earnings)
+        return engine_simulate(rule, hist, initial_capital)
+
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        result = simulate(rule, hist, initial_capital)
+        best = min(best, time.perf_counter() - start)
+    del result
+
+    # tracemalloc frena la ejecución: la memoria se mide en una corrida separada
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = simulate(rule, hist, initial_capital)
+        _, peak = tracemalloc.get_traced_memory()
+        # Bloques que siguen vivos en el resultado (ejecuciones, curva de equity)
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "seconds": best,
+        "bars_per_second": len(hist) / best if best > 0 else float("inf"),
+        "peak_kb": peak / 1024,
+        "blocks": blocks,
+        "executions": result["total_executions"]
+    }
+
+
+def run(sizes=DEFAULT_SIZES, engine: str = "vectorized", repeats: int = 3, seed: int = 42) -> List[Dict]:
+    """Corre todos los casos (tamaño x tipo de regla x BUY/SELL)"""
+    cases = []
+    for n in sizes:
+        hist = gbm_bars(n, seed=seed)
+        earnings = gbm_earnings(hist, seed=seed)
+        for rule_type in RULE_TYPES:
+            for execution_type in EXECUTION_TYPES:
+                rule = dict(bench_rule(hist, rule_type), execution_type=execution_type)
+                case = {"case": f"{engine}/{n}/{rule_type}/{execution_type}", "bars": n}
+                pe_earnings = earnings if rule_type in BacktestEngine.PE_RULES else None
+                case.update(measure(hist, rule, engine, repeats, earnings=pe_earnings))
+                cases.append(case)
+    return cases
+
+
+def compare(cases: List[Dict], baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Regresiones contra la referencia
+
+    Returns:
+        Lista de mensajes (vacía si no hay regresiones)
+    """
+    reference = {case["case"]: case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in cases:
+        base = reference.get(case["case"])
+        if not base:
+            continue
+        if case["bars_per_second"] < base["bars_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{case['case']}: {case['bars_per_second']:,.0f} velas/s (referencia {base['bars_per_second']:,.0f})"
+            )
+        if case["peak_kb"] > base["peak_kb"] * (1 + tolerance):
+            regressions.append(f"{case['case']}: pico de {case['peak_kb']:,.0f} KB (referencia {base['peak_kb']:,.0f} KB)")
+        if case["blocks"] > base["blocks"] * (1 + tolerance):
+            regressions.append(f"{case['case']}: {case['blocks']:,} bloques (referencia {base['blocks']:,})")
+        if case["executions"] != base["executions"]:
+            regressions.append(f"{case['case']}: {case['executions']} ejecuciones (referencia {base['executions']})")
+    return regressions
+
+
+def report(cases: List[Dict], baseline: Optional[Dict] = None) -> str:
+    """Tabla de resultados, con la variación de throughput contra la referencia"""
+    reference = {case["case"]: case for case in (baseline or {}).get("cases", [])}
+    lines = [f"{'caso':<42}{'velas/s':>14}{'vs ref':>9}{'pico KB':>12}{'bloques':>10}{'ejec.':>9}"]
+    for case in cases:
+        base = reference.get(case["case"])
+        delta = f"{case['bars_per_second'] / base['bars_per_second'] - 1:+.0%}" if base else "-"
+        lines.append(
+            f"{case['case']:<42}{case['bars_per_second']:>14,.0f}{delta:>9}{case['peak_kb']:>12,.0f}"
+            f"{case['blocks']:>10,}{case['executions']:>9,}"
+        )
+    return "\n".join(lines)
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(cases: List[Dict], path: str = BASELINE_PATH):
+    """Guarda los resultados como referencia (reemplaza solo los casos medidos)"""
+    baseline = load_baseline(path)
+    merged = {case["case"]: case for case in baseline.get("cases", [])}
+    merged.update({case["case"]: case for case in cases})
+    baseline = {
+        "updated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": f"{platform.machine()} {platform.python_implementation()} {platform.python_version()}, numpy {np.__version__}, pandas {pd.__version__}",
+        "cases": [
+            dict(case, seconds=round(case["seconds"], 6), bars_per_second=round(case["bars_per_second"]), peak_kb=round(case["peak_kb"], 1))
+            for case in sorted(merged.values(), key=lambda c: (c["case"].split("/")[0], c["bars"], c["case"]))
+        ]
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark del motor de backtesting")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES), help="Cantidades de velas, separadas por coma")
+    parser.add_argument("--engine", choices=BacktestEngine.ENGINES, default="vectorized")
+    parser.add_argument("--repeats", type=int, default=3, help="Corridas por caso (se toma la más rápida)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Guardar los resultados como referencia")
+    parser.add_argument("--json", action="store_true", help="Imprimir los resultados en JSON")
+    args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in args.sizes.split(",") if n]
+    cases = run(sizes, args.engine, args.repeats, args.seed)
+    baseline = load_baseline(args.baseline)
+
+    print(json.dumps(cases, indent=2) if args.json else report(cases, baseline))
+
+    if args.update_baseline:
+        save_baseline(cases, args.baseline)
+        print(f"\nReferencia guardada en {args.baseline}")
+        return 0
+
+    regressions = compare(cases, baseline, args.tolerance)
+    if regressions:
+        print("\nRegresiones:\n  " + "\n  ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
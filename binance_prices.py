@@ -0,0 +1,147 @@
+"""
+Tabla de precios de Binance compartida por el proceso
+Todas las valuaciones de portfolio leen de una tabla con todos los precios, que se
+descarga de nuevo solo cuando alguien la lee vencida; solo los símbolos que falten se
+consultan individualmente
+"""
+import asyncio
+import logging
+import os
+import time
+import weakref
+from typing import Dict, Iterable, Optional
+
+import broker_http
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = float(os.getenv("BINANCE_PRICE_TTL", "10"))
+
+
+class BinancePriceTable:
+    """
+    Precios spot de Binance (símbolo -> precio) con TTL corto
+
+    - refresh(): una descarga completa de /api/v3/ticker/price (single-flight)
+    - get_prices(): lee de la tabla; si no se pudo cargar, consulta solo los
+      símbolos pedidos con ?symbol= y los guarda en un cache por símbolo
+    - No hay refresco en segundo plano: sin lecturas no se descarga nada, y con
+      lecturas continuas se descarga a lo sumo una vez por TTL
+    """
+
+    def __init__(self, base_url: Optional[str] = None, ttl: float = DEFAULT_TTL):
+        """
+        Args:
+            base_url: URL base de la API de Binance
+            ttl: Segundos de vigencia de los precios
+        """
+        self.base_url = base_url or os.getenv("BINANCE_BASE_URL", "https://api.binance.com")
+        self.ttl = ttl
+        self._prices: Dict[str, float] = {}
+        self._loaded_at = 0.0
+        self._symbol_cache: Dict[str, tuple] = {}  # símbolo -> (precio o None, time.monotonic)
+        self._locks = weakref.WeakKeyDictionary()  # event loop -> asyncio.Lock
+
+    def is_fresh(self) -> bool:
+        """Indica si la tabla completa está vigente"""
+        return bool(self._prices) and time.monotonic() - self._loaded_at < self.ttl
+
+    def _lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if loop not in self._locks:
+            self._locks[loop] = asyncio.Lock()
+        return self._locks[loop]
+
+    async def refresh(self) -> bool:
+        """
+        Descarga todos los precios (una sola vez aunque haya llamadas concurrentes)
+
+        Returns:
+            True si la tabla quedó vigente
+        """
+        async with self._lock():
+            if self.is_fresh():
+                return True
+            try:
+                response = await broker_http.request("GET", f"{self.base_url}/api/v3/ticker/price", timeout=10)
+                if response.status_code != 200:
+                    logger.error(f"Error obteniendo precios de Binance: {response.status_code}")
+                    return False
+                self._prices = {item["symbol"]: float(item["price"]) for item in response.json()}
+                self._loaded_at = time.monotonic()
+                return True
+            except Exception as e:
+                logger.error(f"Excepción al obtener precios de Binance: {str(e)}")
+                return False
+
+    async def _fetch_symbol(self, symbol: str) -> Optional[float]:
+        """Consulta un único símbolo (miss); guarda también los inexistentes"""
+        price = None
+        try:
+            response = await broker_http.request(
+                "GET",
+                f"{self.base_url}/api/v3/ticker/price",
+                params={"symbol": symbol},
+                timeout=10
+            )
+            if response.status_code == 200:
+                price = float(response.json()["price"])
+            elif response.status_code != 400:  # 400 = símbolo inexistente
+                logger.warning(f"Error obteniendo precio de {symbol} en Binance: {response.status_code}")
+                return None
+        except Exception as e:
+            logger.warning(f"Excepción al obtener precio de {symbol} en Binance: {str(e)}")
+            return None
+        self._symbol_cache[symbol] = (price, time.monotonic())
+        return price
+
+    async def get_prices(self, symbols: Iterable[str]) -> Dict[str, float]:
+        """
+        Obtiene precios para los símbolos indicados
+
+        Si la tabla está vencida, la primera llamada la recarga y las concurrentes
+        esperan esa misma descarga. Solo si la tabla no pudo cargarse se consultan
+        los símbolos individualmente (miss).
+
+        Args:
+            symbols: Pares de Binance (ej: "BTCUSDT")
+
+        Returns:
+            Diccionario símbolo -> precio (los símbolos inexistentes se omiten)
+        """
+        symbols = list(dict.fromkeys(symbols))
+
+        if self.is_fresh() or await self.refresh():
+            # Con la tabla vigente, un símbolo ausente no existe en Binance
+            return {symbol: self._prices[symbol] for symbol in symbols if symbol in self._prices}
+
+        result: Dict[str, float] = {}
+        misses = []
+        now = time.monotonic()
+        for symbol in symbols:
+            cached = self._symbol_cache.get(symbol)
+            if cached and now - cached[1] < self.ttl:
+                if cached[0] is not None:
+                    result[symbol] = cached[0]
+                continue
+            misses.append(symbol)
+
+        if misses:
+            prices = await asyncio.gather(*[self._fetch_symbol(symbol) for symbol in misses])
+            for symbol, price in zip(misses, prices):
+                if price is not None:
+                    result[symbol] = price
+        return result
+
+    async def get_price(self, symbol: str) -> Optional[float]:
+        return (await self.get_prices([symbol])).get(symbol)
+
+    def clear(self):
+        """Descarta la tabla y el cache por símbolo"""
+        self._prices = {}
+        self._loaded_at = 0.0
+        self._symbol_cache.clear()
+
+
+# Instancia compartida por todas las valuaciones de portfolio del proceso
+binance_price_table = BinancePriceTable()
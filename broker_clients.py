@@ -1,12 +1,13 @@
 """
 Broker API clients for IOL and Binance
 """
-import requests
 import hmac
 import hashlib
 import logging
 from datetime import datetime
 from typing import Dict, List, Optional
+import broker_http
+from binance_prices import binance_price_table
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +25,7 @@ async def get_iol_access_token(username: str, password: str) -> Optional[str]:
             "grant_type": "password"
         }
         
-        response = requests.post(url, data=payload)
+        response = await broker_http.request("POST", url, data=payload, timeout=10, idempotent=True)
         
         if response.status_code == 200:
             data = response.json()
@@ -46,7 +47,7 @@ async def get_iol_portfolio(access_token: str) -> Optional[List[Dict]]:
             "Authorization": f"Bearer {access_token}"
         }
         
-        response = requests.get(url, headers=headers)
+        response = await broker_http.request("GET", url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -97,16 +98,17 @@ async def get_binance_portfolio(api_key: str, api_secret: str) -> Optional[List[
             "X-MBX-APIKEY": api_key
         }
         
-        response = requests.get(url, headers=headers)
+        response = await broker_http.request("GET", url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
             
-            # Get current prices for all assets
-            prices_url = f"{base_url}/api/v3/ticker/price"
-            prices_response = requests.get(prices_url)
-            prices_data = prices_response.json() if prices_response.status_code == 200 else []
-            prices_dict = {item["symbol"]: float(item["price"]) for item in prices_data}
+            # Current prices from the process-wide price table (only held assets)
+            prices_dict = await binance_price_table.get_prices([
+                f"{balance.get('asset', '')}USDT"
+                for balance in data.get("balances", [])
+                if float(balance.get("free", 0)) + float(balance.get("locked", 0)) > 0
+            ])
             
             # Transform Binance data to our standard format
             portfolio = []
@@ -0,0 +1,193 @@
+"""
+Transporte HTTP asíncrono compartido para los clientes de broker (IOL y Binance)
+Un httpx.AsyncClient por event loop con pool keep-alive, límite de conexiones por
+host, timeouts explícitos y reintentos con backoff
+"""
+import asyncio
+import logging
+import os
+import random
+import weakref
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+MAX_CONNECTIONS = int(os.getenv("BROKER_HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("BROKER_HTTP_MAX_KEEPALIVE", "40"))
+PER_HOST_LIMIT = int(os.getenv("BROKER_HTTP_PER_HOST_LIMIT", "20"))
+DEFAULT_RETRIES = int(os.getenv("BROKER_HTTP_RETRIES", "2"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER = 5.0
+
+# Errores en los que el request nunca llegó al servidor: reintentar es seguro
+# incluso para órdenes (POST)
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+_host_semaphores = weakref.WeakKeyDictionary()  # event loop -> {host: asyncio.Semaphore}
+_transport: Optional[httpx.AsyncBaseTransport] = None
+_response_hooks: List[Callable[[httpx.Response], None]] = []
+
+
+def set_transport(transport: Optional[httpx.AsyncBaseTransport]):
+    """
+    Reemplaza el transporte de red (por ejemplo, un servidor falso de IOL/Binance)
+
+    Args:
+        transport: Transporte httpx a usar, o None para volver a la red real
+    """
+    global _transport
+    _transport = transport
+    _clients.clear()
+    _host_semaphores.clear()
+
+
+def add_response_hook(hook: Callable[[httpx.Response], None]):
+    """
+    Registra una función que recibe cada respuesta (por ejemplo, para leer los
+    headers de peso usado de Binance)
+    """
+    if hook not in _response_hooks:
+        _response_hooks.append(hook)
+
+
+def remove_response_hook(hook: Callable[[httpx.Response], None]):
+    if hook in _response_hooks:
+        _response_hooks.remove(hook)
+
+
+def _notify_hooks(response: httpx.Response):
+    for hook in list(_response_hooks):
+        try:
+            hook(response)
+        except Exception as e:
+            logger.warning(f"Error en hook de respuesta: {str(e)}")
+
+
+def get_client() -> httpx.AsyncClient:
+    """Cliente compartido del event loop actual (se crea en el primer uso)"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=30
+            ),
+            transport=_transport
+        )
+        _clients[loop] = client
+    return client
+
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphores: Dict[str, asyncio.Semaphore] = _host_semaphores.setdefault(loop, {})
+    host = urlsplit(url).netloc
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(PER_HOST_LIMIT)
+    return semaphores[host]
+
+
+def _backoff(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_RETRY_AFTER)
+            except ValueError:
+                pass
+    return 0.25 * (2 ** attempt) + random.uniform(0, 0.1)
+
+
+async def _send(method, url, params, data, json, headers, timeout) -> httpx.Response:
+    async with _host_semaphore(url):
+        return await get_client().request(
+            method, url, params=params, data=data, json=json, headers=headers, timeout=timeout
+        )
+
+
+async def request(
+    method: str,
+    url: str,
+    *,
+    params: Optional[Dict] = None,
+    data: Optional[Dict] = None,
+    json: Optional[Dict] = None,
+    headers: Optional[Dict] = None,
+    timeout: Optional[float] = None,
+    retries: int = DEFAULT_RETRIES,
+    idempotent: Optional[bool] = None
+) -> httpx.Response:
+    """
+    Ejecuta un request HTTP con el cliente compartido
+
+    Las operaciones idempotentes (por defecto GET) se reintentan ante errores de red,
+    429 y 5xx. Las no idempotentes (órdenes) solo se reintentan si el request no llegó
+    a enviarse, para no duplicar una orden tras un timeout de lectura.
+
+    timeout es un plazo total: cubre la espera del límite por host, todas las fases
+    de cada intento (httpx aplica su timeout a cada fase por separado) y los
+    reintentos con su backoff. Un reintento que no entra en el plazo no se hace.
+
+    Args:
+        method: Método HTTP
+        url: URL completa
+        timeout: Plazo total en segundos (por defecto 10s; connect, 5s como máximo)
+        retries: Reintentos adicionales
+        idempotent: Si el request puede repetirse sin efectos secundarios
+
+    Returns:
+        httpx.Response de la última respuesta
+
+    Raises:
+        httpx.HTTPError: Si se agotan los reintentos por errores de red
+        httpx.TimeoutException: Si se cumple el plazo total
+    """
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+    request_timeout = httpx.Timeout(timeout, connect=min(timeout, 5.0)) if timeout else DEFAULT_TIMEOUT
+    total = timeout or DEFAULT_TIMEOUT.read
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + total
+
+    attempt = 0
+    while True:
+        try:
+            response = await asyncio.wait_for(
+                _send(method, url, params, data, json, headers, request_timeout),
+                max(deadline - loop.time(), 0)
+            )
+        except asyncio.TimeoutError:
+            raise httpx.TimeoutException(f"{method} {urlsplit(url).path} superó el plazo total de {total:.0f}s")
+        except httpx.HTTPError as e:
+            retryable = isinstance(e, NOT_SENT_ERRORS) or (idempotent and isinstance(e, httpx.TransportError))
+            delay = _backoff(attempt)
+            if not retryable or attempt >= retries or loop.time() + delay >= deadline:
+                raise
+            logger.warning(f"Error de red en {method} {urlsplit(url).path} ({type(e).__name__}), reintento en {delay:.2f}s")
+        else:
+            _notify_hooks(response)
+            if not (idempotent and response.status_code in RETRY_STATUS and attempt < retries):
+                return response
+            delay = _backoff(attempt, response)
+            if loop.time() + delay >= deadline:
+                return response
+            logger.warning(f"{method} {urlsplit(url).path} respondió {response.status_code}, reintento en {delay:.2f}s")
+
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+async def aclose():
+    """Cierra el cliente del event loop actual (apagado del worker o de la API)"""
+    loop = asyncio.get_running_loop()
+    client = _clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
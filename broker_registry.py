@@ -0,0 +1,167 @@
+"""
+Registro en memoria de conexiones de broker para el worker de reglas
+Carga en bloque las conexiones usadas por las reglas del ciclo y mantiene las
+credenciales desencriptadas solo en memoria, con TTL e invalidación explícita
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ENCRYPTED_FIELDS = ("api_key_encrypted", "api_secret_encrypted", "username_encrypted", "password_encrypted")
+
+
+def decrypt_connection_credentials(connection: Dict, decrypt: Callable[[str], str]) -> Dict[str, str]:
+    """
+    Desencripta las credenciales de una conexión según el broker
+
+    Args:
+        connection: Fila de broker_connections
+        decrypt: Función de desencriptado (Fernet)
+
+    Returns:
+        Diccionario con username/password (IOL) o api_key/api_secret (BINANCE)
+    """
+    broker_name = connection.get("broker_name")
+    if broker_name == "IOL":
+        return {
+            "username": decrypt(connection.get("username_encrypted")),
+            "password": decrypt(connection.get("password_encrypted"))
+        }
+    if broker_name == "BINANCE":
+        return {
+            "api_key": decrypt(connection.get("api_key_encrypted")),
+            "api_secret": decrypt(connection.get("api_secret_encrypted"))
+        }
+    return {}
+
+
+class BrokerConnectionRegistry:
+    """
+    Cache de conexiones activas con credenciales desencriptadas
+
+    En cada ciclo refresh() hace una sola consulta por todas las conexiones que usan
+    las reglas. Las que fueron borradas o desactivadas se invalidan en ese momento;
+    las credenciales se vuelven a desencriptar solo si la fila cambió (updated_at) o
+    si venció el TTL.
+    """
+
+    def __init__(self, supabase_client, decrypt: Callable[[str], str], ttl: float = 300):
+        """
+        Args:
+            supabase_client: Cliente de Supabase (service role)
+            decrypt: Función para desencriptar credenciales
+            ttl: Segundos que se mantienen las credenciales desencriptadas
+        """
+        self.supabase = supabase_client
+        self.decrypt = decrypt
+        self.ttl = ttl
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, rules: Iterable[Dict]) -> int:
+        """
+        Carga en bloque las conexiones de las reglas indicadas
+
+        Args:
+            rules: Reglas del ciclo actual
+
+        Returns:
+            Cantidad de conexiones activas disponibles
+        """
+        connection_ids = sorted({rule.get("broker_connection_id") for rule in rules if rule.get("broker_connection_id")})
+        if not connection_ids:
+            self.evict_expired()
+            return 0
+
+        try:
+            response = self.supabase.table("broker_connections") \
+                .select("*") \
+                .in_("id", connection_ids) \
+                .execute()
+        except Exception as e:
+            logger.error(f"Error cargando conexiones de broker: {str(e)}")
+            self.evict_expired()
+            return len(self._entries)
+
+        rows = {row["id"]: row for row in (response.data or [])}
+        now = time.monotonic()
+        decrypted = 0
+
+        with self._lock:
+            for connection_id in connection_ids:
+                row = rows.get(connection_id)
+                if not row or not row.get("is_active"):
+                    if self._entries.pop(connection_id, None) is not None:
+                        logger.info(f"Conexión {connection_id} eliminada o desactivada, credenciales descartadas")
+                    continue
+
+                entry = self._entries.get(connection_id)
+                if entry and entry["updated_at"] == row.get("updated_at") and entry["expires_at"] > now:
+                    continue
+
+                try:
+                    credentials = decrypt_connection_credentials(row, self.decrypt)
+                except Exception as e:
+                    logger.error(f"Error desencriptando conexión {connection_id}: {str(e)}")
+                    self._entries.pop(connection_id, None)
+                    continue
+
+                self._entries[connection_id] = {
+                    "connection": {k: v for k, v in row.items() if k not in ENCRYPTED_FIELDS},
+                    "credentials": credentials,
+                    "updated_at": row.get("updated_at"),
+                    "expires_at": now + self.ttl
+                }
+                decrypted += 1
+
+        if decrypted:
+            logger.info(f"Desencriptadas {decrypted} conexiones de broker")
+        self.evict_expired()
+        return len(self._entries)
+
+    def get(self, connection_id: Optional[str]) -> Optional[Dict]:
+        """
+        Obtiene una conexión activa del registro
+
+        Returns:
+            Diccionario con "connection" (fila sin campos encriptados) y "credentials",
+            o None si no está cargada, venció o fue invalidada
+        """
+        if not connection_id:
+            return None
+        with self._lock:
+            entry = self._entries.get(connection_id)
+            if not entry:
+                return None
+            if entry["expires_at"] <= time.monotonic():
+                del self._entries[connection_id]
+                return None
+            return entry
+
+    def invalidate(self, connection_id: str):
+        """Descarta una conexión y sus credenciales (borrada, desactivada o rechazada por el broker)"""
+        with self._lock:
+            self._entries.pop(connection_id, None)
+
+    def invalidate_all(self):
+        with self._lock:
+            self._entries.clear()
+
+    def evict_expired(self) -> List[str]:
+        """Elimina de memoria las credenciales con TTL vencido"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [cid for cid, entry in self._entries.items() if entry["expires_at"] <= now]
+            for connection_id in expired:
+                del self._entries[connection_id]
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        # Nunca exponer credenciales en logs
+        return f"BrokerConnectionRegistry(connections={len(self._entries)}, ttl={self.ttl})"
@@ -2,19 +2,22 @@
 Módulo de conexión con Binance
 Maneja autenticación y obtención de portfolio desde la API de Binance
 """
-import requests
 import hmac
 import hashlib
 import logging
+import os
 from typing import Dict, List, Optional
 from datetime import datetime
+import httpx
+import broker_http
+from binance_prices import binance_price_table
 
 logger = logging.getLogger(__name__)
 
 class ConexionBinance:
     """Clase para manejar conexiones con Binance"""
     
-    BASE_URL = "https://api.binance.com"
+    BASE_URL = os.getenv("BINANCE_BASE_URL", "https://api.binance.com")
     
     def __init__(self, api_key: str, api_secret: str):
         """
@@ -43,23 +46,19 @@ class ConexionBinance:
             hashlib.sha256
         ).hexdigest()
     
-    def _obtener_precios(self) -> Dict[str, float]:
+    async def _obtener_precios(self, symbols: List[str]) -> Dict[str, float]:
         """
-        Obtiene los precios actuales de todos los símbolos en Binance
+        Obtiene los precios actuales de los símbolos indicados desde la tabla
+        compartida del proceso (sin descargar todos los símbolos por llamada)
+        
+        Args:
+            symbols: Pares de Binance (ej: "BTCUSDT")
         
         Returns:
             Diccionario con símbolo como clave y precio como valor
         """
         try:
-            url = f"{self.BASE_URL}/api/v3/ticker/price"
-            response = requests.get(url, timeout=10)
-            
-            if response.status_code == 200:
-                prices_data = response.json()
-                return {item["symbol"]: float(item["price"]) for item in prices_data}
-            else:
-                logger.error(f"Error obteniendo precios de Binance: {response.status_code}")
-                return {}
+            return await binance_price_table.get_prices(symbols)
         except Exception as e:
             logger.error(f"Excepción al obtener precios de Binance: {str(e)}")
             return {}
@@ -82,7 +81,7 @@ class ConexionBinance:
                 "X-MBX-APIKEY": self.api_key
             }
             
-            response = requests.get(url, headers=headers, timeout=10)
+            response = await broker_http.request("GET", url, headers=headers, timeout=10)
             
             if response.status_code == 200:
                 logger.info("Credenciales de Binance validadas exitosamente")
@@ -94,10 +93,10 @@ class ConexionBinance:
                 logger.error(f"Error validando credenciales de Binance: {response.status_code}")
                 return False
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout al validar credenciales de Binance")
             return False
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error de conexión al validar credenciales de Binance: {str(e)}")
             return False
         except Exception as e:
@@ -122,17 +121,25 @@ class ConexionBinance:
                 "X-MBX-APIKEY": self.api_key
             }
             
-            response = requests.get(url, headers=headers, timeout=10)
+            response = await broker_http.request("GET", url, headers=headers, timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
+                balances = [
+                    balance for balance in data.get("balances", [])
+                    if float(balance.get("free", 0)) + float(balance.get("locked", 0)) > 0
+                ]
                 
-                # Obtener precios actuales
-                prices_dict = self._obtener_precios()
+                # Obtener precios actuales solo de los activos con balance
+                assets = [balance.get("asset", "") for balance in balances]
+                prices_dict = await self._obtener_precios([f"{asset}USDT" for asset in assets if asset != "USDT"])
+                sin_precio = [asset for asset in assets if asset != "USDT" and f"{asset}USDT" not in prices_dict]
+                if sin_precio:
+                    prices_dict.update(await self._obtener_precios([f"{asset}BTC" for asset in sin_precio] + ["BTCUSDT"]))
                 
                 # Transformar datos de Binance a formato estándar
                 portfolio = []
-                for balance in data.get("balances", []):
+                for balance in balances:
                     free = float(balance.get("free", 0))
                     locked = float(balance.get("locked", 0))
                     total = free + locked
@@ -178,10 +185,10 @@ class ConexionBinance:
                 logger.error(f"Error obteniendo portfolio de Binance: {response.status_code} - {response.text}")
                 return None
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout al obtener portfolio de Binance")
             return None
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error de conexión al obtener portfolio de Binance: {str(e)}")
             return None
         except Exception as e:
@@ -236,7 +243,8 @@ class ConexionBinance:
                 "X-MBX-APIKEY": self.api_key
             }
             
-            response = requests.post(url, headers=headers, timeout=30)
+            # Sin reintentos tras envío: un timeout de lectura no garantiza que la orden no exista
+            response = await broker_http.request("POST", url, headers=headers, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -2,85 +2,267 @@
 Módulo de conexión con IOL (InvertirOnline)
 Maneja autenticación y obtención de portfolio desde la API de IOL
 """
-import requests
+import asyncio
+import hashlib
 import logging
-from typing import Dict, List, Optional
+import os
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, List, Optional
 from datetime import datetime
+import httpx
+import broker_http
 
 logger = logging.getLogger(__name__)
 
+class IOLTokenManager:
+    """
+    Cache de access tokens de IOL compartido por todo el proceso
+    
+    Los tokens se guardan por clave de conexión hasta poco antes de su vencimiento
+    (expires_in). Al vencer se usa el refresh token y, si este falla, el password grant.
+    Las renovaciones de una misma cuenta se serializan (single-flight): si varias
+    llamadas concurrentes necesitan token, solo una va a /token y el resto reutiliza
+    el resultado.
+    """
+    
+    def __init__(self, refresh_margin: float = 60):
+        """
+        Args:
+            refresh_margin: Segundos antes del vencimiento en que el token deja de usarse
+        """
+        self.refresh_margin = refresh_margin
+        self._tokens: Dict[str, Dict] = {}
+        self._locks = weakref.WeakKeyDictionary()  # event loop -> {clave: asyncio.Lock}
+        self._mutex = threading.Lock()
+    
+    def _lock_for(self, key: str) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._mutex:
+            locks = self._locks.setdefault(loop, {})
+            if key not in locks:
+                locks[key] = asyncio.Lock()
+            return locks[key]
+    
+    def get_cached(self, key: str) -> Optional[str]:
+        """Devuelve el access token vigente de la clave o None"""
+        with self._mutex:
+            entry = self._tokens.get(key)
+            if entry and entry["expires_at"] > time.monotonic():
+                return entry["access_token"]
+        return None
+    
+    def store(self, key: str, data: Dict, issued_at: Optional[float] = None) -> Optional[str]:
+        """
+        Guarda la respuesta de /token
+        
+        Args:
+            key: Clave de la conexión
+            data: JSON devuelto por IOL (access_token, refresh_token, expires_in)
+            issued_at: time.monotonic() del momento en que se pidió el token
+        """
+        access_token = data.get("access_token")
+        if not access_token:
+            return None
+        issued_at = issued_at if issued_at is not None else time.monotonic()
+        expires_in = float(data.get("expires_in") or 900)
+        with self._mutex:
+            self._tokens[key] = {
+                "access_token": access_token,
+                "refresh_token": data.get("refresh_token"),
+                "expires_at": issued_at + max(expires_in - self.refresh_margin, 0)
+            }
+        return access_token
+    
+    def invalidate(self, key: str, keep_refresh_token: bool = True):
+        """
+        Descarta el access token de una clave (por ejemplo, tras un 401)
+        
+        Args:
+            key: Clave de la conexión
+            keep_refresh_token: Conservar el refresh token para la próxima renovación
+        """
+        with self._mutex:
+            entry = self._tokens.get(key)
+            if not entry:
+                return
+            if keep_refresh_token and entry.get("refresh_token"):
+                entry["expires_at"] = 0
+            else:
+                del self._tokens[key]
+    
+    async def get_token(
+        self,
+        key: str,
+        password_grant: Callable[[], Awaitable[Optional[Dict]]],
+        refresh_grant: Callable[[str], Awaitable[Optional[Dict]]],
+        stale_token: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Obtiene un access token vigente, renovándolo si hace falta
+        
+        Args:
+            key: Clave de la conexión
+            password_grant: Corrutina que pide un token con usuario y contraseña
+            refresh_grant: Corrutina que pide un token con un refresh token
+            stale_token: Token rechazado por IOL que no debe reutilizarse
+        
+        Returns:
+            Access token o None si no se pudo autenticar
+        """
+        cached = self.get_cached(key)
+        if cached and cached != stale_token:
+            return cached
+        
+        async with self._lock_for(key):
+            # Otra corrutina pudo haber renovado el token mientras esperábamos
+            cached = self.get_cached(key)
+            if cached and cached != stale_token:
+                return cached
+            
+            with self._mutex:
+                entry = self._tokens.get(key)
+                refresh_token = entry.get("refresh_token") if entry else None
+            
+            data = None
+            issued_at = time.monotonic()
+            if refresh_token:
+                data = await refresh_grant(refresh_token)
+            if not data or not data.get("access_token"):
+                issued_at = time.monotonic()
+                data = await password_grant()
+            if not data or not data.get("access_token"):
+                with self._mutex:
+                    self._tokens.pop(key, None)
+                return None
+            
+            return self.store(key, data, issued_at)
+
+# Instancia compartida por todas las ConexionIOL del proceso (API y worker)
+iol_token_manager = IOLTokenManager()
+
 class ConexionIOL:
     """Clase para manejar conexiones con IOL"""
     
-    BASE_URL = "https://api.invertironline.com"
+    BASE_URL = os.getenv("IOL_BASE_URL", "https://api.invertironline.com")
     
-    def __init__(self, username: str, password: str):
+    def __init__(self, username: str, password: str, connection_id: Optional[str] = None, token_manager: Optional[IOLTokenManager] = None):
         """
         Inicializa la conexión con IOL
         
         Args:
             username: Usuario de IOL
             password: Contraseña de IOL
+            connection_id: ID de broker_connections, usado como clave del cache de tokens
+            token_manager: Cache de tokens (por defecto el compartido del proceso)
         """
         self.username = username
         self.password = password
         self.access_token: Optional[str] = None
+        self.token_manager = token_manager or iol_token_manager
+        # Sin connection_id la clave incluye la contraseña, así credenciales distintas
+        # nunca comparten un token cacheado
+        self.token_key = connection_id or hashlib.sha256(f"{username}\0{password}".encode()).hexdigest()
     
-    async def autenticar(self) -> Optional[str]:
+    async def _solicitar_token(self, payload: Dict) -> Optional[Dict]:
         """
-        Autentica con la API de IOL y obtiene el access token
+        Pide un token al endpoint /token de IOL
+        
+        Args:
+            payload: Datos del grant (password o refresh_token)
         
         Returns:
-            Access token si la autenticación fue exitosa, None en caso contrario
+            JSON de la respuesta o None si hay error
         """
+        grant_type = payload.get("grant_type")
         try:
             url = f"{self.BASE_URL}/token"
-            
-            payload = {
-                "username": self.username,
-                "password": self.password,
-                "grant_type": "password"
-            }
-            
-            response = requests.post(url, data=payload, timeout=10)
+            response = await broker_http.request("POST", url, data=payload, timeout=10, idempotent=True)
             
             if response.status_code == 200:
                 data = response.json()
-                self.access_token = data.get("access_token")
-                
-                if self.access_token:
-                    logger.info(f"Autenticación exitosa con IOL para usuario: {self.username}")
-                    return self.access_token
-                else:
-                    logger.error("IOL no retornó access_token en la respuesta")
-                    return None
+                if data.get("access_token"):
+                    return data
+                logger.error("IOL no retornó access_token en la respuesta")
+                return None
             else:
-                logger.error(f"Error autenticando con IOL: {response.status_code} - {response.text}")
+                logger.error(f"Error autenticando con IOL ({grant_type}): {response.status_code} - {response.text}")
                 return None
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout al autenticar con IOL")
             return None
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error de conexión al autenticar con IOL: {str(e)}")
             return None
         except Exception as e:
             logger.error(f"Excepción inesperada al autenticar con IOL: {str(e)}")
             return None
     
-    async def obtener_portfolio(self) -> Optional[List[Dict]]:
+    async def _password_grant(self) -> Optional[Dict]:
+        return await self._solicitar_token({
+            "username": self.username,
+            "password": self.password,
+            "grant_type": "password"
+        })
+    
+    async def _refresh_grant(self, refresh_token: str) -> Optional[Dict]:
+        return await self._solicitar_token({
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token"
+        })
+    
+    async def autenticar(self) -> Optional[str]:
+        """
+        Autentica con la API de IOL y obtiene el access token
+        
+        Siempre usa usuario y contraseña (valida credenciales); el token obtenido
+        queda en el cache compartido.
+        
+        Returns:
+            Access token si la autenticación fue exitosa, None en caso contrario
+        """
+        issued_at = time.monotonic()
+        data = await self._password_grant()
+        if not data:
+            self.access_token = None
+            return None
+        
+        self.access_token = self.token_manager.store(self.token_key, data, issued_at)
+        logger.info(f"Autenticación exitosa con IOL para usuario: {self.username}")
+        return self.access_token
+    
+    async def obtener_token(self, stale_token: Optional[str] = None) -> Optional[str]:
+        """
+        Obtiene un access token del cache compartido, renovándolo solo si venció
+        
+        Args:
+            stale_token: Token rechazado por IOL (401) que debe reemplazarse
+        
+        Returns:
+            Access token o None si no se pudo autenticar
+        """
+        if stale_token:
+            self.token_manager.invalidate(self.token_key)
+        self.access_token = await self.token_manager.get_token(
+            self.token_key,
+            self._password_grant,
+            self._refresh_grant,
+            stale_token=stale_token
+        )
+        return self.access_token
+    
+    async def obtener_portfolio(self, _reintento: bool = False) -> Optional[List[Dict]]:
         """
         Obtiene el portfolio desde IOL
         
         Returns:
             Lista de activos en formato estándar o None si hay error
         """
-        if not self.access_token:
-            # Intentar autenticar si no hay token
-            auth_success = await self.autenticar()
-            if not auth_success:
-                logger.error("No se pudo autenticar con IOL para obtener portfolio")
-                return None
+        if not await self.obtener_token():
+            logger.error("No se pudo autenticar con IOL para obtener portfolio")
+            return None
         
         try:
             url = f"{self.BASE_URL}/api/v2/portafolio/argentina"
@@ -88,7 +270,7 @@ class ConexionIOL:
                 "Authorization": f"Bearer {self.access_token}"
             }
             
-            response = requests.get(url, headers=headers, timeout=10)
+            response = await broker_http.request("GET", url, headers=headers, timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -111,13 +293,11 @@ class ConexionIOL:
                 
                 logger.info(f"Portfolio de IOL obtenido exitosamente: {len(portfolio)} activos")
                 return portfolio
-            elif response.status_code == 401:
-                # Token expirado, intentar reautenticar
-                logger.warning("Token de IOL expirado, reautenticando...")
-                auth_success = await self.autenticar()
-                if auth_success:
-                    # Reintentar obtener portfolio
-                    return await self.obtener_portfolio()
+            elif response.status_code == 401 and not _reintento:
+                # Token expirado o revocado, renovar (refresh token) y reintentar una vez
+                logger.warning("Token de IOL expirado, renovando...")
+                if await self.obtener_token(stale_token=self.access_token):
+                    return await self.obtener_portfolio(_reintento=True)
                 else:
                     logger.error("No se pudo reautenticar con IOL")
                     return None
@@ -125,10 +305,10 @@ class ConexionIOL:
                 logger.error(f"Error obteniendo portfolio de IOL: {response.status_code} - {response.text}")
                 return None
                 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("Timeout al obtener portfolio de IOL")
             return None
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error de conexión al obtener portfolio de IOL: {str(e)}")
             return None
         except Exception as e:
@@ -145,7 +325,7 @@ class ConexionIOL:
         token = await self.autenticar()
         return token is not None
     
-    async def ejecutar_orden(self, ticker: str, cantidad: float, tipo: str, precio: Optional[float] = None) -> Optional[Dict]:
+    async def ejecutar_orden(self, ticker: str, cantidad: float, tipo: str, precio: Optional[float] = None, _reintento: bool = False) -> Optional[Dict]:
         """
         Ejecuta una orden de compra o venta en IOL
         
@@ -158,11 +338,9 @@ class ConexionIOL:
         Returns:
             Diccionario con información de la orden ejecutada o None si hay error
         """
-        if not self.access_token:
-            auth_success = await self.autenticar()
-            if not auth_success:
-                logger.error("No se pudo autenticar con IOL para ejecutar orden")
-                return None
+        if not await self.obtener_token():
+            logger.error("No se pudo autenticar con IOL para ejecutar orden")
+            return None
         
         try:
             # Mapear tipo de orden
@@ -195,7 +373,8 @@ class ConexionIOL:
                 "Content-Type": "application/json"
             }
             
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
+            # Sin reintentos tras envío: un timeout de lectura no garantiza que la orden no exista
+            response = await broker_http.request("POST", url, json=payload, headers=headers, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -210,6 +389,16 @@ class ConexionIOL:
                     "status": "EXECUTED",
                     "broker_response": data
                 }
+            elif response.status_code == 401 and not _reintento:
+                # Un 401 implica que la orden no fue aceptada: renovar token y reintentar una vez
+                logger.warning("Token de IOL rechazado al ejecutar orden, renovando...")
+                if await self.obtener_token(stale_token=self.access_token):
+                    return await self.ejecutar_orden(ticker, cantidad, tipo, precio, _reintento=True)
+                return {
+                    "success": False,
+                    "error": "No se pudo reautenticar con IOL",
+                    "status": "FAILED"
+                }
             else:
                 logger.error(f"Error ejecutando orden en IOL: {response.status_code} - {response.text}")
                 return {
@@ -254,8 +443,7 @@ async def get_iol_access_token(username: str, password: str) -> Optional[str]:
         Access token o None si hay error
     """
     conexion = ConexionIOL(username, password)
-    success = await conexion.autenticar()
-    return conexion.access_token if success else None
+    return await conexion.obtener_token()
 
 async def get_iol_portfolio(access_token: str) -> Optional[List[Dict]]:
     """
@@ -270,7 +458,7 @@ async def get_iol_portfolio(access_token: str) -> Optional[List[Dict]]:
     # Nota: Esta función requiere token, pero la clase maneja autenticación automática
     # Por compatibilidad, creamos una conexión temporal
     # En producción, se recomienda usar la clase ConexionIOL directamente
-    conexion = ConexionIOL("", "")
-    conexion.access_token = access_token
+    conexion = ConexionIOL("", "", connection_id=f"token:{hashlib.sha256(access_token.encode()).hexdigest()}")
+    conexion.token_manager.store(conexion.token_key, {"access_token": access_token})
     return await conexion.obtener_portfolio()
 
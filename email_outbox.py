@@ -0,0 +1,398 @@
+"""
+Outbox durable de emails con envío en segundo plano
+Los handlers de la API y el worker solo encolan (SQLite local en modo WAL); un sender
+en segundo plano envía en lote con un único cliente de Brevo, con reintentos, backoff
+y respetando los límites de la API
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+
+from sib_api_v3_sdk import ApiClient, Configuration, TransactionalEmailsApi
+from sib_api_v3_sdk.rest import ApiException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SENDER_NAME = "BullAnalytics"
+DEFAULT_SENDER_EMAIL = "noreply@aperturaia.com"
+MAX_BACKOFF = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_email TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    html_content TEXT NOT NULL,
+    sender_name TEXT NOT NULL,
+    sender_email TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_until REAL,
+    message_id TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at);
+"""
+
+
+class BrevoClient:
+    """
+    Cliente de Brevo compartido por el proceso
+
+    Un solo ApiClient (pool de conexiones urllib3) para todos los envíos. Varios
+    mensajes del mismo remitente se envían en una llamada con messageVersions.
+    """
+
+    def __init__(self, api_key: str, pool_size: int = 10):
+        """
+        Args:
+            api_key: API key de Brevo
+            pool_size: Conexiones HTTP reutilizables
+        """
+        configuration = Configuration()
+        configuration.api_key['api-key'] = api_key
+        configuration.connection_pool_maxsize = pool_size
+        self.api = TransactionalEmailsApi(ApiClient(configuration))
+
+    def send(self, sender: Dict[str, str], messages: List[Dict]) -> List[Optional[str]]:
+        """
+        Envía uno o varios mensajes en una sola llamada
+
+        Args:
+            sender: {"name", "email"}
+            messages: Lista de {to_email, subject, html_content}
+
+        Returns:
+            message_id de Brevo por mensaje (en el mismo orden)
+
+        Raises:
+            ApiException: Si Brevo rechaza la llamada
+        """
+        first = messages[0]
+        payload = {
+            'sender': sender,
+            'subject': first["subject"],
+            'htmlContent': first["html_content"]
+        }
+        if len(messages) == 1:
+            payload['to'] = [{'email': first["to_email"]}]
+        else:
+            payload['messageVersions'] = [
+                {
+                    'to': [{'email': message["to_email"]}],
+                    'subject': message["subject"],
+                    'htmlContent': message["html_content"]
+                }
+                for message in messages
+            ]
+
+        response = self.api.send_transac_email(payload)
+        message_ids = getattr(response, "message_ids", None) or [getattr(response, "message_id", None)]
+        return (list(message_ids) + [None] * len(messages))[:len(messages)]
+
+
+def _retry_after(error: ApiException) -> Optional[float]:
+    """Segundos hasta que Brevo vuelve a aceptar requests (429)"""
+    headers = {k.lower(): v for k, v in dict(error.headers or {}).items()}
+    for header in ("x-sib-ratelimit-reset", "retry-after"):
+        if header in headers:
+            try:
+                return float(headers[header])
+            except ValueError:
+                pass
+    return None
+
+
+class _RateLimited(Exception):
+    """Brevo respondió 429: no se envía nada más hasta su reset"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class EmailOutbox:
+    """
+    Cola durable de emails
+
+    enqueue() solo escribe una fila en SQLite y vuelve. run() reclama los mensajes
+    vencidos (con un lease, por si varios procesos comparten el archivo), los agrupa
+    por remitente y los envía en lotes respetando rate_per_second. Un error 429 pausa
+    el envío hasta el reset informado por Brevo y devuelve a pending todo lo reclamado
+    sin enviar (no se espera con mensajes reservados: la reserva vencería y otro
+    proceso podría enviarlos también); un error 4xx es definitivo; el resto se
+    reintenta con backoff exponencial hasta max_attempts.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        client: Optional[BrevoClient] = None,
+        batch_size: int = 50,
+        rate_per_second: float = 5.0,
+        max_attempts: int = 8,
+        base_backoff: float = 30,
+        poll_interval: float = 1.0,
+        claim_ttl: float = 120
+    ):
+        """
+        Args:
+            path: Archivo SQLite del outbox
+            client: Cliente de Brevo (None: solo encola, no envía)
+            batch_size: Mensajes máximos por llamada a Brevo
+            rate_per_second: Llamadas máximas por segundo a Brevo
+            max_attempts: Intentos antes de marcar un email como fallido
+            base_backoff: Segundos de espera tras el primer fallo
+            poll_interval: Segundos entre revisiones del outbox vacío
+            claim_ttl: Segundos que un lote reclamado queda reservado para este proceso
+        """
+        self.path = path
+        self.client = client
+        self.batch_size = batch_size
+        self.rate_per_second = rate_per_second
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.poll_interval = poll_interval
+        self.claim_ttl = claim_ttl
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls, api_key: Optional[str] = None) -> "EmailOutbox":
+        """Crea el outbox usando EMAIL_OUTBOX_PATH, EMAIL_BATCH_SIZE, BREVO_RATE_LIMIT y EMAIL_MAX_ATTEMPTS"""
+        api_key = api_key or os.getenv("BREVO_API_KEY")
+        path = os.getenv("EMAIL_OUTBOX_PATH") or os.path.join(
+            os.getenv("RULE_WORKER_SPOOL_DIR", "spool"), "email_outbox.db"
+        )
+        return cls(
+            path,
+            client=BrevoClient(api_key) if api_key else None,
+            batch_size=int(os.getenv("EMAIL_BATCH_SIZE", "50")),
+            rate_per_second=float(os.getenv("BREVO_RATE_LIMIT", "5")),
+            max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS", "8"))
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def enqueue(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        sender_name: str = DEFAULT_SENDER_NAME,
+        sender_email: str = DEFAULT_SENDER_EMAIL
+    ) -> int:
+        """
+        Encola un email
+
+        Returns:
+            Id del mensaje en el outbox
+        """
+        return self.enqueue_many([{
+            "to_email": to_email,
+            "subject": subject,
+            "html_content": html_content,
+            "sender_name": sender_name,
+            "sender_email": sender_email
+        }])[0]
+
+    def enqueue_many(self, messages: List[Dict]) -> List[int]:
+        """Encola varios emails en una sola transacción"""
+        now = time.time()
+        ids = []
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for message in messages:
+                cursor = conn.execute(
+                    "INSERT INTO email_outbox (to_email, subject, html_content, sender_name, sender_email, "
+                    "next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        message["to_email"],
+                        message["subject"],
+                        message["html_content"],
+                        message.get("sender_name") or DEFAULT_SENDER_NAME,
+                        message.get("sender_email") or DEFAULT_SENDER_EMAIL,
+                        now,
+                        now
+                    )
+                )
+                ids.append(cursor.lastrowid)
+            conn.execute("COMMIT")
+        return ids
+
+    def claim_due(self, limit: int, now: Optional[float] = None) -> List[Dict]:
+        """Reserva hasta limit mensajes listos para enviar"""
+        now = time.time() if now is None else now
+        with self._lock, closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM email_outbox "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "   OR (status = 'sending' AND claimed_until < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE email_outbox SET status = 'sending', claimed_until = ? WHERE id = ?",
+                    [(now + self.claim_ttl, row["id"]) for row in rows]
+                )
+            conn.execute("COMMIT")
+        return [dict(row) for row in rows]
+
+    def _mark_sent(self, rows: List[Dict], message_ids: List[Optional[str]]):
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE email_outbox SET status = 'sent', sent_at = ?, message_id = ?, "
+                "attempts = attempts + 1, claimed_until = NULL WHERE id = ?",
+                [(now, message_id, row["id"]) for row, message_id in zip(rows, message_ids)]
+            )
+
+    def _mark_failed(self, rows: List[Dict], error: str, permanent: bool = False, retry_after: Optional[float] = None):
+        now = time.time()
+        updates = []
+        for row in rows:
+            attempts = row["attempts"] + 1
+            if permanent or attempts >= self.max_attempts:
+                updates.append(("failed", attempts, now, error, row["id"]))
+                logger.error(f"Email {row['id']} a {row['to_email']} descartado tras {attempts} intentos: {error}")
+            else:
+                delay = retry_after if retry_after is not None else min(self.base_backoff * 2 ** (attempts - 1), MAX_BACKOFF)
+                updates.append(("pending", attempts, now + delay, error, row["id"]))
+        with self._lock, closing(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+                "claimed_until = NULL WHERE id = ?",
+                updates
+            )
+
+    def _release(self, rows: List[Dict], next_attempt_at: float):
+        """Devuelve a pending los mensajes reclamados que no se llegaron a enviar"""
+        with self._lock, closing(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE email_outbox SET status = 'pending', next_attempt_at = ?, claimed_until = NULL "
+                "WHERE id = ? AND status = 'sending'",
+                [(next_attempt_at, row["id"]) for row in rows]
+            )
+
+    async def _throttle(self):
+        """Espaciado entre llamadas a Brevo (rate_per_second)"""
+        now = time.monotonic()
+        wait = self._next_slot - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._next_slot = max(time.monotonic(), self._next_slot) + 1 / self.rate_per_second
+
+    async def _send_group(self, sender: Tuple[str, str], rows: List[Dict]) -> int:
+        await self._throttle()
+        try:
+            message_ids = await asyncio.to_thread(
+                self.client.send,
+                {"name": sender[0], "email": sender[1]},
+                rows
+            )
+        except ApiException as e:
+            status = e.status or 0
+            if status == 429:
+                retry_after = _retry_after(e) or 60
+                self._paused_until = time.monotonic() + retry_after
+                logger.warning(f"Límite de Brevo alcanzado, envío pausado {retry_after:.0f}s")
+                self._mark_failed(rows, f"429 {e.reason}", retry_after=retry_after)
+                raise _RateLimited(retry_after)
+            else:
+                # 4xx: el mensaje es inválido y reintentar no lo arregla (salvo 401/403 de configuración)
+                permanent = 400 <= status < 500 and status not in (401, 403)
+                if permanent and len(rows) > 1:
+                    # Un solo destinatario inválido rechaza toda la llamada: se parte el lote
+                    # en mitades hasta aislarlo y solo ese mensaje queda descartado
+                    half = len(rows) // 2
+                    logger.warning(f"Brevo rechazó un lote de {len(rows)} emails ({status}), se reenvía en mitades")
+                    return await self._send_group(sender, rows[:half]) + await self._send_group(sender, rows[half:])
+                self._mark_failed(rows, f"{status} {e.reason}", permanent=permanent)
+            return 0
+        except Exception as e:
+            logger.error(f"Error inesperado enviando {len(rows)} emails: {str(e)}")
+            self._mark_failed(rows, str(e))
+            return 0
+
+        self._mark_sent(rows, message_ids)
+        logger.info(f"✅ {len(rows)} emails enviados en una llamada a Brevo")
+        return len(rows)
+
+    async def send_due(self) -> int:
+        """
+        Envía los mensajes vencidos (un lote de hasta batch_size por remitente)
+
+        Returns:
+            Cantidad de emails enviados
+        """
+        if self.client is None or time.monotonic() < self._paused_until:
+            return 0
+        rows = self.claim_due(self.batch_size * 4)
+        if not rows:
+            return 0
+
+        groups: Dict[Tuple[str, str], List[Dict]] = {}
+        for row in rows:
+            groups.setdefault((row["sender_name"], row["sender_email"]), []).append(row)
+
+        sent = 0
+        try:
+            for sender, group in groups.items():
+                for start in range(0, len(group), self.batch_size):
+                    sent += await self._send_group(sender, group[start:start + self.batch_size])
+        except _RateLimited as e:
+            # Los lotes que no llegaron a salir vuelven a la cola hasta el reset de Brevo
+            self._release(rows, time.time() + e.retry_after)
+        return sent
+
+    def stats(self) -> Dict[str, int]:
+        """Cantidad de mensajes por estado"""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+
+    def purge_sent(self, older_than: float = 7 * 86400) -> int:
+        """Elimina los mensajes enviados hace más de older_than segundos"""
+        with self._lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < ?",
+                (time.time() - older_than,)
+            )
+            return cursor.rowcount
+
+    async def run(self, stop_event: Optional[asyncio.Event] = None):
+        """Sender en segundo plano: envía mientras haya mensajes y espera si no"""
+        if self.client is None:
+            logger.error("BREVO_API_KEY no configurada, el outbox de emails no enviará mensajes")
+            return
+        last_purge = 0.0
+        while stop_event is None or not stop_event.is_set():
+            try:
+                sent = await self.send_due()
+                if time.monotonic() - last_purge > 3600:
+                    await asyncio.to_thread(self.purge_sent)
+                    last_purge = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error en el sender de emails: {str(e)}", exc_info=True)
+                sent = 0
+            if not sent:
+                await asyncio.sleep(self.poll_interval)
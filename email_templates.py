@@ -4,7 +4,7 @@ Templates HTML para diferentes tipos de correos electrónicos
 """
 
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 
 def get_onboarding_email_template(user_name: str, user_email: str) -> Dict[str, str]:
@@ -160,6 +160,15 @@ def get_onboarding_email_template(user_name: str, user_email: str) -> Dict[str,
     }
 
 
+def _alert_style(rule_type: str, alert_message: str) -> Tuple[str, str, str]:
+    """Emoji, color y verbo según el tipo de alerta"""
+    if "below" in rule_type or "bajo" in alert_message.lower():
+        return "📉", "#dc3545", "bajó"  # Rojo
+    if "above" in rule_type or "encima" in alert_message.lower():
+        return "📈", "#28a745", "subió"  # Verde
+    return "🔔", "#ffc107", "cambió"  # Amarillo
+
+
 def get_alert_email_template(
     rule_name: str,
     ticker: str,
@@ -182,19 +191,7 @@ def get_alert_email_template(
     Returns:
         Dict con 'subject' y 'html_content'
     """
-    # Determinar emoji y color según tipo de alerta
-    if "below" in rule_type or "bajo" in alert_message.lower():
-        emoji = "📉"
-        color = "#dc3545"  # Rojo
-        trend = "bajó"
-    elif "above" in rule_type or "encima" in alert_message.lower():
-        emoji = "📈"
-        color = "#28a745"  # Verde
-        trend = "subió"
-    else:
-        emoji = "🔔"
-        color = "#ffc107"  # Amarillo
-        trend = "cambió"
+    emoji, color, trend = _alert_style(rule_type, alert_message)
     
     subject = f"{emoji} Alerta: {ticker} - {alert_message}"
     
@@ -340,6 +337,147 @@ def get_alert_email_template(
     }
 
 
+def get_alert_digest_email_template(alerts: List[Dict]) -> Dict[str, str]:
+    """
+    Template de email con varias alertas en un solo mensaje (resumen)
+    
+    Args:
+        alerts: Lista de alertas, cada una con las claves de get_alert_email_template
+            (rule_name, ticker, alert_message, current_price, threshold, rule_type)
+    
+    Returns:
+        Dict con 'subject' y 'html_content'
+    """
+    tickers = list(dict.fromkeys(alert["ticker"] for alert in alerts))
+    shown = ", ".join(tickers[:3])
+    if len(tickers) > 3:
+        shown += f" y {len(tickers) - 3} más"
+    subject = f"🔔 {len(alerts)} alertas: {shown}"
+    
+    rows = []
+    for alert in alerts:
+        emoji, color, _ = _alert_style(alert["rule_type"], alert["alert_message"])
+        rows.append(f"""
+                    <tr>
+                        <td><strong>{alert["ticker"]}</strong></td>
+                        <td style="color: {color};">{emoji} {alert["alert_message"]}<br><small>"{alert["rule_name"]}"</small></td>
+                        <td class="number">${alert["current_price"]:,.2f}</td>
+                        <td class="number">${alert["threshold"]:,.2f}</td>
+                    </tr>""")
+    
+    html_content = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <style>
+            body {{
+                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                line-height: 1.6;
+                color: #333;
+                max-width: 600px;
+                margin: 0 auto;
+                padding: 20px;
+                background-color: #f4f4f4;
+            }}
+            .container {{
+                background: white;
+                border-radius: 10px;
+                overflow: hidden;
+                box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+            }}
+            .header {{
+                background: linear-gradient(135deg, #ffc107 0%, #ffc107dd 100%);
+                color: white;
+                padding: 30px;
+                text-align: center;
+            }}
+            .header h1 {{
+                margin: 0;
+                font-size: 24px;
+            }}
+            .content {{
+                padding: 30px;
+            }}
+            table {{
+                width: 100%;
+                border-collapse: collapse;
+                margin: 20px 0;
+            }}
+            th {{
+                background: #f8f9fa;
+                color: #666;
+                font-size: 12px;
+                text-transform: uppercase;
+                text-align: left;
+                padding: 10px;
+            }}
+            td {{
+                border-bottom: 1px solid #eee;
+                padding: 10px;
+                vertical-align: top;
+            }}
+            td.number {{
+                text-align: right;
+                white-space: nowrap;
+            }}
+            .button {{
+                display: inline-block;
+                padding: 12px 30px;
+                background: #ffc107;
+                color: white;
+                text-decoration: none;
+                border-radius: 5px;
+                margin: 20px 0;
+                font-weight: bold;
+            }}
+            .footer {{
+                background: #f8f9fa;
+                padding: 20px 30px;
+                text-align: center;
+                color: #666;
+                font-size: 12px;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>🔔 {len(alerts)} alertas de BullAnalytics</h1>
+            </div>
+            <div class="content">
+                <p>Se activaron <strong>{len(alerts)}</strong> de tus reglas en los últimos minutos.</p>
+                
+                <table>
+                    <tr>
+                        <th>Activo</th>
+                        <th>Alerta</th>
+                        <th style="text-align: right;">Precio</th>
+                        <th style="text-align: right;">Umbral</th>
+                    </tr>{"".join(rows)}
+                </table>
+                
+                <div style="text-align: center;">
+                    <a href="https://bullanalytics.io/dashboard.html" class="button">Ver Dashboard</a>
+                    <a href="https://bullanalytics.io/rules.html" class="button" style="background: #6c757d; margin-left: 10px;">Gestionar Alertas</a>
+                </div>
+            </div>
+            <div class="footer">
+                <p>Este es un correo automático de BullAnalytics.</p>
+                <p>Puedes gestionar tus alertas en tu panel de control.</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    
+    return {
+        "subject": subject,
+        "html_content": html_content
+    }
+
+
 def get_password_reset_email_template(reset_link: str, user_name: str) -> Dict[str, str]:
     """
     Template de email para restablecimiento de contraseña
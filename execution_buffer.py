@@ -0,0 +1,225 @@
+"""
+Persistencia en lote de ejecuciones de reglas (write-behind)
+Acumula los registros de rule_executions, los guarda en un spool local para no
+perderlos ante una caída y los envía a Supabase en una sola llamada por lote
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = "spool"
+
+
+def persist_executions(supabase_client, executions: List[Dict]) -> List[Dict]:
+    """
+    Inserta ejecuciones y actualiza rules.last_execution_at en un solo round-trip
+
+    Args:
+        supabase_client: Cliente de Supabase
+        executions: Registros de rule_executions (con id generado en el cliente)
+
+    Returns:
+        Filas insertadas (las ya existentes se omiten)
+    """
+    if not executions:
+        return []
+    response = supabase_client.rpc("record_rule_executions", {"p_executions": executions}).execute()
+    return response.data or []
+
+
+class ExecutionWriteBuffer:
+    """
+    Buffer write-behind para rule_executions
+
+    Cada registro recibe un id en el cliente y se agrega al spool (JSONL con fsync)
+    antes de quedar pendiente. Un flush envía todo lo pendiente con
+    persist_executions y reescribe el spool con lo que quede. Si el proceso se cae
+    después de que Supabase aceptó el lote pero antes de limpiar el spool, el
+    reintento es idempotente porque la inserción ignora ids repetidos.
+    """
+
+    def __init__(
+        self,
+        supabase_client,
+        spool_path: Optional[str] = None,
+        max_batch: int = 500,
+        max_latency: float = 2.0,
+        fsync: bool = True,
+    ):
+        """
+        Args:
+            supabase_client: Cliente de Supabase
+            spool_path: Archivo JSONL de respaldo local (None desactiva el spool)
+            max_batch: Cantidad de registros pendientes que fuerza un flush
+            max_latency: Segundos máximos que un registro puede esperar antes de enviarse
+            fsync: Forzar escritura a disco en cada registro
+        """
+        self.supabase = supabase_client
+        self.spool_path = spool_path
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.fsync = fsync
+        self._pending: List[Dict] = []
+        self._oldest_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        if self.spool_path:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            self._recover()
+
+    @classmethod
+    def from_env(cls, supabase_client, name: str = "rule_executions") -> "ExecutionWriteBuffer":
+        """Crea el buffer usando RULE_WORKER_SPOOL_DIR, EXECUTION_FLUSH_BATCH y EXECUTION_FLUSH_LATENCY"""
+        spool_dir = os.getenv("RULE_WORKER_SPOOL_DIR", DEFAULT_SPOOL_DIR)
+        return cls(
+            supabase_client,
+            spool_path=os.path.join(spool_dir, f"{name}.jsonl"),
+            max_batch=int(os.getenv("EXECUTION_FLUSH_BATCH", "500")),
+            max_latency=float(os.getenv("EXECUTION_FLUSH_LATENCY", "2")),
+        )
+
+    def _recover(self):
+        """Carga los registros que quedaron en el spool de una ejecución anterior"""
+        if not os.path.exists(self.spool_path):
+            return
+        recovered = []
+        with open(self.spool_path, "r", encoding="utf-8") as spool:
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    recovered.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Última línea truncada por una caída durante la escritura
+                    logger.warning("Línea inválida en el spool de ejecuciones, se descarta")
+        if recovered:
+            self._pending = recovered
+            self._oldest_at = time.monotonic()
+            logger.info(f"Recuperadas {len(recovered)} ejecuciones pendientes del spool")
+
+    def _append_to_spool(self, record: Dict):
+        with open(self.spool_path, "a", encoding="utf-8") as spool:
+            spool.write(json.dumps(record, default=str) + "\n")
+            spool.flush()
+            if self.fsync:
+                os.fsync(spool.fileno())
+
+    def _rewrite_spool(self, records: List[Dict]):
+        tmp_path = f"{self.spool_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as spool:
+            for record in records:
+                spool.write(json.dumps(record, default=str) + "\n")
+            spool.flush()
+            if self.fsync:
+                os.fsync(spool.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+    def add(self, execution: Dict) -> Dict:
+        """
+        Agrega un registro de ejecución al buffer
+
+        Args:
+            execution: Registro de rule_executions
+
+        Returns:
+            El registro con su id asignado
+        """
+        record = dict(execution)
+        record.setdefault("id", str(uuid.uuid4()))
+
+        with self._lock:
+            if self.spool_path:
+                self._append_to_spool(record)
+            self._pending.append(record)
+            if self._oldest_at is None:
+                self._oldest_at = time.monotonic()
+
+        if self.should_flush():
+            self.flush()
+        return record
+
+    def should_flush(self) -> bool:
+        """Indica si se alcanzó el tamaño de lote o la latencia máxima"""
+        with self._lock:
+            if not self._pending:
+                return False
+            if len(self._pending) >= self.max_batch:
+                return True
+            return time.monotonic() - self._oldest_at >= self.max_latency
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def pending_last_execution(self) -> Dict[str, str]:
+        """Último triggered_at pendiente de persistir por rule_id"""
+        latest: Dict[str, str] = {}
+        with self._lock:
+            for record in self._pending:
+                rule_id = record.get("rule_id")
+                triggered_at = record.get("executed_at") or record.get("triggered_at")
+                if rule_id and triggered_at and triggered_at > latest.get(rule_id, ""):
+                    latest[rule_id] = triggered_at
+        return latest
+
+    def apply_pending(self, rules: List[Dict]) -> List[Dict]:
+        """
+        Superpone en las reglas el last_execution_at aún no persistido
+
+        Evita que una regla vuelva a dispararse dentro del cooldown mientras su
+        ejecución anterior sigue en el buffer.
+        """
+        latest = self.pending_last_execution()
+        if not latest:
+            return rules
+        for rule in rules:
+            pending_at = latest.get(rule.get("id"))
+            if pending_at and pending_at > (rule.get("last_execution_at") or ""):
+                rule["last_execution_at"] = pending_at
+        return rules
+
+    def flush(self) -> int:
+        """
+        Envía todos los registros pendientes en una sola llamada
+
+        Returns:
+            Cantidad de registros enviados (0 si no había o si falló)
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+                self._oldest_at = None
+            if not batch:
+                return 0
+
+            try:
+                persist_executions(self.supabase, batch)
+            except Exception as e:
+                logger.error(f"Error persistiendo {len(batch)} ejecuciones, se reintentará: {str(e)}")
+                with self._lock:
+                    self._pending = batch + self._pending
+                    self._oldest_at = time.monotonic()
+                return 0
+
+            if self.spool_path:
+                with self._lock:
+                    self._rewrite_spool(self._pending)
+            logger.info(f"Persistidas {len(batch)} ejecuciones en lote")
+            return len(batch)
+
+    async def run(self, stop_event: Optional[asyncio.Event] = None):
+        """Flush periódico en segundo plano para acotar la latencia de escritura"""
+        while stop_event is None or not stop_event.is_set():
+            await asyncio.sleep(self.max_latency)
+            if self.should_flush():
+                await asyncio.to_thread(self.flush)
@@ -666,6 +666,30 @@ async function openBacktestModal(ruleId) {
     }
 }
 
+// Tiempo máximo de espera: el servidor falla los backtests huérfanos a los 30 minutos
+const BACKTEST_POLL_TIMEOUT_MS = 40 * 60 * 1000;
+
+// Consulta el backtest encolado hasta que termina, mostrando el progreso
+async function waitForBacktest(backtestId, token, resultsDiv) {
+    const deadline = Date.now() + BACKTEST_POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+        const response = await fetch(`${getApiBaseUrl()}/backtests/${backtestId}`, {
+            headers: { 'Authorization': `Bearer ${token}` }
+        });
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.detail || 'Error al consultar el backtest');
+        }
+        const backtest = await response.json();
+        if (backtest.status === 'COMPLETED' || backtest.status === 'FAILED' || backtest.status === 'CANCELLED') {
+            return backtest;
+        }
+        resultsDiv.innerHTML = `<div class="text-center py-8"><div class="animate-spin rounded-full h-12 w-12 border-b-2 border-green-500 mx-auto"></div><p class="mt-4 text-gray-600 dark:text-gray-400">${backtest.progress_message || 'Ejecutando backtest...'} (${backtest.progress || 0}%)</p></div>`;
+        await new Promise(resolve => setTimeout(resolve, 1500));
+    }
+    throw new Error('El backtest sigue en curso; revisá el historial de backtests más tarde');
+}
+
 async function runBacktest() {
     const modal = document.getElementById('backtestModal');
     const ruleId = modal.getAttribute('data-rule-id');
@@ -705,10 +729,10 @@ async function runBacktest() {
             throw new Error(error.detail || 'Error al ejecutar backtest');
         }
         
-        const result = await response.json();
+        const queued = await response.json();
+        const r = await waitForBacktest(queued.backtest_id, token, resultsDiv);
         
-        if (result.success && result.results) {
-            const r = result.results;
+        if (r.status === 'COMPLETED') {
             resultsDiv.innerHTML = `
                 <div class="space-y-4">
                     <div class="grid grid-cols-2 md:grid-cols-4 gap-4">
@@ -737,7 +761,7 @@ async function runBacktest() {
                 </div>
             `;
         } else {
-            resultsDiv.innerHTML = `<div class="text-red-500 text-center py-4">Error: ${result.error || 'Error desconocido'}</div>`;
+            resultsDiv.innerHTML = `<div class="text-red-500 text-center py-4">Error: ${r.error_message || 'Error desconocido'}</div>`;
         }
     } catch (error) {
         console.error('Error running backtest:', error);
@@ -0,0 +1,299 @@
+"""
+Calendario de sesiones de mercado
+Horarios, feriados y cierres anticipados de NYSE/NASDAQ y BYMA, y mercado cripto 24/7.
+Lo usan los caches de la API y el worker para no pedir datos ni evaluar reglas de
+mercados cerrados
+"""
+import logging
+import os
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from functools import lru_cache
+from typing import Callable, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Minutos después del cierre en los que los precios todavía pueden cambiar (subasta
+# de cierre, ajustes del proveedor); pasado ese margen se cachea hasta la apertura
+DEFAULT_SETTLE_MINUTES = 15
+MAX_LOOKAHEAD_DAYS = 15
+
+
+def _easter(year: int) -> date:
+    """Domingo de Pascua (algoritmo gregoriano anónimo)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """n-ésimo día de la semana del mes (n=-1: el último)"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _observed(day: date) -> date:
+    """Feriado de NYSE que cae en fin de semana: sábado -> viernes, domingo -> lunes"""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def _extra_days(env_var: str) -> Set[date]:
+    """Fechas adicionales (YYYY-MM-DD separadas por coma) para feriados decretados"""
+    days = set()
+    for value in os.getenv(env_var, "").split(","):
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            days.add(date.fromisoformat(value))
+        except ValueError:
+            logger.warning(f"Fecha inválida en {env_var}: {value}")
+    return days
+
+
+@lru_cache(maxsize=32)
+def nyse_holidays(year: int) -> Set[date]:
+    """Feriados de NYSE/NASDAQ"""
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),  # Presidents' Day
+        _easter(year) - timedelta(days=2),  # Good Friday
+        _nth_weekday(year, 5, 0, -1),  # Memorial Day
+        _observed(date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),  # Labor Day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        _observed(date(year, 12, 25)),
+    }
+    # Año Nuevo en sábado no se compensa el viernes anterior (regla de NYSE)
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        holidays.add(_observed(new_year))
+    if year >= 2022:
+        holidays.add(_observed(date(year, 6, 19)))  # Juneteenth
+    return holidays | {day for day in _extra_days("MARKET_HOLIDAYS_NYSE") if day.year == year}
+
+
+@lru_cache(maxsize=32)
+def nyse_early_closes(year: int) -> Set[date]:
+    """Días en que NYSE/NASDAQ cierran a las 13:00"""
+    early = {_nth_weekday(year, 11, 3, 4) + timedelta(days=1)}  # Día después de Thanksgiving
+    july_3 = date(year, 7, 3)
+    if july_3.weekday() < 5 and july_3 not in nyse_holidays(year):
+        early.add(july_3)
+    christmas_eve = date(year, 12, 24)
+    if christmas_eve.weekday() < 5 and christmas_eve not in nyse_holidays(year):
+        early.add(christmas_eve)
+    return early
+
+
+def _movable(day: date) -> date:
+    """Feriado trasladable argentino (Ley 27.399): martes/miércoles al lunes anterior, jueves/viernes al lunes siguiente"""
+    if day.weekday() in (1, 2):
+        return day - timedelta(days=day.weekday())
+    if day.weekday() in (3, 4):
+        return day + timedelta(days=7 - day.weekday())
+    return day
+
+
+@lru_cache(maxsize=32)
+def byma_holidays(year: int) -> Set[date]:
+    """Feriados de BYMA (feriados nacionales argentinos y Semana Santa)"""
+    easter = _easter(year)
+    holidays = {
+        date(year, 1, 1),
+        easter - timedelta(days=48),  # Carnaval
+        easter - timedelta(days=47),
+        date(year, 3, 24),
+        date(year, 4, 2),
+        easter - timedelta(days=3),  # Jueves Santo
+        easter - timedelta(days=2),  # Viernes Santo
+        date(year, 5, 1),
+        date(year, 5, 25),
+        _movable(date(year, 6, 17)),
+        date(year, 6, 20),
+        date(year, 7, 9),
+        _movable(date(year, 8, 17)),
+        _movable(date(year, 10, 12)),
+        _movable(date(year, 11, 20)),
+        date(year, 12, 8),
+        date(year, 12, 25),
+    }
+    # Días no laborables con fines turísticos y cambios por decreto
+    return holidays | {day for day in _extra_days("MARKET_HOLIDAYS_BYMA") if day.year == year}
+
+
+def _no_days(year: int) -> Set[date]:
+    return set()
+
+
+class MarketCalendar:
+    """
+    Sesiones de un mercado
+
+    Las horas se expresan en la zona horaria local del mercado; las consultas aceptan
+    datetimes con zona (o naive en UTC) y devuelven datetimes con zona.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tz: str,
+        open_time: dtime = dtime(0, 0),
+        close_time: dtime = dtime(23, 59, 59),
+        early_close_time: Optional[dtime] = None,
+        holidays: Callable[[int], Set[date]] = _no_days,
+        early_closes: Callable[[int], Set[date]] = _no_days,
+        always_open: bool = False
+    ):
+        """
+        Args:
+            name: Nombre del mercado
+            tz: Zona horaria IANA del mercado
+            open_time: Hora de apertura
+            close_time: Hora de cierre
+            early_close_time: Hora de cierre en días de cierre anticipado
+            holidays: Función año -> feriados
+            early_closes: Función año -> días de cierre anticipado
+            always_open: Mercado 24/7 (cripto)
+        """
+        self.name = name
+        self.tz = ZoneInfo(tz)
+        self.open_time = open_time
+        self.close_time = close_time
+        self.early_close_time = early_close_time
+        self.holidays = holidays
+        self.early_closes = early_closes
+        self.always_open = always_open
+
+    def __repr__(self) -> str:
+        return f"MarketCalendar({self.name})"
+
+    def _local(self, at: Optional[datetime]) -> datetime:
+        if at is None:
+            at = datetime.now(timezone.utc)
+        elif at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        return at.astimezone(self.tz)
+
+    def is_trading_day(self, day: date) -> bool:
+        if self.always_open:
+            return True
+        return day.weekday() < 5 and day not in self.holidays(day.year)
+
+    def session(self, day: date) -> Optional[Tuple[datetime, datetime]]:
+        """Apertura y cierre del día (None si no opera)"""
+        if not self.is_trading_day(day):
+            return None
+        close_time = self.close_time
+        if self.early_close_time and day in self.early_closes(day.year):
+            close_time = self.early_close_time
+        return (
+            datetime.combine(day, self.open_time, tzinfo=self.tz),
+            datetime.combine(day, close_time, tzinfo=self.tz)
+        )
+
+    def is_open(self, at: Optional[datetime] = None) -> bool:
+        if self.always_open:
+            return True
+        local = self._local(at)
+        session = self.session(local.date())
+        return session is not None and session[0] <= local < session[1]
+
+    def next_open(self, at: Optional[datetime] = None) -> datetime:
+        """Próxima apertura (la hora consultada si el mercado ya está abierto)"""
+        local = self._local(at)
+        if self.is_open(local):
+            return local
+        for offset in range(MAX_LOOKAHEAD_DAYS):
+            session = self.session(local.date() + timedelta(days=offset))
+            if session and session[0] > local:
+                return session[0]
+        raise ValueError(f"{self.name} sin sesiones en los próximos {MAX_LOOKAHEAD_DAYS} días")
+
+    def last_close(self, at: Optional[datetime] = None) -> Optional[datetime]:
+        """Último cierre anterior a la hora consultada (None en mercados 24/7)"""
+        if self.always_open:
+            return None
+        local = self._local(at)
+        for offset in range(MAX_LOOKAHEAD_DAYS):
+            session = self.session(local.date() - timedelta(days=offset))
+            if session and session[1] <= local:
+                return session[1]
+        return None
+
+    def cache_ttl(self, base_ttl: float, at: Optional[datetime] = None, settle_minutes: float = DEFAULT_SETTLE_MINUTES) -> float:
+        """
+        Segundos de vigencia de un dato de mercado
+
+        Con el mercado abierto (o recién cerrado, dentro de settle_minutes) es base_ttl;
+        con el mercado cerrado, el dato no cambia hasta la próxima apertura.
+        """
+        local = self._local(at)
+        if self.is_open(local):
+            return base_ttl
+        last_close = self.last_close(local)
+        if last_close and local - last_close < timedelta(minutes=settle_minutes):
+            return base_ttl
+        return max(base_ttl, (self.next_open(local) - local).total_seconds())
+
+
+NYSE = MarketCalendar(
+    "NYSE",
+    "America/New_York",
+    open_time=dtime(9, 30),
+    close_time=dtime(16, 0),
+    early_close_time=dtime(13, 0),
+    holidays=nyse_holidays,
+    early_closes=nyse_early_closes
+)
+
+BYMA = MarketCalendar(
+    "BYMA",
+    "America/Argentina/Buenos_Aires",
+    open_time=dtime(11, 0),
+    close_time=dtime(17, 0),
+    holidays=byma_holidays
+)
+
+CRYPTO = MarketCalendar("CRYPTO", "UTC", always_open=True)
+
+CRYPTO_QUOTES = ("-USD", "-USDT", "USDT", "BUSD", "-BTC", "-ETH")
+
+
+def market_for_ticker(ticker: str, broker_name: Optional[str] = None) -> MarketCalendar:
+    """
+    Mercado en el que cotiza un ticker
+
+    Args:
+        ticker: Ticker de Yahoo Finance o símbolo del broker
+        broker_name: Broker de la regla (IOL opera en BYMA, Binance es cripto)
+
+    Returns:
+        NYSE (acciones y ADRs de EE.UU., por defecto), BYMA (sufijo .BA o IOL) o CRYPTO
+    """
+    symbol = (ticker or "").strip().upper()
+    if broker_name == "BINANCE" or symbol.endswith(CRYPTO_QUOTES):
+        return CRYPTO
+    if broker_name == "IOL" or symbol.endswith(".BA"):
+        return BYMA
+    return NYSE
+
+
+def cache_ttl_for_ticker(ticker: str, base_ttl: float, at: Optional[datetime] = None) -> float:
+    """Segundos de vigencia de los datos de un ticker según la sesión de su mercado"""
+    return market_for_ticker(ticker).cache_ttl(base_ttl, at)
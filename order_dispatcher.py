@@ -0,0 +1,200 @@
+"""
+Despacho concurrente de órdenes del worker de reglas
+El evaluador encola las órdenes disparadas y el dispatcher las ejecuta en paralelo,
+con un límite global por broker, orden estricto por cuenta y freno según el peso
+usado que informa Binance en X-MBX-USED-WEIGHT-1M
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import httpx
+import broker_http
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER_LIMITS = {"IOL": 4, "BINANCE": 10}
+DEFAULT_BROKER_LIMIT = 4
+
+
+class BinanceWeightThrottle:
+    """
+    Freno de órdenes según el peso de requests usado en el minuto actual
+
+    Binance devuelve en cada respuesta el peso acumulado de la IP en la ventana de un
+    minuto (alineada al reloj). Cuando se supera el umbral, las órdenes esperan al
+    próximo minuto; ante un 429/418 se respeta el Retry-After.
+    """
+
+    WEIGHT_HEADER = "x-mbx-used-weight-1m"
+
+    def __init__(self, weight_limit: int = 6000, threshold: float = 0.9):
+        """
+        Args:
+            weight_limit: Peso máximo por minuto de la IP
+            threshold: Fracción del límite a partir de la cual se frenan las órdenes
+        """
+        self.weight_limit = weight_limit
+        self.threshold = threshold
+        self._used = 0
+        self._window: Optional[int] = None
+        self._blocked_until = 0.0
+
+    def observe_response(self, response: httpx.Response):
+        """Registra el peso usado y los bloqueos informados por Binance"""
+        used = response.headers.get(self.WEIGHT_HEADER)
+        now = time.time()
+        if used is not None:
+            try:
+                self._used = int(used)
+                self._window = int(now // 60)
+            except ValueError:
+                pass
+        # Solo las respuestas de Binance traen el header de peso; un 429 de IOL no frena Binance
+        if response.status_code in (418, 429) and used is not None:
+            try:
+                retry_after = float(response.headers.get("Retry-After", "60"))
+            except ValueError:
+                retry_after = 60.0
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            logger.warning(f"Binance limitó los requests ({response.status_code}), órdenes en espera {retry_after:.0f}s")
+
+    def delay(self, now: Optional[float] = None) -> float:
+        """
+        Segundos que debe esperar la próxima orden
+
+        Returns:
+            0 si hay peso disponible
+        """
+        now = time.time() if now is None else now
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        if self._window == int(now // 60) and self._used >= self.weight_limit * self.threshold:
+            return (self._window + 1) * 60 - now
+        return 0.0
+
+    async def wait(self):
+        delay = self.delay()
+        while delay > 0:
+            logger.info(f"Peso de Binance en {self._used}/{self.weight_limit}, orden demorada {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = self.delay()
+
+
+class OrderDispatcher:
+    """
+    Ejecuta órdenes en paralelo respetando límites por broker y por cuenta
+
+    - Cada broker tiene un semáforo global (una orden lenta de IOL no demora a Binance)
+    - Las órdenes de una misma cuenta se ejecutan en el orden en que se encolaron
+    - Las órdenes de Binance esperan si el peso usado del minuto está cerca del límite
+    - Una clave (rule_id) con orden en curso no puede volver a encolarse
+    """
+
+    def __init__(
+        self,
+        broker_limits: Optional[Dict[str, int]] = None,
+        weight_throttle: Optional[BinanceWeightThrottle] = None
+    ):
+        """
+        Args:
+            broker_limits: Órdenes simultáneas máximas por broker
+            weight_throttle: Freno por peso de Binance
+        """
+        self.broker_limits = dict(DEFAULT_BROKER_LIMITS)
+        self.broker_limits.update(broker_limits or {})
+        self.weight_throttle = weight_throttle or BinanceWeightThrottle()
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._account_tails: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        broker_http.add_response_hook(self.weight_throttle.observe_response)
+
+    @classmethod
+    def from_env(cls) -> "OrderDispatcher":
+        """Crea el dispatcher usando ORDER_CONCURRENCY_IOL, ORDER_CONCURRENCY_BINANCE y BINANCE_WEIGHT_LIMIT"""
+        return cls(
+            broker_limits={
+                "IOL": int(os.getenv("ORDER_CONCURRENCY_IOL", str(DEFAULT_BROKER_LIMITS["IOL"]))),
+                "BINANCE": int(os.getenv("ORDER_CONCURRENCY_BINANCE", str(DEFAULT_BROKER_LIMITS["BINANCE"])))
+            },
+            weight_throttle=BinanceWeightThrottle(weight_limit=int(os.getenv("BINANCE_WEIGHT_LIMIT", "6000")))
+        )
+
+    def _semaphore(self, broker_name: str) -> asyncio.Semaphore:
+        if broker_name not in self._semaphores:
+            limit = self.broker_limits.get(broker_name, DEFAULT_BROKER_LIMIT)
+            self._semaphores[broker_name] = asyncio.Semaphore(limit)
+        return self._semaphores[broker_name]
+
+    def is_pending(self, key: str) -> bool:
+        """Indica si la clave tiene una orden encolada o en curso"""
+        return key in self._pending
+
+    def pending_keys(self) -> Set[str]:
+        return set(self._pending)
+
+    def submit(
+        self,
+        key: str,
+        broker_name: str,
+        account_id: str,
+        order: Callable[[], Awaitable],
+        on_done: Optional[Callable] = None
+    ) -> Optional[asyncio.Task]:
+        """
+        Encola una orden; empieza a ejecutarse apenas lo permitan los límites
+
+        Args:
+            key: Identificador único de la orden en curso (rule_id)
+            broker_name: "IOL" o "BINANCE"
+            account_id: Cuenta del broker (broker_connection_id)
+            order: Función async que envía la orden y devuelve su resultado
+            on_done: Callback con el resultado (o la excepción) al terminar
+
+        Returns:
+            La tarea de la orden, o None si la clave ya tenía una orden en curso
+        """
+        if key in self._pending:
+            return None
+
+        previous = self._account_tails.get(account_id)
+        task = asyncio.create_task(self._run(key, broker_name, account_id, previous, order, on_done))
+        self._account_tails[account_id] = task
+        self._pending[key] = task
+        return task
+
+    async def _run(self, key, broker_name, account_id, previous, order, on_done):
+        try:
+            if previous is not None and not previous.done():
+                # Orden estricto por cuenta: esperar a la orden anterior sin heredar su error
+                await asyncio.wait([previous])
+
+            async with self._semaphore(broker_name):
+                if broker_name == "BINANCE":
+                    await self.weight_throttle.wait()
+                try:
+                    result = await order()
+                except Exception as e:
+                    logger.error(f"Error ejecutando orden {key} en {broker_name}: {str(e)}")
+                    result = e
+
+            if on_done is not None:
+                try:
+                    on_done(result)
+                except Exception as e:
+                    logger.error(f"Error registrando resultado de la orden {key}: {str(e)}", exc_info=True)
+            return result
+        finally:
+            self._pending.pop(key, None)
+            if self._account_tails.get(account_id) is asyncio.current_task():
+                del self._account_tails[account_id]
+
+    async def drain(self):
+        """Espera a que terminen todas las órdenes encoladas"""
+        while self._pending:
+            await asyncio.wait(list(self._pending.values()))
+
+    def close(self):
+        broker_http.remove_response_hook(self.weight_throttle.observe_response)
@@ -0,0 +1,234 @@
+"""
+Cola durable de órdenes entre la evaluación de reglas y su ejecución
+El evaluador solo escribe la orden disparada en SQLite (modo WAL) y sigue; la ejecución
+la consume al ritmo que permiten los brokers. Tras una caída se retoma sin duplicar
+órdenes ni perder los registros de rule_executions
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = "spool"
+OPEN_STATUSES = ("pending", "sending", "done")
+INTERRUPTED_ERROR = "El worker se detuvo mientras la orden se enviaba al broker; verificar en el broker"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS order_queue (
+    idempotency_key TEXT PRIMARY KEY,
+    execution_id TEXT NOT NULL,
+    rule_id TEXT NOT NULL,
+    broker_connection_id TEXT,
+    rule TEXT NOT NULL,
+    current_data TEXT,
+    triggered_at TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    result TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_order_queue_status ON order_queue(status, created_at);
+"""
+
+
+def idempotency_key(rule: Dict) -> str:
+    """
+    Clave de la orden de una regla en su ventana de disparo
+
+    La ventana empieza en la última ejecución registrada (last_execution_at): mientras
+    no se registre una nueva ejecución, cualquier disparo de la regla —por ejemplo,
+    volver a evaluarla después de un reinicio— produce la misma clave y no encola
+    otra orden.
+    """
+    return f"{rule.get('id')}:{rule.get('last_execution_at') or 'never'}"
+
+
+class OrderQueue:
+    """
+    Cola de órdenes en SQLite
+
+    Estados: pending (encolada) -> sending (enviándose al broker) -> done (resultado del
+    broker guardado) -> recorded (registrada en rule_executions). También cancelled
+    (no se envió, por ejemplo por perder el lease; el próximo disparo la vuelve a encolar).
+
+    Cada orden lleva un execution_id fijo, así que volver a registrar una orden done
+    tras una caída es idempotente. Una orden que quedó en sending no se reenvía (el
+    broker pudo haberla aceptado): recover() la cierra como UNKNOWN para que se
+    registre y se revise a mano.
+    """
+
+    def __init__(self, path: str, retention: float = 7 * 86400):
+        """
+        Args:
+            path: Archivo SQLite de la cola
+            retention: Segundos que se conservan las órdenes cerradas
+        """
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._open_rules: Set[str] = set()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._open_rules = {
+                row[0] for row in conn.execute(
+                    f"SELECT rule_id FROM order_queue WHERE status IN {OPEN_STATUSES}"
+                )
+            }
+
+    @classmethod
+    def from_env(cls) -> "OrderQueue":
+        """Crea la cola usando ORDER_QUEUE_PATH o RULE_WORKER_SPOOL_DIR"""
+        path = os.getenv("ORDER_QUEUE_PATH") or os.path.join(
+            os.getenv("RULE_WORKER_SPOOL_DIR", DEFAULT_SPOOL_DIR), "order_queue.db"
+        )
+        return cls(path)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        # Cada cambio de estado de una orden tiene que sobrevivir a un corte de luz
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row(row: sqlite3.Row) -> Dict:
+        entry = dict(row)
+        entry["rule"] = json.loads(entry["rule"])
+        entry["current_data"] = json.loads(entry["current_data"]) if entry["current_data"] else None
+        entry["result"] = json.loads(entry["result"]) if entry["result"] else None
+        return entry
+
+    def _set_status(self, key: str, status: str, result: Optional[Dict] = None):
+        with self._lock, closing(self._connect()) as conn:
+            if result is None:
+                conn.execute(
+                    "UPDATE order_queue SET status = ?, updated_at = ? WHERE idempotency_key = ?",
+                    (status, time.time(), key)
+                )
+            else:
+                conn.execute(
+                    "UPDATE order_queue SET status = ?, result = ?, updated_at = ? WHERE idempotency_key = ?",
+                    (status, json.dumps(result, default=str), time.time(), key)
+                )
+            if status not in OPEN_STATUSES:
+                rule_id = conn.execute(
+                    "SELECT rule_id FROM order_queue WHERE idempotency_key = ?", (key,)
+                ).fetchone()
+                if rule_id:
+                    self._open_rules.discard(rule_id[0])
+
+    def has_open(self, rule_id: str) -> bool:
+        """Indica si la regla tiene una orden encolada, en curso o sin registrar"""
+        return rule_id in self._open_rules
+
+    def enqueue(self, rule: Dict, current_data: Optional[Dict], triggered_at: str) -> Optional[str]:
+        """
+        Encola la orden de una regla disparada
+
+        Args:
+            rule: Regla (se guarda completa para ejecutarla y registrarla después)
+            current_data: Datos de mercado de la evaluación
+            triggered_at: Momento del disparo (ISO)
+
+        Una orden cancelada no se envió, así que no ocupa la ventana: volver a disparar
+        la regla reutiliza la fila con un execution_id nuevo.
+
+        Returns:
+            La clave de idempotencia, o None si esa ventana ya tenía una orden
+        """
+        key = idempotency_key(rule)
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO order_queue (idempotency_key, execution_id, rule_id, broker_connection_id, "
+                "rule, current_data, triggered_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(idempotency_key) DO UPDATE SET execution_id = excluded.execution_id, "
+                "broker_connection_id = excluded.broker_connection_id, rule = excluded.rule, "
+                "current_data = excluded.current_data, triggered_at = excluded.triggered_at, status = 'pending', "
+                "result = NULL, created_at = excluded.created_at, updated_at = excluded.updated_at "
+                "WHERE order_queue.status = 'cancelled'",
+                (
+                    key,
+                    str(uuid.uuid4()),
+                    rule.get("id"),
+                    rule.get("broker_connection_id"),
+                    json.dumps(rule, default=str),
+                    json.dumps(current_data, default=str) if current_data else None,
+                    triggered_at,
+                    now,
+                    now
+                )
+            )
+            if cursor.rowcount == 0:
+                logger.info(f"Orden duplicada ignorada para la regla {rule.get('id')} ({key})")
+                return None
+            self._open_rules.add(rule.get("id"))
+        return key
+
+    def pending(self, limit: int = 500, exclude: Optional[Set[str]] = None) -> List[Dict]:
+        """Órdenes encoladas en orden de llegada (omitiendo las claves de exclude)"""
+        exclude = exclude or set()
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM order_queue WHERE status = 'pending' ORDER BY created_at LIMIT ?",
+                (limit + len(exclude),)
+            ).fetchall()
+        return [self._row(row) for row in rows if row["idempotency_key"] not in exclude][:limit]
+
+    def mark_sending(self, key: str):
+        """Se llama justo antes de enviar la orden al broker"""
+        self._set_status(key, "sending")
+
+    def mark_done(self, key: str, result: Dict):
+        """Guarda la respuesta del broker (antes de registrar la ejecución)"""
+        self._set_status(key, "done", result)
+
+    def mark_recorded(self, key: str):
+        self._set_status(key, "recorded")
+
+    def mark_cancelled(self, key: str):
+        self._set_status(key, "cancelled")
+
+    def recover(self) -> List[Dict]:
+        """
+        Retoma la cola tras un reinicio
+
+        Las órdenes en sending pasan a done con estado UNKNOWN (no se reenvían).
+
+        Returns:
+            Las órdenes done que todavía no se registraron en rule_executions
+        """
+        unknown = {"success": False, "status": "UNKNOWN", "error": INTERRUPTED_ERROR}
+        with self._lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE order_queue SET status = 'done', result = ?, updated_at = ? WHERE status = 'sending'",
+                (json.dumps(unknown), time.time())
+            )
+            if cursor.rowcount:
+                logger.warning(f"{cursor.rowcount} órdenes interrumpidas durante el envío quedan como UNKNOWN")
+            rows = conn.execute("SELECT * FROM order_queue WHERE status = 'done' ORDER BY created_at").fetchall()
+        return [self._row(row) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """Cantidad de órdenes por estado"""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM order_queue GROUP BY status").fetchall())
+
+    def purge(self) -> int:
+        """Elimina las órdenes cerradas más viejas que retention"""
+        with self._lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM order_queue WHERE status IN ('recorded', 'cancelled') AND updated_at < ?",
+                (time.time() - self.retention,)
+            )
+            return cursor.rowcount
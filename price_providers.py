@@ -0,0 +1,691 @@
+"""
+Proveedores de precios
+Interfaz común para cotizaciones, velas históricas y datos fundamentales, con
+implementaciones para Yahoo Finance, Binance (cripto) y un proveedor sintético
+determinístico para benchmarks y tests. ProviderRouter elige el proveedor según la
+clase de activo del ticker (market_calendar)
+"""
+import logging
+import os
+import time
+import zlib
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Union
+
+import httpx
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from market_calendar import CRYPTO, market_for_ticker
+
+logger = logging.getLogger(__name__)
+
+BAR_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+PERIOD_DAYS = {
+    "1d": 1, "5d": 5, "1mo": 31, "3mo": 92, "6mo": 183,
+    "1y": 366, "2y": 731, "5y": 1827, "10y": 3653
+}
+
+INTERVAL_MINUTES = {
+    "1m": 1, "2m": 2, "5m": 5, "15m": 15, "30m": 30, "60m": 60, "90m": 90, "1h": 60
+}
+
+DateLike = Union[str, date, datetime, None]
+
+
+def _to_date(value: DateLike) -> Optional[date]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def period_range(period: Optional[str], start: DateLike = None, end: DateLike = None, earliest: Optional[date] = None):
+    """
+    Rango de fechas [inicio, fin) de una consulta de velas
+
+    Args:
+        period: Período de yfinance (1mo, 1y, ytd, max...); se ignora si hay start
+        start: Fecha de inicio (incluida)
+        end: Fecha de fin (excluida, como en yfinance); por defecto mañana
+        earliest: Inicio para period="max"
+
+    Returns:
+        Tupla (inicio, fin)
+    """
+    end_day = _to_date(end) or date.today() + timedelta(days=1)
+    start_day = _to_date(start)
+    if start_day is None:
+        if period == "ytd":
+            start_day = date(end_day.year, 1, 1)
+        elif period in PERIOD_DAYS:
+            start_day = end_day - timedelta(days=PERIOD_DAYS[period])
+        else:
+            start_day = earliest or date(1970, 1, 1)
+    return start_day, end_day
+
+
+def pe_ratio(fundamentals: Optional[Dict]) -> Optional[float]:
+    """P/E de un diccionario de datos fundamentales (trailing, o forward si no hay)"""
+    if not fundamentals:
+        return None
+    return fundamentals.get("trailingPE") or fundamentals.get("forwardPE")
+
+
+def empty_bars() -> pd.DataFrame:
+    return pd.DataFrame(columns=BAR_COLUMNS, dtype=float)
+
+
+# Días entre el cierre de un trimestre y su anuncio que se suponen al deducir de qué
+# trimestre es un anuncio
+ANNOUNCE_LAG_DAYS = 30
+
+
+def fiscal_quarter(period_end) -> List[str]:
+    """
+    Trimestre calendario ("2024Q1") cuyo cierre es el más cercano a cada fecha
+
+    Identifica un trimestre aunque cada fuente lo feche distinto (cierre fiscal que no
+    coincide con el calendario, o día de anuncio menos ANNOUNCE_LAG_DAYS).
+    """
+    index = pd.DatetimeIndex(period_end)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return [str(quarter) for quarter in (index + pd.Timedelta(days=45)).to_period("Q") - 1]
+
+
+def earnings_frame(eps, available, quarters: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    EPS trimestral indexado por el día en que se conoció (ordenado, un registro por
+    trimestre y por día)
+
+    Args:
+        eps: EPS de cada trimestre
+        available: Primer día en que el dato era público
+        quarters: Trimestre de cada EPS (ver fiscal_quarter; por defecto se deduce del
+            día de publicación)
+    """
+    index = pd.DatetimeIndex(available).as_unit("ns")
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    index = index.normalize()
+    if quarters is None:
+        quarters = fiscal_quarter(index - pd.Timedelta(days=ANNOUNCE_LAG_DAYS))
+    frame = pd.DataFrame({"eps": np.asarray(eps, dtype=float), "quarter": list(quarters)}, index=index)
+    frame.index.name = "Date"
+    frame = frame.dropna().sort_index()
+    frame = frame[~frame["quarter"].duplicated(keep="last")]
+    return frame[~frame.index.duplicated(keep="last")]
+
+
+class PriceProvider:
+    """
+    Interfaz de un proveedor de datos de mercado
+
+    - Cotización: {ticker, current_price, high_52w, pe_ratio} (pe_ratio puede ser None;
+      el dato confiable de P/E está en los fundamentales)
+    - Velas: DataFrame con índice de fechas y columnas Open, High, Low, Close, Volume
+    - Fundamentales: diccionario con las claves de Yahoo Finance (trailingPE,
+      marketCap, fiftyTwoWeekHigh...)
+
+    - Resultados: DataFrame con columna eps (EPS trimestral) indexado por el primer día
+      en que el dato era público, para armar el P/E histórico sin mirar el futuro
+
+    Los métodos en lote llaman por defecto al método individual ticker por ticker; los
+    proveedores que tienen endpoints en lote los sobrescriben. Un proveedor que no
+    ofrece una capacidad lanza NotImplementedError.
+    """
+
+    name = "base"
+
+    def get_quote(self, ticker: str) -> Optional[Dict]:
+        return self.get_quotes([ticker]).get(ticker)
+
+    def get_quotes(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        """Cotizaciones de varios tickers (se omiten los que no tienen precio)"""
+        quotes = {}
+        for ticker in tickers:
+            quote = self.get_quote(ticker)
+            if quote:
+                quotes[ticker] = quote
+        return quotes
+
+    def get_bars(
+        self,
+        ticker: str,
+        start: DateLike = None,
+        end: DateLike = None,
+        period: Optional[str] = None,
+        interval: str = "1d"
+    ) -> pd.DataFrame:
+        raise NotImplementedError(f"{self.name} no ofrece velas históricas")
+
+    def get_bars_batch(
+        self,
+        tickers: Iterable[str],
+        start: DateLike = None,
+        end: DateLike = None,
+        period: Optional[str] = None,
+        interval: str = "1d"
+    ) -> Dict[str, pd.DataFrame]:
+        """Velas de varios tickers (se omiten los que no tienen datos)"""
+        bars = {}
+        for ticker in tickers:
+            frame = self.get_bars(ticker, start=start, end=end, period=period, interval=interval)
+            if frame is not None and not frame.empty:
+                bars[ticker] = frame
+        return bars
+
+    def get_fundamentals(self, ticker: str) -> Dict:
+        raise NotImplementedError(f"{self.name} no ofrece datos fundamentales")
+
+    def get_fundamentals_batch(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        return {ticker: self.get_fundamentals(ticker) for ticker in tickers}
+
+    def get_earnings(self, ticker: str) -> pd.DataFrame:
+        raise NotImplementedError(f"{self.name} no ofrece resultados trimestrales")
+
+    def cache_key(self, ticker: str) -> Optional[str]:
+        """Fuente de las velas del ticker en la caché de backtests (None: no se cachean)"""
+        return self.name
+
+
+class YahooProvider(PriceProvider):
+    """Yahoo Finance vía yfinance (acciones, ADRs, BYMA con sufijo .BA y cripto)"""
+
+    name = "yahoo"
+
+    def get_quote(self, ticker: str) -> Optional[Dict]:
+        # Una sola consulta a info trae precio, P/E y máximo de 52 semanas
+        info = self.get_fundamentals(ticker)
+        if not info:
+            logger.warning(f"No se pudieron obtener datos para {ticker}")
+            return None
+        current_price = info.get("currentPrice") or info.get("regularMarketPrice")
+        if not current_price:
+            logger.warning(f"No se pudo obtener precio actual para {ticker}")
+            return None
+        return {
+            "ticker": ticker,
+            "current_price": current_price,
+            "pe_ratio": pe_ratio(info),
+            "high_52w": info.get("fiftyTwoWeekHigh")
+        }
+
+    def get_quotes(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        """Precio y máximo de 52 semanas con una sola descarga de un año diario (sin P/E)"""
+        tickers = list(tickers)
+        quotes = {}
+        for ticker, frame in self.get_bars_batch(tickers, period="1y").items():
+            closes = frame["Close"].dropna()
+            if closes.empty:
+                continue
+            quotes[ticker] = {
+                "ticker": ticker,
+                "current_price": float(closes.iloc[-1]),
+                "high_52w": float(frame["High"].max()),
+                "pe_ratio": None
+            }
+        return quotes
+
+    def get_bars(self, ticker, start=None, end=None, period=None, interval="1d") -> pd.DataFrame:
+        stock = yf.Ticker(ticker)
+        if start or end:
+            return stock.history(start=start, end=end, interval=interval)
+        return stock.history(period=period or "1y", interval=interval)
+
+    def get_bars_batch(self, tickers, start=None, end=None, period=None, interval="1d") -> Dict[str, pd.DataFrame]:
+        tickers = list(tickers)
+        if not tickers:
+            return {}
+        kwargs = {"start": start, "end": end} if (start or end) else {"period": period or "1y"}
+        # Ajustadas como stock.history, para que coincidan con get_bars
+        data = yf.download(
+            tickers,
+            interval=interval,
+            group_by="ticker",
+            auto_adjust=True,
+            progress=False,
+            threads=True,
+            **kwargs
+        )
+        bars = {}
+        if data is None or data.empty:
+            return bars
+
+        for ticker in tickers:
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                frame = data[ticker]
+            elif len(tickers) == 1:
+                frame = data
+            else:
+                continue
+            frame = frame.dropna(subset=["Close"])
+            if not frame.empty:
+                bars[ticker] = frame
+        return bars
+
+    def get_fundamentals(self, ticker: str) -> Dict:
+        return yf.Ticker(ticker).info or {}
+
+    # Sin fecha de anuncio, un trimestre se da por conocido estos días después del cierre
+    REPORT_LAG_DAYS = 45
+
+    def get_earnings(self, ticker: str) -> pd.DataFrame:
+        """
+        EPS trimestral point-in-time
+
+        Usa las fechas de anuncio de earnings_dates (el dato cuenta desde el día
+        siguiente, porque se suele anunciar con el mercado abierto o cerrado); si no
+        hay, el EPS diluido de quarterly_income_stmt con REPORT_LAG_DAYS de demora. Las
+        dos fuentes fechan distinto un mismo trimestre; cada EPS lleva su trimestre
+        (fiscal_quarter) para que la caché no lo cuente dos veces.
+        """
+        stock = yf.Ticker(ticker)
+        try:
+            dates = stock.get_earnings_dates(limit=100)
+            if dates is not None and "Reported EPS" in dates:
+                reported = dates["Reported EPS"].dropna()
+                if not reported.empty:
+                    available = pd.DatetimeIndex(reported.index).tz_localize(None).normalize() + pd.Timedelta(days=1)
+                    return earnings_frame(reported.to_numpy(), available)
+        except Exception as e:
+            logger.warning(f"No se pudieron obtener fechas de resultados de {ticker}: {str(e)}")
+
+        try:
+            statement = stock.quarterly_income_stmt
+        except Exception as e:
+            logger.warning(f"No se pudo obtener el estado de resultados de {ticker}: {str(e)}")
+            statement = None
+        if statement is None or statement.empty or "Diluted EPS" not in statement.index:
+            return earnings_frame([], [])
+        eps = statement.loc["Diluted EPS"].dropna()
+        return earnings_frame(
+            eps.to_numpy(),
+            pd.DatetimeIndex(eps.index) + pd.Timedelta(days=self.REPORT_LAG_DAYS),
+            fiscal_quarter(eps.index)
+        )
+
+
+class BinanceProvider(PriceProvider):
+    """
+    Datos públicos de mercado de Binance (sin API key)
+
+    Los tickers de Yahoo se traducen a símbolos de Binance: BTC-USD -> BTCUSDT,
+    ETH-BTC -> ETHBTC. No hay datos fundamentales.
+    """
+
+    name = "binance"
+    KLINES_LIMIT = 1000
+    HIGH_TTL = 3600
+    INTERVALS = {
+        "1m": "1m", "5m": "5m", "15m": "15m", "30m": "30m", "60m": "1h", "1h": "1h",
+        "90m": "1h", "1d": "1d", "5d": "1d", "1wk": "1w", "1mo": "1M", "3mo": "1M"
+    }
+
+    def __init__(self, base_url: Optional[str] = None, timeout: float = 10.0, client: Optional[httpx.Client] = None):
+        """
+        Args:
+            base_url: URL de la API (BINANCE_MARKET_DATA_URL o api.binance.com)
+            timeout: Timeout de cada request en segundos
+            client: Cliente httpx a usar (tests)
+        """
+        self.base_url = (base_url or os.getenv("BINANCE_MARKET_DATA_URL", "https://api.binance.com")).rstrip("/")
+        self.client = client or httpx.Client(timeout=timeout)
+        self._highs: Dict[str, tuple] = {}  # símbolo -> (máximo de 52 semanas, vence en time.monotonic)
+
+    @staticmethod
+    def symbol(ticker: str) -> str:
+        base, _, quote = ticker.upper().partition("-")
+        if not quote:
+            return base
+        return base + ("USDT" if quote == "USD" else quote)
+
+    def _get(self, path: str, params: Dict):
+        response = self.client.get(f"{self.base_url}{path}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def _klines(self, symbol: str, interval: str, start_ms: Optional[int] = None, end_ms: Optional[int] = None, limit: int = KLINES_LIMIT) -> List[list]:
+        params = {"symbol": symbol, "interval": interval, "limit": limit}
+        if start_ms is not None:
+            params["startTime"] = start_ms
+        if end_ms is not None:
+            params["endTime"] = end_ms
+        return self._get("/api/v3/klines", params)
+
+    def _high_52w(self, symbol: str) -> Optional[float]:
+        cached = self._highs.get(symbol)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+        weekly = self._klines(symbol, "1w", limit=52)
+        high = max((float(k[2]) for k in weekly), default=None)
+        self._highs[symbol] = (high, time.monotonic() + self.HIGH_TTL)
+        return high
+
+    def get_quotes(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        """Precios con una sola llamada a /ticker/price; el máximo de 52 semanas sale de velas semanales (cacheado)"""
+        symbols = {self.symbol(ticker): ticker for ticker in tickers}
+        if not symbols:
+            return {}
+        payload = "[" + ",".join(f'"{symbol}"' for symbol in symbols) + "]"
+        quotes = {}
+        for item in self._get("/api/v3/ticker/price", {"symbols": payload}):
+            ticker = symbols.get(item.get("symbol"))
+            if ticker is None:
+                continue
+            quotes[ticker] = {
+                "ticker": ticker,
+                "current_price": float(item["price"]),
+                "high_52w": self._high_52w(item["symbol"]),
+                "pe_ratio": None
+            }
+        return quotes
+
+    def get_bars(self, ticker, start=None, end=None, period=None, interval="1d") -> pd.DataFrame:
+        if interval not in self.INTERVALS:
+            raise NotImplementedError(f"Intervalo {interval} no soportado por Binance")
+        start_day, end_day = period_range(period, start, end, earliest=date(2017, 7, 14))
+        start_ms = int(datetime.combine(start_day, dtime(), tzinfo=timezone.utc).timestamp() * 1000)
+        end_ms = int(datetime.combine(end_day, dtime(), tzinfo=timezone.utc).timestamp() * 1000) - 1
+
+        symbol = self.symbol(ticker)
+        rows = []
+        while start_ms <= end_ms:
+            page = self._klines(symbol, self.INTERVALS[interval], start_ms, end_ms)
+            if not page:
+                break
+            rows.extend(page)
+            if len(page) < self.KLINES_LIMIT:
+                break
+            start_ms = int(page[-1][6]) + 1  # close time de la última vela
+
+        if not rows:
+            return empty_bars()
+        frame = pd.DataFrame(
+            [[float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])] for k in rows],
+            columns=BAR_COLUMNS,
+            index=pd.to_datetime([int(k[0]) for k in rows], unit="ms", utc=True)
+        )
+        frame.index.name = "Date"
+        return frame
+
+
+class FakeProvider(PriceProvider):
+    """
+    Proveedor sintético determinístico para benchmarks y tests
+
+    Cada ticker tiene una caminata aleatoria geométrica con semilla fija (crc32 del
+    ticker) que arranca en ORIGIN, así que la misma fecha devuelve siempre la misma
+    vela sin importar el rango pedido. Los días hábiles salen del calendario del
+    mercado del ticker (cripto opera todos los días). Las velas intradiarias se
+    generan dentro de la sesión de cada día, también con semilla fija.
+    """
+
+    name = "fake"
+    ORIGIN = date(2000, 1, 3)
+
+    def __init__(self, today: Optional[date] = None, volatility: float = 0.02, drift: float = 0.0003):
+        """
+        Args:
+            today: Último día con datos (por defecto, hoy)
+            volatility: Desvío diario de los retornos logarítmicos
+            drift: Retorno logarítmico diario medio
+        """
+        self.today = today
+        self.volatility = volatility
+        self.drift = drift
+
+    @staticmethod
+    def seed(ticker: str) -> int:
+        return zlib.crc32(ticker.upper().encode())
+
+    def _last_day(self) -> date:
+        return self.today or date.today()
+
+    @lru_cache(maxsize=256)
+    def _daily(self, ticker: str, last_day: date) -> pd.DataFrame:
+        calendar = market_for_ticker(ticker)
+        days = pd.date_range(self.ORIGIN, last_day, freq="D")
+        days = [day for day in days if calendar.is_trading_day(day.date())]
+        n = len(days)
+        seed = self.seed(ticker)
+        # Una sola matriz de normales: las primeras filas no dependen de n
+        noise = np.random.default_rng(seed).standard_normal((n, 4))
+
+        log_returns = self.drift + self.volatility * noise[:, 0]
+        close = (10 + seed % 490) * np.exp(np.cumsum(log_returns))
+        open_ = np.concatenate(([close[0] / np.exp(log_returns[0])], close[:-1])) * np.exp(0.002 * noise[:, 1])
+        high = np.maximum(open_, close) * (1 + np.abs(noise[:, 2]) * self.volatility / 2)
+        low = np.minimum(open_, close) * (1 - np.abs(noise[:, 3]) * self.volatility / 2)
+        volume = np.round(1_000_000 * (1 + seed % 50) * np.exp(0.3 * noise[:, 2]))
+
+        index = pd.DatetimeIndex(days).tz_localize(calendar.tz)
+        index.name = "Date"
+        return pd.DataFrame({"Open": open_, "High": high, "Low": low, "Close": close, "Volume": volume}, index=index)
+
+    def _intraday(self, ticker: str, daily: pd.DataFrame, minutes: int) -> pd.DataFrame:
+        calendar = market_for_ticker(ticker)
+        frames = []
+        for day, row in daily.iterrows():
+            session = calendar.session(day.date())
+            if session is None:
+                continue
+            opens = pd.date_range(session[0], session[1], freq=f"{minutes}min", inclusive="left")
+            n = len(opens)
+            if n == 0:
+                continue
+            rng = np.random.default_rng(self.seed(f"{ticker}|{day.date().isoformat()}|{minutes}"))
+            # Puente browniano entre la apertura y el cierre del día
+            steps = rng.standard_normal(n)
+            walk = np.cumsum(steps)
+            bridge = walk - np.arange(1, n + 1) / n * walk[-1]
+            scale = self.volatility / np.sqrt(n)
+            path = np.exp(np.log(row["Open"]) + np.arange(1, n + 1) / n * np.log(row["Close"] / row["Open"]) + scale * bridge)
+            bar_open = np.concatenate(([row["Open"]], path[:-1]))
+            wiggle = np.abs(rng.standard_normal(n)) * scale / 2
+            frames.append(pd.DataFrame({
+                "Open": bar_open,
+                "High": np.maximum(bar_open, path) * (1 + wiggle),
+                "Low": np.minimum(bar_open, path) * (1 - wiggle),
+                "Close": path,
+                "Volume": np.round(row["Volume"] / n * (1 + np.abs(steps) / 4))
+            }, index=opens))
+        if not frames:
+            return empty_bars()
+        frame = pd.concat(frames)
+        frame.index.name = "Datetime"
+        return frame
+
+    def get_bars(self, ticker, start=None, end=None, period=None, interval="1d") -> pd.DataFrame:
+        start_day, end_day = period_range(period, start, end, earliest=self.ORIGIN)
+        daily = self._daily(ticker.upper(), self._last_day())
+        local_days = daily.index.date
+        daily = daily[(local_days >= start_day) & (local_days < end_day)]
+        if interval == "1d":
+            return daily.copy()
+        if interval in INTERVAL_MINUTES:
+            return self._intraday(ticker.upper(), daily, INTERVAL_MINUTES[interval])
+        if interval in ("1wk", "1mo"):
+            rule = "W-FRI" if interval == "1wk" else "MS"
+            resampled = daily.resample(rule).agg(
+                {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum"}
+            )
+            return resampled.dropna(subset=["Close"])
+        raise NotImplementedError(f"Intervalo {interval} no soportado por el proveedor sintético")
+
+    def get_earnings(self, ticker: str) -> pd.DataFrame:
+        """EPS trimestral sintético (P/E alrededor del trailingPE), publicado 30 días después del trimestre"""
+        if market_for_ticker(ticker) is CRYPTO:
+            raise NotImplementedError("Los activos cripto no tienen resultados trimestrales")
+        daily = self._daily(ticker.upper(), self._last_day())
+        quarter_ends = pd.date_range(self.ORIGIN, self._last_day(), freq="QE")
+        available = quarter_ends + pd.Timedelta(days=30)
+        quarter_ends = quarter_ends[available.date <= self._last_day()]
+        if daily.empty or quarter_ends.empty:
+            return earnings_frame([], [])
+        closes = daily["Close"].reindex(
+            pd.DatetimeIndex(quarter_ends).tz_localize(daily.index.tz), method="ffill"
+        ).bfill().to_numpy()
+        base_pe = self.get_fundamentals(ticker)["trailingPE"]
+        noise = np.random.default_rng(self.seed(f"{ticker}|eps")).standard_normal(len(quarter_ends))
+        pe = base_pe * np.exp(0.15 * noise)
+        return earnings_frame(closes / pe / 4, quarter_ends + pd.Timedelta(days=30), fiscal_quarter(quarter_ends))
+
+    def cache_key(self, ticker: str) -> Optional[str]:
+        # Las velas se generan al instante: no hace falta cachearlas
+        return None
+
+    def get_quote(self, ticker: str) -> Optional[Dict]:
+        daily = self._daily(ticker.upper(), self._last_day())
+        if daily.empty:
+            return None
+        return {
+            "ticker": ticker,
+            "current_price": float(daily["Close"].iloc[-1]),
+            "high_52w": float(daily["High"].iloc[-252:].max()),
+            "pe_ratio": pe_ratio(self.get_fundamentals(ticker))
+        }
+
+    def get_fundamentals(self, ticker: str) -> Dict:
+        seed = self.seed(ticker)
+        daily = self._daily(ticker.upper(), self._last_day())
+        price = float(daily["Close"].iloc[-1]) if not daily.empty else None
+        if market_for_ticker(ticker) is CRYPTO:
+            return {"symbol": ticker, "shortName": ticker, "currentPrice": price, "regularMarketPrice": price}
+        shares = 1e8 * (1 + seed % 97)
+        return {
+            "symbol": ticker,
+            "shortName": f"{ticker} Synthetic",
+            "currentPrice": price,
+            "regularMarketPrice": price,
+            "trailingPE": round(5 + (seed % 4000) / 100, 2),
+            "forwardPE": round(4 + (seed % 3500) / 100, 2),
+            "fiftyTwoWeekHigh": float(daily["High"].iloc[-252:].max()) if price else None,
+            "marketCap": shares * price if price else None,
+            "averageVolume": float(daily["Volume"].iloc[-90:].mean()) if price else None,
+            "dividendYield": round((seed % 500) / 10000, 4),
+            "operatingCashflow": shares * (seed % 13)
+        }
+
+
+class ProviderRouter(PriceProvider):
+    """
+    Enruta cada ticker al proveedor de su clase de activo
+
+    Las rutas van por nombre de mercado de market_calendar (CRYPTO, BYMA, NYSE); los
+    mercados sin ruta usan el proveedor por defecto. Si el proveedor de la ruta falla o
+    no ofrece la capacidad pedida, se reintenta con el proveedor por defecto.
+    """
+
+    name = "router"
+
+    def __init__(self, default: PriceProvider, routes: Optional[Dict[str, PriceProvider]] = None):
+        """
+        Args:
+            default: Proveedor por defecto
+            routes: Mercado -> proveedor (ej. {"CRYPTO": BinanceProvider()})
+        """
+        self.default = default
+        self.routes = routes or {}
+
+    def provider_for(self, ticker: str) -> PriceProvider:
+        return self.routes.get(market_for_ticker(ticker).name, self.default)
+
+    def cache_key(self, ticker: str) -> Optional[str]:
+        return self.provider_for(ticker).cache_key(ticker)
+
+    def _group(self, tickers: Iterable[str]) -> List[tuple]:
+        groups: Dict[int, tuple] = {}
+        for ticker in dict.fromkeys(tickers):
+            provider = self.provider_for(ticker)
+            groups.setdefault(id(provider), (provider, []))[1].append(ticker)
+        return list(groups.values())
+
+    def _call(self, ticker: str, method: str, *args, **kwargs):
+        provider = self.provider_for(ticker)
+        try:
+            return getattr(provider, method)(*args, **kwargs)
+        except Exception as e:
+            if provider is self.default:
+                raise
+            if not isinstance(e, NotImplementedError):
+                logger.warning(f"{provider.name} falló en {method} para {ticker}, usando {self.default.name}: {str(e)}")
+            return getattr(self.default, method)(*args, **kwargs)
+
+    def _batch(self, tickers: Iterable[str], method: str, **kwargs) -> Dict:
+        results = {}
+        for provider, group in self._group(tickers):
+            try:
+                results.update(getattr(provider, method)(group, **kwargs))
+            except Exception as e:
+                if provider is self.default:
+                    raise
+                if not isinstance(e, NotImplementedError):
+                    logger.warning(f"{provider.name} falló en {method} para {len(group)} tickers: {str(e)}")
+            if provider is not self.default:
+                missing = [ticker for ticker in group if ticker not in results]
+                if missing:
+                    results.update(getattr(self.default, method)(missing, **kwargs))
+        return results
+
+    def get_quote(self, ticker: str) -> Optional[Dict]:
+        return self._call(ticker, "get_quote", ticker)
+
+    def get_quotes(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        return self._batch(tickers, "get_quotes")
+
+    def get_bars(self, ticker, start=None, end=None, period=None, interval="1d") -> pd.DataFrame:
+        return self._call(ticker, "get_bars", ticker, start=start, end=end, period=period, interval=interval)
+
+    def get_bars_batch(self, tickers, start=None, end=None, period=None, interval="1d") -> Dict[str, pd.DataFrame]:
+        return self._batch(tickers, "get_bars_batch", start=start, end=end, period=period, interval=interval)
+
+    def get_fundamentals(self, ticker: str) -> Dict:
+        return self._call(ticker, "get_fundamentals", ticker)
+
+    def get_fundamentals_batch(self, tickers: Iterable[str]) -> Dict[str, Dict]:
+        return self._batch(tickers, "get_fundamentals_batch")
+
+    def get_earnings(self, ticker: str) -> pd.DataFrame:
+        return self._call(ticker, "get_earnings", ticker)
+
+
+def build_provider_from_env() -> PriceProvider:
+    """
+    Proveedor configurado por variables de entorno
+
+    - PRICE_PROVIDER: yahoo (por defecto) o fake (todo sintético)
+    - PRICE_PROVIDER_CRYPTO: binance (por defecto) o yahoo para los tickers cripto
+    """
+    if os.getenv("PRICE_PROVIDER", "yahoo").lower() == "fake":
+        return FakeProvider()
+    routes = {}
+    if os.getenv("PRICE_PROVIDER_CRYPTO", "binance").lower() == "binance":
+        routes[CRYPTO.name] = BinanceProvider()
+    return ProviderRouter(YahooProvider(), routes)
+
+
+_provider: Optional[PriceProvider] = None
+
+
+def get_price_provider() -> PriceProvider:
+    """Proveedor compartido del proceso (se crea la primera vez desde el entorno)"""
+    global _provider
+    if _provider is None:
+        _provider = build_provider_from_env()
+    return _provider
+
+
+def set_price_provider(provider: Optional[PriceProvider]):
+    """Reemplaza el proveedor compartido (None vuelve a leerlo del entorno)"""
+    global _provider
+    _provider = provider
@@ -0,0 +1,136 @@
+"""
+Cotizaciones compartidas para evaluar reglas en lote
+Una consulta en lote por grupo de tickers (price_providers) en lugar de una por regla, con
+TTL corto para precios y TTL largo para datos fundamentales (P/E)
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from market_calendar import cache_ttl_for_ticker
+from price_providers import PriceProvider, get_price_provider, pe_ratio
+
+logger = logging.getLogger(__name__)
+
+
+class QuoteBook:
+    """
+    Cache de cotizaciones por ticker
+
+    - Precio actual y máximo de 52 semanas: get_quotes del proveedor, en bloques de
+      chunk_size tickers por llamada (con Yahoo, una descarga de un año diario)
+    - P/E: datos fundamentales solo de los tickers que lo necesitan (reglas pe_*),
+      una vez por fundamentals_ttl
+
+    Con el mercado del ticker cerrado, el precio vale hasta la próxima apertura
+    (market_calendar), así que fuera de horario no se vuelve a descargar.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60,
+        fundamentals_ttl: float = 3600,
+        chunk_size: int = 200,
+        concurrency: int = 8,
+        provider: Optional[PriceProvider] = None
+    ):
+        """
+        Args:
+            ttl: Segundos de vigencia de los precios con el mercado abierto
+            fundamentals_ttl: Segundos de vigencia del P/E
+            chunk_size: Tickers por descarga
+            concurrency: Consultas simultáneas de datos fundamentales
+            provider: Proveedor de precios (por defecto, el compartido del proceso)
+        """
+        self.ttl = ttl
+        self.fundamentals_ttl = fundamentals_ttl
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self._provider = provider
+        self._prices: Dict[str, tuple] = {}  # ticker -> (quote, vence en time.monotonic)
+        self._fundamentals: Dict[str, tuple] = {}  # ticker -> (pe_ratio, time.monotonic)
+
+    @property
+    def provider(self) -> PriceProvider:
+        return self._provider or get_price_provider()
+
+    def _download(self, tickers: List[str]) -> Dict[str, Dict]:
+        """Precio y máximo de 52 semanas de varios tickers en una sola consulta"""
+        return {
+            ticker: {"current_price": quote["current_price"], "high_52w": quote.get("high_52w")}
+            for ticker, quote in self.provider.get_quotes(tickers).items()
+            if quote.get("current_price")
+        }
+
+    def _fetch_pe(self, ticker: str):
+        return pe_ratio(self.provider.get_fundamentals(ticker))
+
+    async def _refresh_prices(self, tickers: List[str]):
+        for start in range(0, len(tickers), self.chunk_size):
+            chunk = tickers[start:start + self.chunk_size]
+            try:
+                downloaded = await asyncio.to_thread(self._download, chunk)
+            except Exception as e:
+                logger.error(f"Error descargando cotizaciones de {len(chunk)} tickers: {str(e)}")
+                continue
+            now = time.monotonic()
+            for ticker, quote in downloaded.items():
+                self._prices[ticker] = (quote, now + cache_ttl_for_ticker(ticker, self.ttl))
+            missing = len(chunk) - len(downloaded)
+            if missing:
+                logger.warning(f"Sin cotización para {missing} de {len(chunk)} tickers")
+
+    async def _refresh_fundamentals(self, tickers: List[str]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(ticker):
+            async with semaphore:
+                try:
+                    pe_ratio = await asyncio.to_thread(self._fetch_pe, ticker)
+                except Exception as e:
+                    logger.warning(f"No se pudo obtener P/E de {ticker}: {str(e)}")
+                    return
+                self._fundamentals[ticker] = (pe_ratio, time.monotonic())
+
+        await asyncio.gather(*[fetch(ticker) for ticker in tickers])
+
+    async def get_quotes(self, tickers: Iterable[str], with_fundamentals: Iterable[str] = ()) -> Dict[str, Dict]:
+        """
+        Obtiene cotizaciones, descargando solo los tickers vencidos
+
+        Args:
+            tickers: Tickers a cotizar
+            with_fundamentals: Subconjunto de tickers que además necesita P/E
+
+        Returns:
+            Diccionario ticker -> {ticker, current_price, pe_ratio, high_52w, evaluated_at}
+            (los tickers sin cotización se omiten)
+        """
+        tickers = list(dict.fromkeys(t for t in tickers if t))
+        now = time.monotonic()
+
+        stale = [t for t in tickers if t not in self._prices or now >= self._prices[t][1]]
+        if stale:
+            await self._refresh_prices(stale)
+
+        stale_pe = [
+            t for t in dict.fromkeys(with_fundamentals)
+            if t not in self._fundamentals or now - self._fundamentals[t][1] >= self.fundamentals_ttl
+        ]
+        if stale_pe:
+            await self._refresh_fundamentals(stale_pe)
+
+        evaluated_at = datetime.now().isoformat()
+        quotes = {}
+        for ticker in tickers:
+            cached = self._prices.get(ticker)
+            if not cached:
+                continue
+            quote = dict(cached[0])
+            quote["ticker"] = ticker
+            quote["pe_ratio"] = self._fundamentals.get(ticker, (None, 0))[0]
+            quote["evaluated_at"] = evaluated_at
+            quotes[ticker] = quote
+        return quotes
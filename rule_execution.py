@@ -2,25 +2,98 @@
 Sistema de Ejecución Automática y Backtesting de Reglas
 Maneja la verificación de reglas, ejecución automática y backtesting
 """
-import yfinance as yf
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from decimal import Decimal
 import asyncio
 
+import numpy as np
+import pandas as pd
+
+from bar_cache import get_bar_cache
+from price_providers import INTERVAL_MINUTES, get_price_provider
+
 logger = logging.getLogger(__name__)
 
 class RuleEvaluator:
     """Evalúa si una regla se cumple con los datos actuales del mercado"""
     
     @staticmethod
-    async def evaluate_rule(rule: Dict) -> Tuple[bool, Optional[Dict]]:
+    def check_condition(
+        rule_type: str,
+        value_threshold: float,
+        current_price: float,
+        pe_ratio: Optional[float] = None,
+        high_52w: Optional[float] = None
+    ) -> bool:
+        """
+        Evalúa la condición de una regla contra una cotización ya obtenida
+        
+        Args:
+            rule_type: Tipo de regla (price_below, price_above, pe_below, pe_above, max_distance)
+            value_threshold: Valor umbral de la regla
+            current_price: Precio actual
+            pe_ratio: P/E actual (reglas pe_*)
+            high_52w: Máximo de 52 semanas (reglas max_distance)
+        
+        Returns:
+            True si la condición se cumple
+        """
+        if rule_type == "price_below":
+            return current_price < value_threshold
+        
+        elif rule_type == "price_above":
+            return current_price > value_threshold
+        
+        elif rule_type == "pe_below":
+            return bool(pe_ratio) and pe_ratio < value_threshold
+        
+        elif rule_type == "pe_above":
+            return bool(pe_ratio) and pe_ratio > value_threshold
+        
+        elif rule_type == "max_distance":
+            # Obtener máximo histórico (52 semanas)
+            if high_52w:
+                distance = ((current_price - high_52w) / high_52w) * 100
+                # value_threshold es negativo para "debajo del máximo"
+                return distance <= value_threshold
+        
+        return False
+    
+    @staticmethod
+    def get_current_data(ticker: str) -> Optional[Dict]:
+        """
+        Obtiene precio, P/E y máximo de 52 semanas de un activo
+        
+        Args:
+            ticker: Símbolo del activo
+        
+        Returns:
+            Diccionario con los datos actuales o None si no hay precio
+        """
+        quote = get_price_provider().get_quote(ticker)
+        if not quote or not quote.get("current_price"):
+            logger.warning(f"No se pudo obtener precio actual para {ticker}")
+            return None
+        
+        return {
+            "ticker": ticker,
+            "current_price": quote["current_price"],
+            "pe_ratio": quote.get("pe_ratio"),
+            "high_52w": quote.get("high_52w"),
+            "evaluated_at": datetime.now().isoformat()
+        }
+    
+    @staticmethod
+    async def evaluate_rule(rule: Dict, current_data: Optional[Dict] = None) -> Tuple[bool, Optional[Dict]]:
         """
         Evalúa si una regla se cumple
         
         Args:
             rule: Diccionario con datos de la regla
+            current_data: Datos del activo ya obtenidos con get_current_data (por
+                ejemplo, compartidos entre reglas del mismo ticker)
         
         Returns:
             Tuple (se_cumple, datos_actuales)
@@ -34,52 +107,18 @@ class RuleEvaluator:
                 return False, None
             
             # Obtener datos del activo
-            stock = yf.Ticker(ticker)
-            info = stock.info
-            
-            if not info or len(info) == 0:
-                logger.warning(f"No se pudieron obtener datos para {ticker}")
+            if current_data is None:
+                current_data = RuleEvaluator.get_current_data(ticker)
+            if current_data is None:
                 return False, None
             
-            current_price = info.get("currentPrice") or info.get("regularMarketPrice")
-            if not current_price:
-                logger.warning(f"No se pudo obtener precio actual para {ticker}")
-                return False, None
-            
-            # Evaluar según tipo de regla
-            condition_met = False
-            
-            if rule_type == "price_below":
-                condition_met = current_price < value_threshold
-                
-            elif rule_type == "price_above":
-                condition_met = current_price > value_threshold
-                
-            elif rule_type == "pe_below":
-                pe_ratio = info.get("trailingPE") or info.get("forwardPE")
-                if pe_ratio:
-                    condition_met = pe_ratio < value_threshold
-                    
-            elif rule_type == "pe_above":
-                pe_ratio = info.get("trailingPE") or info.get("forwardPE")
-                if pe_ratio:
-                    condition_met = pe_ratio > value_threshold
-                    
-            elif rule_type == "max_distance":
-                # Obtener máximo histórico (52 semanas)
-                high_52w = info.get("fiftyTwoWeekHigh")
-                if high_52w:
-                    distance = ((current_price - high_52w) / high_52w) * 100
-                    # value_threshold es negativo para "debajo del máximo"
-                    condition_met = distance <= value_threshold
-            
-            current_data = {
-                "ticker": ticker,
-                "current_price": current_price,
-                "pe_ratio": info.get("trailingPE") or info.get("forwardPE"),
-                "high_52w": info.get("fiftyTwoWeekHigh"),
-                "evaluated_at": datetime.now().isoformat()
-            }
+            condition_met = RuleEvaluator.check_condition(
+                rule_type,
+                value_threshold,
+                current_data["current_price"],
+                pe_ratio=current_data.get("pe_ratio"),
+                high_52w=current_data.get("high_52w")
+            )
             
             return condition_met, current_data
             
@@ -91,8 +130,134 @@ class RuleEvaluator:
 class BacktestEngine:
     """Motor de backtesting para reglas"""
     
+    ENGINES = ("vectorized", "loop", "stream")
+    PE_RULES = ("pe_below", "pe_above")
+    INTERVALS = ("1d",) + tuple(INTERVAL_MINUTES)
+    
+    # Velas por tramo del motor por tramos (con 1m, 5 días: Yahoo admite 8 por pedido)
+    STREAM_CHUNK_BARS = 8_000
+    # Detalles de ejecución que guarda el motor por tramos (los contadores siguen completos)
+    STREAM_MAX_DETAILS = 5_000
+    
+    @staticmethod
+    def earnings(ticker: str) -> Optional[pd.DataFrame]:
+        """EPS trimestral del ticker desde la caché (None si el activo no tiene resultados)"""
+        try:
+            return get_bar_cache().get_earnings(ticker)
+        except NotImplementedError:
+            return None
+    
+    @staticmethod
+    def pe_series(hist: pd.DataFrame, earnings: Optional[pd.DataFrame]) -> np.ndarray:
+        """
+        P/E diario point-in-time: cierre / EPS de los últimos 4 trimestres publicados
+        
+        Cada vela toma, con searchsorted, el último trimestre conocido a su fecha (sin
+        mirar resultados futuros). Sin 4 trimestres o con EPS acumulado <= 0 el P/E
+        queda en NaN, como trailingPE, y la regla no se cumple.
+        
+        Args:
+            hist: Velas con columna Close
+            earnings: EPS trimestral indexado por día de publicación (ver get_earnings)
+        
+        Returns:
+            Array con un P/E por vela
+        """
+        close = hist["Close"].to_numpy(dtype=float)
+        pe = np.full(len(close), np.nan)
+        if earnings is None or len(earnings) < 4 or not len(close):
+            return pe
+        
+        eps = earnings["eps"].to_numpy(dtype=float)
+        sums = np.concatenate(([0.0], np.cumsum(eps)))
+        ttm = sums[4:] - sums[:-4]  # ttm[i]: trimestres i..i+3
+        published = earnings.index.to_numpy(dtype="datetime64[D]")
+        
+        index = pd.DatetimeIndex(hist.index)
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        days = index.to_numpy(dtype="datetime64[D]")
+        last = np.searchsorted(published, days, side="right") - 1
+        known = last >= 3
+        trailing = np.where(known, ttm[np.clip(last - 3, 0, None)], np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(trailing > 0, close / trailing, pe)
+    
+    @staticmethod
+    def attach_pe(hist: pd.DataFrame, earnings: Optional[pd.DataFrame]) -> pd.DataFrame:
+        """Copia de las velas con la columna PE (ver pe_series)"""
+        return hist.assign(PE=BacktestEngine.pe_series(hist, earnings))
+    
     @staticmethod
-    async def run_backtest(rule: Dict, start_date: str, end_date: str, initial_capital: float = 10000) -> Dict:
+    def load_history(ticker: str, start_date: str, end_date: str, rule_types=()) -> pd.DataFrame:
+        """
+        Velas diarias de la caché, con el P/E diario si alguna regla es pe_below/pe_above
+        
+        Args:
+            ticker: Ticker
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD)
+            rule_types: Tipos de regla que se van a simular sobre las velas
+        """
+        hist = get_bar_cache().get_bars(ticker, start=start_date, end=end_date)
+        if hist is not None and not hist.empty and any(rule_type in BacktestEngine.PE_RULES for rule_type in rule_types):
+            hist = BacktestEngine.attach_pe(hist, BacktestEngine.earnings(ticker))
+        return hist
+    
+    @staticmethod
+    def chunk_days(interval: str, chunk_bars: int = STREAM_CHUNK_BARS) -> int:
+        """Días por tramo para no pasar de chunk_bars velas (aun en mercados de 24 horas)"""
+        minutes = INTERVAL_MINUTES.get(interval, 24 * 60)
+        return max(1, chunk_bars * minutes // (24 * 60))
+    
+    @staticmethod
+    def stream_history(
+        ticker: str,
+        start_date: str,
+        end_date: str,
+        interval: str = "1d",
+        rule_types=(),
+        chunk_bars: int = STREAM_CHUNK_BARS
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Velas de la caché por tramos de fechas consecutivos (ver simulate_stream)
+        
+        Cada tramo se pide recién cuando se consumió el anterior, así que en memoria
+        hay un solo tramo a la vez. Con reglas de P/E cada tramo trae la columna PE.
+        
+        Args:
+            ticker: Ticker
+            start_date: Fecha de inicio (YYYY-MM-DD)
+            end_date: Fecha de fin (YYYY-MM-DD, excluida)
+            interval: Intervalo de las velas (1d, 1h, 5m, 1m...)
+            rule_types: Tipos de regla que se van a simular sobre las velas
+            chunk_bars: Máximo de velas por tramo
+        
+        Yields:
+            DataFrame de velas de cada tramo con datos
+        """
+        with_pe = any(rule_type in BacktestEngine.PE_RULES for rule_type in rule_types)
+        earnings = BacktestEngine.earnings(ticker) if with_pe else None
+        step = timedelta(days=BacktestEngine.chunk_days(interval, chunk_bars))
+        cursor = date.fromisoformat(str(start_date)[:10])
+        end = date.fromisoformat(str(end_date)[:10])
+        while cursor < end:
+            window_end = min(cursor + step, end)
+            chunk = get_bar_cache().get_bars(ticker, start=cursor.isoformat(), end=window_end.isoformat(), interval=interval)
+            cursor = window_end
+            if chunk is None or chunk.empty:
+                continue
+            yield BacktestEngine.attach_pe(chunk, earnings) if with_pe else chunk
+    
+    @staticmethod
+    async def run_backtest(
+        rule: Dict,
+        start_date: str,
+        end_date: str,
+        initial_capital: float = 10000,
+        engine: str = "vectorized",
+        interval: str = "1d"
+    ) -> Dict:
         """
         Ejecuta un backtest de una regla
         
@@ -101,6 +266,9 @@ class BacktestEngine:
             start_date: Fecha de inicio (YYYY-MM-DD)
             end_date: Fecha de fin (YYYY-MM-DD)
             initial_capital: Capital inicial para simulación
+            engine: "vectorized" (por defecto), "loop" (implementación de referencia) o
+                "stream" (por tramos; siempre que el intervalo no es diario)
+            interval: Intervalo de las velas (1d, 1h, 5m, 1m...)
         
         Returns:
             Diccionario con resultados del backtest
@@ -108,8 +276,6 @@ class BacktestEngine:
         try:
             ticker = rule.get("ticker")
             rule_type = rule.get("rule_type")
-            value_threshold = float(rule.get("value_threshold", 0))
-            execution_type = rule.get("execution_type", "ALERT_ONLY")
             
             if not ticker or not rule_type:
                 return {
@@ -117,162 +283,746 @@ class BacktestEngine:
                     "error": "Ticker o tipo de regla no especificado"
                 }
             
+            if engine == "stream" or interval != "1d":
+                chunks = BacktestEngine.stream_history(ticker, start_date, end_date, interval, [rule_type])
+                return await asyncio.to_thread(BacktestEngine.simulate_stream, rule, chunks, initial_capital, interval)
+            
             # Obtener datos históricos
-            stock = yf.Ticker(ticker)
-            hist = stock.history(start=start_date, end=end_date)
+            hist = BacktestEngine.load_history(ticker, start_date, end_date, [rule_type])
             
-            if hist.empty:
+            if hist is None or hist.empty:
                 return {
                     "success": False,
                     "error": "No se pudieron obtener datos históricos"
                 }
             
-            # Inicializar variables de backtest
-            capital = initial_capital
-            positions = []  # Lista de posiciones abiertas
-            executions = []
-            daily_equity = []
-            max_capital = initial_capital
-            max_drawdown = 0
+            if engine == "loop":
+                return BacktestEngine.simulate_loop(rule, hist, initial_capital)
+            return BacktestEngine.simulate(rule, hist, initial_capital)
             
-            wins = 0
-            losses = 0
-            total_profit = 0
-            total_loss = 0
+        except Exception as e:
+            logger.error(f"Error en backtest: {str(e)}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    @staticmethod
+    def signals(rule_type: str, value_threshold, hist: pd.DataFrame, prior_high: float = np.nan) -> np.ndarray:
+        """
+        Días en que se cumple la condición de la regla (operaciones sobre arrays)
+        
+        Args:
+            rule_type: Tipo de regla
+            value_threshold: Umbral de la regla, o array de umbrales
+            hist: Velas diarias con columnas Close y High (y PE para las reglas de P/E)
+            prior_high: Máximo de las velas anteriores a hist (motor por tramos)
+        
+        Returns:
+            Array booleano con un valor por vela, o matriz (umbrales x velas) si
+            value_threshold es un array
+        """
+        close = hist["Close"].to_numpy(dtype=float)
+        if np.ndim(value_threshold):
+            value_threshold = np.asarray(value_threshold, dtype=float)[:, None]
+        if rule_type == "price_below":
+            return close < value_threshold
+        if rule_type == "price_above":
+            return close > value_threshold
+        if rule_type == "max_distance":
+            # Máximo acumulado ignorando NaN, como hist.loc[:date, "High"].max()
+            high_so_far = np.fmax(hist["High"].cummax().ffill().to_numpy(dtype=float), prior_high)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                distance = ((close - high_so_far) / high_so_far) * 100
+            return distance <= value_threshold
+        if rule_type in BacktestEngine.PE_RULES:
+            # P/E diario de attach_pe; sin él (o en NaN) la regla no se cumple
+            pe = hist["PE"].to_numpy(dtype=float) if "PE" in hist else np.full(len(close), np.nan)
+            with np.errstate(invalid="ignore"):
+                return pe < value_threshold if rule_type == "pe_below" else pe > value_threshold
+        return np.zeros(np.broadcast(close, value_threshold).shape, dtype=bool)
+    
+    @staticmethod
+    def _affordable_buys(amounts: np.ndarray, initial_capital: float) -> np.ndarray:
+        """
+        Compras que se ejecutan con el capital disponible (en orden cronológico)
+        
+        Se compra mientras alcance el capital; tras la primera compra rechazada, la
+        siguiente que entra en lo que queda abre un nuevo tramo. Cada tramo se resuelve
+        con un acumulado, así que el costo es O(n) por tramo y no por día.
+        
+        Args:
+            amounts: Monto de cada intento de compra
+            initial_capital: Capital inicial
+        
+        Returns:
+            Array booleano con las compras ejecutadas
+        """
+        executed = np.zeros(len(amounts), dtype=bool)
+        capital = initial_capital
+        start = 0
+        while start < len(amounts):
+            # Capital antes de cada compra si todas las del tramo se ejecutan (restando
+            # en el mismo orden que la simulación día a día)
+            before = np.subtract.accumulate(np.concatenate(([capital], amounts[start:])))[:-1]
+            rejected = np.flatnonzero(before < amounts[start:])
+            stop = start + rejected[0] if len(rejected) else len(amounts)
+            executed[start:stop] = True
+            if stop == len(amounts):
+                break
+            capital = before[stop - start]
+            remaining = np.flatnonzero(amounts[stop + 1:] <= capital)
+            if not len(remaining):
+                break
+            start = stop + 1 + remaining[0]
+        return executed
+    
+    @staticmethod
+    def simulate(rule: Dict, hist: pd.DataFrame, initial_capital: float = 10000) -> Dict:
+        """
+        Backtest vectorizado sobre velas ya descargadas
+        
+        Señales con máscaras booleanas y máximo acumulado; compras, equity y drawdown
+        con sumas acumuladas y máximo corrido. Da los mismos resultados que
+        simulate_loop.
+        
+        Args:
+            rule: Diccionario con datos de la regla
+            hist: Velas con índice de fechas y columnas Close y High
+            initial_capital: Capital inicial para simulación
+        
+        Returns:
+            Diccionario con resultados del backtest
+        """
+        rule_type = rule.get("rule_type")
+        value_threshold = float(rule.get("value_threshold", 0))
+        execution_type = rule.get("execution_type", "ALERT_ONLY")
+        
+        close = hist["Close"].to_numpy(dtype=float)
+        dates = hist.index.strftime("%Y-%m-%d").tolist()
+        n = len(close)
+        
+        triggered = BacktestEngine.signals(rule_type, value_threshold, hist)
+        quantity = 0
+        if execution_type in ["BUY", "SELL"] and triggered.any():
+            quantity = rule.get("quantity", 0)
+        if not quantity > 0:
+            triggered = np.zeros(n, dtype=bool)
+        
+        trigger_idx = np.flatnonzero(triggered)
+        executions = []
+        buy_idx = np.zeros(0, dtype=int)
+        if len(trigger_idx):
+            prices = close[trigger_idx]
+            amounts = prices * quantity
+            if execution_type == "BUY":
+                bought = BacktestEngine._affordable_buys(amounts, initial_capital)
+                buy_idx = trigger_idx[bought]
+                statuses = np.where(bought, "EXECUTED", "INSUFFICIENT_FUNDS")
+            else:
+                # Sin compras no hay posiciones abiertas que vender
+                statuses = np.full(len(trigger_idx), "NO_POSITION")
+            executions = [
+                {
+                    "date": dates[i],
+                    "price": price,
+                    "type": execution_type,
+                    "quantity": quantity,
+                    "amount": amount,
+                    "status": status
+                }
+                for i, price, amount, status in zip(trigger_idx.tolist(), prices.tolist(), amounts.tolist(), statuses.tolist())
+            ]
+        
+        # Capital y valor de posiciones (a precio de entrada) después de cada compra,
+        # acumulados en el mismo orden que la simulación día a día
+        buy_amounts = close[buy_idx] * quantity if len(buy_idx) else np.zeros(0)
+        capital_steps = np.subtract.accumulate(np.concatenate(([initial_capital], buy_amounts)))
+        value_steps = np.add.accumulate(np.concatenate(([0.0], buy_amounts)))
+        bought_on = np.zeros(n, dtype=bool)
+        bought_on[buy_idx] = True
+        step = np.cumsum(bought_on)
+        capital = capital_steps[step]
+        positions_value = value_steps[step]
+        equity = capital + positions_value
+        
+        # Máximo corrido de equity (arrancando en el capital inicial) y drawdown
+        max_capital = np.maximum.accumulate(np.concatenate(([initial_capital], equity)))[1:]
+        drawdown = ((max_capital - equity) / max_capital) * 100
+        max_drawdown = max(0, float(drawdown.max()))
+        
+        # Cerrar posiciones abiertas al final
+        final_price = float(close[-1])
+        profits = (final_price - close[buy_idx]) * quantity if len(buy_idx) else np.zeros(0)
+        proceeds = np.full(len(buy_idx), final_price * quantity if len(buy_idx) else 0.0)
+        final_capital = float(np.add.accumulate(np.concatenate(([capital_steps[-1]], proceeds)))[-1])
+        winners = profits > 0
+        wins = int(winners.sum())
+        losses = len(profits) - wins
+        total_profit = float(np.add.accumulate(np.concatenate(([0.0], profits[winners])))[-1])
+        total_loss = float(np.add.accumulate(np.concatenate(([0.0], np.abs(profits[~winners]))))[-1])
+        
+        daily_equity = [
+            {"date": d, "equity": e, "capital": c, "positions_value": v}
+            for d, e, c, v in zip(dates, equity.tolist(), capital.tolist(), positions_value.tolist())
+        ]
+        return BacktestEngine._summary(
+            initial_capital, final_capital, max_drawdown, wins, losses, total_profit, total_loss, executions, daily_equity,
+            hist.attrs.get("data_version")
+        )
+    
+    @staticmethod
+    def simulate_stream(
+        rule: Dict,
+        chunks: Iterable[pd.DataFrame],
+        initial_capital: float = 10000,
+        interval: str = "1d"
+    ) -> Dict:
+        """
+        Backtest por tramos de velas, con memoria acotada sin importar el horizonte
+        
+        Cada tramo se simula con las mismas operaciones que simulate y entre tramos solo
+        se arrastra el estado: capital, valor de posiciones, máximo de High, máximo de
+        equity, drawdown y precios de compra. La curva de equity tiene un punto por día
+        (la última vela de cada sesión), así que con velas diarias las métricas son las
+        mismas que las de simulate.
+        
+        Los detalles de ejecución guardan cada compra, pero los disparos rechazados
+        seguidos (INSUFFICIENT_FUNDS o NO_POSITION) se agrupan en un solo registro con
+        la cantidad de velas (bars) y la última fecha (end_date), y se guardan a lo sumo
+        STREAM_MAX_DETAILS registros. Los totales de ejecuciones se cuentan aparte, así
+        que no dependen de ese tope.
+        
+        Args:
+            rule: Diccionario con datos de la regla
+            chunks: Tramos consecutivos de velas (ver stream_history)
+            initial_capital: Capital inicial para simulación
+            interval: Intervalo de las velas; intradiario, las ejecuciones llevan la hora
+        
+        Returns:
+            Diccionario con resultados del backtest
+        """
+        rule_type = rule.get("rule_type")
+        value_threshold = float(rule.get("value_threshold", 0))
+        execution_type = rule.get("execution_type", "ALERT_ONLY")
+        quantity = (rule.get("quantity") or 0) if execution_type in ["BUY", "SELL"] else 0
+        time_format = "%Y-%m-%d %H:%M" if interval in INTERVAL_MINUTES else "%Y-%m-%d"
+        
+        capital = float(initial_capital)
+        positions_value = 0.0
+        max_capital = float(initial_capital)
+        max_drawdown = 0.0
+        prior_high = np.nan
+        buy_prices = []
+        executions = []
+        total_executions = 0
+        successful_executions = 0
+        daily_equity = []
+        pending = None  # Último punto del tramo anterior (su día puede seguir en el próximo)
+        final_price = None
+        versions = []
+        
+        for chunk in chunks:
+            close = chunk["Close"].to_numpy(dtype=float)
+            n = len(close)
+            if not n:
+                continue
+            index = pd.DatetimeIndex(chunk.index)
+            local = index.tz_localize(None) if index.tz is not None else index
+            version = chunk.attrs.get("data_version")
+            if version and version not in versions:
+                versions.append(version)
             
-            # Iterar sobre cada día
-            for date, row in hist.iterrows():
-                current_price = float(row["Close"])
-                current_date = date.strftime("%Y-%m-%d")
-                
-                # Evaluar condición de la regla
-                condition_met = False
-                
-                if rule_type == "price_below":
-                    condition_met = current_price < value_threshold
-                elif rule_type == "price_above":
-                    condition_met = current_price > value_threshold
-                elif rule_type == "pe_below":
-                    # Para backtesting, usar precio como proxy (en producción se usaría P/E real)
-                    # Esto es una simplificación
-                    condition_met = False  # P/E requiere datos fundamentales diarios
-                elif rule_type == "pe_above":
-                    condition_met = False
-                elif rule_type == "max_distance":
-                    high_so_far = float(hist.loc[:date, "High"].max())
-                    distance = ((current_price - high_so_far) / high_so_far) * 100
-                    condition_met = distance <= value_threshold
-                
-                # Si la condición se cumple y hay ejecución automática
-                if condition_met and execution_type in ["BUY", "SELL"]:
-                    quantity = rule.get("quantity", 0)
-                    if quantity > 0:
-                        execution = {
-                            "date": current_date,
-                            "price": current_price,
-                            "type": execution_type,
-                            "quantity": quantity,
-                            "amount": current_price * quantity
-                        }
-                        
-                        if execution_type == "BUY":
-                            if capital >= execution["amount"]:
-                                capital -= execution["amount"]
-                                positions.append({
-                                    "entry_price": current_price,
-                                    "quantity": quantity,
-                                    "entry_date": current_date
-                                })
-                                execution["status"] = "EXECUTED"
-                            else:
-                                execution["status"] = "INSUFFICIENT_FUNDS"
-                        elif execution_type == "SELL":
-                            if positions:
-                                # Vender primera posición
-                                position = positions.pop(0)
-                                profit = (current_price - position["entry_price"]) * quantity
-                                capital += execution["amount"]
-                                
-                                if profit > 0:
-                                    wins += 1
-                                    total_profit += profit
-                                else:
-                                    losses += 1
-                                    total_loss += abs(profit)
-                                
-                                execution["status"] = "EXECUTED"
-                                execution["profit_loss"] = profit
-                            else:
-                                execution["status"] = "NO_POSITION"
-                        
-                        executions.append(execution)
-                
-                # Calcular equity actual (capital + valor de posiciones)
-                positions_value = sum(p["entry_price"] * p["quantity"] for p in positions)
-                current_equity = capital + positions_value
-                
-                # Actualizar máximo y drawdown
-                if current_equity > max_capital:
-                    max_capital = current_equity
-                drawdown = ((max_capital - current_equity) / max_capital) * 100
-                if drawdown > max_drawdown:
-                    max_drawdown = drawdown
-                
-                daily_equity.append({
-                    "date": current_date,
-                    "equity": current_equity,
-                    "capital": capital,
-                    "positions_value": positions_value
-                })
+            triggered = np.zeros(n, dtype=bool)
+            if quantity > 0:
+                triggered = BacktestEngine.signals(rule_type, value_threshold, chunk, prior_high)
+            if rule_type == "max_distance":
+                prior_high = float(np.fmax.reduce(np.append(chunk["High"].to_numpy(dtype=float), prior_high)))
             
-            # Cerrar posiciones abiertas al final
-            final_price = float(hist.iloc[-1]["Close"])
-            for position in positions:
-                profit = (final_price - position["entry_price"]) * position["quantity"]
-                capital += final_price * position["quantity"]
-                
-                if profit > 0:
-                    wins += 1
-                    total_profit += profit
+            trigger_idx = np.flatnonzero(triggered)
+            buy_idx = np.zeros(0, dtype=int)
+            if len(trigger_idx):
+                prices = close[trigger_idx]
+                amounts = prices * quantity
+                if execution_type == "BUY":
+                    bought = BacktestEngine._affordable_buys(amounts, capital)
+                    buy_idx = trigger_idx[bought]
+                    statuses = np.where(bought, "EXECUTED", "INSUFFICIENT_FUNDS")
                 else:
-                    losses += 1
-                    total_loss += abs(profit)
+                    statuses = np.full(len(trigger_idx), "NO_POSITION")
+                total_executions += len(trigger_idx)
+                successful_executions += len(buy_idx)
+                BacktestEngine._append_runs(
+                    executions, local[trigger_idx], prices, amounts, statuses, execution_type, quantity, time_format
+                )
+            
+            # Capital y valor de posiciones por vela, siguiendo desde el tramo anterior
+            buy_amounts = close[buy_idx] * quantity if len(buy_idx) else np.zeros(0)
+            capital_steps = np.subtract.accumulate(np.concatenate(([capital], buy_amounts)))
+            value_steps = np.add.accumulate(np.concatenate(([positions_value], buy_amounts)))
+            bought_on = np.zeros(n, dtype=bool)
+            bought_on[buy_idx] = True
+            step = np.cumsum(bought_on)
+            bar_capital = capital_steps[step]
+            bar_positions = value_steps[step]
+            equity = bar_capital + bar_positions
+            
+            peaks = np.maximum.accumulate(np.concatenate(([max_capital], equity)))[1:]
+            drawdown = ((peaks - equity) / peaks) * 100
+            max_drawdown = max(max_drawdown, float(drawdown.max()))
+            max_capital = float(peaks[-1])
+            capital = float(capital_steps[-1])
+            positions_value = float(value_steps[-1])
+            if len(buy_idx):
+                buy_prices.append(close[buy_idx])
+            final_price = float(close[-1])
             
-            final_capital = capital
-            total_return = ((final_capital - initial_capital) / initial_capital) * 100
-            total_pl = final_capital - initial_capital
+            # Un punto por día: la última vela de cada sesión
+            days = np.datetime_as_string(local.to_numpy().astype("datetime64[D]"))
+            if pending is not None and pending["date"] != days[0]:
+                daily_equity.append(pending)
+            last_of_day = np.flatnonzero(days[:-1] != days[1:])
+            daily_equity.extend(
+                {"date": d, "equity": e, "capital": c, "positions_value": v}
+                for d, e, c, v in zip(
+                    days[last_of_day].tolist(), equity[last_of_day].tolist(),
+                    bar_capital[last_of_day].tolist(), bar_positions[last_of_day].tolist()
+                )
+            )
+            pending = {
+                "date": str(days[-1]),
+                "equity": float(equity[-1]),
+                "capital": float(bar_capital[-1]),
+                "positions_value": float(bar_positions[-1])
+            }
+        
+        if final_price is None:
+            return {"success": False, "error": "No se pudieron obtener datos históricos"}
+        daily_equity.append(pending)
+        
+        # Cerrar posiciones abiertas al final
+        bought_prices = np.concatenate(buy_prices) if buy_prices else np.zeros(0)
+        profits = (final_price - bought_prices) * quantity
+        proceeds = np.full(len(bought_prices), final_price * quantity)
+        final_capital = float(np.add.accumulate(np.concatenate(([capital], proceeds)))[-1])
+        winners = profits > 0
+        wins = int(winners.sum())
+        losses = len(profits) - wins
+        total_profit = float(np.add.accumulate(np.concatenate(([0.0], profits[winners])))[-1])
+        total_loss = float(np.add.accumulate(np.concatenate(([0.0], np.abs(profits[~winners]))))[-1])
+        
+        return BacktestEngine._summary(
+            initial_capital, final_capital, max_drawdown, wins, losses, total_profit, total_loss, executions, daily_equity,
+            ",".join(versions) or None, (total_executions, successful_executions)
+        )
+    
+    @staticmethod
+    def _append_runs(
+        executions: List[Dict],
+        times: pd.DatetimeIndex,
+        prices: np.ndarray,
+        amounts: np.ndarray,
+        statuses: np.ndarray,
+        execution_type: str,
+        quantity: float,
+        time_format: str
+    ):
+        """
+        Agrega los disparos de un tramo a los detalles de simulate_stream
+        
+        Cada compra es un registro; los rechazos seguidos con el mismo estado son uno
+        solo, que sigue al del tramo anterior si el tramo arranca con el mismo rechazo.
+        """
+        rejected = statuses != "EXECUTED"
+        # Empieza un registro en cada compra y en cada cambio de estado
+        starts = np.flatnonzero(~rejected | np.concatenate(([True], statuses[1:] != statuses[:-1])))
+        ends = np.append(starts[1:], len(statuses)) - 1
+        last = executions[-1] if executions else None
+        if rejected[0] and last is not None and last.get("status") == statuses[0]:
+            last["bars"] += int(ends[0] - starts[0] + 1)
+            last["end_date"] = times[ends[0]].strftime(time_format)
+            starts, ends = starts[1:], ends[1:]
+        room = BacktestEngine.STREAM_MAX_DETAILS - len(executions)
+        for start, end in zip(starts[:room].tolist(), ends[:room].tolist()):
+            execution = {
+                "date": times[start].strftime(time_format),
+                "price": float(prices[start]),
+                "type": execution_type,
+                "quantity": quantity,
+                "amount": float(amounts[start]),
+                "status": str(statuses[start])
+            }
+            if rejected[start]:
+                execution["bars"] = end - start + 1
+                execution["end_date"] = times[end].strftime(time_format)
+            executions.append(execution)
+    
+    SWEEP_COLUMNS = [
+        "value_threshold", "quantity", "cooldown_minutes", "trigger_count", "total_executions",
+        "successful_executions", "final_capital", "total_return", "total_profit_loss",
+        "max_drawdown", "win_rate", "profit_factor"
+    ]
+    SWEEP_OBJECTIVES = ("total_return", "total_profit_loss", "win_rate", "profit_factor", "max_drawdown")
+    
+    @staticmethod
+    def sweep(
+        rule: Dict,
+        hist: pd.DataFrame,
+        initial_capital: float = 10000,
+        thresholds: Optional[List[float]] = None,
+        quantities: Optional[List[float]] = None,
+        cooldowns: Optional[List[Optional[float]]] = None,
+        objective: str = "total_return"
+    ) -> Dict:
+        """
+        Backtest de todas las combinaciones de parámetros sobre una misma serie de precios
+        
+        Las señales de todos los umbrales salen de una sola comparación (umbrales x
+        días). Las compras avanzan solo por los días en que alguna combinación se
+        dispara, con el estado de todas las combinaciones en vectores, así que cientos
+        de variantes cuestan poco más que un backtest. Sin cooldown, cada combinación da
+        lo mismo que simulate.
+        
+        Args:
+            rule: Regla base (rule_type, execution_type y valores por defecto)
+            hist: Velas con índice de fechas y columnas Close y High
+            initial_capital: Capital inicial de cada combinación
+            thresholds: Umbrales a probar (por defecto, el de la regla)
+            quantities: Cantidades a probar (por defecto, la de la regla)
+            cooldowns: Cooldowns en minutos a probar (None: sin cooldown)
+            objective: Métrica para elegir la mejor combinación (max_drawdown se minimiza)
+        
+        Returns:
+            Diccionario con columns, rows (una fila por combinación) y best
+        """
+        rule_type = rule.get("rule_type")
+        execution_type = rule.get("execution_type", "ALERT_ONLY")
+        thresholds = thresholds or [float(rule.get("value_threshold", 0))]
+        quantities = quantities or [rule.get("quantity") or 0]
+        cooldowns = cooldowns or [None]
+        
+        unique_thresholds = np.unique(np.asarray(thresholds, dtype=float))
+        combos = [(t, q, c) for t in unique_thresholds.tolist() for q in quantities for c in cooldowns]
+        threshold_row = np.searchsorted(unique_thresholds, [c[0] for c in combos])
+        quantity = np.array([c[1] for c in combos], dtype=float)
+        cooldown = np.array([np.nan if c[2] is None else c[2] * 60 for c in combos], dtype=float)
+        
+        close = hist["Close"].to_numpy(dtype=float)
+        times = hist.index.as_unit("ns").asi8 / 1e9
+        final_price = float(close[-1])
+        executes = execution_type in ["BUY", "SELL"]
+        
+        # Matriz de señales (umbrales x días); solo importan los días con alguna señal
+        grid = BacktestEngine.signals(rule_type, unique_thresholds, hist)
+        active_days = np.flatnonzero(grid.any(axis=0))
+        
+        size = len(combos)
+        last_trigger = np.full(size, -np.inf)
+        triggers = np.zeros(size, dtype=int)
+        fills = np.zeros(size, dtype=int)
+        capital = np.full(size, float(initial_capital))
+        positions_value = np.zeros(size)
+        max_capital = np.full(size, float(initial_capital))
+        max_drawdown = np.zeros(size)
+        wins = np.zeros(size, dtype=int)
+        losses = np.zeros(size, dtype=int)
+        total_profit = np.zeros(size)
+        total_loss = np.zeros(size)
+        no_cooldown = np.isnan(cooldown)
+        
+        for day in active_days:
+            triggered = grid[threshold_row, day]
+            triggered &= no_cooldown | (times[day] - last_trigger >= np.nan_to_num(cooldown))
+            if executes:
+                triggered &= quantity > 0
+            if not triggered.any():
+                continue
+            last_trigger[triggered] = times[day]
+            triggers += triggered
+            if execution_type != "BUY":
+                continue
             
-            # Calcular métricas
+            amount = close[day] * quantity
+            bought = triggered & (capital >= amount)
+            capital = np.where(bought, capital - amount, capital)
+            positions_value = np.where(bought, positions_value + amount, positions_value)
+            fills += bought
+            
+            # Cada posición se cierra al precio final: su resultado se conoce al comprar
+            profit = (final_price - close[day]) * quantity
+            won = bought & (profit > 0)
+            lost = bought & ~(profit > 0)
+            wins += won
+            losses += lost
+            total_profit = np.where(won, total_profit + profit, total_profit)
+            total_loss = np.where(lost, total_loss + np.abs(profit), total_loss)
+            
+            equity = capital + positions_value
+            max_capital = np.maximum(max_capital, equity)
+            max_drawdown = np.maximum(max_drawdown, ((max_capital - equity) / max_capital) * 100)
+        
+        final_capital = capital + fills * final_price * quantity
+        total_executions = triggers if executes else np.zeros(size, dtype=int)
+        closed = wins + losses
+        with np.errstate(invalid="ignore", divide="ignore"):
+            win_rate = np.where(closed > 0, wins / np.maximum(closed, 1) * 100, 0)
+            profit_factor = np.where(total_loss > 0, total_profit / np.where(total_loss > 0, total_loss, 1), total_profit)
+        
+        metrics = {
+            "value_threshold": unique_thresholds[threshold_row],
+            "quantity": quantity,
+            "cooldown_minutes": [c[2] for c in combos],
+            "trigger_count": triggers,
+            "total_executions": total_executions,
+            "successful_executions": fills,
+            "final_capital": final_capital,
+            "total_return": (final_capital - initial_capital) / initial_capital * 100,
+            "total_profit_loss": final_capital - initial_capital,
+            "max_drawdown": max_drawdown,
+            "win_rate": win_rate,
+            "profit_factor": profit_factor
+        }
+        columns = BacktestEngine.SWEEP_COLUMNS
+        rows = [list(row) for row in zip(*[
+            metrics[name] if isinstance(metrics[name], list) else metrics[name].tolist() for name in columns
+        ])]
+        
+        scores = np.asarray(metrics[objective], dtype=float)
+        best = int(np.argmin(scores) if objective == "max_drawdown" else np.argmax(scores))
+        return {
+            "success": True,
+            "combinations": size,
+            "days": len(close),
+            "objective": objective,
+            "columns": columns,
+            "rows": rows,
+            "best": dict(zip(columns, rows[best]), index=best)
+        }
+    
+    @staticmethod
+    def _summary(
+        initial_capital: float,
+        final_capital: float,
+        max_drawdown: float,
+        wins: int,
+        losses: int,
+        total_profit: float,
+        total_loss: float,
+        executions: List[Dict],
+        daily_equity: List[Dict],
+        data_version: Optional[str] = None,
+        execution_counts: Optional[Tuple[int, int]] = None
+    ) -> Dict:
+        total_return = ((final_capital - initial_capital) / initial_capital) * 100
+        total_pl = final_capital - initial_capital
+        
+        # Calcular métricas (execution_counts: totales contados aparte de los detalles)
+        if execution_counts is not None:
+            total_executions, successful_executions = execution_counts
+        else:
             total_executions = len(executions)
             successful_executions = len([e for e in executions if e.get("status") == "EXECUTED"])
-            failed_executions = total_executions - successful_executions
+        failed_executions = total_executions - successful_executions
+        
+        win_rate = (wins / (wins + losses) * 100) if (wins + losses) > 0 else 0
+        profit_factor = (total_profit / total_loss) if total_loss > 0 else (total_profit if total_profit > 0 else 0)
+        
+        # Calcular Sharpe ratio simplificado (requiere más datos)
+        sharpe_ratio = 0  # Placeholder, requiere cálculo de volatilidad
+        
+        return {
+            "success": True,
+            "total_executions": total_executions,
+            "successful_executions": successful_executions,
+            "failed_executions": failed_executions,
+            "final_capital": final_capital,
+            "total_return": total_return,
+            "total_profit_loss": total_pl,
+            "max_drawdown": max_drawdown,
+            "win_rate": win_rate,
+            "profit_factor": profit_factor,
+            "sharpe_ratio": sharpe_ratio,
+            "execution_details": executions,
+            "daily_equity_curve": daily_equity,
+            "data_version": data_version
+        }
+
+    @staticmethod
+    def portfolio(results: List[Dict], initial_capital: float = 10000) -> Dict:
+        """
+        Curva de equity agregada de varios backtests con el mismo capital inicial
+
+        Los tickers con calendarios distintos (acciones y cripto) se alinean por fecha:
+        cada curva arrastra su último valor y, antes de su primera vela, vale el capital
+        inicial.
+
+        Args:
+            results: Resultados exitosos de simulate
+            initial_capital: Capital inicial de cada backtest
+
+        Returns:
+            Dict con initial_equity, final_equity, total_return, max_drawdown y equity_curve
+        """
+        initial_equity = initial_capital * len(results)
+        curves = [
+            pd.Series(
+                [point["equity"] for point in result["daily_equity_curve"]],
+                index=[point["date"] for point in result["daily_equity_curve"]],
+                dtype=float
+            )
+            for result in results
+        ]
+        curves = [curve[~curve.index.duplicated(keep="last")] for curve in curves if not curve.empty]
+        if curves:
+            frame = pd.concat(curves, axis=1).sort_index().ffill().fillna(initial_capital)
+            equity = frame.sum(axis=1)
+            # Las reglas sin velas suman su capital inicial intacto
+            equity += initial_capital * (len(results) - len(curves))
+        else:
+            equity = pd.Series(dtype=float)
+
+        peaks = np.maximum.accumulate(np.concatenate(([initial_equity], equity.to_numpy())))[1:]
+        drawdowns = (peaks - equity.to_numpy()) / peaks * 100 if len(equity) else np.zeros(0)
+        final_equity = float(sum(result["final_capital"] for result in results))
+        return {
+            "initial_equity": initial_equity,
+            "final_equity": final_equity,
+            "total_return": (final_equity - initial_equity) / initial_equity * 100 if initial_equity else 0,
+            "max_drawdown": float(drawdowns.max()) if len(drawdowns) else 0,
+            "equity_curve": [
+                {"date": date, "equity": value} for date, value in zip(equity.index.tolist(), equity.tolist())
+            ]
+        }
+
+    @staticmethod
+    def simulate_loop(rule: Dict, hist: pd.DataFrame, initial_capital: float = 10000) -> Dict:
+        """
+        Backtest día a día (implementación de referencia de simulate)
+        
+        Args:
+            rule: Diccionario con datos de la regla
+            hist: Velas con índice de fechas y columnas Close y High
+            initial_capital: Capital inicial para simulación
+        
+        Returns:
+            Diccionario con resultados del backtest
+        """
+        rule_type = rule.get("rule_type")
+        value_threshold = float(rule.get("value_threshold", 0))
+        execution_type = rule.get("execution_type", "ALERT_ONLY")
+        
+        # Inicializar variables de backtest
+        capital = initial_capital
+        positions = []  # Lista de posiciones abiertas
+        executions = []
+        daily_equity = []
+        max_capital = initial_capital
+        max_drawdown = 0
+        
+        wins = 0
+        losses = 0
+        total_profit = 0
+        total_loss = 0
+        
+        # Iterar sobre cada día
+        for date, row in hist.iterrows():
+            current_price = float(row["Close"])
+            current_date = date.strftime("%Y-%m-%d")
             
-            win_rate = (wins / (wins + losses) * 100) if (wins + losses) > 0 else 0
-            profit_factor = (total_profit / total_loss) if total_loss > 0 else (total_profit if total_profit > 0 else 0)
+            # Evaluar condición de la regla
+            condition_met = False
             
-            # Calcular Sharpe ratio simplificado (requiere más datos)
-            sharpe_ratio = 0  # Placeholder, requiere cálculo de volatilidad
+            if rule_type == "price_below":
+                condition_met = current_price < value_threshold
+            elif rule_type == "price_above":
+                condition_met = current_price > value_threshold
+            elif rule_type in ("pe_below", "pe_above"):
+                # P/E point-in-time de attach_pe (NaN sin 4 trimestres publicados)
+                pe_ratio = float(row["PE"]) if "PE" in row.index else float("nan")
+                condition_met = RuleEvaluator.check_condition(
+                    rule_type, value_threshold, current_price, pe_ratio=None if np.isnan(pe_ratio) else pe_ratio
+                )
+            elif rule_type == "max_distance":
+                high_so_far = float(hist.loc[:date, "High"].max())
+                distance = ((current_price - high_so_far) / high_so_far) * 100
+                condition_met = distance <= value_threshold
             
-            return {
-                "success": True,
-                "total_executions": total_executions,
-                "successful_executions": successful_executions,
-                "failed_executions": failed_executions,
-                "final_capital": final_capital,
-                "total_return": total_return,
-                "total_profit_loss": total_pl,
-                "max_drawdown": max_drawdown,
-                "win_rate": win_rate,
-                "profit_factor": profit_factor,
-                "sharpe_ratio": sharpe_ratio,
-                "execution_details": executions,
-                "daily_equity_curve": daily_equity
-            }
+            # Si la condición se cumple y hay ejecución automática
+            if condition_met and execution_type in ["BUY", "SELL"]:
+                quantity = rule.get("quantity", 0)
+                if quantity > 0:
+                    execution = {
+                        "date": current_date,
+                        "price": current_price,
+                        "type": execution_type,
+                        "quantity": quantity,
+                        "amount": current_price * quantity
+                    }
+                    
+                    if execution_type == "BUY":
+                        if capital >= execution["amount"]:
+                            capital -= execution["amount"]
+                            positions.append({
+                                "entry_price": current_price,
+                                "quantity": quantity,
+                                "entry_date": current_date
+                            })
+                            execution["status"] = "EXECUTED"
+                        else:
+                            execution["status"] = "INSUFFICIENT_FUNDS"
+                    elif execution_type == "SELL":
+                        if positions:
+                            # Vender primera posición
+                            position = positions.pop(0)
+                            profit = (current_price - position["entry_price"]) * quantity
+                            capital += execution["amount"]
+                            
+                            if profit > 0:
+                                wins += 1
+                                total_profit += profit
+                            else:
+                                losses += 1
+                                total_loss += abs(profit)
+                            
+                            execution["status"] = "EXECUTED"
+                            execution["profit_loss"] = profit
+                        else:
+                            execution["status"] = "NO_POSITION"
+                    
+                    executions.append(execution)
             
-        except Exception as e:
-            logger.error(f"Error en backtest: {str(e)}")
-            return {
-                "success": False,
-                "error": str(e)
-            }
-
+            # Calcular equity actual (capital + valor de posiciones)
+            positions_value = sum(p["entry_price"] * p["quantity"] for p in positions)
+            current_equity = capital + positions_value
+            
+            # Actualizar máximo y drawdown
+            if current_equity > max_capital:
+                max_capital = current_equity
+            drawdown = ((max_capital - current_equity) / max_capital) * 100
+            if drawdown > max_drawdown:
+                max_drawdown = drawdown
+            
+            daily_equity.append({
+                "date": current_date,
+                "equity": current_equity,
+                "capital": capital,
+                "positions_value": positions_value
+            })
+        
+        # Cerrar posiciones abiertas al final
+        final_price = float(hist.iloc[-1]["Close"])
+        for position in positions:
+            profit = (final_price - position["entry_price"]) * position["quantity"]
+            capital += final_price * position["quantity"]
+            
+            if profit > 0:
+                wins += 1
+                total_profit += profit
+            else:
+                losses += 1
+                total_loss += abs(profit)
+        
+        return BacktestEngine._summary(
+            initial_capital, capital, max_drawdown, wins, losses, total_profit, total_loss, executions, daily_equity,
+            hist.attrs.get("data_version")
+        )
@@ -0,0 +1,116 @@
+"""
+Agenda de reglas según su cooldown
+Mantiene en memoria cuándo vuelve a estar habilitada cada regla (min-heap) para que el
+worker no evalúe ni pida cotizaciones de reglas que siguen en cooldown
+"""
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COOLDOWN_MINUTES = 60
+
+
+class CooldownSchedule:
+    """
+    Min-heap de (habilitada_desde, rule_id) para las reglas en cooldown
+
+    Las reglas habilitadas están en un set; las que están en cooldown, en el heap.
+    En cada ciclo se sacan del heap solo las que vencieron, así que el trabajo por
+    ciclo depende de las reglas habilitadas y no del total. La hora de habilitación se
+    recalcula únicamente cuando cambian el timestamp de la última ejecución o el
+    cooldown de la regla (por ejemplo, cuando se persiste una ejecución). Las entradas
+    del heap que quedaron viejas se descartan al salir.
+    """
+
+    def __init__(self, timestamp_field: str = "last_execution_at", default_cooldown_minutes: int = DEFAULT_COOLDOWN_MINUTES):
+        """
+        Args:
+            timestamp_field: Campo con la última ejecución (last_execution_at o last_triggered)
+            default_cooldown_minutes: Cooldown de las reglas con cooldown_minutes nulo
+        """
+        self.timestamp_field = timestamp_field
+        self.default_cooldown_minutes = default_cooldown_minutes
+        self._state: Dict[str, Tuple[tuple, float]] = {}  # rule_id -> ((timestamp, cooldown), habilitada_desde)
+        self._heap: List[Tuple[float, str]] = []
+        self._eligible: Set[str] = set()
+
+    def next_eligible_at(self, rule: Dict) -> float:
+        """Epoch desde el que la regla puede volver a dispararse (0 si nunca se ejecutó)"""
+        last = rule.get(self.timestamp_field)
+        if not last:
+            return 0.0
+        try:
+            last_at = datetime.fromisoformat(last.replace('Z', '+00:00')).timestamp()
+        except (AttributeError, ValueError):
+            logger.warning(f"{self.timestamp_field} inválido en regla {rule.get('id')}: {last}")
+            return 0.0
+        cooldown_minutes = rule.get("cooldown_minutes")
+        if cooldown_minutes is None:
+            cooldown_minutes = self.default_cooldown_minutes
+        return last_at + cooldown_minutes * 60
+
+    def sync(self, rules: List[Dict], now: Optional[float] = None):
+        """
+        Actualiza la agenda con las reglas cargadas en este ciclo
+
+        Las reglas nuevas o cuyo timestamp/cooldown cambió se reprograman; las que ya
+        no están (desactivadas o de otra partición) se olvidan.
+        """
+        now = time.time() if now is None else now
+        seen = set()
+        for rule in rules:
+            rule_id = rule.get("id")
+            seen.add(rule_id)
+            key = (rule.get(self.timestamp_field), rule.get("cooldown_minutes"))
+            state = self._state.get(rule_id)
+            if state is not None and state[0] == key:
+                continue
+            next_at = self.next_eligible_at(rule)
+            self._state[rule_id] = (key, next_at)
+            if next_at <= now:
+                self._eligible.add(rule_id)
+            else:
+                self._eligible.discard(rule_id)
+                heapq.heappush(self._heap, (next_at, rule_id))
+
+        if len(seen) != len(self._state):
+            for rule_id in [rule_id for rule_id in self._state if rule_id not in seen]:
+                del self._state[rule_id]
+                self._eligible.discard(rule_id)
+
+    def release_due(self, now: Optional[float] = None) -> int:
+        """Pasa a habilitadas las reglas cuyo cooldown venció"""
+        now = time.time() if now is None else now
+        released = 0
+        while self._heap and self._heap[0][0] <= now:
+            next_at, rule_id = heapq.heappop(self._heap)
+            state = self._state.get(rule_id)
+            # Entrada vieja: la regla se reprogramó o ya no existe
+            if state is None or state[1] != next_at:
+                continue
+            self._eligible.add(rule_id)
+            released += 1
+        return released
+
+    def eligible(self, rules: List[Dict], now: Optional[float] = None) -> List[Dict]:
+        """
+        Sincroniza la agenda y devuelve solo las reglas fuera de cooldown
+
+        Args:
+            rules: Reglas cargadas en este ciclo
+            now: Hora actual (epoch), para tests
+
+        Returns:
+            Las reglas habilitadas, en el orden recibido
+        """
+        now = time.time() if now is None else now
+        self.sync(rules, now)
+        self.release_due(now)
+        return [rule for rule in rules if rule.get("id") in self._eligible]
+
+    def cooling_count(self) -> int:
+        return len(self._state) - len(self._eligible)
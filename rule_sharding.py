@@ -0,0 +1,200 @@
+"""
+Sharding de workers de reglas con ownership por leases
+Reparte las reglas por hash del ticker en particiones fijas y mantiene los leases
+de las particiones que posee este worker mediante heartbeats contra Supabase
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITIONS = 64
+# Segundos. El vencimiento local (ttl - ttl / 6) tiene que superar la orden más lenta
+# más la latencia del buffer de ejecuciones, para que el lease no venza entre el envío
+# de una orden y la escritura de last_execution_at. Los timeouts de broker_http son
+# plazos totales; en IOL, el peor caso es token (10s) + orden (30s) y, si la orden da
+# 401, otro token y otra orden: 80s
+DEFAULT_LEASE_TTL = 120
+
+
+def partition_for_ticker(ticker: str, num_partitions: int) -> int:
+    """
+    Calcula la partición de un ticker con un hash estable entre procesos
+
+    Args:
+        ticker: Símbolo del activo
+        num_partitions: Cantidad total de particiones
+
+    Returns:
+        Número de partición en [0, num_partitions)
+    """
+    return zlib.crc32((ticker or "").strip().upper().encode()) % num_partitions
+
+
+def default_worker_id() -> str:
+    """Identificador único del proceso: host, pid y sufijo aleatorio"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class PartitionLeaseManager:
+    """
+    Mantiene los leases de particiones de este worker
+
+    El vencimiento local de cada lease se calcula desde el momento en que se envió
+    el heartbeat (no desde la respuesta) y se le resta un margen de seguridad, por lo
+    que siempre vence localmente antes que en la base de datos. La base solo entrega
+    una partición a otro worker cuando el lease ya venció allí, así que nunca hay dos
+    dueños simultáneos aunque un heartbeat se demore o falle.
+
+    Al perder particiones (rebalanceo o stop) se llama a on_release, por ejemplo para
+    persistir las ejecuciones en buffer antes de que el nuevo dueño lea las reglas.
+    """
+
+    def __init__(
+        self,
+        supabase_client,
+        worker_id: Optional[str] = None,
+        num_partitions: int = DEFAULT_PARTITIONS,
+        lease_ttl: int = DEFAULT_LEASE_TTL,
+        heartbeat_interval: Optional[float] = None,
+        safety_margin: Optional[float] = None,
+        on_release: Optional[Callable[[Set[int]], None]] = None,
+    ):
+        """
+        Args:
+            supabase_client: Cliente de Supabase (service role)
+            worker_id: Identificador del worker (se genera si no se indica)
+            num_partitions: Cantidad total de particiones
+            lease_ttl: Duración del lease en segundos
+            heartbeat_interval: Segundos entre heartbeats (por defecto ttl / 3)
+            safety_margin: Segundos que se descuentan al vencimiento local (por defecto ttl / 6)
+            on_release: Se llama con las particiones perdidas (desde el thread de heartbeat)
+        """
+        self.supabase = supabase_client
+        self.worker_id = worker_id or default_worker_id()
+        self.num_partitions = num_partitions
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else lease_ttl / 3
+        self.safety_margin = safety_margin if safety_margin is not None else lease_ttl / 6
+        self.on_release = on_release
+        self._leases: Dict[int, float] = {}  # partition_id -> vencimiento local (time.monotonic)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, supabase_client, on_release: Optional[Callable[[Set[int]], None]] = None) -> "PartitionLeaseManager":
+        """Crea el manager usando RULE_WORKER_ID, RULE_WORKER_PARTITIONS y RULE_WORKER_LEASE_TTL"""
+        return cls(
+            supabase_client,
+            worker_id=os.getenv("RULE_WORKER_ID") or None,
+            num_partitions=int(os.getenv("RULE_WORKER_PARTITIONS", str(DEFAULT_PARTITIONS))),
+            lease_ttl=int(os.getenv("RULE_WORKER_LEASE_TTL", str(DEFAULT_LEASE_TTL))),
+            on_release=on_release,
+        )
+
+    def _released(self, partitions: Set[int]):
+        if partitions and self.on_release is not None:
+            try:
+                self.on_release(partitions)
+            except Exception as e:
+                logger.error(f"Error al liberar {len(partitions)} particiones: {str(e)}")
+
+    def heartbeat(self) -> Set[int]:
+        """
+        Renueva los leases propios y rebalancea contra los demás workers
+
+        Returns:
+            Conjunto de particiones que posee este worker tras el heartbeat
+        """
+        sent_at = time.monotonic()
+        try:
+            response = self.supabase.rpc("heartbeat_rule_worker", {
+                "p_worker_id": self.worker_id,
+                "p_partitions": self.num_partitions,
+                "p_ttl_seconds": self.lease_ttl
+            }).execute()
+        except Exception as e:
+            logger.error(f"Error en heartbeat del worker {self.worker_id}: {str(e)}")
+            return self.owned_partitions()
+
+        expires_at = sent_at + self.lease_ttl - self.safety_margin
+        owned = {int(row["partition_id"]) for row in (response.data or [])}
+
+        with self._lock:
+            previous = set(self._leases)
+            self._leases = {partition_id: expires_at for partition_id in owned}
+
+        gained = owned - previous
+        lost = previous - owned
+        if gained or lost:
+            logger.info(
+                f"Worker {self.worker_id} rebalanceado: {len(owned)} particiones "
+                f"(+{len(gained)} / -{len(lost)})"
+            )
+        self._released(lost)
+        return owned
+
+    def owned_partitions(self) -> Set[int]:
+        """Particiones cuyo lease sigue vigente localmente"""
+        now = time.monotonic()
+        with self._lock:
+            return {partition_id for partition_id, expires in self._leases.items() if expires > now}
+
+    def owns_ticker(self, ticker: str) -> bool:
+        """Indica si este worker es el dueño actual de la partición del ticker"""
+        partition_id = partition_for_ticker(ticker, self.num_partitions)
+        now = time.monotonic()
+        with self._lock:
+            return self._leases.get(partition_id, 0) > now
+
+    def filter_rules(self, rules: Iterable[Dict]) -> List[Dict]:
+        """Filtra las reglas cuyo ticker pertenece a una partición propia"""
+        owned = self.owned_partitions()
+        return [
+            rule for rule in rules
+            if partition_for_ticker(rule.get("ticker") or "", self.num_partitions) in owned
+        ]
+
+    def _heartbeat_loop(self):
+        """Loop del thread de heartbeat (independiente del event loop del worker)"""
+        while not self._stop_event.wait(self.heartbeat_interval):
+            self.heartbeat()
+
+    def start(self):
+        """Hace el primer heartbeat y arranca el thread de renovación"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.heartbeat()
+        self._thread = threading.Thread(
+            target=self._heartbeat_loop,
+            name=f"lease-heartbeat-{self.worker_id}",
+            daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            f"Worker {self.worker_id} iniciado con {self.num_partitions} particiones "
+            f"(lease {self.lease_ttl}s)"
+        )
+
+    def stop(self):
+        """Detiene los heartbeats y libera los leases en la base de datos"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.heartbeat_interval + 1)
+        with self._lock:
+            released = set(self._leases)
+            self._leases = {}
+        self._released(released)
+        try:
+            self.supabase.rpc("release_rule_worker", {"p_worker_id": self.worker_id}).execute()
+            logger.info(f"Leases liberados para worker {self.worker_id}")
+        except Exception as e:
+            logger.error(f"Error liberando leases del worker {self.worker_id}: {str(e)}")
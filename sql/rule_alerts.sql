@@ -0,0 +1,57 @@
+-- ============================================
+-- ALERT PIPELINE (ALERT_ONLY RULES)
+-- ============================================
+-- Soporte para alert_pipeline.py: las reglas ALERT_ONLY se evalúan en lote en el
+-- worker y las alertas generadas se guardan con una sola llamada por lote.
+
+-- ============================================
+-- 1. INDEXES
+-- ============================================
+
+-- Carga paginada de reglas de alerta activas
+CREATE INDEX IF NOT EXISTS idx_rules_active_alert_only
+    ON public.rules(id)
+    WHERE is_active = TRUE AND execution_type = 'ALERT_ONLY';
+
+-- ============================================
+-- 2. BATCHED ALERT PERSISTENCE
+-- ============================================
+
+-- Inserts a batch of alerts and updates rules.last_triggered in a single round-trip.
+-- Rows carry a client-generated id so a retried batch is idempotent.
+CREATE OR REPLACE FUNCTION record_rule_alerts(p_alerts JSONB)
+RETURNS SETOF public.alerts AS $$
+BEGIN
+    RETURN QUERY
+    WITH inserted AS (
+        INSERT INTO public.alerts (id, user_id, rule_id, ticker, message, alert_type, created_at)
+        SELECT
+            COALESCE(x.id, gen_random_uuid()), x.user_id, x.rule_id, x.ticker, x.message,
+            x.alert_type, COALESCE(x.created_at, NOW())
+        FROM jsonb_to_recordset(p_alerts) AS x(
+            id UUID,
+            user_id UUID,
+            rule_id UUID,
+            ticker TEXT,
+            message TEXT,
+            alert_type TEXT,
+            created_at TIMESTAMPTZ
+        )
+        ON CONFLICT (id) DO NOTHING
+        RETURNING *
+    ), touched AS (
+        UPDATE public.rules r
+        SET last_triggered = t.last_at
+        FROM (
+            SELECT i.rule_id, MAX(i.created_at) AS last_at
+            FROM inserted i
+            WHERE i.rule_id IS NOT NULL
+            GROUP BY i.rule_id
+        ) t
+        WHERE r.id = t.rule_id
+          AND (r.last_triggered IS NULL OR r.last_triggered < t.last_at)
+        RETURNING r.id
+    )
+    SELECT * FROM inserted;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
@@ -0,0 +1,74 @@
+-- ============================================
+-- RULE BACKTEST BATCHES
+-- ============================================
+-- Backtest en lote de varias reglas de un usuario (o de una watchlist con una
+-- regla plantilla). Cada ticker se descarga una sola vez, las reglas se simulan
+-- en paralelo y los resultados se guardan con un solo insert en rule_backtests
+-- (batch_id) más la curva de equity agregada del portafolio.
+
+-- ============================================
+-- 1. RULE BACKTEST BATCHES TABLE
+-- ============================================
+
+CREATE TABLE IF NOT EXISTS public.rule_backtest_batches (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID NOT NULL REFERENCES auth.users(id) ON DELETE CASCADE,
+
+    -- Origen: reglas del usuario o watchlist + plantilla
+    source VARCHAR(20) NOT NULL DEFAULT 'rules' CHECK (source IN ('rules', 'watchlist')),
+    watchlist_id UUID REFERENCES public.watchlists(id) ON DELETE SET NULL,
+    template JSONB,
+
+    -- Parámetros
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    initial_capital DECIMAL(20, 4) NOT NULL DEFAULT 10000, -- Por regla
+    rule_count INTEGER NOT NULL DEFAULT 0,
+    ticker_count INTEGER NOT NULL DEFAULT 0,
+
+    -- Resultados agregados
+    completed_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    final_equity DECIMAL(20, 4),
+    total_return DECIMAL(10, 4),
+    max_drawdown DECIMAL(10, 4),
+    results JSONB, -- Resumen por regla/ticker
+    portfolio_equity_curve JSONB, -- Suma diaria de las curvas de equity
+
+    -- Estado
+    status VARCHAR(20) NOT NULL DEFAULT 'PENDING' CHECK (status IN ('PENDING', 'RUNNING', 'COMPLETED', 'FAILED', 'CANCELLED')),
+    progress SMALLINT NOT NULL DEFAULT 0 CHECK (progress BETWEEN 0 AND 100),
+    progress_message TEXT,
+    error_message TEXT,
+
+    -- Timestamps
+    started_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_rule_backtest_batches_user_id ON public.rule_backtest_batches(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_rule_backtest_batches_active
+ON public.rule_backtest_batches(user_id)
+WHERE status IN ('PENDING', 'RUNNING');
+
+-- ============================================
+-- 2. RULE BACKTESTS BATCH REFERENCE
+-- ============================================
+
+ALTER TABLE public.rule_backtests
+ADD COLUMN IF NOT EXISTS batch_id UUID REFERENCES public.rule_backtest_batches(id) ON DELETE CASCADE;
+
+CREATE INDEX IF NOT EXISTS idx_rule_backtests_batch_id ON public.rule_backtests(batch_id);
+
+-- ============================================
+-- 3. ROW LEVEL SECURITY
+-- ============================================
+
+ALTER TABLE public.rule_backtest_batches ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Users can view own rule backtest batches" ON public.rule_backtest_batches;
+CREATE POLICY "Users can view own rule backtest batches"
+    ON public.rule_backtest_batches FOR SELECT
+    USING (auth.uid() = user_id);
@@ -0,0 +1,9 @@
+-- ============================================
+-- RULE BACKTEST DATA VERSION
+-- ============================================
+-- Versión de las velas con que corrió cada backtest (caché de bar_cache.py, por
+-- ejemplo "yahoo:AAPL:1d:v3"); con ella el backtest se puede reproducir aunque el
+-- proveedor haya corregido precios después.
+
+ALTER TABLE public.rule_backtests
+ADD COLUMN IF NOT EXISTS data_version TEXT;
@@ -0,0 +1,9 @@
+-- ============================================
+-- RULE BACKTEST INTERVAL
+-- ============================================
+-- Intervalo de las velas de cada backtest (1d, 1h, 5m, 1m...). Los intradiarios se
+-- simulan por tramos y su curva de equity tiene un punto por día; las ejecuciones
+-- llevan fecha y hora ("2024-03-01 10:35").
+
+ALTER TABLE public.rule_backtests
+ADD COLUMN IF NOT EXISTS interval TEXT NOT NULL DEFAULT '1d';
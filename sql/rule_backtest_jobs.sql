@@ -0,0 +1,15 @@
+-- ============================================
+-- RULE BACKTEST JOBS
+-- ============================================
+-- Los backtests se encolan (PENDING) y corren en segundo plano; el progreso se
+-- informa en rule_backtests para que el frontend lo consulte con
+-- GET /api/backtests/{backtest_id}.
+
+ALTER TABLE public.rule_backtests
+ADD COLUMN IF NOT EXISTS progress SMALLINT NOT NULL DEFAULT 0 CHECK (progress BETWEEN 0 AND 100),
+ADD COLUMN IF NOT EXISTS progress_message TEXT;
+
+-- Backtests activos por usuario (límite de admisión)
+CREATE INDEX IF NOT EXISTS idx_rule_backtests_user_active
+ON public.rule_backtests(user_id)
+WHERE status IN ('PENDING', 'RUNNING');
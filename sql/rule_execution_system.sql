@@ -261,3 +261,60 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql SECURITY DEFINER;
 
+
+-- ============================================
+-- 7. BATCHED EXECUTION PERSISTENCE
+-- ============================================
+
+-- Inserts a batch of executions and updates rules.last_execution_at in a single
+-- round-trip. Rows carry a client-generated id so replaying a local spool after a
+-- crash is idempotent (ON CONFLICT DO NOTHING).
+CREATE OR REPLACE FUNCTION record_rule_executions(p_executions JSONB)
+RETURNS SETOF public.rule_executions AS $$
+BEGIN
+    RETURN QUERY
+    WITH inserted AS (
+        INSERT INTO public.rule_executions (
+            id, rule_id, user_id, broker_connection_id, execution_type, ticker,
+            quantity, price, total_amount, status, error_message, broker_response,
+            broker_order_id, triggered_at, executed_at
+        )
+        SELECT
+            COALESCE(x.id, gen_random_uuid()), x.rule_id, x.user_id, x.broker_connection_id,
+            x.execution_type, x.ticker, x.quantity, x.price, x.total_amount, x.status,
+            x.error_message, x.broker_response, x.broker_order_id,
+            COALESCE(x.triggered_at, NOW()), x.executed_at
+        FROM jsonb_to_recordset(p_executions) AS x(
+            id UUID,
+            rule_id UUID,
+            user_id UUID,
+            broker_connection_id UUID,
+            execution_type VARCHAR,
+            ticker VARCHAR,
+            quantity DECIMAL,
+            price DECIMAL,
+            total_amount DECIMAL,
+            status VARCHAR,
+            error_message TEXT,
+            broker_response JSONB,
+            broker_order_id VARCHAR,
+            triggered_at TIMESTAMPTZ,
+            executed_at TIMESTAMPTZ
+        )
+        ON CONFLICT (id) DO NOTHING
+        RETURNING *
+    ), touched AS (
+        UPDATE public.rules r
+        SET last_execution_at = t.last_at
+        FROM (
+            SELECT i.rule_id, MAX(COALESCE(i.executed_at, i.triggered_at)) AS last_at
+            FROM inserted i
+            GROUP BY i.rule_id
+        ) t
+        WHERE r.id = t.rule_id
+          AND (r.last_execution_at IS NULL OR r.last_execution_at < t.last_at)
+        RETURNING r.id
+    )
+    SELECT * FROM inserted;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
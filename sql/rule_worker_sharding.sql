@@ -0,0 +1,134 @@
+-- ============================================
+-- RULE WORKER SHARDING (LEASE-BASED OWNERSHIP)
+-- ============================================
+-- Permite correr varias instancias de workers/rule_executor_worker.py.
+-- Las reglas se reparten por hash del ticker en particiones fijas; cada
+-- particion tiene un lease con vencimiento que un solo worker puede tener.
+
+-- ============================================
+-- 1. RULE WORKERS TABLE
+-- ============================================
+-- Workers vivos (heartbeat reciente). Se usa para calcular el reparto justo.
+
+CREATE TABLE IF NOT EXISTS public.rule_workers (
+    worker_id VARCHAR(200) PRIMARY KEY,
+    heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- ============================================
+-- 2. RULE WORKER LEASES TABLE
+-- ============================================
+-- Un registro por particion. Un lease vencido puede ser reclamado por otro worker.
+
+CREATE TABLE IF NOT EXISTS public.rule_worker_leases (
+    partition_id INTEGER PRIMARY KEY,
+    worker_id VARCHAR(200),
+    lease_expires_at TIMESTAMPTZ,
+    acquired_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_rule_worker_leases_worker_id ON public.rule_worker_leases(worker_id);
+
+-- Solo el service role (workers) accede a estas tablas
+ALTER TABLE public.rule_workers ENABLE ROW LEVEL SECURITY;
+ALTER TABLE public.rule_worker_leases ENABLE ROW LEVEL SECURITY;
+
+-- ============================================
+-- 3. HEARTBEAT / REBALANCE FUNCTION
+-- ============================================
+-- Una sola llamada por heartbeat, atomica:
+--   1. registra el heartbeat del worker y elimina workers muertos
+--   2. libera las particiones que exceden el reparto justo (sin renovar su lease,
+--      asi nadie las toma antes de que venza el lease anterior)
+--   3. renueva los leases propios
+--   4. reclama particiones libres o vencidas hasta completar el reparto justo
+-- Devuelve los leases que el worker posee al terminar.
+
+CREATE OR REPLACE FUNCTION heartbeat_rule_worker(
+    p_worker_id VARCHAR,
+    p_partitions INTEGER,
+    p_ttl_seconds INTEGER
+)
+RETURNS TABLE (
+    partition_id INTEGER,
+    lease_expires_at TIMESTAMPTZ
+) AS $$
+DECLARE
+    v_live_workers INTEGER;
+    v_fair_share INTEGER;
+    v_owned INTEGER;
+    v_ttl INTERVAL := (p_ttl_seconds || ' seconds')::INTERVAL;
+BEGIN
+    INSERT INTO public.rule_worker_leases (partition_id)
+    SELECT generate_series(0, p_partitions - 1)
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO public.rule_workers (worker_id, heartbeat_at)
+    VALUES (p_worker_id, NOW())
+    ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = NOW();
+
+    DELETE FROM public.rule_workers w
+    WHERE w.heartbeat_at < NOW() - v_ttl;
+
+    SELECT COUNT(*) INTO v_live_workers FROM public.rule_workers;
+    v_fair_share := CEIL(p_partitions::NUMERIC / GREATEST(v_live_workers, 1));
+
+    -- Liberar excedente (conserva lease_expires_at para evitar solapamiento)
+    UPDATE public.rule_worker_leases l
+    SET worker_id = NULL, updated_at = NOW()
+    WHERE l.partition_id IN (
+        SELECT o.partition_id FROM public.rule_worker_leases o
+        WHERE o.worker_id = p_worker_id
+        ORDER BY o.partition_id DESC
+        OFFSET v_fair_share
+    );
+
+    -- Renovar leases propios
+    UPDATE public.rule_worker_leases l
+    SET lease_expires_at = NOW() + v_ttl, updated_at = NOW()
+    WHERE l.worker_id = p_worker_id;
+
+    SELECT COUNT(*) INTO v_owned FROM public.rule_worker_leases l WHERE l.worker_id = p_worker_id;
+
+    -- Reclamar particiones libres o vencidas
+    IF v_owned < v_fair_share THEN
+        UPDATE public.rule_worker_leases l
+        SET worker_id = p_worker_id,
+            lease_expires_at = NOW() + v_ttl,
+            acquired_at = NOW(),
+            updated_at = NOW()
+        WHERE l.partition_id IN (
+            SELECT c.partition_id FROM public.rule_worker_leases c
+            WHERE c.partition_id < p_partitions
+              AND (c.lease_expires_at IS NULL OR c.lease_expires_at < NOW())
+            ORDER BY c.partition_id
+            LIMIT v_fair_share - v_owned
+            FOR UPDATE SKIP LOCKED
+        );
+    END IF;
+
+    RETURN QUERY
+    SELECT l.partition_id, l.lease_expires_at
+    FROM public.rule_worker_leases l
+    WHERE l.worker_id = p_worker_id
+    ORDER BY l.partition_id;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- ============================================
+-- 4. RELEASE FUNCTION
+-- ============================================
+-- Llamada en el apagado ordenado: libera todo sin esperar al vencimiento.
+
+CREATE OR REPLACE FUNCTION release_rule_worker(p_worker_id VARCHAR)
+RETURNS VOID AS $$
+BEGIN
+    UPDATE public.rule_worker_leases
+    SET worker_id = NULL, lease_expires_at = NULL, updated_at = NOW()
+    WHERE worker_id = p_worker_id;
+
+    DELETE FROM public.rule_workers WHERE worker_id = p_worker_id;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
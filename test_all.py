@@ -15,6 +15,7 @@ os.environ["SUPABASE_SERVICE_KEY"] = "test-key"
 os.environ["SUPABASE_ANON_KEY"] = "test-anon-key"
 os.environ["SUPABASE_JWT_SECRET"] = "test-jwt-secret"
 os.environ["BREVO_API_KEY"] = "test-brevo-key"
+os.environ["EMAIL_OUTBOX_PATH"] = os.path.join(__import__("tempfile").mkdtemp(), "email_outbox.db")
 
 # Import app after setting env vars
 from app_supabase import app, supabase, get_current_user, send_alert_email
@@ -117,19 +118,31 @@ def sample_coupon_data():
     }
 
 @pytest.fixture
-def mock_brevo_api():
-    """Mock Brevo API client"""
-    with patch('app_supabase.TransactionalEmailsApi') as mock_api_class:
-        mock_api_instance = MagicMock()
-        mock_api_class.return_value = mock_api_instance
-        
-        # Mock successful response
-        mock_response = MagicMock()
-        mock_response.message_id = "test-message-id-123"
-        mock_api_instance.send_transac_email.return_value = mock_response
-        
+def mock_brevo_api(tmp_path):
+    """Mock Brevo API client behind a temporary email outbox"""
+    from email_outbox import EmailOutbox, BrevoClient
+    
+    mock_api_instance = MagicMock()
+    
+    # Mock successful response
+    mock_response = MagicMock()
+    mock_response.message_id = "test-message-id-123"
+    mock_response.message_ids = None
+    mock_api_instance.send_transac_email.return_value = mock_response
+    
+    brevo_client = BrevoClient("test-brevo-key")
+    brevo_client.api = mock_api_instance
+    outbox = EmailOutbox(str(tmp_path / "outbox.db"), client=brevo_client, rate_per_second=1000)
+    
+    with patch('app_supabase.email_outbox', outbox):
         yield mock_api_instance
 
+def flush_email_outbox():
+    """Run the outbox sender once (handlers only enqueue)"""
+    import asyncio
+    import app_supabase
+    return asyncio.run(app_supabase.email_outbox.send_due())
+
 @pytest.fixture
 def mock_supabase_auth():
     """Mock Supabase Auth for user registration"""
@@ -665,41 +678,34 @@ class TestSendAlertEmail:
     """Test the send_alert_email function"""
     
     def test_send_email_success(self, mock_brevo_api):
-        """Test successful email sending"""
-        with patch('app_supabase.Configuration') as mock_config, \
-             patch('app_supabase.ApiClient') as mock_api_client:
-            
-            # Mock Configuration with all necessary attributes
-            mock_config_instance = MagicMock()
-            mock_config.return_value = mock_config_instance
-            mock_config_instance.api_key = {}
-            mock_config_instance.assert_hostname = None
-            
-            # Mock ApiClient to return our mocked TransactionalEmailsApi
-            mock_client_instance = MagicMock()
-            mock_api_client.return_value = mock_client_instance
-            
-            result = send_alert_email(
-                to_email="test@example.com",
-                subject="Test Subject",
-                html_content="<html>Test Content</html>",
-                sender_name="BullAnalytics",
-                sender_email="noreply@aperturaia.com"
-            )
-            
-            assert result["success"] is True
-            assert result["message_id"] == "test-message-id-123"
-            assert result["to"] == "test@example.com"
-            
-            # Verify Brevo API was called correctly
-            mock_brevo_api.send_transac_email.assert_called_once()
-            call_args = mock_brevo_api.send_transac_email.call_args[0][0]
-            
-            assert call_args['to'][0]['email'] == "test@example.com"
-            assert call_args['subject'] == "Test Subject"
-            assert call_args['htmlContent'] == "<html>Test Content</html>"
-            assert call_args['sender']['name'] == "BullAnalytics"
-            assert call_args['sender']['email'] == "noreply@aperturaia.com"
+        """Test email is queued and then sent by the outbox sender"""
+        import app_supabase
+        result = send_alert_email(
+            to_email="test@example.com",
+            subject="Test Subject",
+            html_content="<html>Test Content</html>",
+            sender_name="BullAnalytics",
+            sender_email="noreply@aperturaia.com"
+        )
+        
+        assert result["success"] is True
+        assert result["queued"] is True
+        assert result["to"] == "test@example.com"
+        
+        # Handlers only enqueue: nothing sent yet
+        mock_brevo_api.send_transac_email.assert_not_called()
+        assert flush_email_outbox() == 1
+        
+        # Verify Brevo API was called correctly
+        mock_brevo_api.send_transac_email.assert_called_once()
+        call_args = mock_brevo_api.send_transac_email.call_args[0][0]
+        
+        assert call_args['to'][0]['email'] == "test@example.com"
+        assert call_args['subject'] == "Test Subject"
+        assert call_args['htmlContent'] == "<html>Test Content</html>"
+        assert call_args['sender']['name'] == "BullAnalytics"
+        assert call_args['sender']['email'] == "noreply@aperturaia.com"
+        assert app_supabase.email_outbox.stats() == {"sent": 1}
     
     def test_send_email_no_api_key(self):
         """Test email sending fails when BREVO_API_KEY is not set"""
@@ -715,25 +721,23 @@ class TestSendAlertEmail:
     
     def test_send_email_api_exception(self, mock_brevo_api):
         """Test handling of Brevo API exceptions"""
+        import app_supabase
         from sib_api_v3_sdk.rest import ApiException
         
         # Mock API exception
         api_error = ApiException(status=400, reason="Bad Request")
         mock_brevo_api.send_transac_email.side_effect = api_error
         
-        with patch('app_supabase.Configuration') as mock_config:
-            mock_config_instance = MagicMock()
-            mock_config.return_value = mock_config_instance
-            mock_config_instance.api_key = {}
-            
-            result = send_alert_email(
-                to_email="test@example.com",
-                subject="Test Subject",
-                html_content="<html>Test Content</html>"
-            )
-            
-            assert result["success"] is False
-            assert "error" in result
+        result = send_alert_email(
+            to_email="test@example.com",
+            subject="Test Subject",
+            html_content="<html>Test Content</html>"
+        )
+        
+        assert result["success"] is True
+        assert flush_email_outbox() == 0
+        # 400 is permanent: not retried
+        assert app_supabase.email_outbox.stats() == {"failed": 1}
 
 class TestUserRegistrationEmailFlow:
     """Test the complete user registration flow with email sending"""
@@ -747,21 +751,9 @@ class TestUserRegistrationEmailFlow:
         mock_create_default_subscription
     ):
         """Test that user registration triggers onboarding email"""
-        with patch('app_supabase.Configuration') as mock_config, \
-             patch('app_supabase.ApiClient') as mock_api_client, \
-             patch('app_supabase.ensure_user_persisted') as mock_ensure_user, \
+        with patch('app_supabase.ensure_user_persisted') as mock_ensure_user, \
              patch('asyncio.sleep') as mock_sleep:
             
-            # Setup mocks
-            mock_config_instance = MagicMock()
-            mock_config.return_value = mock_config_instance
-            mock_config_instance.api_key = {}
-            mock_config_instance.assert_hostname = None
-            
-            # Mock ApiClient
-            mock_client_instance = MagicMock()
-            mock_api_client.return_value = mock_client_instance
-            
             # Mock asyncio.sleep to return immediately
             async def mock_sleep_func(delay):
                 return None
@@ -794,21 +786,23 @@ class TestUserRegistrationEmailFlow:
             assert "access_token" in data
             assert data["user"]["email"] == "test@example.com"
             
-            # Verify email was sent
-            mock_brevo_api.send_transac_email.assert_called_once()
-            call_args = mock_brevo_api.send_transac_email.call_args[0][0]
-            
-            # Verify email details
-            assert call_args['to'][0]['email'] == "test@example.com"
-            assert "¡Bienvenido a BullAnalytics!" in call_args['subject']
-            assert "test" in call_args['htmlContent']
-            assert "BullAnalytics" in call_args['htmlContent']
-            assert call_args['sender']['name'] == "BullAnalytics"
-            assert call_args['sender']['email'] == "noreply@aperturaia.com"
+        # Verify email was queued, then sent by the outbox sender
+        assert flush_email_outbox() == 1
+        mock_brevo_api.send_transac_email.assert_called_once()
+        call_args = mock_brevo_api.send_transac_email.call_args[0][0]
+        
+        # Verify email details
+        assert call_args['to'][0]['email'] == "test@example.com"
+        assert "¡Bienvenido a BullAnalytics!" in call_args['subject']
+        assert "test" in call_args['htmlContent']
+        assert "BullAnalytics" in call_args['htmlContent']
+        assert call_args['sender']['name'] == "BullAnalytics"
+        assert call_args['sender']['email'] == "noreply@aperturaia.com"
     
     def test_signup_email_failure_does_not_block_registration(
         self,
         client,
+        mock_brevo_api,
         mock_supabase_auth,
         mock_supabase_table,
         mock_create_default_subscription
@@ -816,30 +810,16 @@ class TestUserRegistrationEmailFlow:
         """Test that email sending failure doesn't prevent user registration"""
         from sib_api_v3_sdk.rest import ApiException
         
-        with patch('app_supabase.Configuration') as mock_config, \
-             patch('app_supabase.ApiClient') as mock_api_client, \
-             patch('app_supabase.TransactionalEmailsApi') as mock_api_class, \
-             patch('app_supabase.ensure_user_persisted') as mock_ensure_user, \
+        with patch('app_supabase.ensure_user_persisted') as mock_ensure_user, \
              patch('asyncio.sleep') as mock_sleep:
             
-            mock_config_instance = MagicMock()
-            mock_config.return_value = mock_config_instance
-            mock_config_instance.api_key = {}
-            mock_config_instance.assert_hostname = None
-            
-            # Mock ApiClient
-            mock_client_instance = MagicMock()
-            mock_api_client.return_value = mock_client_instance
-            
             # Mock asyncio.sleep
             async def mock_sleep_func(delay):
                 return None
             mock_sleep.side_effect = mock_sleep_func
             
             # Mock email API to fail
-            mock_api_instance = MagicMock()
-            mock_api_class.return_value = mock_api_instance
-            mock_api_instance.send_transac_email.side_effect = ApiException(
+            mock_brevo_api.send_transac_email.side_effect = ApiException(
                 status=500,
                 reason="Internal Server Error"
             )
@@ -866,6 +846,11 @@ class TestUserRegistrationEmailFlow:
             response = client.post("/auth/signup", json=signup_data)
             assert response.status_code == 200
             assert "access_token" in response.json()
+        
+        # The failed send stays in the outbox for a retry
+        import app_supabase
+        assert flush_email_outbox() == 0
+        assert app_supabase.email_outbox.stats() == {"pending": 1}
 
 # ============================================================================
 # TESTS DE INTEGRACIÓN
@@ -1076,6 +1061,35 @@ class TestHealthCheck:
 # TESTS DE CONEXIONES DE BROKER
 # ============================================================================
 
+@pytest.fixture
+def fake_broker_server():
+    """
+    Local fake IOL/Binance server on the shared broker HTTP transport.
+    Routes map (method, path) to a response or a callable(request) -> response.
+    """
+    import httpx
+    import broker_http
+    from conexion_iol import iol_token_manager
+    from binance_prices import binance_price_table
+    
+    routes = {}
+    received = []
+    
+    def handler(request):
+        received.append(request)
+        route = routes.get((request.method, request.url.path))
+        if route is None:
+            return httpx.Response(404, text="Not found")
+        return route(request) if callable(route) else route
+    
+    broker_http.set_transport(httpx.MockTransport(handler))
+    iol_token_manager._tokens.clear()
+    binance_price_table.clear()
+    yield routes, received
+    broker_http.set_transport(None)
+    iol_token_manager._tokens.clear()
+    binance_price_table.clear()
+
 @pytest.mark.unit
 class TestConexionIOL:
     """Test suite for IOL connection module"""
@@ -1087,50 +1101,41 @@ class TestConexionIOL:
         assert conexion.password == "test_pass"
         assert conexion.access_token is None
     
-    @patch('conexion_iol.requests.post')
-    def test_iol_autenticar_success(self, mock_post):
+    def test_iol_autenticar_success(self, fake_broker_server):
         """Test successful IOL authentication"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"access_token": "test-token-123"}
-        mock_post.return_value = mock_response
+        import httpx
+        routes, _ = fake_broker_server
+        routes[("POST", "/token")] = httpx.Response(200, json={"access_token": "test-token-123"})
         
         conexion = ConexionIOL("test_user", "test_pass")
         import asyncio
         result = asyncio.run(conexion.autenticar())
         
-        assert result is True
+        assert result == "test-token-123"
         assert conexion.access_token == "test-token-123"
     
-    @patch('conexion_iol.requests.post')
-    def test_iol_autenticar_failure(self, mock_post):
+    def test_iol_autenticar_failure(self, fake_broker_server):
         """Test failed IOL authentication"""
-        mock_response = Mock()
-        mock_response.status_code = 401
-        mock_response.text = "Invalid credentials"
-        mock_post.return_value = mock_response
+        import httpx
+        routes, _ = fake_broker_server
+        routes[("POST", "/token")] = httpx.Response(401, text="Invalid credentials")
         
         conexion = ConexionIOL("test_user", "test_pass")
         import asyncio
         result = asyncio.run(conexion.autenticar())
         
-        assert result is False
+        assert result is None
         assert conexion.access_token is None
     
-    @patch('conexion_iol.requests.get')
-    @patch('conexion_iol.requests.post')
-    def test_iol_obtener_portfolio_success(self, mock_post, mock_get):
+    def test_iol_obtener_portfolio_success(self, fake_broker_server):
         """Test successful portfolio retrieval from IOL"""
+        import httpx
+        routes, _ = fake_broker_server
         # Mock authentication
-        mock_auth_response = Mock()
-        mock_auth_response.status_code = 200
-        mock_auth_response.json.return_value = {"access_token": "test-token-123"}
-        mock_post.return_value = mock_auth_response
+        routes[("POST", "/token")] = httpx.Response(200, json={"access_token": "test-token-123"})
         
         # Mock portfolio response
-        mock_portfolio_response = Mock()
-        mock_portfolio_response.status_code = 200
-        mock_portfolio_response.json.return_value = {
+        routes[("GET", "/api/v2/portafolio/argentina")] = httpx.Response(200, json={
             "activos": [
                 {
                     "simbolo": "AAPL",
@@ -1143,8 +1148,7 @@ class TestConexionIOL:
                     "gananciaPerdidaPorcentaje": 3.33
                 }
             ]
-        }
-        mock_get.return_value = mock_portfolio_response
+        })
         
         conexion = ConexionIOL("test_user", "test_pass")
         import asyncio
@@ -1175,13 +1179,11 @@ class TestConexionBinance:
         assert conexion.api_key == "test_api_key"
         assert conexion.api_secret == "test_api_secret"
     
-    @patch('conexion_binance.requests.get')
-    def test_binance_validar_credenciales_success(self, mock_get):
+    def test_binance_validar_credenciales_success(self, fake_broker_server):
         """Test successful Binance credentials validation"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {"balances": []}
-        mock_get.return_value = mock_response
+        import httpx
+        routes, _ = fake_broker_server
+        routes[("GET", "/api/v3/account")] = httpx.Response(200, json={"balances": []})
         
         conexion = ConexionBinance("test_api_key", "test_api_secret")
         import asyncio
@@ -1189,13 +1191,11 @@ class TestConexionBinance:
         
         assert result is True
     
-    @patch('conexion_binance.requests.get')
-    def test_binance_validar_credenciales_failure(self, mock_get):
+    def test_binance_validar_credenciales_failure(self, fake_broker_server):
         """Test failed Binance credentials validation"""
-        mock_response = Mock()
-        mock_response.status_code = 401
-        mock_response.text = "Invalid API key"
-        mock_get.return_value = mock_response
+        import httpx
+        routes, _ = fake_broker_server
+        routes[("GET", "/api/v3/account")] = httpx.Response(401, text="Invalid API key")
         
         conexion = ConexionBinance("test_api_key", "test_api_secret")
         import asyncio
@@ -1203,38 +1203,28 @@ class TestConexionBinance:
         
         assert result is False
     
-    @patch('conexion_binance.requests.get')
-    def test_binance_obtener_portfolio_success(self, mock_get):
+    def test_binance_obtener_portfolio_success(self, fake_broker_server):
         """Test successful portfolio retrieval from Binance"""
-        call_count = [0]
-        def mock_get_side_effect(*args, **kwargs):
-            call_count[0] += 1
-            mock_response = Mock()
-            if call_count[0] == 1:  # First call is account info
-                mock_response.status_code = 200
-                mock_response.json.return_value = {
-                    "balances": [
-                        {
-                            "asset": "BTC",
-                            "free": "0.5",
-                            "locked": "0.0"
-                        },
-                        {
-                            "asset": "USDT",
-                            "free": "1000.0",
-                            "locked": "0.0"
-                        }
-                    ]
+        import httpx
+        routes, _ = fake_broker_server
+        routes[("GET", "/api/v3/account")] = httpx.Response(200, json={
+            "balances": [
+                {
+                    "asset": "BTC",
+                    "free": "0.5",
+                    "locked": "0.0"
+                },
+                {
+                    "asset": "USDT",
+                    "free": "1000.0",
+                    "locked": "0.0"
                 }
-            else:  # Second call is prices
-                mock_response.status_code = 200
-                mock_response.json.return_value = [
-                    {"symbol": "BTCUSDT", "price": "50000.0"},
-                    {"symbol": "USDTUSDT", "price": "1.0"}
-                ]
-            return mock_response
-        
-        mock_get.side_effect = mock_get_side_effect
+            ]
+        })
+        routes[("GET", "/api/v3/ticker/price")] = httpx.Response(200, json=[
+            {"symbol": "BTCUSDT", "price": "50000.0"},
+            {"symbol": "USDTUSDT", "price": "1.0"}
+        ])
         
         conexion = ConexionBinance("test_api_key", "test_api_secret")
         import asyncio
@@ -1251,9 +1241,190 @@ class TestConexionBinance:
         info = conexion.obtener_info()
         
         assert info["broker"] == "BINANCE"
-        assert info["api_key"] == "test_api_key_12345..."
+        # Only the first 8 characters of the key are exposed
+        assert info["api_key"] == "test_api..."
         assert "base_url" in info
 
+@pytest.mark.unit
+class TestBinancePriceTable:
+    """Test suite for the shared Binance price table"""
+    
+    def test_concurrent_portfolios_share_one_price_download(self, fake_broker_server):
+        """Many portfolio valuations download the full price table once"""
+        import asyncio
+        import httpx
+        routes, received = fake_broker_server
+        routes[("GET", "/api/v3/account")] = httpx.Response(200, json={
+            "balances": [{"asset": "ETH", "free": "2", "locked": "0"}]
+        })
+        routes[("GET", "/api/v3/ticker/price")] = httpx.Response(200, json=[
+            {"symbol": "ETHUSDT", "price": "3000.0"},
+            {"symbol": "BTCUSDT", "price": "50000.0"}
+        ])
+        
+        async def run():
+            conexiones = [ConexionBinance(f"key_{i}", "secret") for i in range(20)]
+            return await asyncio.gather(*[c.obtener_portfolio() for c in conexiones])
+        
+        portfolios = asyncio.run(run())
+        
+        price_calls = [r for r in received if r.url.path == "/api/v3/ticker/price"]
+        assert len(price_calls) == 1
+        assert all(p[0]["market_value"] == 6000.0 for p in portfolios)
+    
+    def test_falls_back_to_single_symbols_when_table_fails(self, fake_broker_server):
+        """Only the requested symbols are fetched if the full table is unavailable"""
+        import asyncio
+        import httpx
+        from binance_prices import BinancePriceTable
+        routes, received = fake_broker_server
+        
+        def ticker(request):
+            symbol = request.url.params.get("symbol")
+            if symbol is None:
+                return httpx.Response(503)
+            if symbol == "ETHUSDT":
+                return httpx.Response(200, json={"symbol": symbol, "price": "3000.0"})
+            return httpx.Response(400, json={"code": -1121, "msg": "Invalid symbol."})
+        routes[("GET", "/api/v3/ticker/price")] = ticker
+        
+        table = BinancePriceTable(ttl=60)
+        
+        async def run():
+            first = await table.get_prices(["ETHUSDT", "FOOUSDT"])
+            second = await table.get_prices(["ETHUSDT", "FOOUSDT"])
+            return first, second
+        
+        first, second = asyncio.run(run())
+        
+        assert first == {"ETHUSDT": 3000.0} and second == first
+        single = [r.url.params["symbol"] for r in received if "symbol" in r.url.params]
+        # The invalid symbol is cached too: each symbol is requested once
+        assert sorted(single) == ["ETHUSDT", "FOOUSDT"]
+    
+    def test_fresh_table_is_not_downloaded_again(self, fake_broker_server):
+        """Reads within the TTL are served from memory"""
+        import asyncio
+        import httpx
+        from binance_prices import BinancePriceTable
+        routes, received = fake_broker_server
+        routes[("GET", "/api/v3/ticker/price")] = httpx.Response(200, json=[
+            {"symbol": "BTCUSDT", "price": "50000.0"}
+        ])
+        table = BinancePriceTable(ttl=60)
+        
+        async def run():
+            for _ in range(5):
+                assert await table.get_price("BTCUSDT") == 50000.0
+            return await table.get_price("NOPEUSDT")
+        
+        assert asyncio.run(run()) is None
+        assert len(received) == 1
+    
+    def test_no_downloads_without_reads(self, fake_broker_server):
+        """A single read costs one download; the table is only reloaded when read stale"""
+        import asyncio
+        import httpx
+        from binance_prices import BinancePriceTable
+        routes, received = fake_broker_server
+        routes[("GET", "/api/v3/ticker/price")] = httpx.Response(200, json=[
+            {"symbol": "BTCUSDT", "price": "50000.0"}
+        ])
+        table = BinancePriceTable(ttl=0.05)
+        
+        async def run():
+            await table.get_price("BTCUSDT")
+            await asyncio.sleep(0.3)
+            downloads_while_idle = len(received)
+            await table.get_price("BTCUSDT")
+            return downloads_while_idle
+        
+        assert asyncio.run(run()) == 1
+        assert len(received) == 2
+
+@pytest.mark.unit
+class TestBrokerHTTPTransport:
+    """Test suite for the shared async broker HTTP transport"""
+    
+    def test_get_retries_on_server_error(self, fake_broker_server):
+        """Test idempotent requests are retried on 5xx"""
+        import asyncio
+        import httpx
+        import broker_http
+        routes, received = fake_broker_server
+        responses = iter([httpx.Response(503), httpx.Response(200, json={"ok": True})])
+        routes[("GET", "/ping")] = lambda request: next(responses)
+        
+        with patch("broker_http._backoff", return_value=0):
+            response = asyncio.run(broker_http.request("GET", "https://api.binance.com/ping"))
+        
+        assert response.status_code == 200
+        assert len(received) == 2
+    
+    def test_order_post_is_not_retried_after_send(self, fake_broker_server):
+        """Test orders are not resent after a read timeout"""
+        import asyncio
+        import httpx
+        import broker_http
+        routes, received = fake_broker_server
+        
+        def timeout(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+        routes[("POST", "/api/v3/order")] = timeout
+        
+        conexion = ConexionBinance("key", "secret")
+        with patch("broker_http._backoff", return_value=0):
+            result = asyncio.run(conexion.ejecutar_orden("BTCUSDT", 0.1, "BUY"))
+        
+        assert result["success"] is False
+        assert len(received) == 1
+    
+    def test_orders_run_concurrently(self, fake_broker_server):
+        """Test a slow broker response does not serialize other requests"""
+        import asyncio
+        import time
+        import httpx
+        import broker_http
+        
+        class SlowTransport(httpx.AsyncBaseTransport):
+            async def handle_async_request(self, request):
+                await asyncio.sleep(0.2)
+                return httpx.Response(200, json={"orderId": 1, "status": "FILLED", "price": "1"})
+        
+        broker_http.set_transport(SlowTransport())
+        conexion = ConexionBinance("key", "secret")
+        
+        async def run():
+            return await asyncio.gather(*[conexion.ejecutar_orden("BTCUSDT", 0.1, "BUY") for _ in range(10)])
+        
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        
+        assert all(r["success"] for r in results)
+        assert time.perf_counter() - start < 1.0
+    
+    def test_timeout_is_a_total_deadline(self, fake_broker_server):
+        """Test a response that keeps trickling in is cut at the total timeout, retries included"""
+        import asyncio
+        import time
+        import httpx
+        import broker_http
+        calls = []
+        
+        class TricklingTransport(httpx.AsyncBaseTransport):
+            async def handle_async_request(self, request):
+                calls.append(request)
+                await asyncio.sleep(1.0)
+                return httpx.Response(200)
+        
+        broker_http.set_transport(TricklingTransport())
+        start = time.perf_counter()
+        with pytest.raises(httpx.TimeoutException):
+            asyncio.run(broker_http.request("GET", "https://api.binance.com/ping", timeout=0.2))
+        
+        assert time.perf_counter() - start < 0.6
+        assert len(calls) == 1
+
 @pytest.mark.integration
 class TestBrokerConnectionsAPI:
     """Test broker connections API endpoints"""
@@ -1426,3 +1597,1700 @@ class TestBrokerConnectionsAPI:
             assert data["broker"] == "BINANCE"
             assert len(data["portfolio"]) == 1
 
+
+# ============================================================================
+# TESTS DEL WORKER DE REGLAS
+# ============================================================================
+
+@pytest.mark.unit
+class TestRuleSharding:
+    """Test suite for lease-based rule worker sharding"""
+    
+    def _mock_supabase_rpc(self, partitions):
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = Mock(
+            data=[{"partition_id": p, "lease_expires_at": "2030-01-01T00:00:00Z"} for p in partitions]
+        )
+        return mock_client
+    
+    def test_partition_for_ticker_is_stable(self):
+        """Test ticker partition is deterministic and in range"""
+        from rule_sharding import partition_for_ticker
+        
+        assert partition_for_ticker("AAPL", 64) == partition_for_ticker("aapl ", 64)
+        assert all(0 <= partition_for_ticker(t, 8) < 8 for t in ["AAPL", "BTC-USD", "GGAL", ""])
+    
+    def test_heartbeat_filters_rules_by_owned_partitions(self):
+        """Test worker only keeps rules from partitions it owns"""
+        from rule_sharding import PartitionLeaseManager, partition_for_ticker
+        
+        owned = partition_for_ticker("AAPL", 4)
+        manager = PartitionLeaseManager(self._mock_supabase_rpc([owned]), worker_id="w1", num_partitions=4)
+        manager.heartbeat()
+        
+        tickers = ["AAPL", "NVDA", "GGAL", "BTC-USD", "MELI"]
+        rules = manager.filter_rules([{"id": t, "ticker": t} for t in tickers])
+        
+        assert manager.owns_ticker("AAPL")
+        assert [r["ticker"] for r in rules] == [t for t in tickers if partition_for_ticker(t, 4) == owned]
+    
+    def test_lease_expires_locally_when_heartbeat_fails(self):
+        """Test ownership is dropped once the local lease expires"""
+        from rule_sharding import PartitionLeaseManager
+        
+        mock_client = self._mock_supabase_rpc([0, 1])
+        manager = PartitionLeaseManager(mock_client, worker_id="w1", num_partitions=2, lease_ttl=0, safety_margin=0)
+        manager.heartbeat()
+        mock_client.rpc.side_effect = Exception("connection refused")
+        manager.heartbeat()
+        
+        assert manager.owned_partitions() == set()
+        assert not manager.owns_ticker("AAPL")
+    
+    def test_released_partitions_trigger_on_release(self):
+        """Losing partitions in a rebalance or on stop hands them to on_release (e.g. a buffer flush)"""
+        from rule_sharding import DEFAULT_LEASE_TTL, PartitionLeaseManager
+        released = []
+        mock_client = self._mock_supabase_rpc([0, 1, 2])
+        manager = PartitionLeaseManager(mock_client, worker_id="w1", num_partitions=4, on_release=released.append)
+        manager.heartbeat()
+        mock_client.rpc.return_value.execute.return_value = Mock(data=[{"partition_id": 2}])
+        manager.heartbeat()
+        manager.stop()
+        
+        assert released == [{0, 1}, {2}]
+        # The local lease outlives the slowest IOL order (token + order, twice after a 401)
+        # plus the execution flush latency
+        assert DEFAULT_LEASE_TTL * 5 / 6 > 2 * (10 + 30) + 2
+
+@pytest.mark.unit
+class TestExecutionWriteBuffer:
+    """Test suite for batched rule_executions persistence"""
+    
+    def test_flush_sends_single_rpc_and_clears_spool(self, tmp_path):
+        """Test pending executions are written in one call and removed from spool"""
+        from execution_buffer import ExecutionWriteBuffer
+        
+        mock_client = MagicMock()
+        spool_path = str(tmp_path / "executions.jsonl")
+        buffer = ExecutionWriteBuffer(mock_client, spool_path=spool_path, max_batch=100, max_latency=60, fsync=False)
+        for i in range(3):
+            buffer.add({"rule_id": f"rule-{i}", "triggered_at": "2025-01-01T00:00:00+00:00"})
+        
+        assert buffer.flush() == 3
+        mock_client.rpc.assert_called_once()
+        name, params = mock_client.rpc.call_args[0]
+        assert name == "record_rule_executions"
+        assert len(params["p_executions"]) == 3
+        assert all("id" in record for record in params["p_executions"])
+        assert open(spool_path).read() == ""
+    
+    def test_spool_recovers_after_failed_flush(self, tmp_path):
+        """Test executions survive a failed flush and a process restart"""
+        from execution_buffer import ExecutionWriteBuffer
+        
+        failing_client = MagicMock()
+        failing_client.rpc.side_effect = Exception("timeout")
+        spool_path = str(tmp_path / "executions.jsonl")
+        buffer = ExecutionWriteBuffer(failing_client, spool_path=spool_path, max_latency=60, fsync=False)
+        record = buffer.add({"rule_id": "rule-1", "triggered_at": "2025-01-01T00:00:00+00:00"})
+        
+        assert buffer.flush() == 0
+        assert buffer.pending_count() == 1
+        
+        restarted = ExecutionWriteBuffer(MagicMock(), spool_path=spool_path, max_latency=60, fsync=False)
+        assert restarted.pending_count() == 1
+        assert restarted.flush() == 1
+        assert restarted.supabase.rpc.call_args[0][1]["p_executions"][0]["id"] == record["id"]
+    
+    def test_apply_pending_overrides_last_execution(self):
+        """Test unflushed executions keep rules in cooldown"""
+        from execution_buffer import ExecutionWriteBuffer
+        
+        buffer = ExecutionWriteBuffer(MagicMock(), spool_path=None, max_latency=60)
+        buffer.add({"rule_id": "rule-1", "triggered_at": "2025-06-01T12:00:00+00:00"})
+        rules = buffer.apply_pending([
+            {"id": "rule-1", "last_execution_at": "2025-05-01T00:00:00+00:00"},
+            {"id": "rule-2", "last_execution_at": None}
+        ])
+        
+        assert rules[0]["last_execution_at"] == "2025-06-01T12:00:00+00:00"
+        assert rules[1]["last_execution_at"] is None
+
+@pytest.mark.unit
+class TestBrokerConnectionRegistry:
+    """Test suite for the worker broker connection registry"""
+    
+    def _mock_supabase(self, rows):
+        mock_client = MagicMock()
+        mock_client.table.return_value.select.return_value.in_.return_value.execute.return_value = Mock(data=rows)
+        return mock_client
+    
+    def test_refresh_loads_and_decrypts_once(self):
+        """Test connections are fetched in bulk and decrypted only once"""
+        from broker_registry import BrokerConnectionRegistry
+        
+        row = {
+            "id": "conn-1", "broker_name": "IOL", "is_active": True, "updated_at": "t1",
+            "username_encrypted": "enc-user", "password_encrypted": "enc-pass"
+        }
+        mock_client = self._mock_supabase([row])
+        decrypt = Mock(side_effect=lambda value: value.replace("enc-", ""))
+        registry = BrokerConnectionRegistry(mock_client, decrypt)
+        rules = [{"id": f"rule-{i}", "broker_connection_id": "conn-1"} for i in range(20)]
+        
+        registry.refresh(rules)
+        registry.refresh(rules)
+        entry = registry.get("conn-1")
+        
+        assert decrypt.call_count == 2
+        assert mock_client.table.return_value.select.return_value.in_.call_count == 2
+        assert entry["credentials"] == {"username": "user", "password": "pass"}
+        assert "password_encrypted" not in entry["connection"]
+    
+    def test_deactivated_connection_is_invalidated(self):
+        """Test credentials are dropped when a connection is deactivated or deleted"""
+        from broker_registry import BrokerConnectionRegistry
+        
+        row = {
+            "id": "conn-1", "broker_name": "BINANCE", "is_active": True, "updated_at": "t1",
+            "api_key_encrypted": "k", "api_secret_encrypted": "s"
+        }
+        mock_client = self._mock_supabase([row])
+        registry = BrokerConnectionRegistry(mock_client, lambda value: value)
+        rules = [{"id": "rule-1", "broker_connection_id": "conn-1"}]
+        registry.refresh(rules)
+        assert registry.get("conn-1") is not None
+        
+        mock_client.table.return_value.select.return_value.in_.return_value.execute.return_value = Mock(
+            data=[{**row, "is_active": False}]
+        )
+        registry.refresh(rules)
+        assert registry.get("conn-1") is None
+    
+    def test_credentials_expire_after_ttl(self):
+        """Test decrypted credentials are not served after the TTL"""
+        from broker_registry import BrokerConnectionRegistry
+        
+        row = {"id": "conn-1", "broker_name": "BINANCE", "is_active": True, "api_key_encrypted": "k", "api_secret_encrypted": "s"}
+        registry = BrokerConnectionRegistry(self._mock_supabase([row]), lambda value: value, ttl=0)
+        registry.refresh([{"broker_connection_id": "conn-1"}])
+        
+        assert registry.get("conn-1") is None
+        assert len(registry) == 0
+
+@pytest.mark.unit
+class TestIOLTokenManager:
+    """Test suite for the process-wide IOL token cache"""
+    
+    def test_concurrent_requests_share_one_password_grant(self):
+        """Test concurrent token requests for one account hit /token once"""
+        import asyncio
+        from conexion_iol import IOLTokenManager
+        
+        manager = IOLTokenManager()
+        calls = []
+        
+        async def fake_solicitar_token(self, payload):
+            calls.append(payload["grant_type"])
+            await asyncio.sleep(0.01)
+            return {"access_token": "token-1", "refresh_token": "refresh-1", "expires_in": 900}
+        
+        async def run():
+            conexiones = [ConexionIOL("user", "pass", connection_id="conn-1", token_manager=manager) for _ in range(10)]
+            return await asyncio.gather(*[c.obtener_token() for c in conexiones])
+        
+        with patch.object(ConexionIOL, "_solicitar_token", fake_solicitar_token):
+            tokens = asyncio.run(run())
+        
+        assert tokens == ["token-1"] * 10
+        assert calls == ["password"]
+    
+    def test_rejected_token_uses_refresh_grant(self):
+        """Test a 401 renews the token with the refresh token instead of the password"""
+        import asyncio
+        from conexion_iol import IOLTokenManager
+        
+        manager = IOLTokenManager()
+        manager.store("conn-1", {"access_token": "old", "refresh_token": "refresh-1", "expires_in": 900})
+        calls = []
+        
+        async def fake_solicitar_token(self, payload):
+            calls.append(payload)
+            return {"access_token": "new", "refresh_token": "refresh-2", "expires_in": 900}
+        
+        conexion = ConexionIOL("user", "pass", connection_id="conn-1", token_manager=manager)
+        with patch.object(ConexionIOL, "_solicitar_token", fake_solicitar_token):
+            token = asyncio.run(conexion.obtener_token(stale_token="old"))
+        
+        assert token == "new"
+        assert calls == [{"refresh_token": "refresh-1", "grant_type": "refresh_token"}]
+    
+    def test_token_key_without_connection_id_depends_on_password(self):
+        """Test different credentials never share a cached token"""
+        assert ConexionIOL("user", "pass").token_key != ConexionIOL("user", "other").token_key
+        assert ConexionIOL("user", "pass", connection_id="conn-1").token_key == "conn-1"
+
+@pytest.mark.unit
+class TestOrderDispatcher:
+    """Test suite for concurrent order dispatch"""
+    
+    def test_slow_broker_does_not_block_other_broker(self):
+        """A slow IOL order does not delay a Binance order, same-account orders stay in order"""
+        import asyncio
+        from order_dispatcher import OrderDispatcher
+        events = []
+        
+        def order(name, delay):
+            async def send():
+                events.append(f"start {name}")
+                await asyncio.sleep(delay)
+                events.append(f"end {name}")
+                return {"success": True}
+            return send
+        
+        async def run():
+            dispatcher = OrderDispatcher()
+            try:
+                dispatcher.submit("r1", "IOL", "iol-acc", order("iol-1", 0.2))
+                dispatcher.submit("r2", "IOL", "iol-acc", order("iol-2", 0))
+                dispatcher.submit("r3", "BINANCE", "bn-acc", order("bn-1", 0))
+                await dispatcher.drain()
+            finally:
+                dispatcher.close()
+        
+        asyncio.run(run())
+        
+        assert events.index("end bn-1") < events.index("end iol-1")
+        assert events.index("end iol-1") < events.index("start iol-2")
+    
+    def test_broker_limit_and_duplicate_key(self):
+        """Never more orders in flight per broker than its limit; a pending rule is not enqueued twice"""
+        import asyncio
+        from order_dispatcher import OrderDispatcher
+        state = {"running": 0, "peak": 0}
+        results = []
+        
+        async def send():
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            await asyncio.sleep(0.01)
+            state["running"] -= 1
+            return {"success": True}
+        
+        async def run():
+            dispatcher = OrderDispatcher(broker_limits={"BINANCE": 3})
+            try:
+                for i in range(10):
+                    dispatcher.submit(f"r{i}", "BINANCE", f"acc-{i}", send, results.append)
+                assert dispatcher.submit("r0", "BINANCE", "acc-0", send) is None
+                await dispatcher.drain()
+            finally:
+                dispatcher.close()
+        
+        asyncio.run(run())
+        
+        assert state["peak"] == 3
+        assert len(results) == 10
+    
+    def test_weight_throttle_from_binance_headers(self):
+        """Orders wait for the next minute when the used weight is near the limit"""
+        import httpx
+        import time
+        from order_dispatcher import BinanceWeightThrottle
+        throttle = BinanceWeightThrottle(weight_limit=100, threshold=0.9)
+        
+        throttle.observe_response(httpx.Response(200, headers={"X-MBX-USED-WEIGHT-1M": "50"}))
+        assert throttle.delay() == 0
+        
+        throttle.observe_response(httpx.Response(200, headers={"X-MBX-USED-WEIGHT-1M": "95"}))
+        now = time.time()
+        assert 0 < throttle.delay(now) <= 60
+        assert throttle.delay(now + 60) == 0
+        
+        # 429 without the weight header (not Binance) does not block
+        throttle = BinanceWeightThrottle()
+        throttle.observe_response(httpx.Response(429, headers={"Retry-After": "30"}))
+        assert throttle.delay() == 0
+        throttle.observe_response(httpx.Response(429, headers={"Retry-After": "30", "X-MBX-USED-WEIGHT-1M": "10"}))
+        assert 29 < throttle.delay() <= 30
+
+@pytest.mark.unit
+class TestAlertPipeline:
+    """Test suite for batched ALERT_ONLY evaluation"""
+    
+    # Miércoles 11:00 en Nueva York
+    NYSE_OPEN = datetime.fromisoformat("2024-01-03T16:00:00+00:00")
+    
+    def _rules(self, count, **overrides):
+        rules = []
+        for i in range(count):
+            rule = {
+                "id": f"rule-{i}",
+                "user_id": "user-1",
+                "name": f"Alerta {i}",
+                "rule_type": "price_below",
+                "ticker": ["AAPL", "MSFT", "NVDA"][i % 3],
+                "value_threshold": 1000,
+                "email": "user@example.com",
+                "last_triggered": None,
+                "cooldown_minutes": 60
+            }
+            rule.update(overrides)
+            rules.append(rule)
+        return rules
+    
+    def test_one_quote_fetch_per_ticker_and_bulk_insert(self):
+        """Thousands of rules share one quote lookup and one insert per batch"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from alert_pipeline import AlertPipeline
+        supabase = MagicMock()
+        quote_book = MagicMock()
+        quote_book.get_quotes = AsyncMock(return_value={
+            t: {"ticker": t, "current_price": 100.0, "high_52w": 150.0, "pe_ratio": None}
+            for t in ("AAPL", "MSFT", "NVDA")
+        })
+        emails = []
+        pipeline = AlertPipeline(supabase, quote_book, enqueue_emails=emails.extend, insert_batch=500)
+        pipeline.load_rules = Mock(return_value=self._rules(1200))
+        
+        summary = asyncio.run(pipeline.run_cycle(now=self.NYSE_OPEN))
+        
+        quote_book.get_quotes.assert_awaited_once()
+        assert sorted(quote_book.get_quotes.await_args.args[0]) == ["AAPL", "MSFT", "NVDA"]
+        assert supabase.rpc.call_count == 3
+        assert summary["alerts"] == 1200
+        assert len(emails) == 1200
+        assert emails[0]["to_email"] == "user@example.com"
+        assert "AAPL" in emails[0]["subject"]
+    
+    def test_cooldown_and_conditions(self):
+        """Rules in cooldown or whose condition is not met do not fire"""
+        from datetime import datetime, timezone, timedelta
+        from alert_pipeline import AlertPipeline
+        now = datetime.now(timezone.utc)
+        rules = [
+            {**self._rules(1)[0], "id": "fires"},
+            {**self._rules(1)[0], "id": "cooldown", "last_triggered": (now - timedelta(minutes=5)).isoformat()},
+            {**self._rules(1)[0], "id": "cooled", "last_triggered": (now - timedelta(minutes=90)).isoformat()},
+            {**self._rules(1)[0], "id": "not-met", "value_threshold": 50},
+            {**self._rules(1)[0], "id": "no-quote", "ticker": "ZZZZ"},
+            {**self._rules(1)[0], "id": "pe", "rule_type": "pe_above", "value_threshold": 20},
+        ]
+        quotes = {"AAPL": {"ticker": "AAPL", "current_price": 100.0, "high_52w": 150.0, "pe_ratio": 30.0}}
+        
+        triggered = AlertPipeline(MagicMock(), MagicMock()).evaluate(rules, quotes, now)
+        
+        assert [t["rule"]["id"] for t in triggered] == ["fires", "cooled", "pe"]
+        assert triggered[0]["alert"]["message"] == "AAPL está por debajo de $1,000.00"
+        assert triggered[2]["alert"]["alert_type"] == "pe_above"
+    
+    def test_failed_batch_sends_no_emails(self):
+        """Emails are only queued for alerts that were persisted"""
+        from alert_pipeline import AlertPipeline
+        supabase = MagicMock()
+        supabase.rpc.return_value.execute.side_effect = [Exception("timeout"), MagicMock()]
+        emails = []
+        pipeline = AlertPipeline(supabase, MagicMock(), enqueue_emails=emails.extend, insert_batch=2)
+        quotes = {t: {"ticker": t, "current_price": 100.0, "high_52w": 150.0, "pe_ratio": None} for t in ("AAPL", "MSFT", "NVDA")}
+        triggered = pipeline.evaluate(self._rules(4), quotes)
+        
+        persisted = pipeline.persist(triggered)
+        pipeline.queue_emails(persisted)
+        
+        assert [t["rule"]["id"] for t in persisted] == ["rule-2", "rule-3"]
+        assert len(emails) == 2
+    
+    def test_closed_market_rules_are_not_evaluated(self):
+        """After the NYSE close only rules on open markets (crypto) are quoted and fire"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from alert_pipeline import AlertPipeline
+        quote_book = MagicMock()
+        quote_book.get_quotes = AsyncMock(side_effect=lambda tickers, **kwargs: {
+            t: {"ticker": t, "current_price": 100.0, "high_52w": 150.0, "pe_ratio": None} for t in tickers
+        })
+        emails = []
+        pipeline = AlertPipeline(MagicMock(), quote_book, enqueue_emails=emails.extend)
+        pipeline.load_rules = Mock(return_value=[
+            {**self._rules(1)[0], "id": "nyse"},
+            {**self._rules(1)[0], "id": "crypto", "ticker": "BTC-USD"}
+        ])
+        saturday = datetime.fromisoformat("2024-01-06T16:00:00+00:00")
+        
+        summary = asyncio.run(pipeline.run_cycle(now=saturday))
+        
+        assert list(quote_book.get_quotes.await_args.args[0]) == ["BTC-USD"]
+        assert summary["closed_market"] == 1 and summary["alerts"] == 1
+        assert len(emails) == 1 and "BTC-USD" in emails[0]["subject"]
+
+@pytest.mark.unit
+class TestEmailOutbox:
+    """Test suite for the durable email outbox"""
+    
+    def _outbox(self, tmp_path, **kwargs):
+        from email_outbox import EmailOutbox, BrevoClient
+        client = BrevoClient("test-key")
+        client.api = MagicMock()
+        response = MagicMock()
+        response.message_id = None
+        response.message_ids = None
+        client.api.send_transac_email.return_value = response
+        return EmailOutbox(str(tmp_path / "outbox.db"), client=client, rate_per_second=1000, **kwargs), client.api
+    
+    def test_many_recipients_sent_in_one_batch_call(self, tmp_path):
+        """Messages from the same sender go out as message versions of one call"""
+        import asyncio
+        outbox, api = self._outbox(tmp_path, batch_size=50)
+        outbox.enqueue_many([
+            {"to_email": f"user{i}@example.com", "subject": f"Alerta {i}", "html_content": f"<p>{i}</p>"}
+            for i in range(120)
+        ])
+        
+        assert asyncio.run(outbox.send_due()) == 120
+        
+        assert api.send_transac_email.call_count == 3
+        payload = api.send_transac_email.call_args_list[0][0][0]
+        assert len(payload["messageVersions"]) == 50
+        assert payload["messageVersions"][1] == {
+            "to": [{"email": "user1@example.com"}], "subject": "Alerta 1", "htmlContent": "<p>1</p>"
+        }
+        assert outbox.stats() == {"sent": 120}
+    
+    def test_rate_limit_pauses_and_retries_later(self, tmp_path):
+        """A 429 keeps the messages pending until Brevo's reset time"""
+        import asyncio
+        import time
+        from sib_api_v3_sdk.rest import ApiException
+        outbox, api = self._outbox(tmp_path)
+        error = ApiException(status=429, reason="Too Many Requests")
+        error.headers = {"x-sib-ratelimit-reset": "30"}
+        api.send_transac_email.side_effect = error
+        outbox.enqueue("user@example.com", "Hola", "<p>hola</p>")
+        
+        assert asyncio.run(outbox.send_due()) == 0
+        
+        assert outbox.stats() == {"pending": 1}
+        assert outbox.claim_due(10) == []
+        assert len(outbox.claim_due(10, now=time.time() + 31)) == 1
+    
+    def test_server_errors_back_off_until_max_attempts(self, tmp_path):
+        """Transient errors are retried with backoff, then marked failed"""
+        import asyncio
+        import time
+        from sib_api_v3_sdk.rest import ApiException
+        outbox, api = self._outbox(tmp_path, max_attempts=2, base_backoff=10)
+        api.send_transac_email.side_effect = ApiException(status=503, reason="Unavailable")
+        outbox.enqueue("user@example.com", "Hola", "<p>hola</p>")
+        
+        assert asyncio.run(outbox.send_due()) == 0
+        rows = outbox.claim_due(10, now=time.time() + 11)
+        assert len(rows) == 1 and rows[0]["attempts"] == 1
+        asyncio.run(outbox._send_group((rows[0]["sender_name"], rows[0]["sender_email"]), rows))
+        
+        assert outbox.stats() == {"failed": 1}
+    
+    def test_invalid_recipient_only_fails_its_own_message(self, tmp_path):
+        """A 400 on a batch is bisected so the valid messages still go out"""
+        import asyncio
+        from sib_api_v3_sdk.rest import ApiException
+        outbox, api = self._outbox(tmp_path, batch_size=8)
+        
+        def send(payload):
+            versions = payload.get("messageVersions") or [payload]
+            if any(v["to"][0]["email"] == "bad@" for v in versions):
+                raise ApiException(status=400, reason="Bad Request")
+            response = MagicMock()
+            response.message_id = None
+            response.message_ids = None
+            return response
+        api.send_transac_email.side_effect = send
+        outbox.enqueue_many([
+            {"to_email": "bad@" if i == 5 else f"user{i}@example.com", "subject": "Alerta", "html_content": "<p>x</p>"}
+            for i in range(8)
+        ])
+        
+        assert asyncio.run(outbox.send_due()) == 7
+        
+        assert outbox.stats() == {"sent": 7, "failed": 1}
+        assert api.send_transac_email.call_count == 7
+    
+    def test_rate_limit_releases_every_claimed_message(self, tmp_path):
+        """After a 429 no claim is held while paused, so another process cannot send the same email"""
+        import asyncio
+        import time
+        from sib_api_v3_sdk.rest import ApiException
+        from email_outbox import EmailOutbox
+        outbox, api = self._outbox(tmp_path, claim_ttl=120)
+        error = ApiException(status=429, reason="Too Many Requests")
+        error.headers = {"x-sib-ratelimit-reset": "300"}
+        api.send_transac_email.side_effect = error
+        outbox.enqueue("a@example.com", "Hola", "<p>a</p>", sender_email="alerts@example.com")
+        outbox.enqueue("b@example.com", "Hola", "<p>b</p>", sender_email="news@example.com")
+        other = EmailOutbox(outbox.path, client=MagicMock(), claim_ttl=120)
+        
+        assert asyncio.run(outbox.send_due()) == 0
+        
+        assert api.send_transac_email.call_count == 1
+        assert outbox.stats() == {"pending": 2}
+        assert other.claim_due(10, now=time.time() + 121) == []
+        assert len(other.claim_due(10, now=time.time() + 301)) == 2
+        api.send_transac_email.side_effect = None
+        assert asyncio.run(outbox.send_due()) == 0
+        assert api.send_transac_email.call_count == 1
+
+
+@pytest.mark.unit
+class TestAlertDigestCoalescer:
+    """Test suite for per-user alert digest emails"""
+    
+    def _alert(self, to_email, ticker="AAPL"):
+        return {
+            "to_email": to_email,
+            "rule_name": f"Caída {ticker}",
+            "ticker": ticker,
+            "alert_message": f"{ticker} está por debajo de $100.00",
+            "current_price": 95.0,
+            "threshold": 100.0,
+            "rule_type": "price_below"
+        }
+    
+    def test_burst_is_merged_into_one_digest_per_user(self):
+        """Forty alerts for one user become a single digest email"""
+        from alert_digest import AlertDigestCoalescer
+        emails = []
+        digest = AlertDigestCoalescer(emails.extend, min_window=10, max_window=120)
+        tickers = [f"T{i}" for i in range(40)]
+        digest.add_many([self._alert("a@example.com", t) for t in tickers], now=1000)
+        digest.add_many([self._alert("b@example.com")], now=1000)
+        
+        assert digest.flush_due(now=1011) == 1
+        assert emails[0]["to_email"] == "b@example.com"
+        assert emails[0]["subject"].startswith("📉 Alerta: AAPL")
+        assert digest.flush_due(now=1119) == 0
+        assert digest.flush_due(now=1120) == 1
+        assert emails[1]["to_email"] == "a@example.com"
+        assert emails[1]["subject"] == "🔔 40 alertas: T0, T1, T2 y 37 más"
+        assert all(t in emails[1]["html_content"] for t in tickers)
+        assert digest.pending_count() == 0
+    
+    def test_window_grows_with_burst_volume_but_is_capped(self):
+        """Later alerts extend an open window up to max_window from the first one"""
+        from alert_digest import AlertDigestCoalescer
+        emails = []
+        digest = AlertDigestCoalescer(emails.extend, min_window=10, max_window=60)
+        
+        digest.add_many([self._alert("a@example.com")], now=0)
+        assert digest.flush_due(now=5) == 0
+        digest.add_many([self._alert("a@example.com", "MSFT")], now=8)
+        assert digest.flush_due(now=20) == 0
+        digest.add_many([self._alert("a@example.com", t) for t in ("NVDA", "TSLA", "AMD")], now=25)
+        assert digest.flush_due(now=59) == 0
+        assert digest.flush_due(now=60) == 1
+        assert emails[0]["subject"].startswith("🔔 5 alertas")
+        assert digest.window_for("a@example.com", now=400) == 10
+    
+    def test_pending_alerts_survive_restart(self, tmp_path):
+        """Alerts waiting in a window are recovered from the spool"""
+        from alert_digest import AlertDigestCoalescer
+        spool = str(tmp_path / "alert_digest.jsonl")
+        digest = AlertDigestCoalescer(Mock(side_effect=Exception("disk full")), spool_path=spool, fsync=False)
+        digest.add_many([self._alert("a@example.com"), self._alert("a@example.com", "MSFT")])
+        assert digest.flush_due(force=True) == 0
+        
+        emails = []
+        recovered = AlertDigestCoalescer(emails.extend, spool_path=spool, fsync=False)
+        
+        assert recovered.pending_count() == 2
+        assert recovered.flush_due() == 1
+        assert emails[0]["subject"] == "🔔 2 alertas: AAPL, MSFT"
+        assert AlertDigestCoalescer(emails.extend, spool_path=spool, fsync=False).pending_count() == 0
+
+
+@pytest.mark.unit
+class TestCooldownSchedule:
+    """Test suite for the cooldown min-heap used by the worker"""
+    
+    def _rule(self, rule_id, minutes_ago=None, cooldown=60, ticker="AAPL"):
+        from datetime import datetime, timezone, timedelta
+        last = None
+        if minutes_ago is not None:
+            last = (datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc) - timedelta(minutes=minutes_ago)).isoformat()
+        return {"id": rule_id, "ticker": ticker, "last_execution_at": last, "cooldown_minutes": cooldown}
+    
+    def test_rules_become_eligible_when_cooldown_expires(self):
+        """Rules leave the heap exactly when their cooldown ends"""
+        from datetime import datetime, timezone
+        from rule_schedule import CooldownSchedule
+        now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc).timestamp()
+        rules = [
+            self._rule("never"),
+            self._rule("cooled", minutes_ago=90),
+            self._rule("cooling", minutes_ago=10),
+            self._rule("default-cooldown", minutes_ago=30, cooldown=None),
+        ]
+        schedule = CooldownSchedule()
+        
+        assert [r["id"] for r in schedule.eligible(rules, now)] == ["never", "cooled"]
+        assert schedule.cooling_count() == 2
+        assert [r["id"] for r in schedule.eligible(rules, now + 30 * 60)] == ["never", "cooled", "default-cooldown"]
+        assert [r["id"] for r in schedule.eligible(rules, now + 50 * 60)] == [r["id"] for r in rules]
+    
+    def test_new_execution_reschedules_and_removed_rules_are_forgotten(self):
+        """A changed last_execution_at moves the rule back into cooldown"""
+        from datetime import datetime, timezone
+        from rule_schedule import CooldownSchedule
+        now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc).timestamp()
+        schedule = CooldownSchedule()
+        schedule.eligible([self._rule("a"), self._rule("b")], now)
+        
+        executed = self._rule("a", minutes_ago=0)
+        assert schedule.eligible([executed, self._rule("b")], now) == [self._rule("b")]
+        assert schedule.eligible([executed], now + 3600) == [executed]
+        assert schedule.cooling_count() == 0
+        assert schedule.release_due(now + 7200) == 0
+    
+    def test_shared_data_per_ticker_and_only_eligible_tickers_fetched(self):
+        """evaluate_rule reuses pre-fetched data; the alert pipeline skips cooling tickers"""
+        import asyncio
+        from datetime import datetime, timezone, timedelta
+        from unittest.mock import AsyncMock
+        from alert_pipeline import AlertPipeline
+        from rule_execution import RuleEvaluator
+        from rule_schedule import CooldownSchedule
+        data = {"ticker": "AAPL", "current_price": 90.0, "pe_ratio": None, "high_52w": 120.0}
+        with patch("rule_execution.get_price_provider") as provider:
+            met, current = asyncio.run(RuleEvaluator.evaluate_rule(
+                {"ticker": "AAPL", "rule_type": "price_below", "value_threshold": 100}, data
+            ))
+        assert met and current is data
+        provider.assert_not_called()
+        
+        # Wednesday 11:00 in New York: the NYSE is open
+        now = datetime(2024, 1, 3, 16, 0, tzinfo=timezone.utc)
+        recent = (now - timedelta(minutes=5)).isoformat()
+        rules = [
+            {"id": "1", "ticker": "AAPL", "rule_type": "price_below", "value_threshold": 100, "last_triggered": None},
+            {"id": "2", "ticker": "MSFT", "rule_type": "price_below", "value_threshold": 100, "last_triggered": recent},
+        ]
+        quote_book = MagicMock()
+        quote_book.get_quotes = AsyncMock(return_value={})
+        pipeline = AlertPipeline(MagicMock(), quote_book, schedule=CooldownSchedule("last_triggered"))
+        pipeline.load_rules = Mock(return_value=rules)
+        
+        summary = asyncio.run(pipeline.run_cycle(now=now))
+        
+        assert list(quote_book.get_quotes.await_args.args[0]) == ["AAPL"]
+        assert summary["evaluated"] == 1
+
+
+@pytest.mark.unit
+class TestMarketCalendar:
+    """Test suite for market sessions, holidays and session-aware TTLs"""
+    
+    def test_nyse_and_byma_holidays(self):
+        """Holiday rules match the published 2024 calendars"""
+        from datetime import date
+        from market_calendar import nyse_holidays, nyse_early_closes, byma_holidays
+        assert nyse_holidays(2024) == {
+            date(2024, 1, 1), date(2024, 1, 15), date(2024, 2, 19), date(2024, 3, 29), date(2024, 5, 27),
+            date(2024, 6, 19), date(2024, 7, 4), date(2024, 9, 2), date(2024, 11, 28), date(2024, 12, 25),
+        }
+        assert nyse_early_closes(2024) == {date(2024, 7, 3), date(2024, 11, 29), date(2024, 12, 24)}
+        assert date(2021, 12, 31) not in nyse_holidays(2021)  # New Year's Day 2022 fell on a Saturday
+        assert {date(2024, 2, 12), date(2024, 2, 13), date(2024, 3, 28), date(2024, 11, 18)} <= byma_holidays(2024)
+    
+    def test_sessions_by_market(self):
+        """Equities follow their exchange hours; crypto is always open"""
+        from datetime import datetime, timezone
+        from market_calendar import NYSE, BYMA, CRYPTO, market_for_ticker
+        early_close_afternoon = datetime(2024, 7, 3, 18, 30, tzinfo=timezone.utc)  # 14:30 New York
+        saturday = datetime(2024, 6, 8, 15, 0, tzinfo=timezone.utc)
+        
+        assert NYSE.is_open(datetime(2024, 7, 3, 16, 0, tzinfo=timezone.utc))
+        assert not NYSE.is_open(early_close_afternoon)
+        assert NYSE.next_open(early_close_afternoon) == datetime(2024, 7, 5, 13, 30, tzinfo=timezone.utc)
+        assert BYMA.is_open(datetime(2024, 6, 7, 15, 0, tzinfo=timezone.utc))  # 12:00 Buenos Aires
+        assert not BYMA.is_open(saturday) and CRYPTO.is_open(saturday)
+        assert market_for_ticker("BTC-USD") is CRYPTO
+        assert market_for_ticker("GGAL.BA") is BYMA and market_for_ticker("GGAL", "IOL") is BYMA
+        assert market_for_ticker("BTC", "BINANCE") is CRYPTO and market_for_ticker("GGAL") is NYSE
+    
+    def test_ttl_extends_to_next_open_after_close(self):
+        """Quotes fetched after the close are reused until the next session"""
+        import asyncio
+        from datetime import datetime, timezone
+        from market_calendar import NYSE, CRYPTO
+        from quote_book import QuoteBook
+        friday_close = datetime(2024, 6, 7, 20, 0, tzinfo=timezone.utc)
+        
+        assert NYSE.cache_ttl(120, datetime(2024, 6, 7, 15, 0, tzinfo=timezone.utc)) == 120
+        assert NYSE.cache_ttl(120, datetime(2024, 6, 7, 20, 5, tzinfo=timezone.utc)) == 120  # settling
+        assert NYSE.cache_ttl(120, datetime(2024, 6, 8, 12, 0, tzinfo=timezone.utc)) == (
+            datetime(2024, 6, 10, 13, 30, tzinfo=timezone.utc) - datetime(2024, 6, 8, 12, 0, tzinfo=timezone.utc)
+        ).total_seconds()
+        assert CRYPTO.cache_ttl(120, friday_close) == 120
+        
+        book = QuoteBook(ttl=60)
+        book._download = Mock(side_effect=lambda tickers: {t: {"current_price": 10.0, "high_52w": 12.0} for t in tickers})
+        with patch("quote_book.cache_ttl_for_ticker", side_effect=lambda t, ttl: 0 if t == "BTC-USD" else 86400):
+            asyncio.run(book.get_quotes(["AAPL", "BTC-USD"]))
+            asyncio.run(book.get_quotes(["AAPL", "BTC-USD"]))
+        assert book._download.call_args_list[1].args[0] == ["BTC-USD"]
+
+
+@pytest.mark.unit
+class TestOrderQueue:
+    """Test suite for the durable queue between evaluation and execution"""
+    
+    def _rule(self, last_execution_at=None):
+        return {"id": "rule-1", "ticker": "AAPL", "broker_connection_id": "conn-1",
+                "execution_type": "BUY", "quantity": 1, "last_execution_at": last_execution_at}
+    
+    def test_one_order_per_rule_and_trigger_window(self, tmp_path):
+        """Re-triggering before a new execution is recorded does not queue a duplicate"""
+        from order_queue import OrderQueue
+        queue = OrderQueue(str(tmp_path / "orders.db"))
+        
+        key = queue.enqueue(self._rule(), {"current_price": 100.0}, "2024-01-01T15:00:00+00:00")
+        assert key == "rule-1:never"
+        assert queue.enqueue(self._rule(), {"current_price": 99.0}, "2024-01-01T15:01:00+00:00") is None
+        assert queue.has_open("rule-1")
+        
+        queue.mark_sending(key)
+        queue.mark_done(key, {"success": True, "order_id": "42"})
+        queue.mark_recorded(key)
+        assert not queue.has_open("rule-1")
+        assert queue.enqueue(self._rule("2024-01-01T15:00:05+00:00"), None, "2024-01-01T16:30:00+00:00")
+        assert queue.stats() == {"recorded": 1, "pending": 1}
+    
+    def test_pending_orders_survive_restart(self, tmp_path):
+        """A new process sees queued orders in arrival order and skips ones already dispatched"""
+        from order_queue import OrderQueue
+        path = str(tmp_path / "orders.db")
+        queue = OrderQueue(path)
+        first = queue.enqueue(self._rule(), {"current_price": 100.0}, "2024-01-01T15:00:00+00:00")
+        second = queue.enqueue({**self._rule(), "id": "rule-2"}, None, "2024-01-01T15:00:01+00:00")
+        
+        restarted = OrderQueue(path)
+        
+        assert restarted.has_open("rule-1") and restarted.has_open("rule-2")
+        entries = restarted.pending()
+        assert [e["idempotency_key"] for e in entries] == [first, second]
+        assert entries[0]["rule"]["ticker"] == "AAPL" and entries[0]["current_data"] == {"current_price": 100.0}
+        assert [e["idempotency_key"] for e in restarted.pending(exclude={first})] == [second]
+    
+    def test_recover_never_resends_interrupted_orders(self, tmp_path):
+        """Orders cut off mid-send become UNKNOWN; answered ones are re-recorded with the same id"""
+        from order_queue import OrderQueue
+        path = str(tmp_path / "orders.db")
+        queue = OrderQueue(path)
+        sending = queue.enqueue(self._rule(), None, "2024-01-01T15:00:00+00:00")
+        answered = queue.enqueue({**self._rule(), "id": "rule-2"}, None, "2024-01-01T15:00:01+00:00")
+        queue.mark_sending(sending)
+        queue.mark_sending(answered)
+        queue.mark_done(answered, {"success": True, "order_id": "7"})
+        execution_id = queue.recover()[1]["execution_id"]
+        
+        recovered = OrderQueue(path).recover()
+        
+        assert [e["idempotency_key"] for e in recovered] == [sending, answered]
+        assert recovered[0]["result"]["status"] == "UNKNOWN"
+        assert recovered[1]["result"] == {"success": True, "order_id": "7"}
+        assert recovered[1]["execution_id"] == execution_id
+        assert OrderQueue(path).pending() == []
+    
+    def test_cancelled_order_does_not_block_the_window(self, tmp_path):
+        """A cancelled (never sent) order frees its key so the next trigger queues again"""
+        from order_queue import OrderQueue
+        queue = OrderQueue(str(tmp_path / "orders.db"))
+        key = queue.enqueue(self._rule(), None, "2024-01-01T15:00:00+00:00")
+        execution_id = queue.pending()[0]["execution_id"]
+        queue.mark_cancelled(key)
+        assert not queue.has_open("rule-1")
+        
+        assert queue.enqueue(self._rule(), {"current_price": 98.0}, "2024-01-01T15:05:00+00:00") == key
+        
+        assert queue.has_open("rule-1")
+        entries = queue.pending()
+        assert len(entries) == 1 and entries[0]["status"] == "pending"
+        assert entries[0]["execution_id"] != execution_id
+        assert entries[0]["current_data"] == {"current_price": 98.0}
+        assert queue.enqueue(self._rule(), None, "2024-01-01T15:06:00+00:00") is None
+
+
+@pytest.mark.unit
+class TestWorkerMetrics:
+    """Test suite for the worker's Prometheus metrics"""
+    
+    def test_histogram_exposition_is_cumulative(self):
+        """Buckets are cumulative and include sum/count per label set"""
+        from worker_metrics import Histogram
+        histogram = Histogram("stage_seconds", "Stage duration", ("stage",), buckets=(0.1, 1))
+        histogram.observe(0.05, stage="market_data")
+        histogram.observe(0.5, stage="market_data")
+        histogram.observe(3, stage="market_data")
+        
+        lines = histogram.render()
+        
+        assert "# TYPE stage_seconds histogram" in lines
+        assert 'stage_seconds_bucket{stage="market_data",le="0.1"} 1' in lines
+        assert 'stage_seconds_bucket{stage="market_data",le="1"} 2' in lines
+        assert 'stage_seconds_bucket{stage="market_data",le="+Inf"} 3' in lines
+        assert 'stage_seconds_sum{stage="market_data"} 3.55' in lines
+        assert 'stage_seconds_count{stage="market_data"} 3' in lines
+    
+    def test_cycle_overruns_rates_and_upstream_errors(self):
+        """Cycle records track overruns, rules per second and upstream outcomes"""
+        from worker_metrics import WorkerMetrics
+        metrics = WorkerMetrics()
+        metrics.record_cycle(30.0, 600, interval=60)
+        metrics.record_cycle(90.0, 900, interval=60)
+        with metrics.upstream("supabase"):
+            pass
+        with pytest.raises(TimeoutError):
+            with metrics.stage("load_rules"), metrics.upstream("supabase"):
+                raise TimeoutError()
+        metrics.set_queue_depths({"orders_pending": 4})
+        
+        assert metrics.cycle_overruns.value() == 1
+        assert metrics.rules_evaluated.value() == 1500
+        assert metrics.rules_per_second.value() == 10
+        assert metrics.upstream_requests.value(upstream="supabase", outcome="error") == 1
+        assert metrics.stage_seconds.count(stage="load_rules") == 1
+        assert 'rule_worker_queue_depth{queue="orders_pending"} 4' in metrics.registry.render()
+    
+    def test_metrics_endpoint(self):
+        """GET /metrics serves the registry; other paths return 404"""
+        import asyncio
+        from worker_metrics import WorkerMetrics, serve_metrics
+        metrics = WorkerMetrics()
+        metrics.cycles.inc()
+        
+        async def fetch(path):
+            server = await serve_metrics(metrics.registry, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+                await writer.drain()
+                response = await reader.read()
+                writer.close()
+                return response.decode()
+            finally:
+                server.close()
+                await server.wait_closed()
+        
+        response = asyncio.run(fetch("/metrics"))
+        assert response.startswith("HTTP/1.1 200 OK")
+        assert "rule_worker_cycles_total 1" in response
+        assert asyncio.run(fetch("/other")).startswith("HTTP/1.1 404")
+
+
+@pytest.mark.unit
+class TestPriceProviders:
+    """Tests for the pluggable price provider layer"""
+    
+    def test_fake_provider_is_deterministic_across_ranges(self):
+        """The same ticker and date always produce the same bar"""
+        from datetime import date
+        from price_providers import FakeProvider
+        provider = FakeProvider(today=date(2024, 6, 28))
+        full = provider.get_bars("AAPL", start="2024-01-01", end="2024-06-29")
+        window = FakeProvider(today=date(2024, 12, 31)).get_bars("AAPL", start="2024-03-01", end="2024-04-01")
+        
+        assert list(full.columns) == ["Open", "High", "Low", "Close", "Volume"]
+        assert window.equals(full.loc[window.index])
+        assert (full["High"] >= full[["Open", "Close"]].max(axis=1)).all()
+        assert (full["Low"] <= full[["Open", "Close"]].min(axis=1)).all()
+        # 2024-01-15 (MLK) is an NYSE holiday, crypto trades every day
+        assert date(2024, 1, 15) not in set(full.index.date)
+        assert len(provider.get_bars("BTC-USD", start="2024-01-01", end="2024-01-08")) == 7
+        assert provider.get_quote("AAPL")["current_price"] == float(full["Close"].iloc[-1])
+    
+    def test_router_sends_crypto_to_its_provider_and_falls_back(self):
+        """-USD tickers go to the crypto route; failures fall back to the default provider"""
+        from price_providers import FakeProvider, ProviderRouter
+        default = FakeProvider()
+        crypto = MagicMock()
+        crypto.name = "crypto"
+        crypto.get_quotes.return_value = {"BTC-USD": {"ticker": "BTC-USD", "current_price": 1.0}}
+        crypto.get_fundamentals.side_effect = NotImplementedError()
+        router = ProviderRouter(default, {"CRYPTO": crypto})
+        
+        quotes = router.get_quotes(["AAPL", "BTC-USD", "ETH-USD"])
+        
+        crypto.get_quotes.assert_called_once_with(["BTC-USD", "ETH-USD"])
+        assert quotes["BTC-USD"]["current_price"] == 1.0
+        assert quotes["ETH-USD"] == default.get_quote("ETH-USD")
+        assert quotes["AAPL"] == default.get_quote("AAPL")
+        assert router.get_fundamentals("BTC-USD") == default.get_fundamentals("BTC-USD")
+    
+    def test_call_sites_use_the_shared_provider(self):
+        """RuleEvaluator, BacktestEngine and QuoteBook read from the configured provider"""
+        import asyncio
+        from datetime import date
+        from price_providers import FakeProvider, set_price_provider
+        from quote_book import QuoteBook
+        from rule_execution import BacktestEngine, RuleEvaluator
+        provider = FakeProvider(today=date(2024, 6, 28))
+        set_price_provider(provider)
+        try:
+            data = RuleEvaluator.get_current_data("MSFT")
+            result = asyncio.run(BacktestEngine.run_backtest(
+                {"ticker": "MSFT", "rule_type": "price_below", "value_threshold": 1e9},
+                "2024-01-01", "2024-06-01", 10000
+            ))
+            quotes = asyncio.run(QuoteBook().get_quotes(["MSFT"], with_fundamentals=["MSFT"]))
+        finally:
+            set_price_provider(None)
+        
+        assert data["current_price"] == provider.get_quote("MSFT")["current_price"]
+        assert data["pe_ratio"] == provider.get_fundamentals("MSFT")["trailingPE"]
+        assert result["success"]
+        assert quotes["MSFT"]["current_price"] == data["current_price"]
+        assert quotes["MSFT"]["pe_ratio"] == data["pe_ratio"]
+
+
+@pytest.mark.unit
+class TestVectorizedBacktest:
+    """Tests for the vectorized backtest engine against the day-by-day reference"""
+    
+    @staticmethod
+    def _hist(closes, highs=None):
+        import pandas as pd
+        index = pd.date_range("2024-01-01", periods=len(closes), freq="D")
+        return pd.DataFrame({"Close": closes, "High": highs or closes}, index=index)
+    
+    def test_matches_loop_on_synthetic_history(self):
+        """Every rule type and execution type gives identical results to the loop"""
+        from datetime import date
+        from price_providers import FakeProvider
+        from rule_execution import BacktestEngine
+        provider = FakeProvider(today=date(2024, 12, 31))
+        for ticker in ["AAPL", "BTC-USD"]:
+            hist = provider.get_bars(ticker, start="2023-01-01", end="2024-12-31")
+            median = float(hist["Close"].median())
+            for rule_type, threshold in [("price_below", median), ("price_above", median), ("max_distance", -10), ("pe_below", 15)]:
+                for execution_type in ["BUY", "SELL", "ALERT_ONLY"]:
+                    for capital in [10000, 1e7]:
+                        rule = {"rule_type": rule_type, "value_threshold": threshold, "execution_type": execution_type, "quantity": 3}
+                        assert BacktestEngine.simulate(rule, hist, capital) == BacktestEngine.simulate_loop(rule, hist, capital)
+    
+    def test_buys_resume_when_a_cheaper_fill_fits(self):
+        """After a rejected buy, later cheaper buys still fill with the remaining capital"""
+        from rule_execution import BacktestEngine
+        hist = self._hist([60.0, 30.0, 50.0, 20.0, 90.0, 10.0])
+        rule = {"rule_type": "price_below", "value_threshold": 100, "execution_type": "BUY", "quantity": 1}
+        
+        result = BacktestEngine.simulate(rule, hist, 100)
+        
+        assert [e["status"] for e in result["execution_details"]] == [
+            "EXECUTED", "EXECUTED", "INSUFFICIENT_FUNDS", "INSUFFICIENT_FUNDS", "INSUFFICIENT_FUNDS", "EXECUTED"
+        ]
+        assert [d["capital"] for d in result["daily_equity_curve"]] == [40, 10, 10, 10, 10, 0]
+        assert result == BacktestEngine.simulate_loop(rule, hist, 100)
+    
+    def test_max_distance_uses_running_high(self):
+        """max_distance compares each close with the highest high seen so far"""
+        import numpy as np
+        from rule_execution import BacktestEngine
+        hist = self._hist([100.0, 95.0, 120.0, 100.0, 130.0], highs=[100.0, 110.0, 120.0, 125.0, 130.0])
+        
+        signals = BacktestEngine.signals("max_distance", -15, hist)
+        
+        assert signals.tolist() == [False, False, False, True, False]
+        assert not np.any(BacktestEngine.signals("pe_above", 0, hist))
+
+
+@pytest.mark.unit
+class TestBacktestJobQueue:
+    """Tests for the background backtest job queue"""
+    
+    @staticmethod
+    def _supabase(active=0):
+        import itertools
+        supabase = MagicMock()
+        table = supabase.table.return_value
+        ids = itertools.count(1)
+        table.insert.return_value.execute.side_effect = lambda: MagicMock(data=[{"id": f"bt-{next(ids)}"}])
+        table.select.return_value.eq.return_value.in_.return_value.execute.return_value = MagicMock(count=active)
+        return supabase
+    
+    @staticmethod
+    def _rule(user_id="user-1"):
+        return {"id": "rule-1", "user_id": user_id, "ticker": "AAPL", "rule_type": "price_below",
+                "value_threshold": 1e9, "execution_type": "BUY", "quantity": 1}
+    
+    def test_per_user_concurrency_and_round_robin(self):
+        """One user's backlog does not take every slot from other users"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from backtest_jobs import BacktestJobQueue
+        
+        async def scenario():
+            queue = BacktestJobQueue(self._supabase(), max_workers=2, per_user_running=1,
+                                     executor=ThreadPoolExecutor(2))
+            with patch.object(BacktestJobQueue, "_run", new=lambda self, job: asyncio.sleep(3600)):
+                for _ in range(3):
+                    queue.submit(self._rule("user-1"), "user-1", "2024-01-01", "2024-06-01", 10000)
+                queue.submit(self._rule("user-2"), "user-2", "2024-01-01", "2024-06-01", 10000)
+                running = dict(queue._running)
+                pending = queue.pending_count()
+                queue.shutdown()
+            return running, pending
+        
+        running, pending = asyncio.run(scenario())
+        assert running == {"user-1": 1, "user-2": 1}
+        assert pending == 2
+    
+    def test_rejects_when_user_has_too_many_active(self):
+        """Admission is capped on the active backtests stored in rule_backtests"""
+        from backtest_jobs import BacktestJobQueue, BacktestQueueFull
+        supabase = self._supabase(active=5)
+        queue = BacktestJobQueue(supabase, max_active_per_user=5)
+        
+        with pytest.raises(BacktestQueueFull):
+            queue.submit(self._rule(), "user-1", "2024-01-01", "2024-06-01", 10000)
+        supabase.table.return_value.insert.assert_not_called()
+    
+    def test_job_reports_progress_and_results_from_process_pool(self):
+        """A queued job runs in a worker process and ends COMPLETED with its results"""
+        import asyncio
+        from datetime import date
+        from backtest_jobs import BacktestJobQueue
+        from price_providers import FakeProvider, set_price_provider
+        supabase = self._supabase()
+        
+        async def scenario():
+            queue = BacktestJobQueue(supabase, max_workers=1)
+            backtest_id = queue.submit(self._rule(), "user-1", "2024-01-01", "2024-06-01", 10000)
+            await asyncio.gather(*queue._tasks)
+            queue.shutdown()
+            return backtest_id
+        
+        set_price_provider(FakeProvider(today=date(2024, 6, 28)))
+        try:
+            backtest_id = asyncio.run(scenario())
+        finally:
+            set_price_provider(None)
+        
+        updates = [c.args[0] for c in supabase.table.return_value.update.call_args_list]
+        assert backtest_id == "bt-1"
+        assert supabase.table.return_value.insert.call_args.args[0]["status"] == "PENDING"
+        assert [u.get("progress") for u in updates] == [10, 50, 100]
+        assert updates[-1]["status"] == "COMPLETED"
+        assert updates[-1]["total_executions"] == updates[-1]["daily_equity_curve"]["length"] > 100
+        assert updates[-1]["successful_executions"] >= 1
+    
+    def test_recovery_keeps_own_jobs_alive_and_fails_orphans(self):
+        """The periodic pass renews this process's queued jobs before failing stale rows"""
+        import asyncio
+        from backtest_jobs import BacktestJobQueue
+        supabase = TestBacktestJobQueue._supabase()
+        table = supabase.table.return_value
+        table.update.return_value.in_.return_value.lt.return_value.execute.return_value = MagicMock(data=[{"id": "old"}])
+        
+        async def scenario():
+            queue = BacktestJobQueue(supabase, max_workers=1)
+            with patch.object(BacktestJobQueue, "_run", new=lambda self, job: asyncio.sleep(3600)):
+                running = queue.submit(TestBacktestJobQueue._rule(), "user-1", "2024-01-01", "2024-06-01", 10000)
+                queued = queue.submit(TestBacktestJobQueue._rule(), "user-1", "2024-01-01", "2024-06-01", 10000)
+                stop = asyncio.Event()
+                table.update.return_value.in_.return_value.lt.return_value.execute.side_effect = \
+                    lambda: (stop.set(), MagicMock(data=[{"id": "old"}]))[1]
+                await asyncio.wait_for(queue.run_recovery(interval=0, stop_event=stop), 5)
+                queue.shutdown()
+            return running, queued
+        
+        running, queued = asyncio.run(scenario())
+        
+        updates = [c.args[0] for c in table.update.call_args_list]
+        assert set(updates[0]) == {"updated_at"}
+        table.update.return_value.in_.assert_any_call("id", [running, queued])
+        assert updates[1]["status"] == "FAILED"
+
+
+@pytest.mark.unit
+class TestBacktestSweep:
+    """Tests for parameter-sweep backtests"""
+    
+    def test_each_combination_matches_a_single_backtest(self):
+        """Without cooldowns every grid row equals BacktestEngine.simulate"""
+        from datetime import date
+        from price_providers import FakeProvider
+        from rule_execution import BacktestEngine
+        hist = FakeProvider(today=date(2024, 12, 31)).get_bars("MSFT", start="2022-01-01", end="2024-12-31")
+        thresholds = [float(q) for q in hist["Close"].quantile([0.1, 0.5, 0.9])]
+        rule = {"rule_type": "price_below", "execution_type": "BUY"}
+        
+        result = BacktestEngine.sweep(rule, hist, 50000, thresholds, [1, 10])
+        
+        assert result["combinations"] == 6
+        for row in result["rows"]:
+            row = dict(zip(result["columns"], row))
+            single = BacktestEngine.simulate(
+                dict(rule, value_threshold=row["value_threshold"], quantity=row["quantity"]), hist, 50000
+            )
+            for key in ["total_executions", "successful_executions", "final_capital", "win_rate", "profit_factor", "max_drawdown"]:
+                assert row[key] == pytest.approx(single[key])
+        assert result["best"]["total_return"] == max(r[result["columns"].index("total_return")] for r in result["rows"])
+    
+    def test_cooldown_spaces_triggers(self):
+        """A cooldown skips triggers until it has elapsed since the previous one"""
+        import pandas as pd
+        from rule_execution import BacktestEngine
+        hist = pd.DataFrame(
+            {"Close": [10.0] * 10, "High": [10.0] * 10},
+            index=pd.date_range("2024-01-01", periods=10, freq="D")
+        )
+        rule = {"rule_type": "price_below", "execution_type": "ALERT_ONLY"}
+        
+        result = BacktestEngine.sweep(rule, hist, 1000, [20], cooldowns=[None, 1440, 3 * 1440])
+        
+        triggers = [row[result["columns"].index("trigger_count")] for row in result["rows"]]
+        assert triggers == [10, 10, 4]
+        assert all(row[result["columns"].index("total_executions")] == 0 for row in result["rows"])
+    
+    def test_threshold_range_is_inclusive_and_capped(self):
+        """threshold_range expands to start..stop and oversized sweeps are rejected"""
+        from fastapi import HTTPException
+        from app_supabase import BacktestSweepRequest, SweepRange, sweep_thresholds
+        request = BacktestSweepRequest(
+            start_date="2024-01-01", end_date="2024-12-31",
+            thresholds=[1.5], threshold_range=SweepRange(start=-10, stop=-5, step=2.5)
+        )
+        assert sweep_thresholds(request) == [1.5, -10, -7.5, -5]
+        
+        huge = BacktestSweepRequest(
+            start_date="2024-01-01", end_date="2024-12-31",
+            threshold_range=SweepRange(start=0, stop=1e6, step=0.01)
+        )
+        with pytest.raises(HTTPException):
+            sweep_thresholds(huge)
+
+
+@pytest.mark.unit
+class TestBatchBacktest:
+    """Tests for batch backtests with shared data loading"""
+    
+    def test_portfolio_sums_curves_aligned_by_date(self):
+        """Curves on different calendars are forward-filled before summing"""
+        from rule_execution import BacktestEngine
+        stock = {"final_capital": 900, "daily_equity_curve": [
+            {"date": "2024-01-01", "equity": 1000}, {"date": "2024-01-03", "equity": 900}
+        ]}
+        crypto = {"final_capital": 1200, "daily_equity_curve": [
+            {"date": "2024-01-02", "equity": 1100}, {"date": "2024-01-03", "equity": 1200}
+        ]}
+        
+        portfolio = BacktestEngine.portfolio([stock, crypto], 1000)
+        
+        assert portfolio["equity_curve"] == [
+            {"date": "2024-01-01", "equity": 2000},
+            {"date": "2024-01-02", "equity": 2100},
+            {"date": "2024-01-03", "equity": 2100}
+        ]
+        assert portfolio["final_equity"] == 2100
+        assert portfolio["total_return"] == pytest.approx(5)
+        assert portfolio["max_drawdown"] == 0
+    
+    def test_batch_downloads_each_ticker_once_and_inserts_in_bulk(self):
+        """Rules sharing a ticker reuse one download and results land in a single insert"""
+        import asyncio
+        from datetime import date
+        from concurrent.futures import ThreadPoolExecutor
+        from backtest_jobs import BacktestJobQueue
+        from price_providers import FakeProvider, set_price_provider
+        supabase = TestBacktestJobQueue._supabase()
+        provider = FakeProvider(today=date(2024, 6, 28))
+        provider.get_bars_batch = MagicMock(wraps=provider.get_bars_batch)
+        rules = [
+            dict(TestBacktestJobQueue._rule(), id=f"rule-{i}", ticker=ticker)
+            for i, ticker in enumerate(["AAPL", "AAPL", "MSFT"])
+        ]
+        
+        async def scenario():
+            queue = BacktestJobQueue(supabase, max_workers=1, executor=ThreadPoolExecutor(2))
+            batch_id = queue.submit_batch(rules, "user-1", "2024-01-01", "2024-06-01", 10000)
+            await asyncio.gather(*queue._tasks)
+            queue.shutdown()
+            return batch_id
+        
+        set_price_provider(provider)
+        try:
+            batch_id = asyncio.run(scenario())
+        finally:
+            set_price_provider(None)
+        
+        provider.get_bars_batch.assert_called_once()
+        assert sorted(provider.get_bars_batch.call_args.args[0]) == ["AAPL", "MSFT"]
+        inserts = [c.args[0] for c in supabase.table.return_value.insert.call_args_list]
+        assert inserts[0]["ticker_count"] == 2
+        assert [row["rule_id"] for row in inserts[1]] == ["rule-0", "rule-1", "rule-2"]
+        assert all(row["batch_id"] == batch_id for row in inserts[1])
+        final = supabase.table.return_value.update.call_args.args[0]
+        assert final["status"] == "COMPLETED"
+        assert final["completed_count"] == 3
+        assert final["final_equity"] == pytest.approx(sum(row["final_capital"] for row in inserts[1]))
+        assert final["portfolio_equity_curve"]["columns"]["equity"][0] <= 30000
+    
+    def test_rejects_second_active_batch(self):
+        """Admission is capped on the active batches stored in rule_backtest_batches"""
+        from backtest_jobs import BacktestJobQueue, BacktestQueueFull
+        supabase = TestBacktestJobQueue._supabase(active=1)
+        queue = BacktestJobQueue(supabase, max_active_batches=1)
+        
+        with pytest.raises(BacktestQueueFull):
+            queue.submit_batch([TestBacktestJobQueue._rule()], "user-1", "2024-01-01", "2024-06-01", 10000)
+        supabase.table.assert_called_with("rule_backtest_batches")
+        supabase.table.return_value.insert.assert_not_called()
+    
+    def test_recover_stale_fails_orphaned_batches(self):
+        """Batches left active by a restart are failed too, freeing the per-user batch slot"""
+        from backtest_jobs import BacktestJobQueue
+        supabase = MagicMock()
+        stale = supabase.table.return_value.update.return_value.in_.return_value.lt.return_value
+        stale.execute.side_effect = [MagicMock(data=[]), MagicMock(data=[{"id": "batch-1"}])]
+        
+        assert BacktestJobQueue(supabase).recover_stale() == 1
+        
+        assert [c.args[0] for c in supabase.table.call_args_list] == ["rule_backtests", "rule_backtest_batches"]
+        update = supabase.table.return_value.update.call_args.args[0]
+        assert update["status"] == "FAILED" and update["error_message"]
+
+
+@pytest.mark.unit
+class TestBarCache:
+    """Tests for the range-aware historical bar cache"""
+    
+    @staticmethod
+    def _provider(drift=0.0003):
+        from datetime import date
+        from price_providers import FakeProvider
+        provider = FakeProvider(today=date(2024, 12, 31), drift=drift)
+        provider.cache_key = lambda ticker: "fake"
+        provider.get_bars_batch = MagicMock(wraps=provider.get_bars_batch)
+        return provider
+    
+    def test_sub_ranges_are_served_and_only_missing_edges_fetched(self, tmp_path):
+        """A cached range answers any sub-range; a wider range fetches only its edges"""
+        from bar_cache import BarCache
+        provider = self._provider()
+        cache = BarCache(str(tmp_path / "bars.db"), provider=provider)
+        
+        cache.get_bars("AAPL", "2020-01-01", "2022-01-01")
+        sub = cache.get_bars("AAPL", "2020-06-01", "2021-06-01")
+        assert provider.get_bars_batch.call_count == 1
+        expected = provider.get_bars("AAPL", start="2020-06-01", end="2021-06-01")
+        assert sub["Close"].tolist() == expected["Close"].tolist()
+        assert list(sub.index.date) == list(expected.index.date)
+        
+        wider = cache.get_bars("AAPL", "2019-01-01", "2023-01-01")
+        fetched = sorted((c.kwargs["start"], c.kwargs["end"]) for c in provider.get_bars_batch.call_args_list[1:])
+        assert fetched == [("2018-12-27", "2020-01-06"), ("2021-12-27", "2023-01-06")]
+        assert len(wider) == len(provider.get_bars("AAPL", start="2019-01-01", end="2023-01-01"))
+        assert wider.attrs["data_version"] == "fake:AAPL:1d:v1"
+    
+    def test_revised_prices_open_a_new_version(self, tmp_path):
+        """Corrected bars go to a new version and the old one stays reproducible"""
+        from bar_cache import BarCache
+        path = str(tmp_path / "bars.db")
+        original = BarCache(path, provider=self._provider()).get_bars("MSFT", "2020-01-01", "2021-01-01")
+        
+        revised_cache = BarCache(path, provider=self._provider(drift=0.001))
+        revised = revised_cache.get_bars("MSFT", "2020-01-01", "2021-06-01")
+        pinned = revised_cache.get_bars("MSFT", "2020-01-01", "2021-01-01", version=1)
+        
+        assert revised.attrs["data_version"] == "fake:MSFT:1d:v2"
+        assert revised["Close"].iloc[0] != original["Close"].iloc[0]
+        assert pinned["Close"].tolist() == original["Close"].tolist()
+        assert pinned.attrs["data_version"] == "fake:MSFT:1d:v1"
+    
+    def test_backtests_record_the_data_version(self, tmp_path):
+        """run_backtest reads through the cache and stores the version it used"""
+        import asyncio
+        from bar_cache import BarCache, set_bar_cache
+        from rule_execution import BacktestEngine
+        provider = self._provider()
+        set_bar_cache(BarCache(str(tmp_path / "bars.db"), provider=provider))
+        try:
+            rule = {"ticker": "MSFT", "rule_type": "price_below", "value_threshold": 1e9}
+            first = asyncio.run(BacktestEngine.run_backtest(rule, "2024-01-01", "2024-06-01", 10000))
+            second = asyncio.run(BacktestEngine.run_backtest(rule, "2024-01-01", "2024-06-01", 10000))
+        finally:
+            set_bar_cache(None)
+        
+        assert provider.get_bars_batch.call_count == 1
+        assert first["data_version"] == second["data_version"] == "fake:MSFT:1d:v1"
+        assert first["final_capital"] == second["final_capital"]
+
+
+@pytest.mark.unit
+class TestBacktestStorage:
+    """Tests for the compact backtest curve storage"""
+    
+    def test_round_trip_is_smaller_and_lossless_to_four_decimals(self):
+        """Columnar curves decode to the same points and take a fraction of the JSON"""
+        import json
+        from backtest_storage import decode_records, encode_records
+        curve = [
+            {"date": f"2024-01-{day:02d}", "equity": 10000 + day * 1.23456789, "capital": 5000.5, "positions_value": 4999.5 + day * 1.23456789}
+            for day in (2, 3, 4, 5, 8, 9, 10, 11, 12, 15)
+        ]
+        
+        encoded = encode_records(curve)
+        decoded = decode_records(json.loads(json.dumps(encoded)))
+        
+        assert encoded["day_steps"] == [1, 1, 1, 3, 1, 1, 1, 1, 3]
+        assert [p["date"] for p in decoded] == [p["date"] for p in curve]
+        for original, restored in zip(curve, decoded):
+            for key in ("equity", "capital", "positions_value"):
+                assert restored[key] == pytest.approx(original[key], abs=1e-4)
+        assert len(json.dumps(encoded)) < len(json.dumps(curve)) / 2
+        assert decode_records(curve) == curve
+    
+    def test_resample_keeps_last_point_of_each_period(self):
+        """Weekly and monthly curves keep each period's closing equity"""
+        from backtest_storage import resample_curve
+        points = [{"date": d, "equity": i} for i, d in enumerate(
+            ["2024-01-30", "2024-01-31", "2024-02-01", "2024-02-02", "2024-02-05"]
+        )]
+        
+        assert [p["date"] for p in resample_curve(points, "1wk")] == ["2024-02-02", "2024-02-05"]
+        assert [p["equity"] for p in resample_curve(points, "1mo")] == [1, 4]
+        with pytest.raises(ValueError):
+            resample_curve(points, "1h")
+    
+    def test_list_endpoint_selects_summary_columns(self):
+        """Listing a rule's backtests does not ship equity curves or executions"""
+        from app_supabase import get_rule_backtests
+        from backtest_storage import BACKTEST_SUMMARY_COLUMNS
+        import asyncio
+        user = Mock(id="user-1")
+        with patch("app_supabase.supabase") as supabase:
+            table = supabase.table.return_value
+            table.select.return_value.eq.return_value.eq.return_value.execute.return_value = MagicMock(data=[{"id": "rule-1"}])
+            table.select.return_value.eq.return_value.order.return_value.execute.return_value = MagicMock(data=[{"id": "bt-1"}])
+            result = asyncio.run(get_rule_backtests("rule-1", user))
+        
+        assert result == [{"id": "bt-1"}]
+        assert table.select.call_args_list[-1].args[0] == BACKTEST_SUMMARY_COLUMNS
+        assert "daily_equity_curve" not in BACKTEST_SUMMARY_COLUMNS
+        assert "execution_details" not in BACKTEST_SUMMARY_COLUMNS
+
+
+@pytest.mark.unit
+class TestBacktestBenchmark:
+    """Tests for the offline backtest benchmark suite"""
+    
+    def test_synthetic_series_is_seeded(self):
+        """The same seed gives the same geometric Brownian series"""
+        from bench_backtest import gbm_bars
+        a = gbm_bars(500, seed=7)
+        b = gbm_bars(500, seed=7)
+        
+        assert a.equals(b)
+        assert not a.equals(gbm_bars(500, seed=8))
+        assert (a["High"] >= a[["Open", "Close"]].max(axis=1)).all()
+        assert (a["Low"] <= a[["Open", "Close"]].min(axis=1)).all()
+    
+    def test_run_covers_every_rule_and_execution_type(self):
+        """Each size runs every rule type for BUY and SELL and reports throughput and memory"""
+        from bench_backtest import EXECUTION_TYPES, RULE_TYPES, run
+        cases = run(sizes=[300], repeats=1)
+        
+        assert len(cases) == len(RULE_TYPES) * len(EXECUTION_TYPES)
+        assert {c["case"] for c in cases} == {
+            f"vectorized/300/{r}/{e}" for r in RULE_TYPES for e in EXECUTION_TYPES
+        }
+        assert all(c["bars_per_second"] > 0 and c["peak_kb"] > 0 and c["blocks"] > 0 for c in cases)
+    
+    def test_compare_flags_regressions(self, tmp_path):
+        """Slower, heavier or behaviour-changing runs are reported against the stored baseline"""
+        from bench_backtest import compare, load_baseline, save_baseline
+        case = {"case": "vectorized/1000/price_below/BUY", "bars": 1000, "seconds": 0.001,
+                "bars_per_second": 1_000_000, "peak_kb": 500.0, "blocks": 8000, "executions": 500}
+        path = str(tmp_path / "baseline.json")
+        save_baseline([case], path)
+        baseline = load_baseline(path)
+        
+        assert compare([case], baseline) == []
+        slower = dict(case, bars_per_second=500_000, blocks=20000, executions=499)
+        assert len(compare([slower], baseline)) == 3
+
+
+@pytest.mark.unit
+class TestPointInTimePE:
+    """Tests for the point-in-time P/E series used by pe_below/pe_above backtests"""
+    
+    @staticmethod
+    def _history():
+        import numpy as np
+        import pandas as pd
+        index = pd.bdate_range("2023-01-02", "2024-12-31", name="Date")
+        close = 100 + 10 * np.sin(np.arange(len(index)) / 20)
+        return pd.DataFrame({"Open": close, "High": close, "Low": close, "Close": close, "Volume": 1000}, index=index)
+    
+    @staticmethod
+    def _earnings():
+        import pandas as pd
+        published = pd.to_datetime(["2023-02-01", "2023-05-01", "2023-08-01", "2023-11-01", "2024-02-01", "2024-05-01"])
+        return pd.DataFrame({"eps": [1.0, 1.0, 1.0, 1.0, 2.0, -8.0]}, index=published)
+    
+    def test_pe_uses_only_published_quarters(self):
+        """Each bar divides by the trailing EPS known that day; no P/E before four quarters or with negative EPS"""
+        import numpy as np
+        import pandas as pd
+        from rule_execution import BacktestEngine
+        hist = self._history()
+        pe = pd.Series(BacktestEngine.pe_series(hist, self._earnings()), index=hist.index)
+        close = hist["Close"]
+        
+        assert np.isnan(pe[:"2023-10-31"]).all()
+        assert pe["2023-11-01"] == pytest.approx(close["2023-11-01"] / 4.0)
+        assert pe["2024-01-31"] == pytest.approx(close["2024-01-31"] / 4.0)
+        assert pe["2024-02-01"] == pytest.approx(close["2024-02-01"] / 5.0)
+        assert np.isnan(pe["2024-05-01":]).all()
+        assert np.isnan(BacktestEngine.pe_series(hist, None)).all()
+    
+    @pytest.mark.parametrize("rule_type", ["pe_below", "pe_above"])
+    @pytest.mark.parametrize("execution_type", ["BUY", "SELL"])
+    def test_vectorized_matches_loop(self, rule_type, execution_type):
+        """The vectorized engine and the day-by-day loop agree on P/E rules"""
+        from rule_execution import BacktestEngine
+        hist = BacktestEngine.attach_pe(self._history(), self._earnings())
+        rule = {"ticker": "TEST", "rule_type": rule_type, "value_threshold": 22.0,
+                "execution_type": execution_type, "quantity": 1}
+        
+        result = BacktestEngine.simulate(rule, hist, 100000)
+        
+        assert result["total_executions"] > 0
+        assert result == BacktestEngine.simulate_loop(rule, hist, 100000)
+    
+    def test_earnings_are_cached_per_ticker(self, tmp_path):
+        """Quarterly EPS is served from the bar cache until the TTL expires"""
+        from datetime import date
+        from bar_cache import BarCache
+        from price_providers import FakeProvider
+        provider = FakeProvider(today=date(2024, 12, 31))
+        provider.cache_key = lambda ticker: "fake"
+        provider.get_earnings = MagicMock(wraps=provider.get_earnings)
+        cache = BarCache(str(tmp_path / "bars.db"), provider=provider)
+        
+        first = cache.get_earnings("AAPL")
+        second = cache.get_earnings("AAPL")
+        assert provider.get_earnings.call_count == 1
+        assert second["eps"].tolist() == pytest.approx(first["eps"].tolist())
+        assert list(second.index) == list(first.index)
+        
+        cache.earnings_ttl = 0
+        cache.get_earnings("AAPL")
+        assert provider.get_earnings.call_count == 2
+    
+    def test_sources_dating_a_quarter_differently_are_not_double_counted(self, tmp_path):
+        """Statement-dated and announcement-dated EPS replace each other by quarter; empty fetches are retried"""
+        import pandas as pd
+        from bar_cache import BarCache
+        from price_providers import FakeProvider, earnings_frame, fiscal_quarter
+        quarter_ends = pd.to_datetime(["2023-12-30", "2024-03-30", "2024-06-29", "2024-09-28"])
+        statement = earnings_frame([1.0, 1.1, 1.2, 1.3], quarter_ends + pd.Timedelta(days=45), fiscal_quarter(quarter_ends))
+        announced = earnings_frame([1.0, 1.1, 1.2, 1.4], pd.to_datetime(["2024-02-02", "2024-05-03", "2024-08-02", "2024-11-01"]))
+        provider = FakeProvider()
+        provider.cache_key = lambda ticker: "fake"
+        provider.get_earnings = MagicMock(side_effect=[earnings_frame([], []), statement, announced])
+        cache = BarCache(str(tmp_path / "bars.db"), provider=provider, earnings_ttl=3600)
+        
+        assert cache.get_earnings("AAPL").empty
+        assert cache.get_earnings("AAPL")["eps"].tolist() == [1.0, 1.1, 1.2, 1.3]
+        cache.earnings_ttl = 0
+        merged = cache.get_earnings("AAPL")
+        
+        assert provider.get_earnings.call_count == 3
+        assert merged["quarter"].tolist() == ["2023Q4", "2024Q1", "2024Q2", "2024Q3"]
+        assert merged["eps"].tolist() == [1.0, 1.1, 1.2, 1.4]
+        assert list(merged.index) == list(announced.index)
+
+
+@pytest.mark.unit
+class TestStreamingBacktest:
+    """Tests for intraday backtests on the chunked streaming engine"""
+    
+    @pytest.mark.parametrize("rule_type,threshold", [("price_below", 100.0), ("price_above", 100.0), ("max_distance", -10.0)])
+    @pytest.mark.parametrize("execution_type", ["BUY", "SELL"])
+    def test_stream_matches_vectorized_on_daily_bars(self, rule_type, threshold, execution_type):
+        """Carrying state across chunks gives exactly the single-frame result"""
+        from bench_backtest import gbm_bars
+        from rule_execution import BacktestEngine
+        hist = gbm_bars(1500, seed=5)
+        rule = {"rule_type": rule_type, "value_threshold": threshold, "execution_type": execution_type, "quantity": 1}
+        chunks = (hist.iloc[i:i + 97] for i in range(0, len(hist), 97))
+        
+        streamed = BacktestEngine.simulate_stream(rule, chunks, 20000)
+        full = BacktestEngine.simulate(rule, hist, 20000)
+        streamed_details, full_details = streamed.pop("execution_details"), full.pop("execution_details")
+        assert streamed == full
+        assert [e for e in streamed_details if e["status"] == "EXECUTED"] == [e for e in full_details if e["status"] == "EXECUTED"]
+        assert sum(e.get("bars", 1) for e in streamed_details) == len(full_details)
+        rejected = [e for e in streamed_details if e["status"] != "EXECUTED"]
+        assert all(a["end_date"] < b["date"] for a, b in zip(rejected, rejected[1:]))
+    
+    def test_intraday_chunks_are_bounded_and_curve_is_daily(self, tmp_path):
+        """Intraday bars are read in bounded chunks; the curve keeps one point per session"""
+        from datetime import date
+        import pandas as pd
+        from bar_cache import BarCache, set_bar_cache
+        from price_providers import FakeProvider, set_price_provider
+        from rule_execution import BacktestEngine
+        provider = FakeProvider(today=date(2024, 6, 28))
+        rule = {"ticker": "AAPL", "rule_type": "max_distance", "value_threshold": -2.0,
+                "execution_type": "BUY", "quantity": 1}
+        set_price_provider(provider)
+        set_bar_cache(BarCache(str(tmp_path / "bars.db"), provider=provider))
+        try:
+            chunks = list(BacktestEngine.stream_history("AAPL", "2024-04-01", "2024-06-01", "5m", chunk_bars=500))
+            result = BacktestEngine.simulate_stream(rule, iter(chunks), 100000, "5m")
+        finally:
+            set_price_provider(None)
+            set_bar_cache(None)
+        
+        hist = provider.get_bars("AAPL", start="2024-04-01", end="2024-06-01", interval="5m")
+        assert len(chunks) > 1 and all(len(chunk) <= 500 for chunk in chunks)
+        assert pd.concat(chunks).equals(hist)
+        sessions = sorted({day.isoformat() for day in hist.index.date})
+        assert [point["date"] for point in result["daily_equity_curve"]] == sessions
+        assert result["total_executions"] > 0
+        assert all(len(execution["date"]) == 16 for execution in result["execution_details"])
+        full = BacktestEngine.simulate(rule, hist, 100000)
+        assert result["final_capital"] == full["final_capital"]
+        assert result["max_drawdown"] == full["max_drawdown"]
+        assert result["total_executions"] == full["total_executions"]
+    
+    def test_rejected_triggers_are_counted_not_stored(self):
+        """Details and peak memory stay flat as a 1m stream of rejected triggers grows"""
+        import tracemalloc
+        import numpy as np
+        import pandas as pd
+        from rule_execution import BacktestEngine
+        rule = {"rule_type": "price_above", "value_threshold": 0.0, "execution_type": "BUY", "quantity": 1}
+        
+        def chunks(count, bars=2000):
+            for i in range(count):
+                index = pd.date_range("2024-01-01", periods=bars, freq="1min") + pd.Timedelta(minutes=i * bars)
+                close = 100.0 + np.sin(np.arange(i * bars, (i + 1) * bars) / 50.0)
+                yield pd.DataFrame({"Close": close, "High": close}, index=index)
+        
+        def run(count):
+            tracemalloc.start()
+            result = BacktestEngine.simulate_stream(rule, chunks(count), 1000, "1m")
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return result, peak
+        
+        short, short_peak = run(5)
+        long, long_peak = run(40)
+        
+        assert long["total_executions"] == 80000 and long["successful_executions"] == 10
+        assert len(long["execution_details"]) == len(short["execution_details"]) == 12
+        assert sum(e.get("bars", 1) for e in long["execution_details"]) == 80000
+        assert long["execution_details"][-1]["end_date"] == "2024-02-25 13:19"
+        assert long_peak < short_peak * 1.5
+    
+    def test_job_queue_streams_intraday_backtests(self, tmp_path):
+        """An intraday job stores its interval and finishes with a daily curve"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import date
+        from backtest_jobs import BacktestJobQueue
+        from bar_cache import BarCache, set_bar_cache
+        from price_providers import FakeProvider, set_price_provider
+        supabase = TestBacktestJobQueue._supabase()
+        provider = FakeProvider(today=date(2024, 6, 28))
+        
+        async def scenario():
+            queue = BacktestJobQueue(supabase, max_workers=1, executor=ThreadPoolExecutor(1))
+            queue.submit(TestBacktestJobQueue._rule(), "user-1", "2024-06-03", "2024-06-08", 10000, interval="1m")
+            await asyncio.gather(*queue._tasks)
+            queue.shutdown()
+        
+        set_price_provider(provider)
+        set_bar_cache(BarCache(str(tmp_path / "bars.db"), provider=provider))
+        try:
+            asyncio.run(scenario())
+        finally:
+            set_price_provider(None)
+            set_bar_cache(None)
+        
+        updates = [c.args[0] for c in supabase.table.return_value.update.call_args_list]
+        assert supabase.table.return_value.insert.call_args.args[0]["interval"] == "1m"
+        assert [u.get("progress") for u in updates] == [10, 30, 100]
+        assert updates[-1]["status"] == "COMPLETED"
+        assert updates[-1]["daily_equity_curve"]["length"] == 5
+        assert updates[-1]["execution_details"]["dates"][0].startswith("2024-06-03 ")
+
+
+@pytest.mark.unit
+class TestBacktestRobustness:
+    """Tests for the block-bootstrap and walk-forward robustness analysis"""
+    
+    @staticmethod
+    def _history():
+        from bench_backtest import gbm_bars
+        return gbm_bars(800, seed=11)
+    
+    def test_real_path_matches_the_backtest(self):
+        """Signals and returns on the real series agree with BacktestEngine"""
+        import numpy as np
+        from backtest_robustness import path_signals, simulate_paths
+        from rule_execution import BacktestEngine
+        hist = self._history()
+        close, high = hist["Close"].to_numpy(), hist["High"].to_numpy()
+        pe = np.full(len(hist), np.nan)
+        
+        for rule_type, threshold in [("price_below", float(hist["Close"].median())), ("max_distance", -10.0)]:
+            rule = {"rule_type": rule_type, "value_threshold": threshold, "execution_type": "BUY", "quantity": 1}
+            signals = path_signals(rule_type, threshold, close, high, pe)
+            assert (signals[0] == BacktestEngine.signals(rule_type, threshold, hist)).all()
+            
+            metrics = simulate_paths(signals, close, 1, 5000)
+            result = BacktestEngine.simulate(rule, hist, 5000)
+            assert metrics["total_return"][0] == pytest.approx(result["total_return"])
+            assert metrics["trades"][0] == result["successful_executions"]
+    
+    def test_bootstrap_is_reproducible_across_executors(self):
+        """The same seed gives the same distributions inline and in a pool"""
+        from concurrent.futures import ThreadPoolExecutor
+        from backtest_robustness import run_robustness
+        rule = {"rule_type": "max_distance", "value_threshold": -10.0, "execution_type": "BUY", "quantity": 1}
+        
+        with patch("backtest_robustness.CELLS_PER_TASK", 20_000):
+            inline = run_robustness(rule, self._history(), 10000, paths=120, seed=7)
+            with ThreadPoolExecutor(2) as executor:
+                pooled = run_robustness(rule, self._history(), 10000, paths=120, seed=7, executor=executor)
+        
+        assert inline == pooled
+        bootstrap = inline["bootstrap"]
+        assert sum(bootstrap["total_return"]["histogram"]["counts"]) == 120
+        assert bootstrap["max_drawdown"]["p5"] <= bootstrap["max_drawdown"]["p50"] <= bootstrap["max_drawdown"]["p95"]
+        assert 0 <= bootstrap["probability_of_loss"] <= 1
+        assert run_robustness(rule, self._history(), 10000, paths=120, seed=8)["bootstrap"] != bootstrap
+    
+    def test_walk_forward_picks_thresholds_on_past_windows(self):
+        """Each fold fits on earlier bars and is tested on the next window"""
+        from backtest_robustness import run_robustness
+        rule = {"rule_type": "max_distance", "value_threshold": -10.0, "execution_type": "BUY", "quantity": 1}
+        thresholds = [-20.0, -10.0, -5.0]
+        
+        anchored = run_robustness(rule, self._history(), 10000, paths=10, folds=3, thresholds=thresholds, seed=1)
+        rolling = run_robustness(rule, self._history(), 10000, paths=10, folds=3, thresholds=thresholds,
+                                 anchored=False, seed=1)
+        
+        folds = anchored["walk_forward"]["folds"]
+        assert len(folds) == 3
+        assert all(fold["value_threshold"] in thresholds for fold in folds)
+        assert all(fold["train_end"] < fold["test_start"] <= fold["test_end"] for fold in folds)
+        assert {fold["train_start"] for fold in folds} == {folds[0]["train_start"]}
+        assert [fold["train_start"] for fold in rolling["walk_forward"]["folds"]][1:] == [f["test_start"] for f in folds][:-1]
+        with pytest.raises(ValueError):
+            run_robustness(rule, self._history(), objective="win_rate")
@@ -0,0 +1,287 @@
+"""
+Métricas del worker de reglas en formato Prometheus
+Contadores, gauges e histogramas en memoria (sin dependencias externas) y un servidor
+HTTP mínimo que los expone en /metrics
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}, recibió {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _lines(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._lines()
+
+
+class Counter(_Metric):
+    """Valor que solo crece (requests, errores, reglas evaluadas)"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _lines(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Valor instantáneo (profundidad de colas, reglas por segundo)"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> Optional[float]:
+        return self._values.get(self._key(labels))
+
+    def _lines(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribución de duraciones en buckets acumulativos"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple, Dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Mide la duración del bloque (también si termina con una excepción)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series["count"] if series else 0
+
+    def total(self, **labels) -> float:
+        series = self._series.get(self._key(labels))
+        return series["sum"] if series else 0.0
+
+    def _lines(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((key, {"counts": list(s["counts"]), "sum": s["sum"], "count": s["count"]}) for key, s in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Conjunto de métricas que se exponen juntas"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Texto en formato de exposición de Prometheus (0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class WorkerMetrics:
+    """
+    Métricas del worker de reglas
+
+    - rule_worker_cycle_seconds: duración de cada ciclo
+    - rule_worker_stage_seconds{stage}: duración de cada etapa (load_rules,
+      broker_registry, decrypt, market_data, execution_flush, alert_pipeline,
+      broker_order)
+    - rule_worker_rules_evaluated_total y rule_worker_rules_per_second
+    - rule_worker_upstream_requests_total{upstream,outcome}: tasa de errores del
+      proveedor de precios, Supabase y brokers
+    - rule_worker_queue_depth{queue}: órdenes encoladas y en curso, ejecuciones sin
+      persistir, emails y alertas pendientes
+    - rule_worker_cycle_overruns_total: ciclos más largos que RULE_CHECK_INTERVAL
+    """
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.cycle_seconds = self.registry.register(Histogram(
+            "rule_worker_cycle_seconds", "Duración de un ciclo completo del worker"
+        ))
+        self.stage_seconds = self.registry.register(Histogram(
+            "rule_worker_stage_seconds", "Duración de cada etapa del ciclo", ("stage",)
+        ))
+        self.rules_evaluated = self.registry.register(Counter(
+            "rule_worker_rules_evaluated_total", "Reglas evaluadas"
+        ))
+        self.rules_per_second = self.registry.register(Gauge(
+            "rule_worker_rules_per_second", "Reglas evaluadas por segundo en el último ciclo"
+        ))
+        self.upstream_requests = self.registry.register(Counter(
+            "rule_worker_upstream_requests_total", "Llamadas a servicios externos por resultado", ("upstream", "outcome")
+        ))
+        self.queue_depth = self.registry.register(Gauge(
+            "rule_worker_queue_depth", "Elementos pendientes por cola", ("queue",)
+        ))
+        self.cycles = self.registry.register(Counter(
+            "rule_worker_cycles_total", "Ciclos completados"
+        ))
+        self.cycle_overruns = self.registry.register(Counter(
+            "rule_worker_cycle_overruns_total", "Ciclos que duraron más que el intervalo configurado"
+        ))
+
+    def stage(self, name: str):
+        """Context manager que mide una etapa"""
+        return self.stage_seconds.time(stage=name)
+
+    @contextmanager
+    def upstream(self, name: str) -> Iterator[None]:
+        """Cuenta una llamada externa como ok o error según si lanza una excepción"""
+        try:
+            yield
+        except Exception:
+            self.upstream_requests.inc(upstream=name, outcome="error")
+            raise
+        self.upstream_requests.inc(upstream=name, outcome="ok")
+
+    def record_cycle(self, duration: float, evaluated: int, interval: float):
+        self.cycles.inc()
+        self.cycle_seconds.observe(duration)
+        self.rules_evaluated.inc(evaluated)
+        self.rules_per_second.set(evaluated / duration if duration > 0 else 0)
+        if duration > interval:
+            self.cycle_overruns.inc()
+
+    def set_queue_depths(self, depths: Dict[str, float]):
+        for queue, depth in depths.items():
+            self.queue_depth.set(depth, queue=queue)
+
+
+async def serve_metrics(registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9108) -> asyncio.AbstractServer:
+    """
+    Servidor HTTP mínimo con GET /metrics
+
+    Args:
+        registry: Métricas a exponer
+        host: Interfaz (por defecto solo local)
+        port: Puerto
+
+    Returns:
+        El servidor asyncio (cerrar con close())
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Descartar los headers de la request
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Métricas del worker en http://{host}:{port}/metrics")
+    return server
+
+
+async def serve_metrics_from_env(registry: MetricsRegistry) -> Optional[asyncio.AbstractServer]:
+    """Levanta /metrics en WORKER_METRICS_HOST:WORKER_METRICS_PORT (puerto 0 lo desactiva)"""
+    port = int(os.getenv("WORKER_METRICS_PORT", "9108"))
+    if not port:
+        return None
+    try:
+        return await serve_metrics(registry, os.getenv("WORKER_METRICS_HOST", "127.0.0.1"), port)
+    except OSError as e:
+        logger.error(f"No se pudo abrir el puerto de métricas {port}: {str(e)}")
+        return None
@@ -3,14 +3,30 @@ Worker para ejecutar reglas automáticamente
 Este worker verifica periódicamente las reglas activas y ejecuta órdenes cuando se cumplen
 """
 import asyncio
+import json
 import logging
 import os
+import time
 from datetime import datetime, timezone
-from typing import List, Dict
+from functools import partial
+from typing import List, Dict, Optional
 from supabase import create_client, Client
 from rule_execution import RuleEvaluator
 from conexion_iol import ConexionIOL
 from conexion_binance import ConexionBinance
+from rule_sharding import PartitionLeaseManager
+from rule_schedule import CooldownSchedule
+from market_calendar import market_for_ticker
+from execution_buffer import ExecutionWriteBuffer
+from broker_registry import BrokerConnectionRegistry
+from order_dispatcher import OrderDispatcher
+from order_queue import OrderQueue
+from alert_digest import AlertDigestCoalescer
+from alert_pipeline import AlertPipeline
+from quote_book import QuoteBook
+from email_outbox import EmailOutbox
+from worker_metrics import WorkerMetrics, serve_metrics_from_env
+import broker_http
 from cryptography.fernet import Fernet
 
 # Configure logging
@@ -36,144 +52,364 @@ if not ENCRYPTION_KEY:
 ENCRYPTION_KEY = ENCRYPTION_KEY.encode()
 cipher_suite = Fernet(ENCRYPTION_KEY)
 
+# Process-wide metrics, exposed on WORKER_METRICS_PORT (/metrics)
+metrics = WorkerMetrics()
+
 def decrypt_api_key(encrypted_key: str) -> str:
     """Decrypt an encrypted API key"""
     try:
-        return cipher_suite.decrypt(encrypted_key.encode()).decode()
+        with metrics.stage("decrypt"):
+            return cipher_suite.decrypt(encrypted_key.encode()).decode()
     except Exception as e:
         logger.error(f"Error decrypting key: {str(e)}")
         raise
 
-async def check_and_execute_rules():
-    """Check all active rules and execute if conditions are met"""
+async def execute_order(
+    lease_manager: PartitionLeaseManager,
+    rule: Dict,
+    broker_connection: Dict,
+    credentials: Dict
+) -> Optional[Dict]:
+    """Send a triggered rule's order to its broker (runs inside the order dispatcher)"""
+    ticker = rule.get("ticker")
+    quantity = float(rule.get("quantity", 0))
+    execution_type = rule.get("execution_type")
+    broker_name = broker_connection.get("broker_name")
+    
+    # Re-check ownership right before the order: the lease may have expired
+    # or moved to another worker while the order was queued. Delivery is still
+    # at-least-once: if the lease lapses during the broker call (or before the
+    # execution is flushed), the new owner can trigger the rule again. The lease TTL
+    # is sized above the broker timeout plus the flush latency to keep that rare
+    if not lease_manager.owns_ticker(ticker):
+        logger.warning(f"Lease lost for {ticker}, skipping order for rule {rule.get('id')}")
+        return None
+    
+    execution_result = None
+    try:
+        if broker_name == "IOL":
+            conexion = ConexionIOL(
+                credentials["username"],
+                credentials["password"],
+                connection_id=broker_connection.get("id")
+            )
+            execution_result = await conexion.ejecutar_orden(ticker, quantity, execution_type)
+            
+        elif broker_name == "BINANCE":
+            conexion = ConexionBinance(credentials["api_key"], credentials["api_secret"])
+            symbol = ticker if "USDT" in ticker else f"{ticker}USDT"
+            execution_result = await conexion.ejecutar_orden(symbol, quantity, execution_type)
+        
+        logger.info(f"Execution result for rule {rule.get('id')}: {execution_result}")
+        
+    except Exception as e:
+        logger.error(f"Error executing order for rule {rule.get('id')}: {str(e)}")
+        execution_result = {
+            "success": False,
+            "error": str(e),
+            "status": "FAILED"
+        }
+    return execution_result or {"success": False, "error": f"Unsupported broker: {broker_name}", "status": "FAILED"}
+
+def record_execution(
+    execution_buffer: ExecutionWriteBuffer,
+    rule: Dict,
+    broker_connection: Optional[Dict],
+    current_data: Optional[Dict],
+    triggered_at: str,
+    execution_result,
+    execution_id: Optional[str] = None
+):
+    """Buffer the rule_executions record for a triggered rule"""
+    if isinstance(execution_result, Exception):
+        execution_result = {"success": False, "error": str(execution_result), "status": "FAILED"}
+    
+    execution_data = {
+        "rule_id": rule.get("id"),
+        "user_id": rule.get("user_id"),
+        "broker_connection_id": broker_connection.get("id") if broker_connection else None,
+        "execution_type": rule.get("execution_type", "ALERT_ONLY"),
+        "ticker": rule.get("ticker"),
+        "quantity": rule.get("quantity"),
+        "price": current_data.get("current_price") if current_data else None,
+        "total_amount": (rule.get("quantity", 0) * current_data.get("current_price")) if current_data else None,
+        "status": "EXECUTED" if execution_result and execution_result.get("success") else "FAILED",
+        "error_message": execution_result.get("error") if execution_result and not execution_result.get("success") else None,
+        "broker_response": execution_result,
+        "broker_order_id": execution_result.get("order_id") if execution_result else None,
+        "triggered_at": triggered_at,
+        "executed_at": datetime.now(timezone.utc).isoformat() if execution_result and execution_result.get("success") else None
+    }
+    
+    # A fixed id (queued orders) makes re-recording after a crash idempotent
+    if execution_id:
+        execution_data["id"] = execution_id
+    
+    # Buffered: persisted in bulk together with rules.last_execution_at
+    execution_buffer.add(execution_data)
+    logger.info(f"Rule {rule.get('id')} executed successfully")
+    
+    # Send email notification (if configured)
+    # TODO: Implement email notification
+
+def complete_queued_order(
+    order_queue: OrderQueue,
+    execution_buffer: ExecutionWriteBuffer,
+    entry: Dict,
+    execution_result,
+    lease_manager: Optional[PartitionLeaseManager] = None
+):
+    """Store the broker result of a queued order, then record its execution"""
+    key = entry["idempotency_key"]
+    # None means the order was skipped (lease lost) and nothing is recorded
+    if execution_result is None:
+        order_queue.mark_cancelled(key)
+        return
+    if isinstance(execution_result, Exception):
+        execution_result = {"success": False, "error": str(execution_result), "status": "FAILED"}
+    
+    order_queue.mark_done(key, execution_result)
+    record_execution(
+        execution_buffer,
+        entry["rule"],
+        {"id": entry["broker_connection_id"]} if entry["broker_connection_id"] else None,
+        entry["current_data"],
+        entry["triggered_at"],
+        execution_result,
+        execution_id=entry["execution_id"]
+    )
+    order_queue.mark_recorded(key)
+    # Lease lost while the order was at the broker: persist last_execution_at now so the
+    # new owner does not trigger the rule again from a stale value
+    if lease_manager is not None and not lease_manager.owns_ticker(entry["rule"].get("ticker")):
+        logger.warning(f"Lease lost during order for rule {entry['rule'].get('id')}, flushing executions")
+        execution_buffer.flush()
+
+async def send_queued_order(
+    order_queue: OrderQueue,
+    lease_manager: PartitionLeaseManager,
+    entry: Dict,
+    broker_connection: Dict,
+    credentials: Dict
+) -> Optional[Dict]:
+    # Persisted before the broker call: after a crash this order is never re-sent
+    order_queue.mark_sending(entry["idempotency_key"])
+    with metrics.stage("broker_order"):
+        result = await execute_order(lease_manager, entry["rule"], broker_connection, credentials)
+    if result is not None:
+        outcome = "ok" if result.get("success") else "error"
+        metrics.upstream_requests.inc(upstream=broker_connection.get("broker_name") or "unknown", outcome=outcome)
+    return result
+
+async def execute_queued_orders(
+    order_queue: OrderQueue,
+    order_dispatcher: OrderDispatcher,
+    broker_registry: BrokerConnectionRegistry,
+    lease_manager: PartitionLeaseManager,
+    execution_buffer: ExecutionWriteBuffer
+) -> int:
+    """Hand queued orders to the dispatcher (which applies the per-broker limits)"""
+    entries = order_queue.pending(exclude=order_dispatcher.pending_keys())
+    if not entries:
+        return 0
+    
+    missing = [entry["rule"] for entry in entries if broker_registry.get(entry["broker_connection_id"]) is None]
+    if missing:
+        broker_registry.refresh(missing)
+    
+    for entry in entries:
+        registry_entry = broker_registry.get(entry["broker_connection_id"])
+        if not registry_entry:
+            complete_queued_order(order_queue, execution_buffer, entry, {
+                "success": False, "error": "Broker connection not available", "status": "FAILED"
+            })
+            continue
+        broker_connection = registry_entry["connection"]
+        order_dispatcher.submit(
+            entry["idempotency_key"],
+            broker_connection.get("broker_name"),
+            broker_connection.get("id"),
+            partial(send_queued_order, order_queue, lease_manager, entry, broker_connection, registry_entry["credentials"]),
+            partial(complete_queued_order, order_queue, execution_buffer, entry, lease_manager=lease_manager)
+        )
+    return len(entries)
+
+async def run_order_executor(
+    order_queue: OrderQueue,
+    order_dispatcher: OrderDispatcher,
+    broker_registry: BrokerConnectionRegistry,
+    lease_manager: PartitionLeaseManager,
+    execution_buffer: ExecutionWriteBuffer,
+    interval: float = 1.0
+):
+    """Execution stage: drains the order queue at broker speed, independently of evaluation"""
+    last_purge = 0.0
+    while True:
+        try:
+            await execute_queued_orders(order_queue, order_dispatcher, broker_registry, lease_manager, execution_buffer)
+            if time.monotonic() - last_purge > 3600:
+                order_queue.purge()
+                last_purge = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error in order executor: {str(e)}", exc_info=True)
+        await asyncio.sleep(interval)
+
+def _rule_market(rule: Dict, broker_registry: BrokerConnectionRegistry):
+    # The broker decides the venue for bare symbols (e.g. "BTC" on Binance, "GGAL" on IOL)
+    registry_entry = broker_registry.get(rule.get("broker_connection_id"))
+    broker_name = registry_entry["connection"].get("broker_name") if registry_entry else None
+    return market_for_ticker(rule.get("ticker"), broker_name)
+
+async def check_and_execute_rules(
+    lease_manager: PartitionLeaseManager,
+    execution_buffer: ExecutionWriteBuffer,
+    broker_registry: BrokerConnectionRegistry,
+    order_queue: OrderQueue,
+    cooldown_schedule: CooldownSchedule
+) -> Dict:
+    """Check active rules owned by this worker and queue orders if conditions are met"""
     try:
         # Get all active rules with execution enabled
-        rules_response = supabase.table("rules") \
-            .select("*") \
-            .eq("is_active", True) \
-            .eq("execution_enabled", True) \
-            .neq("execution_type", "ALERT_ONLY") \
-            .execute()
+        with metrics.stage("load_rules"), metrics.upstream("supabase"):
+            rules_response = supabase.table("rules") \
+                .select("*") \
+                .eq("is_active", True) \
+                .eq("execution_enabled", True) \
+                .neq("execution_type", "ALERT_ONLY") \
+                .execute()
         
-        rules = rules_response.data or []
-        logger.info(f"Checking {len(rules)} active rules with execution enabled")
+        all_rules = rules_response.data or []
+        owned_rules = execution_buffer.apply_pending(lease_manager.filter_rules(all_rules))
+        
+        # Rules in cooldown (or with an order still queued, in flight or unrecorded)
+        # are skipped before any market data is fetched
+        eligible_rules = [
+            rule for rule in cooldown_schedule.eligible(owned_rules)
+            if not order_queue.has_open(rule.get("id"))
+        ]
+        
+        # One query for every broker connection used by this cycle's rules
+        with metrics.stage("broker_registry"):
+            broker_registry.refresh(eligible_rules)
+        
+        # Orders can only fill while the rule's market is open (crypto trades 24/7)
+        rules = [rule for rule in eligible_rules if _rule_market(rule, broker_registry).is_open()]
+        rules_by_ticker: Dict[str, List[Dict]] = {}
+        for rule in rules:
+            rules_by_ticker.setdefault(rule.get("ticker"), []).append(rule)
+        logger.info(
+            f"Checking {len(rules)} eligible of {len(owned_rules)} owned rules ({len(all_rules)} active, "
+            f"{cooldown_schedule.cooling_count()} in cooldown, {len(eligible_rules) - len(rules)} in closed markets) "
+            f"across {len(rules_by_ticker)} tickers ({len(lease_manager.owned_partitions())} partitions owned)"
+        )
         
         evaluator = RuleEvaluator()
         executed_count = 0
+        queued_count = 0
+        evaluated_count = 0
         
-        for rule in rules:
+        for ticker, ticker_rules in rules_by_ticker.items():
+            # One market data fetch per ticker, shared by all its eligible rules
             try:
-                # Evaluate rule
-                condition_met, current_data = await evaluator.evaluate_rule(rule)
-                
-                if not condition_met:
-                    continue
-                
-                # Check cooldown
-                last_execution = rule.get("last_execution_at")
-                cooldown_minutes = rule.get("cooldown_minutes", 60)
-                
-                if last_execution:
-                    try:
-                        last_exec = datetime.fromisoformat(last_execution.replace('Z', '+00:00'))
-                        time_since = (datetime.now(timezone.utc) - last_exec).total_seconds()
-                        if time_since < (cooldown_minutes * 60):
-                            logger.info(f"Rule {rule.get('id')} is in cooldown period")
-                            continue
-                    except Exception as e:
-                        logger.warning(f"Error parsing last_execution_at: {str(e)}")
-                
-                # Get broker connection
-                broker_connection = None
-                broker_connection_id = rule.get("broker_connection_id")
-                if broker_connection_id:
-                    broker_response = supabase.table("broker_connections") \
-                        .select("*") \
-                        .eq("id", broker_connection_id) \
-                        .eq("is_active", True) \
-                        .execute()
+                with metrics.stage("market_data"):
+                    ticker_data = await asyncio.to_thread(RuleEvaluator.get_current_data, ticker)
+            except Exception as e:
+                metrics.upstream_requests.inc(upstream="market_data", outcome="error")
+                logger.error(f"Error fetching data for {ticker}: {str(e)}")
+                continue
+            metrics.upstream_requests.inc(upstream="market_data", outcome="ok" if ticker_data else "empty")
+            if ticker_data is None:
+                continue
+            
+            evaluated_count += len(ticker_rules)
+            for rule in ticker_rules:
+                try:
+                    condition_met, current_data = await evaluator.evaluate_rule(rule, ticker_data)
+                    
+                    if not condition_met:
+                        continue
                     
-                    if broker_response.data and len(broker_response.data) > 0:
-                        broker_connection = broker_response.data[0]
-                
-                # Execute order
-                execution_result = None
-                
-                if broker_connection and rule.get("execution_type") in ["BUY", "SELL"]:
-                    broker_name = broker_connection.get("broker_name")
-                    ticker = rule.get("ticker")
-                    quantity = float(rule.get("quantity", 0))
-                    execution_type = rule.get("execution_type")
+                    # Get broker connection (decrypted credentials cached in memory)
+                    broker_connection = None
+                    credentials = {}
+                    registry_entry = broker_registry.get(rule.get("broker_connection_id"))
+                    if registry_entry:
+                        broker_connection = registry_entry["connection"]
+                        credentials = registry_entry["credentials"]
                     
-                    if quantity <= 0:
-                        logger.warning(f"Rule {rule.get('id')} has invalid quantity: {quantity}")
+                    triggered_at = datetime.now(timezone.utc).isoformat()
+                    
+                    if broker_connection and rule.get("execution_type") in ["BUY", "SELL"]:
+                        quantity = float(rule.get("quantity", 0))
+                        if quantity <= 0:
+                            logger.warning(f"Rule {rule.get('id')} has invalid quantity: {quantity}")
+                            continue
+                    
+                        # Durable hand-off: the order executor sends it at broker speed and
+                        # records the execution; one order per (rule, trigger window)
+                        if order_queue.enqueue(rule, current_data, triggered_at):
+                            queued_count += 1
                         continue
                     
-                    try:
-                        # Decrypt and execute
-                        if broker_name == "IOL":
-                            username = decrypt_api_key(broker_connection.get("username_encrypted"))
-                            password = decrypt_api_key(broker_connection.get("password_encrypted"))
-                            conexion = ConexionIOL(username, password)
-                            execution_result = await conexion.ejecutar_orden(ticker, quantity, execution_type)
-                            
-                        elif broker_name == "BINANCE":
-                            api_key = decrypt_api_key(broker_connection.get("api_key_encrypted"))
-                            api_secret = decrypt_api_key(broker_connection.get("api_secret_encrypted"))
-                            conexion = ConexionBinance(api_key, api_secret)
-                            symbol = ticker if "USDT" in ticker else f"{ticker}USDT"
-                            execution_result = await conexion.ejecutar_orden(symbol, quantity, execution_type)
-                        
-                        logger.info(f"Execution result for rule {rule.get('id')}: {execution_result}")
-                        
-                    except Exception as e:
-                        logger.error(f"Error executing order for rule {rule.get('id')}: {str(e)}")
-                        execution_result = {
-                            "success": False,
-                            "error": str(e),
-                            "status": "FAILED"
-                        }
-                
-                # Create execution record
-                execution_data = {
-                    "rule_id": rule.get("id"),
-                    "user_id": rule.get("user_id"),
-                    "broker_connection_id": broker_connection.get("id") if broker_connection else None,
-                    "execution_type": rule.get("execution_type", "ALERT_ONLY"),
-                    "ticker": rule.get("ticker"),
-                    "quantity": rule.get("quantity"),
-                    "price": current_data.get("current_price") if current_data else None,
-                    "total_amount": (rule.get("quantity", 0) * current_data.get("current_price")) if current_data else None,
-                    "status": "EXECUTED" if execution_result and execution_result.get("success") else "FAILED",
-                    "error_message": execution_result.get("error") if execution_result and not execution_result.get("success") else None,
-                    "broker_response": execution_result,
-                    "broker_order_id": execution_result.get("order_id") if execution_result else None,
-                    "triggered_at": datetime.now(timezone.utc).isoformat(),
-                    "executed_at": datetime.now(timezone.utc).isoformat() if execution_result and execution_result.get("success") else None
-                }
-                
-                supabase.table("rule_executions").insert(execution_data).execute()
-                
-                # Update rule's last_execution_at
-                supabase.table("rules") \
-                    .update({"last_execution_at": datetime.now(timezone.utc).isoformat()}) \
-                    .eq("id", rule.get("id")) \
-                    .execute()
-                
-                executed_count += 1
-                logger.info(f"Rule {rule.get('id')} executed successfully")
-                
-                # Send email notification (if configured)
-                # TODO: Implement email notification
-                
-            except Exception as e:
-                logger.error(f"Error processing rule {rule.get('id')}: {str(e)}", exc_info=True)
-                continue
+                    # No usable broker connection: recorded as a failed execution
+                    record_execution(execution_buffer, rule, broker_connection, current_data, triggered_at, None)
+                    executed_count += 1
+                    
+                except Exception as e:
+                    logger.error(f"Error processing rule {rule.get('id')}: {str(e)}", exc_info=True)
+                    continue
         
-        logger.info(f"Worker cycle completed. Executed {executed_count} rules")
+        with metrics.stage("execution_flush"):
+            execution_buffer.flush()
+        logger.info(
+            f"Worker cycle completed. Queued {queued_count} orders, recorded {executed_count} executions"
+        )
+        return {
+            "rules_active": len(all_rules),
+            "rules_owned": len(owned_rules),
+            "rules_cooling": cooldown_schedule.cooling_count(),
+            "rules_closed_market": len(eligible_rules) - len(rules),
+            "tickers": len(rules_by_ticker),
+            "rules_evaluated": evaluated_count,
+            "orders_queued": queued_count,
+            "executions_recorded": executed_count
+        }
         
     except Exception as e:
         logger.error(f"Error in rule executor worker: {str(e)}", exc_info=True)
+        return {"error": str(e)}
+
+async def check_alert_rules(lease_manager: PartitionLeaseManager, alert_pipeline: AlertPipeline) -> Dict:
+    """Evaluate ALERT_ONLY rules owned by this worker in batch (emails go to the outbox)"""
+    try:
+        with metrics.stage("alert_pipeline"):
+            return await alert_pipeline.run_cycle(rule_filter=lease_manager.filter_rules)
+    except Exception as e:
+        logger.error(f"Error in alert pipeline: {str(e)}", exc_info=True)
+        return {"error": str(e)}
+
+def log_cycle_summary(
+    duration: float,
+    check_interval: float,
+    execution_summary: Dict,
+    alert_summary: Dict,
+    queue_depths: Dict[str, int]
+) -> Dict:
+    """Update cycle metrics and emit one structured (JSON) summary record per cycle"""
+    evaluated = execution_summary.get("rules_evaluated", 0) + alert_summary.get("evaluated", 0)
+    metrics.record_cycle(duration, evaluated, check_interval)
+    metrics.set_queue_depths(queue_depths)
+    summary = {
+        "event": "rule_worker_cycle",
+        "duration_s": round(duration, 3),
+        "overrun": duration > check_interval,
+        "rules_per_second": round(evaluated / duration, 2) if duration > 0 else 0,
+        "execution": execution_summary,
+        "alerts": alert_summary,
+        "queues": queue_depths
+    }
+    logger.info(json.dumps(summary, default=str))
+    return summary
 
 async def main():
     """Main worker loop"""
@@ -181,16 +417,96 @@ async def main():
     
     logger.info(f"Starting rule executor worker (check interval: {check_interval}s)")
     
-    while True:
-        try:
-            await check_and_execute_rules()
-            await asyncio.sleep(check_interval)
-        except KeyboardInterrupt:
-            logger.info("Worker stopped by user")
-            break
-        except Exception as e:
-            logger.error(f"Error in worker main loop: {str(e)}", exc_info=True)
-            await asyncio.sleep(check_interval)
+    # Replays any executions left in the local spool by a previous crash
+    execution_buffer = ExecutionWriteBuffer.from_env(supabase)
+    flush_task = asyncio.create_task(execution_buffer.run())
+    
+    # Executions of released partitions are persisted before their new owner reads the rules
+    lease_manager = PartitionLeaseManager.from_env(supabase, on_release=lambda partitions: execution_buffer.flush())
+    lease_manager.start()
+    
+    broker_registry = BrokerConnectionRegistry(
+        supabase,
+        decrypt_api_key,
+        ttl=float(os.getenv("BROKER_CREDENTIALS_TTL", "300"))
+    )
+    
+    order_dispatcher = OrderDispatcher.from_env()
+    
+    # Durable queue between evaluation and execution: finish recording orders the
+    # broker answered before a crash, then drain the rest in the background
+    order_queue = OrderQueue.from_env()
+    for entry in order_queue.recover():
+        complete_queued_order(order_queue, execution_buffer, entry, entry["result"])
+    executor_task = asyncio.create_task(
+        run_order_executor(order_queue, order_dispatcher, broker_registry, lease_manager, execution_buffer)
+    )
+    
+    # Next-eligible times per rule: rules in cooldown cost no market data calls
+    cooldown_schedule = CooldownSchedule("last_execution_at")
+    
+    # Durable outbox: emails survive restarts and are sent in batches in the background
+    email_outbox = EmailOutbox.from_env()
+    email_task = asyncio.create_task(email_outbox.run())
+    
+    # Alerts for the same user within the digest window go out as a single email
+    alert_digest = AlertDigestCoalescer.from_env(email_outbox.enqueue_many)
+    digest_task = asyncio.create_task(alert_digest.run())
+    
+    alert_pipeline = AlertPipeline(
+        supabase,
+        QuoteBook(ttl=float(os.getenv("QUOTE_TTL", "60"))),
+        digest=alert_digest,
+        schedule=CooldownSchedule("last_triggered")
+    )
+    
+    metrics_server = await serve_metrics_from_env(metrics.registry)
+    
+    try:
+        while True:
+            try:
+                cycle_start = time.perf_counter()
+                execution_summary = await check_and_execute_rules(
+                    lease_manager, execution_buffer, broker_registry, order_queue, cooldown_schedule
+                )
+                alert_summary = await check_alert_rules(lease_manager, alert_pipeline)
+                order_stats = order_queue.stats()
+                log_cycle_summary(
+                    time.perf_counter() - cycle_start,
+                    check_interval,
+                    execution_summary,
+                    alert_summary,
+                    {
+                        "orders_pending": order_stats.get("pending", 0),
+                        "orders_in_flight": len(order_dispatcher.pending_keys()),
+                        "executions_unpersisted": execution_buffer.pending_count(),
+                        "emails_pending": email_outbox.stats().get("pending", 0),
+                        "alerts_in_digest": alert_digest.pending_count()
+                    }
+                )
+                await asyncio.sleep(check_interval)
+            except KeyboardInterrupt:
+                logger.info("Worker stopped by user")
+                break
+            except Exception as e:
+                logger.error(f"Error in worker main loop: {str(e)}", exc_info=True)
+                await asyncio.sleep(check_interval)
+    finally:
+        # Let in-flight orders finish so their executions are recorded; queued
+        # orders that did not start stay in the queue for the next run
+        executor_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        await order_dispatcher.drain()
+        order_dispatcher.close()
+        flush_task.cancel()
+        digest_task.cancel()
+        alert_digest.flush_due(force=True)
+        email_task.cancel()
+        execution_buffer.flush()
+        broker_registry.invalidate_all()
+        lease_manager.stop()
+        await broker_http.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())